@@ -0,0 +1,132 @@
+"""Per-step overhead of the TeaCache / FBCache skip decision.
+
+Runs cached blocks of synthetic transformer blocks for a number of steps,
+once deciding the samples to skip in the step itself (the host waits for the
+distance every step) and once deciding them one step ahead (it never waits).
+Reports the host time to issue a step and the wall time of a step, next to
+the ones of the same blocks without any cache. The default threshold of 0
+never skips, so the difference in wall time is the cost of the decision.
+
+    python benchmark/cache_decision_overhead.py --num_layers 28 --tokens 4096
+    torchrun --nproc_per_node=2 benchmark/cache_decision_overhead.py --ulysses_degree 2
+"""
+
+import argparse
+import os
+import time
+
+import torch
+from torch import nn
+
+from xfuser.core.distributed import (
+    init_distributed_environment,
+    initialize_model_parallel,
+)
+from xfuser.model_executor.cache import utils
+
+
+class Block(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.proj = nn.Linear(dim, dim)
+        self.modulation = nn.Linear(dim, 2 * dim)
+
+    def norm1(self, hidden_states, emb):
+        scale, shift = self.modulation(emb).unsqueeze(1).chunk(2, dim=-1)
+        return (
+            nn.functional.layer_norm(hidden_states, hidden_states.shape[-1:])
+            * (1 + scale)
+            + shift,
+        )
+
+    def forward(self, hidden_states, encoder_hidden_states, temb):
+        hidden_states = hidden_states + self.proj(self.norm1(hidden_states, temb)[0])
+        return hidden_states, encoder_hidden_states
+
+
+def run(blocks, hidden_states, temb, num_steps, device):
+    """Host and wall time per step of ``blocks``."""
+    host_time = 0.0
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for step in range(num_steps):
+        # slowly drifting timestep embeddings, like the ones of a scheduler
+        step_temb = temb * (1 + 0.01 * step)
+        issue_start = time.perf_counter()
+        hidden_states, _ = blocks(hidden_states, None, temb=step_temb)
+        host_time += time.perf_counter() - issue_start
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return host_time / num_steps * 1e3, (time.perf_counter() - start) / num_steps * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache decision overhead benchmark")
+    parser.add_argument("--use_cache", type=str, default="Tea", choices=["Tea", "Fb"])
+    parser.add_argument("--num_layers", type=int, default=8)
+    parser.add_argument("--tokens", type=int, default=1024)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_steps", type=int, default=50)
+    parser.add_argument("--rel_l1_thresh", type=float, default=0.0)
+    parser.add_argument("--ulysses_degree", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ.setdefault("RANK", "0")
+    os.environ.setdefault("WORLD_SIZE", "1")
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29511")
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+    init_distributed_environment(backend=backend)
+    initialize_model_parallel(ulysses_degree=args.ulysses_degree, backend=backend)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if device.type == "cuda":
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+        device = torch.device("cuda", torch.cuda.current_device())
+
+    torch.manual_seed(0)
+    layers = [Block(args.dim).to(device) for _ in range(args.num_layers)]
+    hidden_states = torch.randn(
+        args.batch_size, args.tokens // args.ulysses_degree, args.dim, device=device
+    )
+    temb = torch.randn(args.batch_size, args.dim, device=device)
+    cls = {
+        "Tea": utils.TeaCachedTransformerBlocks,
+        "Fb": utils.FBCachedTransformerBlocks,
+    }[args.use_cache]
+
+    def no_cache(hidden, encoder, temb):
+        for layer in layers:
+            hidden, encoder = layer(hidden, encoder, temb=temb)
+        return hidden, encoder
+
+    with torch.no_grad():
+        run(no_cache, hidden_states, temb, 2, device)
+        results = {
+            "no cache": run(no_cache, hidden_states, temb, args.num_steps, device)
+        }
+        for decide_ahead in [False, True]:
+            blocks = cls(
+                layers,
+                rel_l1_thresh=args.rel_l1_thresh,
+                num_steps=args.num_steps,
+                decide_ahead=decide_ahead,
+            )
+            # warmup, then measure a fresh request
+            run(blocks, hidden_states, temb, 2, device)
+            blocks.release_request()
+            host, wall = run(blocks, hidden_states, temb, args.num_steps, device)
+            name = "decide ahead" if decide_ahead else "decide in step"
+            results[name] = (host, wall)
+
+    if torch.distributed.get_rank() == 0:
+        print(
+            f"{args.use_cache}Cache on {device.type}, {args.num_layers} layers, {args.tokens} tokens"
+        )
+        for name, (host, wall) in results.items():
+            print(f"{name:>15}: host {host:.3f} ms/step, wall {wall:.3f} ms/step")
+
+
+if __name__ == "__main__":
+    main()
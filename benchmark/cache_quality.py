@@ -0,0 +1,311 @@
+"""Speedup and quality loss of TeaCache / FBCache / block group caching.
+
+Runs a fixed prompt set once without and once with the cache, on the same
+seeds, and reports per prompt the wall-clock speedup, the share of the block
+work the cache skipped and the error of the final latents and images against
+the uncached run.
+
+    python benchmark/cache_quality.py --model stabilityai/stable-diffusion-3-medium-diffusers \
+        --use_cache Fb --rel_l1_thresh 0.12
+
+Without --model the prompts run through a tiny SD3 transformer and VAE with
+random weights on a plain flow matching loop, which takes seconds on a CPU.
+Random weights say nothing about the quality of a real model, the tiny run
+checks that caching stays wired up and that its error does not regress:
+
+    python benchmark/cache_quality.py --use_cache Tea --rel_l1_thresh 0.3 --max_rel_l1 0.05
+"""
+
+import argparse
+import inspect
+import json
+import math
+import time
+import zlib
+
+import torch
+from diffusers import AutoencoderKL, DiffusionPipeline, SD3Transformer2DModel
+
+from xfuser.model_executor.cache.diffusers_adapters import apply_cache_on_transformer
+from xfuser.model_executor.cache.telemetry import CacheTelemetry
+from xfuser.model_executor.cache.utils import cache_request
+
+DEFAULT_PROMPTS = [
+    "a photo of an astronaut riding a horse on the moon",
+    "a bowl of ramen on a wooden table, studio lighting",
+    "an oil painting of a lighthouse in a storm",
+    "a close-up portrait of an old fisherman, 85mm",
+    "isometric illustration of a futuristic city at night",
+]
+
+
+def error_metrics(
+    reference: torch.Tensor, output: torch.Tensor, data_range: float
+) -> dict:
+    diff = output.float() - reference.float()
+    mse = diff.pow(2).mean().item()
+    return {
+        "rel_l1": (diff.abs().mean() / reference.float().abs().mean()).item(),
+        "mse": mse,
+        "psnr": 10 * math.log10(data_range**2 / mse) if mse > 0 else math.inf,
+    }
+
+
+def synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+class TinyRunner:
+    """Tiny random SD3 transformer and VAE, prompts embedded by their hash."""
+
+    def __init__(self, args, device):
+        torch.manual_seed(args.seed)
+        self.device = device
+        self.num_steps = args.num_inference_steps
+        self.latent_size = (args.height // 8, args.width // 8)
+        self.transformer = (
+            SD3Transformer2DModel(
+                sample_size=max(self.latent_size),
+                patch_size=2,
+                in_channels=4,
+                out_channels=4,
+                num_layers=args.tiny_layers,
+                attention_head_dim=16,
+                num_attention_heads=4,
+                joint_attention_dim=32,
+                caption_projection_dim=64,
+                pooled_projection_dim=32,
+                pos_embed_max_size=max(self.latent_size),
+            )
+            .to(device)
+            .eval()
+        )
+        self.vae = (
+            AutoencoderKL(
+                in_channels=3,
+                out_channels=3,
+                latent_channels=4,
+                down_block_types=("DownEncoderBlock2D",) * 4,
+                up_block_types=("UpDecoderBlock2D",) * 4,
+                block_out_channels=(16,) * 4,
+                norm_num_groups=8,
+            )
+            .to(device)
+            .eval()
+        )
+
+    @torch.no_grad()
+    def __call__(self, prompt: str, seed: int):
+        generator = torch.Generator().manual_seed(zlib.crc32(prompt.encode()))
+        prompt_embeds = torch.randn(1, 16, 32, generator=generator).to(self.device)
+        pooled = torch.randn(1, 32, generator=generator).to(self.device)
+        latents = torch.randn(
+            1, 4, *self.latent_size, generator=torch.Generator().manual_seed(seed)
+        ).to(self.device)
+
+        sigmas = torch.linspace(1.0, 0.0, self.num_steps + 1)
+        for i in range(self.num_steps):
+            velocity = self.transformer(
+                hidden_states=latents,
+                encoder_hidden_states=prompt_embeds,
+                pooled_projections=pooled,
+                timestep=(sigmas[i] * 1000).expand(1).to(self.device),
+                return_dict=False,
+            )[0]
+            latents = latents + (sigmas[i + 1] - sigmas[i]) * velocity
+        image = (self.vae.decode(latents, return_dict=False)[0] / 2 + 0.5).clamp(0, 1)
+        return latents, image
+
+
+class PipelineRunner:
+    """A diffusers pipeline, the latents taken at its last step."""
+
+    def __init__(self, args, device):
+        self.pipe = DiffusionPipeline.from_pretrained(
+            args.model, torch_dtype=getattr(torch, args.dtype)
+        ).to(device)
+        self.transformer = self.pipe.transformer
+        self.device = device
+        self.args = args
+        parameters = inspect.signature(self.pipe.__call__).parameters
+        self.call_kwargs = {}
+        if args.num_frames is not None and "num_frames" in parameters:
+            self.call_kwargs["num_frames"] = args.num_frames
+        self.capture_latents = "callback_on_step_end" in parameters
+
+    @torch.no_grad()
+    def __call__(self, prompt: str, seed: int):
+        latents = {}
+        kwargs = dict(self.call_kwargs)
+        if self.capture_latents:
+
+            def on_step_end(pipe, step, timestep, callback_kwargs):
+                latents["final"] = callback_kwargs["latents"]
+                return {}
+
+            kwargs["callback_on_step_end"] = on_step_end
+        output = self.pipe(
+            prompt=prompt,
+            height=self.args.height,
+            width=self.args.width,
+            num_inference_steps=self.args.num_inference_steps,
+            generator=torch.Generator(device=self.device).manual_seed(seed),
+            output_type="pt",
+            **kwargs,
+        )
+        images = output.frames if hasattr(output, "frames") else output.images
+        return latents.get("final", None), images
+
+
+def run_prompts(runner, prompts, seed, device, request_prefix):
+    results = []
+    for i, prompt in enumerate(prompts):
+        synchronize(device)
+        start = time.perf_counter()
+        with cache_request(f"{request_prefix}{i}"):
+            latents, images = runner(prompt, seed + i)
+        synchronize(device)
+        results.append((time.perf_counter() - start, latents, images))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cache speedup and quality benchmark")
+    parser.add_argument(
+        "--model",
+        type=str,
+        default=None,
+        help="Path to the model, a tiny random one if not given",
+    )
+    parser.add_argument(
+        "--prompt_file", type=str, default=None, help="One prompt per line"
+    )
+    parser.add_argument(
+        "--use_cache", type=str, default="Fb", choices=["Fb", "Tea", "Group"]
+    )
+    parser.add_argument("--rel_l1_thresh", type=float, default=0.12)
+    parser.add_argument("--height", type=int, default=None)
+    parser.add_argument("--width", type=int, default=None)
+    parser.add_argument("--num_frames", type=int, default=None)
+    parser.add_argument("--num_inference_steps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--tiny_layers", type=int, default=4)
+    parser.add_argument(
+        "--warmup", type=int, default=1, help="Prompts run before the timed runs"
+    )
+    parser.add_argument(
+        "--max_rel_l1",
+        type=float,
+        default=None,
+        help="Fail if the mean relative L1 error of the latents exceeds this",
+    )
+    parser.add_argument(
+        "--output", type=str, default=None, help="Write the results to this json file"
+    )
+    args = parser.parse_args()
+
+    if args.prompt_file is not None:
+        with open(args.prompt_file) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    else:
+        prompts = DEFAULT_PROMPTS
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.model is None:
+        args.height, args.width = args.height or 128, args.width or 128
+        runner = TinyRunner(args, device)
+    else:
+        args.height, args.width = args.height or 1024, args.width or 1024
+        runner = PipelineRunner(args, device)
+
+    # the uncached run first, the cache replaces the forward of the transformer
+    run_prompts(runner, prompts[: args.warmup], args.seed, device, "warmup")
+    baseline = run_prompts(runner, prompts, args.seed, device, "baseline")
+    telemetry = CacheTelemetry()
+    apply_cache_on_transformer(
+        runner.transformer,
+        rel_l1_thresh=args.rel_l1_thresh,
+        num_steps=args.num_inference_steps,
+        use_cache=args.use_cache,
+        callbacks=[telemetry],
+    )
+    run_prompts(runner, prompts[: args.warmup], args.seed, device, "warmup")
+    telemetry.clear()
+    cached = run_prompts(runner, prompts, args.seed, device, "cached")
+
+    rows = []
+    for i, (
+        prompt,
+        (base_time, base_latents, base_images),
+        (time_, latents, images),
+    ) in enumerate(zip(prompts, baseline, cached)):
+        summary = telemetry.summary([f"cached{i}"])
+        row = {
+            "prompt": prompt,
+            "baseline_time": base_time,
+            "cached_time": time_,
+            "speedup": base_time / time_,
+            "skipped_steps": summary["skipped_steps"],
+            "skipped_ratio": summary["skipped_ratio"],
+            "mean_distance": summary["mean_distance"],
+        }
+        if base_latents is not None and latents is not None:
+            row.update(
+                {
+                    f"latent_{k}": v
+                    for k, v in error_metrics(base_latents, latents, 2.0).items()
+                }
+            )
+        row.update(
+            {
+                f"pixel_{k}": v
+                for k, v in error_metrics(base_images, images, 1.0).items()
+            }
+        )
+        rows.append(row)
+
+    print(
+        f"{args.use_cache}Cache, threshold {args.rel_l1_thresh}, {args.num_inference_steps} steps, "
+        f"{args.model or 'tiny random SD3'} on {device.type}"
+    )
+    for row in rows:
+        latent = (
+            f"latent rel l1 {row['latent_rel_l1']:.4f}, "
+            if "latent_rel_l1" in row
+            else ""
+        )
+        print(
+            f"{row['speedup']:5.2f}x, {row['skipped_ratio']:6.1%} skipped, "
+            f"mean distance {row['mean_distance']:.4f}, {latent}"
+            f"pixel psnr {row['pixel_psnr']:.2f} dB | {row['prompt']}"
+        )
+    mean = {
+        key: sum(row[key] for row in rows) / len(rows)
+        for key in rows[0]
+        if key != "prompt"
+    }
+    mean["speedup"] = sum(row["baseline_time"] for row in rows) / sum(
+        row["cached_time"] for row in rows
+    )
+    print(
+        f"total {mean['speedup']:.2f}x, {mean['skipped_ratio']:.1%} skipped, "
+        + (
+            f"latent rel l1 {mean['latent_rel_l1']:.4f}, "
+            if "latent_rel_l1" in mean
+            else ""
+        )
+        + f"pixel psnr {mean['pixel_psnr']:.2f} dB"
+    )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "mean": mean, "prompts": rows}, f, indent=4)
+    if args.max_rel_l1 is not None:
+        error = mean.get("latent_rel_l1", mean["pixel_rel_l1"])
+        if error > args.max_rel_l1:
+            raise SystemExit(f"relative L1 error {error:.4f} exceeds {args.max_rel_l1}")
+
+
+if __name__ == "__main__":
+    main()
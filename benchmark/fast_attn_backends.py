@@ -0,0 +1,105 @@
+"""Latency of the DiTFastAttn attention backends.
+
+Times the full attention and the window attention of DiTFastAttn on every
+backend available on the device (flash_attn, flex_attention, SDPA with a
+window mask) for several sequence lengths, and checks that the window
+attention of every backend matches the SDPA one.
+
+    python benchmark/fast_attn_backends.py --seq_lens 1024 4096 16384 --window_size 64
+"""
+
+import argparse
+import time
+
+import torch
+
+from xfuser.core.fast_attention.attn_backend import (
+    available_backends,
+    full_attention,
+    window_attention,
+)
+
+
+def timeit(fn, warmup, iters, device):
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="DiTFastAttn attention backend benchmark"
+    )
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[1024, 4096, 16384])
+    parser.add_argument("--window_size", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--num_heads", type=int, default=16)
+    parser.add_argument("--head_dim", type=int, default=72)
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default=None,
+        help="float16 on GPUs, float32 on CPUs by default",
+    )
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = getattr(
+        torch, args.dtype or ("float16" if device.type == "cuda" else "float32")
+    )
+    backends = available_backends(device)
+    window_size = (args.window_size, args.window_size)
+    print(
+        f"backends {backends} on {device.type}, window {args.window_size}, times in ms"
+    )
+    print(
+        f"{'seq_len':>8} {'backend':>8} {'full':>10} {'window':>10} {'speedup':>8} {'max err':>10}"
+    )
+    for seq_len in args.seq_lens:
+        query, key, value = (
+            torch.randn(
+                args.batch_size,
+                seq_len,
+                args.num_heads,
+                args.head_dim,
+                device=device,
+                dtype=dtype,
+            )
+            for _ in range(3)
+        )
+        reference = window_attention(query, key, value, window_size, "sdpa")
+        for backend in backends:
+            full = timeit(
+                lambda: full_attention(query, key, value, backend),
+                args.warmup,
+                args.iters,
+                device,
+            )
+            window = timeit(
+                lambda: window_attention(query, key, value, window_size, backend),
+                args.warmup,
+                args.iters,
+                device,
+            )
+            error = (
+                (window_attention(query, key, value, window_size, backend) - reference)
+                .abs()
+                .max()
+                .item()
+            )
+            print(
+                f"{seq_len:>8} {backend:>8} {full:>10.3f} {window:>10.3f} {full / window:>7.2f}x {error:>10.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
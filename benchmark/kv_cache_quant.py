@@ -0,0 +1,96 @@
+"""Memory and accuracy of the quantized PipeFusion kv cache.
+
+Simulates the stale kv cache of one attention layer: a full step fills the
+cache, then every pipeline patch refreshes its own tokens and attends to the
+stale kv of the others. The attention output of the int8 / fp8 cache is
+compared with the one of the full precision cache.
+
+    python benchmark/kv_cache_quant.py --height 4096 --width 4096 --num_pipeline_patch 8
+"""
+
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from xfuser.core.cache_manager.kv_quant import dequantize_kv, quantize_kv
+
+
+def attention(q, kv):
+    k, v = kv.chunk(2, dim=-1)
+    return F.scaled_dot_product_attention(q, k, v)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized kv cache benchmark")
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--vae_scale_factor", type=int, default=8)
+    parser.add_argument("--patch_size", type=int, default=2)
+    parser.add_argument("--num_heads", type=int, default=24)
+    parser.add_argument("--head_dim", type=int, default=64)
+    parser.add_argument("--num_layers", type=int, default=28)
+    parser.add_argument("--num_pipeline_patch", type=int, default=4)
+    parser.add_argument(
+        "--drift", type=float, default=0.05, help="Relative kv change per step"
+    )
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = getattr(torch, args.dtype)
+    torch.manual_seed(args.seed)
+    tokens = (args.height // args.vae_scale_factor // args.patch_size) * (
+        args.width // args.vae_scale_factor // args.patch_size
+    )
+    bounds = [
+        tokens * i // args.num_pipeline_patch
+        for i in range(args.num_pipeline_patch + 1)
+    ]
+
+    # heads of real models have very different magnitudes
+    head_scale = torch.logspace(-1, 1, args.num_heads, device=device).view(1, -1, 1, 1)
+    kv = torch.randn(1, args.num_heads, tokens, 2 * args.head_dim, device=device)
+    kv = (kv * head_scale).to(dtype)
+    new_kv = (
+        kv + args.drift * head_scale * torch.randn_like(kv, dtype=torch.float)
+    ).to(dtype)
+    q = torch.randn(
+        1, args.num_heads, bounds[1], args.head_dim, device=device, dtype=dtype
+    )
+
+    full_bytes = kv.numel() * kv.element_size()
+    print(
+        f"{tokens} tokens, full precision cache {full_bytes * args.num_layers / 2**30:.3f} GiB"
+    )
+    for kv_cache_dtype in ["int8", "fp8"]:
+        if kv_cache_dtype == "fp8" and not hasattr(torch, "float8_e4m3fn"):
+            continue
+        quantized = [
+            quantize_kv(kv[:, :, start:end], 2, kv_cache_dtype)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        quant_bytes = sum(
+            q_.numel() * q_.element_size() + scale.numel() * scale.element_size()
+            for q_, scale in quantized
+        )
+        # patch 0 is fresh, the others are read back from the cache
+        stale = torch.cat(
+            [new_kv[:, :, : bounds[1]]]
+            + [dequantize_kv(q_, scale, dtype) for q_, scale in quantized[1:]],
+            dim=2,
+        )
+        reference = torch.cat([new_kv[:, :, : bounds[1]], kv[:, :, bounds[1] :]], dim=2)
+        kv_error = (stale - reference).float().norm() / reference.float().norm()
+        out, out_ref = attention(q, stale), attention(q, reference)
+        out_error = (out - out_ref).float().norm() / out_ref.float().norm()
+        print(
+            f"{kv_cache_dtype}: cache {quant_bytes * args.num_layers / 2**30:.3f} GiB "
+            f"({1 - quant_bytes / full_bytes:.1%} saved), "
+            f"relative kv error {kv_error:.2e}, relative attention output error {out_error:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Cost of reordering the sequence parallel kv cache of a full step.
+
+Compares splitting the kv per ulysses rank and pipeline patch and
+concatenating the pieces with the single ``index_select`` through the
+precomputed gather index the cache manager uses, for several ulysses degrees
+and pipeline patch numbers.
+
+    python benchmark/kv_cache_reorder.py --height 2048 --width 2048
+"""
+
+import argparse
+import time
+
+import torch
+
+from xfuser.core.cache_manager.cache_manager import calc_kv_gather_index
+
+
+def split_and_cat(new_kv, pp_patches_token_num, ulysses_world_size, out):
+    kv_list = [
+        kv.split(pp_patches_token_num, dim=1)
+        for kv in torch.chunk(new_kv, ulysses_world_size, dim=1)
+    ]
+    return torch.cat(
+        [
+            kv_list[rank][pp_patch_idx]
+            for pp_patch_idx in range(len(pp_patches_token_num))
+            for rank in range(ulysses_world_size)
+        ],
+        dim=1,
+        out=out,
+    )
+
+
+def index_select(new_kv, index, out):
+    return torch.index_select(new_kv, 1, index, out=out)
+
+
+def timeit(fn, warmup, iters, device):
+    for _ in range(warmup):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sequence parallel kv reorder benchmark"
+    )
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--vae_scale_factor", type=int, default=8)
+    parser.add_argument("--patch_size", type=int, default=2)
+    parser.add_argument("--num_heads", type=int, default=24)
+    parser.add_argument("--head_dim", type=int, default=64)
+    parser.add_argument("--ring_degree", type=int, default=1)
+    parser.add_argument("--ulysses_degrees", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument(
+        "--num_pipeline_patches", type=int, nargs="+", default=[2, 4, 8]
+    )
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = getattr(torch, args.dtype)
+    tokens = (args.height // args.vae_scale_factor // args.patch_size) * (
+        args.width // args.vae_scale_factor // args.patch_size
+    )
+    print(f"{tokens} tokens on {device}, times per layer in us")
+    print(
+        f"{'ulysses':>8} {'patches':>8} {'split+cat':>10} {'index':>10} {'speedup':>8}"
+    )
+    for ulysses_degree in args.ulysses_degrees:
+        sp_degree = ulysses_degree * args.ring_degree
+        # tokens of the local sequence of one ulysses rank
+        local_tokens = tokens // sp_degree
+        # heads are scattered by ulysses, the sequence gathered
+        num_heads = args.num_heads // ulysses_degree
+        new_kv = torch.randn(
+            1,
+            ulysses_degree * local_tokens,
+            num_heads,
+            2 * args.head_dim,
+            device=device,
+            dtype=dtype,
+        )
+        out = torch.empty_like(new_kv)
+        for num_pipeline_patch in args.num_pipeline_patches:
+            pp_patches_token_num = [
+                local_tokens * (i + 1) // num_pipeline_patch
+                - local_tokens * i // num_pipeline_patch
+                for i in range(num_pipeline_patch)
+            ]
+            index = calc_kv_gather_index(pp_patches_token_num, ulysses_degree, device)
+            assert torch.equal(
+                split_and_cat(new_kv, pp_patches_token_num, ulysses_degree, None),
+                index_select(new_kv, index, None),
+            )
+            t_cat = timeit(
+                lambda: split_and_cat(
+                    new_kv, pp_patches_token_num, ulysses_degree, out
+                ),
+                args.warmup,
+                args.iters,
+                device,
+            )
+            t_index = timeit(
+                lambda: index_select(new_kv, index, out),
+                args.warmup,
+                args.iters,
+                device,
+            )
+            print(
+                f"{ulysses_degree:>8} {num_pipeline_patch:>8} {t_cat:>10.1f} "
+                f"{t_index:>10.1f} {t_cat / t_index:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Recommend a hybrid parallel configuration without running every candidate.
+
+Analytical plan with the default hardware profile:
+    python benchmark/parallel_planner.py --model_id PixArt-alpha/PixArt-XL-2-1024-MS \
+        --sizes 1024 2048 --n_gpus 8
+
+Calibrate the hardware profile with short microbenchmarks first:
+    torchrun --nproc_per_node=8 benchmark/parallel_planner.py --model_id ... \
+        --calibrate --hardware_profile hw.json
+"""
+
+import argparse
+import os
+
+import torch
+import torch.distributed
+
+from xfuser.core.planner import (
+    HardwareProfile,
+    ModelProfile,
+    ParallelPlanner,
+    Workload,
+    calibrate_hardware_profile,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan hybrid parallel configs")
+    parser.add_argument("--model_id", type=str, required=True, help="Path to the model")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", required=True, help="List of sizes to plan for"
+    )
+    parser.add_argument("--n_gpus", type=int, default=8, help="Number of GPUs to use")
+    parser.add_argument("--gpus_per_node", type=int, default=8)
+    parser.add_argument("--num_frames", type=int, default=1)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_inference_steps", type=int, default=20)
+    parser.add_argument("--warmup_steps", type=int, default=1)
+    parser.add_argument("--max_sequence_length", type=int, default=256)
+    parser.add_argument("--max_tp_degree", type=int, default=1)
+    parser.add_argument("--max_num_pipeline_patch", type=int, default=16)
+    parser.add_argument(
+        "--no_use_cfg",
+        action="store_true",
+        help="The pipeline runs without classifier free guidance",
+    )
+    parser.add_argument("--top_k", type=int, default=5)
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help="Run matmul and collective microbenchmarks to calibrate the cost model",
+    )
+    parser.add_argument(
+        "--hardware_profile",
+        type=str,
+        default=None,
+        help="Json file to load the hardware profile from, or to save it to with --calibrate",
+    )
+    args = parser.parse_args()
+
+    rank = 0
+    if args.calibrate:
+        if "RANK" in os.environ:
+            backend = "nccl" if torch.cuda.is_available() else "gloo"
+            torch.distributed.init_process_group(backend=backend)
+            rank = torch.distributed.get_rank()
+            if torch.cuda.is_available():
+                torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+        hardware = calibrate_hardware_profile(
+            base=HardwareProfile(gpus_per_node=args.gpus_per_node)
+        )
+        if rank == 0 and args.hardware_profile is not None:
+            hardware.save(args.hardware_profile)
+    elif args.hardware_profile is not None:
+        hardware = HardwareProfile.load(args.hardware_profile)
+    else:
+        hardware = HardwareProfile(gpus_per_node=args.gpus_per_node)
+
+    if rank == 0:
+        model = ModelProfile.from_pretrained(
+            args.model_id, text_seq_len=args.max_sequence_length
+        )
+        planner = ParallelPlanner(model, hardware)
+        for size in args.sizes:
+            workload = Workload(
+                height=size,
+                width=size,
+                num_frames=args.num_frames,
+                batch_size=args.batch_size,
+                num_inference_steps=args.num_inference_steps,
+                warmup_steps=args.warmup_steps,
+                use_cfg=not args.no_use_cfg,
+            )
+            results = planner.plan(
+                workload,
+                args.n_gpus,
+                top_k=args.top_k,
+                max_tp_degree=args.max_tp_degree,
+                max_num_pipeline_patch=args.max_num_pipeline_patch,
+            )
+            print(f"Plan for size {size}:")
+            for candidate, estimate in results:
+                print(
+                    f"  {str(candidate):<50} latency {estimate.total_time:8.3f}s "
+                    f"(compute {estimate.compute_time:.3f}s, "
+                    f"comm {estimate.comm_time:.3f}s), "
+                    f"memory {estimate.memory_bytes / 1024**3:.2f}GB"
+                    + ("" if estimate.fits_in_memory else " OOM")
+                )
+            if results:
+                best = results[0][0]
+                print(
+                    f"  recommended: --model {args.model_id} --height {size} "
+                    f"--width {size} " + " ".join(best.to_cli_args())
+                )
+
+    if torch.distributed.is_initialized():
+        torch.distributed.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Profile every transformer block on one GPU and store balanced PipeFusion
+stage splits for later runs with --pipefusion_partition auto.
+
+    python benchmark/pipefusion_partition.py --model black-forest-labs/FLUX.1-dev \
+        --sizes 1024 2048 --pp_degrees 2 4 --max_sequence_length 512
+
+The splits are keyed by model and input size, so the runs have to use the
+same --model, --height/--width and --max_sequence_length.
+"""
+
+import argparse
+import inspect
+
+import torch
+from diffusers import DiffusionPipeline
+
+from xfuser.core.planner import BlockProfiler, StagePartitionCache
+from xfuser.core.planner.partition import (
+    stage_partition_key,
+    stage_partition_model_key,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PipeFusion stage partition profiler")
+    parser.add_argument("--model", type=str, required=True, help="Path to the model")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024])
+    parser.add_argument("--pp_degrees", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--max_sequence_length", type=int, default=256)
+    parser.add_argument("--num_inference_steps", type=int, default=4)
+    parser.add_argument(
+        "--blocks_name",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Block lists of the transformer in execution order, detected by default",
+    )
+    parser.add_argument(
+        "--pipefusion_partition_file",
+        type=str,
+        default=None,
+        help="Defaults to ~/.cache/xfuser/pipefusion_partition.json",
+    )
+    args = parser.parse_args()
+
+    pipe = DiffusionPipeline.from_pretrained(args.model, torch_dtype=torch.bfloat16)
+    pipe = pipe.to("cuda")
+    transformer = pipe.transformer
+    blocks_name = args.blocks_name or [
+        name
+        for name in ["transformer_blocks", "single_transformer_blocks"]
+        if hasattr(transformer, name)
+    ]
+    call_kwargs = {}
+    if "max_sequence_length" in inspect.signature(pipe.__call__).parameters:
+        call_kwargs["max_sequence_length"] = args.max_sequence_length
+
+    model = stage_partition_model_key(transformer)
+    cache = StagePartitionCache(args.pipefusion_partition_file)
+    for size in args.sizes:
+        profiler = BlockProfiler(transformer, blocks_name)
+        with profiler.profile(scheduler=pipe.scheduler):
+            pipe(
+                prompt="a photo of an astronaut riding a horse on the moon",
+                height=size,
+                width=size,
+                num_inference_steps=args.num_inference_steps,
+                output_type="latent",
+                **call_kwargs,
+            )
+        partition = profiler.stage_partition()
+        key = stage_partition_key(size, size, text_len=args.max_sequence_length)
+        print(
+            f"{model} {key}: {sum(partition.block_costs) * 1000:.2f}ms in blocks, "
+            f"first stage +{partition.first_stage_cost * 1000:.2f}ms, "
+            f"last stage +{partition.last_stage_cost * 1000:.2f}ms"
+        )
+        for pp_degree in args.pp_degrees:
+            if pp_degree > len(partition.block_costs):
+                continue
+            split = partition.split(pp_degree)
+            stage_costs = partition.stage_costs(split)
+            print(
+                f"  pp {pp_degree}: --attn_layer_num_for_pp {' '.join(map(str, split))}"
+                f"  stage times (ms) {[round(t * 1000, 2) for t in stage_costs]}"
+            )
+        cache.put(model, key, partition)
+    cache.save()
+    print(f"Saved partitions to {cache.path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Measure the startup cost of the model parallel process groups.
+
+Run it once per mode and compare the reported times:
+    torchrun --nproc_per_node=8 benchmark/process_group_init_benchmark.py \
+        --pipefusion_parallel_degree 2 --ulysses_degree 2 --use_cfg_parallel
+    torchrun --nproc_per_node=8 benchmark/process_group_init_benchmark.py \
+        --pipefusion_parallel_degree 2 --ulysses_degree 2 --use_cfg_parallel --eager
+"""
+
+import argparse
+import time
+
+import torch
+import torch.distributed
+
+from xfuser.core.distributed import (
+    init_distributed_environment,
+    initialize_model_parallel,
+    get_world_group,
+    get_dp_group,
+    get_cfg_group,
+    get_sp_group,
+    get_pp_group,
+)
+from xfuser.core.distributed.parallel_state import (
+    get_tp_group,
+    destroy_model_parallel,
+    destroy_distributed_environment,
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process group startup benchmark")
+    parser.add_argument("--data_parallel_degree", type=int, default=1)
+    parser.add_argument("--use_cfg_parallel", action="store_true")
+    parser.add_argument("--ulysses_degree", type=int, default=1)
+    parser.add_argument("--ring_degree", type=int, default=1)
+    parser.add_argument("--pipefusion_parallel_degree", type=int, default=1)
+    parser.add_argument("--tensor_parallel_degree", type=int, default=1)
+    parser.add_argument(
+        "--eager",
+        action="store_true",
+        help="Connect every group during initialization",
+    )
+    parser.add_argument("--backend", type=str, default=None)
+    args = parser.parse_args()
+
+    backend = args.backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    if backend == "gloo" and not torch.distributed.is_initialized():
+        torch.distributed.init_process_group(backend=backend)
+
+    start = time.perf_counter()
+    init_distributed_environment(backend=backend)
+    initialize_model_parallel(
+        data_parallel_degree=args.data_parallel_degree,
+        classifier_free_guidance_degree=2 if args.use_cfg_parallel else 1,
+        ulysses_degree=args.ulysses_degree,
+        ring_degree=args.ring_degree,
+        tensor_parallel_degree=args.tensor_parallel_degree,
+        pipeline_parallel_degree=args.pipefusion_parallel_degree,
+        backend=backend,
+        eager_init=args.eager,
+    )
+    init_time = time.perf_counter() - start
+
+    # the first communication of a lazily connected group pays for its setup
+    start = time.perf_counter()
+    for group in [
+        get_dp_group(),
+        get_cfg_group(),
+        get_pp_group(),
+        get_sp_group(),
+        get_tp_group(),
+    ]:
+        group.warmup()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    first_comm_time = time.perf_counter() - start
+
+    device = get_world_group().device
+    times = torch.tensor([init_time, first_comm_time], device=device)
+    torch.distributed.all_reduce(times, op=torch.distributed.ReduceOp.MAX)
+    if torch.distributed.get_rank() == 0:
+        print(
+            f"{'eager' if args.eager else 'lazy'} process groups: "
+            f"init {times[0].item():.3f}s, first communication "
+            f"{times[1].item():.3f}s, total {times.sum().item():.3f}s"
+        )
+
+    destroy_model_parallel()
+    destroy_distributed_environment()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Cost of the K/V exchange of the ring attention per ring step.
+
+Compares sending K and V as two P2P transfers into freshly allocated
+tensors, as the ring attention did, with sending them packed in one transfer
+between the two ping-pong buffers of ``RingKVBuffers``, for every ring degree
+from 2 to the number of launched processes.
+
+    torchrun --nproc_per_node=8 benchmark/ring_kv_exchange.py --seq_len 16384
+"""
+
+import argparse
+import time
+
+import torch
+import torch.distributed as dist
+from yunchang.ring.utils import RingComm
+
+from xfuser.core.long_ctx_attention.ring.ring_flash_attn import RingKVBuffers
+
+
+def separate_exchange(comm, k, v):
+    for _ in range(comm.world_size - 1):
+        next_k = comm.send_recv(k)
+        next_v = comm.send_recv(v)
+        comm.commit()
+        comm.wait()
+        k, v = next_k, next_v
+
+
+def packed_exchange(comm, k, v, buffers):
+    kv, next_kv = buffers.kv
+    kv[0].copy_(k)
+    kv[1].copy_(v)
+    for _ in range(comm.world_size - 1):
+        comm.send_recv(kv, next_kv)
+        comm.commit()
+        comm.wait()
+        kv, next_kv = next_kv, kv
+
+
+def timeit(fn, warmup, iters, device, group):
+    for _ in range(warmup):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    dist.barrier(group=group)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ring attention K/V exchange benchmark"
+    )
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument(
+        "--seq_len",
+        type=int,
+        default=4096,
+        help="full sequence length, split by the ring",
+    )
+    parser.add_argument("--num_heads", type=int, default=24)
+    parser.add_argument("--head_dim", type=int, default=64)
+    parser.add_argument(
+        "--dtype",
+        type=str,
+        default=None,
+        help="bfloat16 on GPUs, float32 on CPUs by default",
+    )
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dist.init_process_group(backend="nccl" if device == "cuda" else "gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    if device == "cuda":
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    dtype = getattr(
+        torch, args.dtype or ("bfloat16" if device == "cuda" else "float32")
+    )
+    if rank == 0:
+        print(f"{world_size} processes on {device}, times per ring step in us")
+        print(
+            f"{'ring':>6} {'tokens':>8} {'separate':>10} {'packed':>10} {'saved':>10} {'speedup':>8}"
+        )
+    for ring_degree in range(2, world_size + 1):
+        # every process takes part in creating the group, only its members time it
+        group = dist.new_group(list(range(ring_degree)))
+        if rank >= ring_degree:
+            continue
+        comm = RingComm(group)
+        shape = (
+            args.batch_size,
+            args.seq_len // ring_degree,
+            args.num_heads,
+            args.head_dim,
+        )
+        k, v = (torch.randn(shape, device=device, dtype=dtype) for _ in range(2))
+        buffers = RingKVBuffers(shape, dtype, device)
+        steps = ring_degree - 1
+        t_separate = (
+            timeit(
+                lambda: separate_exchange(comm, k, v),
+                args.warmup,
+                args.iters,
+                device,
+                group,
+            )
+            / steps
+        )
+        t_packed = (
+            timeit(
+                lambda: packed_exchange(comm, k, v, buffers),
+                args.warmup,
+                args.iters,
+                device,
+                group,
+            )
+            / steps
+        )
+        if rank == 0:
+            print(
+                f"{ring_degree:>6} {shape[1]:>8} {t_separate:>10.1f} {t_packed:>10.1f} "
+                f"{t_separate - t_packed:>10.1f} {t_separate / t_packed:>7.2f}x"
+            )
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
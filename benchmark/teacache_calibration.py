@@ -0,0 +1,130 @@
+"""Fit the TeaCache rescale polynomial of a model and store it as a profile.
+
+Runs a prompt set without skipping any step, records the relative L1 distance
+of the modulated inputs and of the block outputs between consecutive steps,
+and fits the polynomial that maps the former to the latter.
+
+    python benchmark/teacache_calibration.py --model black-forest-labs/FLUX.1-dev \
+        --prompt_file prompts.txt --num_inference_steps 28
+
+The profile is named after the model family (e.g. "flux") unless --profile is
+given. --use_teacache runs pick it up by that name, or by the name passed as
+coef_profile in the cache args.
+"""
+
+import argparse
+import inspect
+
+import numpy as np
+import torch
+from diffusers import DiffusionPipeline
+
+from xfuser.model_executor.cache.calibration import TeaCacheCalibrator, TeaCacheProfiles
+from xfuser.model_executor.cache.diffusers_adapters import apply_cache_on_transformer
+from xfuser.model_executor.cache.diffusers_adapters.registry import (
+    TRANSFORMER_ADAPTER_REGISTRY,
+)
+
+DEFAULT_PROMPTS = [
+    "a photo of an astronaut riding a horse on the moon",
+    "a bowl of ramen on a wooden table, studio lighting",
+    "an oil painting of a lighthouse in a storm",
+    "a close-up portrait of an old fisherman, 85mm",
+    "isometric illustration of a futuristic city at night",
+]
+
+# blocks of these models return (encoder_hidden_states, hidden_states)
+ENCODER_FIRST = ["flux", "sd3"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TeaCache coefficient calibration")
+    parser.add_argument("--model", type=str, required=True, help="Path to the model")
+    parser.add_argument(
+        "--prompt_file", type=str, default=None, help="One prompt per line"
+    )
+    parser.add_argument("--height", type=int, default=1024)
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--num_frames", type=int, default=None)
+    parser.add_argument("--num_inference_steps", type=int, default=28)
+    parser.add_argument("--degree", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dtype", type=str, default="bfloat16")
+    parser.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="Profile name, the model family by default",
+    )
+    args = parser.parse_args()
+
+    if args.prompt_file is not None:
+        with open(args.prompt_file) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+    else:
+        prompts = DEFAULT_PROMPTS
+
+    pipe = DiffusionPipeline.from_pretrained(
+        args.model, torch_dtype=getattr(torch, args.dtype)
+    )
+    pipe = pipe.to("cuda")
+    name = TRANSFORMER_ADAPTER_REGISTRY.get(type(pipe.transformer))
+    if name is None:
+        raise ValueError(
+            f"TeaCache does not support {pipe.transformer.__class__.__name__}"
+        )
+
+    calibrator = TeaCacheCalibrator()
+    # a threshold of 0 never skips, so every step yields a true output delta
+    apply_cache_on_transformer(
+        pipe.transformer,
+        rel_l1_thresh=0.0,
+        return_hidden_states_first=name not in ENCODER_FIRST,
+        num_steps=args.num_inference_steps,
+        use_cache="Tea",
+        callbacks=[calibrator],
+    )
+    call_kwargs = {}
+    if (
+        args.num_frames is not None
+        and "num_frames" in inspect.signature(pipe.__call__).parameters
+    ):
+        call_kwargs["num_frames"] = args.num_frames
+    for i, prompt in enumerate(prompts):
+        pipe(
+            prompt=prompt,
+            height=args.height,
+            width=args.width,
+            num_inference_steps=args.num_inference_steps,
+            generator=torch.Generator(device="cuda").manual_seed(args.seed + i),
+            output_type="latent",
+            **call_kwargs,
+        )
+        print(
+            f"[{i + 1}/{len(prompts)}] {len(calibrator.input_distances)} step pairs recorded"
+        )
+
+    coefficients = calibrator.fit(args.degree)
+    y = np.asarray(calibrator.output_distances)
+    fit_error = (
+        np.abs(np.polyval(coefficients, calibrator.input_distances) - y).mean()
+        / np.abs(y).mean()
+    )
+    print(f"coefficients {coefficients}, mean relative fit error {fit_error:.3f}")
+
+    profiles = TeaCacheProfiles()
+    profiles.put(
+        args.profile or name,
+        coefficients,
+        model=args.model,
+        num_inference_steps=args.num_inference_steps,
+        height=args.height,
+        width=args.width,
+        num_samples=len(calibrator.input_distances),
+    )
+    profiles.save()
+    print(f"Saved profile {args.profile or name} to {profiles.path}")
+
+
+if __name__ == "__main__":
+    main()
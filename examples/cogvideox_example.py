@@ -26,9 +26,21 @@ def main():
     assert engine_args.pipefusion_parallel_degree == 1, "This script does not support PipeFusion."
     assert engine_args.use_parallel_vae is False, "parallel VAE not implemented for CogVideo"
 
+    cache_args = {
+            "use_teacache": engine_args.use_teacache,
+            "use_fbcache": engine_args.use_fbcache,
+            "use_groupcache": engine_args.use_groupcache,
+            "rel_l1_thresh": 0.12,
+            "return_hidden_states_first": True,
+            "num_steps": input_config.num_inference_steps,
+            "target_latency": engine_args.cache_target_latency,
+            "step_budget": engine_args.cache_step_budget,
+        }
+
     pipe = xFuserCogVideoXPipeline.from_pretrained(
         pretrained_model_name_or_path=engine_config.model_config.model,
         engine_config=engine_config,
+        cache_args=cache_args,
         torch_dtype=torch.bfloat16,
     )
     if args.enable_sequential_cpu_offload:
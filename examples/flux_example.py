@@ -36,9 +36,12 @@ def main():
     cache_args = {
             "use_teacache": engine_args.use_teacache,
             "use_fbcache": engine_args.use_fbcache,
+            "use_groupcache": engine_args.use_groupcache,
             "rel_l1_thresh": 0.12,
             "return_hidden_states_first": False,
             "num_steps": input_config.num_inference_steps,
+            "target_latency": engine_args.cache_target_latency,
+            "step_budget": engine_args.cache_step_budget,
         }
 
     pipe = xFuserFluxPipeline.from_pretrained(
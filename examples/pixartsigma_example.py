@@ -27,9 +27,21 @@ def main():
         quantize(text_encoder, weights=qfloat8)
         freeze(text_encoder)
 
+    cache_args = {
+            "use_teacache": engine_args.use_teacache,
+            "use_fbcache": engine_args.use_fbcache,
+            "use_groupcache": engine_args.use_groupcache,
+            "rel_l1_thresh": 0.12,
+            "return_hidden_states_first": True,
+            "num_steps": input_config.num_inference_steps,
+            "target_latency": engine_args.cache_target_latency,
+            "step_budget": engine_args.cache_step_budget,
+        }
+
     pipe = xFuserPixArtSigmaPipeline.from_pretrained(
         pretrained_model_name_or_path=engine_config.model_config.model,
         engine_config=engine_config,
+        cache_args=cache_args,
         torch_dtype=torch.float16,
         text_encoder=text_encoder,
     ).to(f"cuda:{local_rank}")
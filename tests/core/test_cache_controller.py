@@ -0,0 +1,110 @@
+import math
+import threading
+import types
+import unittest
+
+import torch
+
+from xfuser.model_executor.cache.controller import (
+    CacheThresholdController,
+    RequestCacheRecord,
+    _RequestTracker,
+    accumulated_threshold,
+    allowed_computed_steps,
+    step_threshold,
+)
+
+
+class ThreadStageGroup:
+    """All-reduce of the ranks of a stage, each one a thread."""
+
+    def __init__(self, world_size):
+        self.barrier = threading.Barrier(world_size)
+        self.inputs = {}
+
+    def all_reduce(self, rank, tensor, op):
+        assert op == torch.distributed.ReduceOp.MAX
+        self.inputs[rank] = tensor.clone()
+        self.barrier.wait()
+        out = torch.stack(list(self.inputs.values())).amax(dim=0)
+        self.barrier.wait()
+        return out
+
+
+class TestCacheThresholdController(unittest.TestCase):
+    def test_allowed_computed_steps(self):
+        # 10 steps left, 1.0s to go, 0.2s a computed and 0.05s a skipped step
+        self.assertEqual(allowed_computed_steps(1.0, 10, 0.2, 0.05), 3)
+        self.assertEqual(allowed_computed_steps(10.0, 10, 0.2, 0.05), 10)
+        self.assertEqual(allowed_computed_steps(0.1, 10, 0.2, 0.05), 0)
+
+    def test_accumulated_threshold(self):
+        # 12 steps moving 0.1 each, computed 4 times: every 0.3
+        self.assertAlmostEqual(accumulated_threshold([0.1, 0.1], 12, 4), 0.3)
+        self.assertEqual(accumulated_threshold([0.1], 12, 0), math.inf)
+
+    def test_step_threshold(self):
+        distances = [0.1, 0.4, 0.2, 0.3]
+        # half of the steps run: the ones at least as far as the median
+        self.assertEqual(step_threshold(distances, 10, 5), 0.3)
+        self.assertEqual(step_threshold(distances, 10, 10), 0.0)
+        self.assertEqual(step_threshold(distances, 10, 0), math.inf)
+
+    def test_ranks_agree_on_threshold(self):
+        # the ranks of a stage measured different costs and start times
+        measured = [(0.2, 0.05, 0.0), (0.3, 0.04, -0.5)]
+        group = ThreadStageGroup(len(measured))
+        thresholds = [None] * len(measured)
+
+        def run(rank):
+            run_cost, skip_cost, start = measured[rank]
+            controller = CacheThresholdController(target_latency=3.0)
+            controller.run_cost, controller.skip_cost = run_cost, skip_cost
+            record = RequestCacheRecord("request", num_steps=5, computed_steps=5)
+            tracker = _RequestTracker(
+                record, start=start, last_end=1.0, base_thresh=0.05
+            )
+            tracker.distances = list(
+                torch.tensor([0.1, 0.4, 0.2, 0.3], dtype=torch.float64)
+            )
+            state = types.SimpleNamespace(
+                rel_l1_thresh=torch.tensor(0.05),
+                num_steps=20,
+                all_reduce=lambda tensor, op: group.all_reduce(rank, tensor, op),
+            )
+            thresholds[rank] = controller.next_threshold(state, tracker, now=1.0)
+
+        threads = [
+            threading.Thread(target=run, args=(rank,)) for rank in range(len(measured))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the slowest costs of the stage: 1.5s left, 3 of 15 steps can run
+        expected = step_threshold(
+            [0.1, 0.4, 0.2, 0.3], 15, allowed_computed_steps(1.5, 15, 0.3, 0.05)
+        )
+        self.assertEqual(thresholds, [expected] * len(measured))
+
+    def test_on_track_keeps_threshold(self):
+        controller = CacheThresholdController(step_budget=10)
+        record = RequestCacheRecord("request", num_steps=5, computed_steps=2)
+        tracker = _RequestTracker(record, start=0.0, last_end=1.0, base_thresh=0.05)
+        # read back only for a new threshold
+        tracker.distances = [None]
+        state = types.SimpleNamespace(num_steps=12)
+        self.assertEqual(controller.next_threshold(state, tracker, now=1.0), 0.05)
+        record.computed_steps = 5
+        tracker.distances = list(
+            torch.tensor([0.1, 0.4, 0.2, 0.3], dtype=torch.float64)
+        )
+        self.assertEqual(
+            controller.next_threshold(state, tracker, now=1.0),
+            step_threshold([0.1, 0.4, 0.2, 0.3], 7, 5),
+        )
+
+
+# python -m pytest ./tests/core/test_cache_controller.py
+if __name__ == "__main__":
+    unittest.main()
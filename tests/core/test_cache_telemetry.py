@@ -0,0 +1,61 @@
+import unittest
+
+import torch
+from torch import nn
+
+from xfuser.model_executor.cache.telemetry import CacheTelemetry
+from xfuser.model_executor.cache.utils import TeaCachedTransformerBlocks, cache_request
+
+
+class Block(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.proj = nn.Linear(dim, dim)
+
+    def norm1(self, hidden_states, emb):
+        return (hidden_states * (1 + emb.unsqueeze(1)),)
+
+    def forward(self, hidden_states, encoder_hidden_states, temb):
+        return (
+            hidden_states + self.proj(self.norm1(hidden_states, temb)[0]),
+            encoder_hidden_states,
+        )
+
+
+class TestCacheTelemetry(unittest.TestCase):
+    def run_request(self, blocks, request_id, num_steps):
+        hidden_states = torch.randn(2, 4, 8)
+        with cache_request(request_id), torch.no_grad():
+            for step in range(num_steps):
+                blocks(hidden_states, None, temb=torch.full((2, 8), 0.1 * step))
+
+    def test_records(self):
+        torch.manual_seed(0)
+        telemetry = CacheTelemetry()
+        # a threshold no distance reaches, TeaCache still runs the first and last step
+        blocks = TeaCachedTransformerBlocks(
+            [Block(8)], rel_l1_thresh=1e6, num_steps=4, callbacks=[telemetry]
+        )
+        self.assertIs(blocks.callback_handler.find(CacheTelemetry), telemetry)
+        self.run_request(blocks, "a", 4)
+        self.run_request(blocks, "b", 4)
+
+        records = [r for r in telemetry.records if r.request_id == "a"]
+        self.assertEqual([r.step for r in records], [0, 1, 2, 3])
+        self.assertEqual(
+            [r.use_cache for r in records],
+            [[False, False], [True, True], [True, True], [False, False]],
+        )
+        self.assertIsNone(records[0].distance)
+        self.assertEqual(len(records[1].distance), 2)
+        self.assertEqual(records[1].threshold, [1e6])
+
+        summary = telemetry.summary(["b"])
+        self.assertEqual(summary["num_steps"], 4)
+        self.assertEqual(summary["skipped_steps"], 2)
+        self.assertAlmostEqual(summary["skipped_ratio"], 0.5)
+
+
+# python -m pytest ./tests/core/test_cache_telemetry.py
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+import unittest
+
+import torch
+from torch import nn
+
+from xfuser.model_executor.cache.utils import (
+    BlockGroupCachedTransformerBlocks,
+    CacheContext,
+    FBCachedTransformerBlocks,
+    TeaCachedTransformerBlocks,
+    cache_request,
+)
+
+
+class Block(nn.Module):
+    def __init__(self, dim):
+        super().__init__()
+        self.proj = nn.Linear(dim, dim)
+        self.batch_sizes = []
+
+    def norm1(self, hidden_states, emb):
+        return (hidden_states * (1 + emb.unsqueeze(1)),)
+
+    def forward(self, hidden_states, encoder_hidden_states, temb):
+        self.batch_sizes.append(hidden_states.shape[0])
+        return (
+            hidden_states + self.proj(self.norm1(hidden_states, temb)[0]),
+            encoder_hidden_states,
+        )
+
+
+def full_forward(blocks, hidden_states, temb):
+    for block in blocks:
+        hidden_states, _ = block(hidden_states, None, temb)
+    return hidden_states
+
+
+class TestCachedBlocks(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.blocks = [Block(8) for _ in range(3)]
+        self.temb = torch.full((3, 8), 0.1)
+
+    def test_decide_per_sample(self):
+        cached = FBCachedTransformerBlocks(self.blocks, rel_l1_thresh=0.05)
+        first = torch.randn(3, 4, 8)
+        second = first.clone()
+        # only the second sample moves
+        second[1] = torch.randn(4, 8)
+        with torch.no_grad():
+            cached(first, None, temb=self.temb)
+            self.assertEqual(cached.cache_context.use_cache_host, [False] * 3)
+            for block in self.blocks:
+                block.batch_sizes.clear()
+            out, _ = cached(second, None, temb=self.temb)
+            # the first block runs for the batch, the others for the moved sample
+            self.assertEqual(
+                [block.batch_sizes for block in self.blocks], [[3], [1], [1]]
+            )
+            reference = full_forward(self.blocks, second, self.temb)
+        self.assertEqual(cached.cache_context.use_cache_host, [True, False, True])
+        # skipped samples reuse their residual, the input did not change
+        torch.testing.assert_close(out, reference)
+
+    def test_run_masked(self):
+        cached = FBCachedTransformerBlocks(self.blocks)
+        hidden = torch.randn(3, 4, 8)
+        residual = torch.randn(3, 4, 8)
+        run = lambda hidden, encoder, temb: cached.process_blocks(
+            0, hidden, encoder, temb=temb
+        )
+        with torch.no_grad():
+            out, encoder, (new_residual, encoder_residual) = cached.run_masked(
+                run, [True, False, True], hidden, None, (residual, None), temb=self.temb
+            )
+            computed = full_forward(self.blocks, hidden[1:2], self.temb[1:2])
+        self.assertIsNone(encoder)
+        self.assertIsNone(encoder_residual)
+        torch.testing.assert_close(out[[0, 2]], hidden[[0, 2]] + residual[[0, 2]])
+        torch.testing.assert_close(out[1:2], computed)
+        # only the residual of the computed sample is refreshed
+        torch.testing.assert_close(new_residual[[0, 2]], residual[[0, 2]])
+        torch.testing.assert_close(new_residual[1:2], computed - hidden[1:2])
+
+    def run_steps(self, cached, request_id, hidden, steps):
+        outputs, decisions = [], []
+        with cache_request(request_id), torch.no_grad():
+            for step in steps:
+                outputs.append(
+                    cached(hidden, None, temb=torch.full((3, 8), 0.1 + 0.01 * step))[0]
+                )
+                decisions.append(cached.cache_context.use_cache_host)
+        return outputs, decisions
+
+    def test_interleaved_requests(self):
+        inputs = {"a": torch.randn(3, 4, 8), "b": 2 * torch.randn(3, 4, 8)}
+        num_steps = 6
+        cached = TeaCachedTransformerBlocks(
+            self.blocks, rel_l1_thresh=0.1, num_steps=num_steps
+        )
+        interleaved = {request_id: ([], []) for request_id in inputs}
+        for step in range(num_steps):
+            for request_id, hidden in inputs.items():
+                outputs, decisions = self.run_steps(cached, request_id, hidden, [step])
+                interleaved[request_id][0].extend(outputs)
+                interleaved[request_id][1].extend(decisions)
+                # the step counter wraps around at the end of the generation
+                self.assertEqual(
+                    cached.cache_contexts[request_id].cnt, (step + 1) % num_steps
+                )
+
+        for request_id, hidden in inputs.items():
+            alone = TeaCachedTransformerBlocks(
+                self.blocks, rel_l1_thresh=0.1, num_steps=num_steps
+            )
+            outputs, decisions = self.run_steps(
+                alone, request_id, hidden, range(num_steps)
+            )
+            # some steps reuse the residuals kept for the request
+            self.assertIn(True, sum(decisions, []))
+            self.assertEqual(interleaved[request_id][1], decisions)
+            for out, expected in zip(interleaved[request_id][0], outputs):
+                torch.testing.assert_close(out, expected)
+            context, expected_context = (
+                cached.cache_contexts[request_id],
+                alone.cache_contexts[request_id],
+            )
+            torch.testing.assert_close(
+                context.accumulated_rel_l1_distance,
+                expected_context.accumulated_rel_l1_distance,
+            )
+            torch.testing.assert_close(
+                context.hidden_states_residual, expected_context.hidden_states_residual
+            )
+
+        cached.release_request("a")
+        self.assertNotIn("a", cached.cache_contexts)
+        self.assertIn("b", cached.cache_contexts)
+
+    def test_block_groups_match_decide(self):
+        cached = BlockGroupCachedTransformerBlocks(
+            self.blocks, rel_l1_thresh=0.05, group_size=1
+        )
+        first = torch.randn(3, 4, 8)
+        second = first.clone()
+        second[1] = torch.randn(4, 8)
+        with torch.no_grad():
+            cached(first, None, temb=self.temb)
+            self.assertEqual(cached.cache_context.groups_ran, [[True] * 3] * 3)
+            out, _ = cached(second, None, temb=self.temb)
+            reference = full_forward(self.blocks, second, self.temb)
+            # the input of every group moved as far as the input of the blocks
+            expected = cached.decide(CacheContext(), second, first)
+        self.assertEqual(expected, [True, False, True])
+        self.assertEqual(
+            cached.cache_context.groups_ran, [[not skip for skip in expected]] * 3
+        )
+        torch.testing.assert_close(out, reference)
+
+    def test_skipped_groups_reuse_their_residual(self):
+        # the first group always reuses its residual, the others always run
+        cached = BlockGroupCachedTransformerBlocks(
+            self.blocks, rel_l1_thresh=[1e9, 0.0, 0.0], group_size=1
+        )
+        first, second = torch.randn(3, 4, 8), torch.randn(3, 4, 8)
+        with torch.no_grad():
+            cached(first, None, temb=self.temb)
+            out, _ = cached(second, None, temb=self.temb)
+            residual = full_forward(self.blocks[:1], first, self.temb) - first
+            reference = full_forward(self.blocks[1:], second + residual, self.temb)
+        self.assertEqual(
+            cached.cache_context.groups_ran, [[False] * 3, [True] * 3, [True] * 3]
+        )
+        torch.testing.assert_close(out, reference)
+
+    def test_decide_ahead_matches_decide(self):
+        for cls in (FBCachedTransformerBlocks, TeaCachedTransformerBlocks):
+            with self.subTest(cls=cls.__name__):
+                hidden = torch.randn(3, 4, 8)
+                steps = []
+                for _ in range(4):
+                    # only the second sample moves, every step
+                    hidden = hidden.clone()
+                    hidden[1] = torch.randn(4, 8)
+                    steps.append(hidden)
+                results = {}
+                for decide_ahead in (False, True):
+                    cached = cls(
+                        self.blocks, rel_l1_thresh=0.05, decide_ahead=decide_ahead
+                    )
+                    outputs, decisions = [], []
+                    with torch.no_grad():
+                        for hidden in steps:
+                            outputs.append(cached(hidden, None, temb=self.temb)[0])
+                            decisions.append(cached.cache_context.use_cache_host)
+                    results[decide_ahead] = outputs, decisions
+                outputs, decisions = results[False]
+                ahead_outputs, ahead_decisions = results[True]
+                self.assertEqual(decisions, [[False] * 3] + [[True, False, True]] * 3)
+                # a step follows the decision the synchronous path took one step before
+                self.assertEqual(ahead_decisions, decisions[:1] + decisions[:-1])
+                for out, ahead_out in zip(outputs, ahead_outputs):
+                    torch.testing.assert_close(ahead_out, out)
+
+
+# python -m pytest ./tests/core/test_cached_blocks.py
+if __name__ == "__main__":
+    unittest.main()
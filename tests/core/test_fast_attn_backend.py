@@ -0,0 +1,57 @@
+import unittest
+
+import torch
+
+from xfuser.core.fast_attention.attn_backend import (
+    available_backends,
+    full_attention,
+    resolve_backend,
+    window_attention,
+)
+
+
+def reference_window_attention(query, key, value, window_size):
+    q_len, k_len = query.shape[1], key.shape[1]
+    scores = torch.einsum("bqhd,bkhd->bhqk", query, key) / query.shape[-1] ** 0.5
+    # query i sits at key i + k_len - q_len, as in flash_attn
+    rel = torch.arange(k_len)[None, :] - torch.arange(q_len)[:, None] - (k_len - q_len)
+    outside = (rel < -window_size[0]) | (rel > window_size[1])
+    scores = scores.masked_fill(outside, float("-inf"))
+    return torch.einsum("bhqk,bkhd->bqhd", scores.softmax(-1), value)
+
+
+class TestFastAttnBackend(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_resolve_backend(self):
+        cpu = torch.device("cpu")
+        self.assertEqual(resolve_backend("auto", cpu), "sdpa")
+        self.assertEqual(resolve_backend("sdpa", cpu), "sdpa")
+        with self.assertRaises(RuntimeError):
+            resolve_backend("flash", cpu)
+
+    def test_full_attention(self):
+        query, key, value = (torch.randn(2, 40, 3, 8) for _ in range(3))
+        out = full_attention(query, key, value, "sdpa")
+        torch.testing.assert_close(
+            out, reference_window_attention(query, key, value, (40, 40))
+        )
+
+    def test_window_attention(self):
+        backends = [b for b in available_backends(torch.device("cpu")) if b != "flash"]
+        for q_len, k_len in [(40, 40), (24, 40)]:
+            for window_size in [(3, 3), (0, 5)]:
+                query = torch.randn(2, q_len, 3, 8)
+                key, value = torch.randn(2, k_len, 3, 8), torch.randn(2, k_len, 3, 8)
+                expected = reference_window_attention(query, key, value, window_size)
+                for backend in backends:
+                    out = window_attention(
+                        query, key, value, list(window_size), backend
+                    )
+                    torch.testing.assert_close(out, expected, atol=1e-5, rtol=1e-5)
+
+
+# python -m pytest ./tests/core/test_fast_attn_backend.py
+if __name__ == "__main__":
+    unittest.main()
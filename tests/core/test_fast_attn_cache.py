@@ -0,0 +1,67 @@
+import unittest
+
+import torch
+
+from xfuser.core.fast_attention.attn_layer import FastAttnMethod, xFuserFastAttention
+from xfuser.core.fast_attention.cache_storage import pack, unpack
+
+FULL = FastAttnMethod.FULL_ATTN
+FULL_CFG = FastAttnMethod.FULL_ATTN_CFG_SHARE
+WINDOW = FastAttnMethod.RESIDUAL_WINDOW_ATTN
+WINDOW_CFG = FastAttnMethod.RESIDUAL_WINDOW_ATTN_CFG_SHARE
+SHARE = FastAttnMethod.OUTPUT_SHARE
+
+
+class TestFastAttnCache(unittest.TestCase):
+    def test_pack_cfg_shared(self):
+        half = torch.randn(2, 6, 8)
+        entry = pack(half, repeats=2)
+        self.assertIs(entry.data, half)
+        torch.testing.assert_close(unpack(entry), torch.cat([half, half]))
+        torch.testing.assert_close(unpack(entry, 2), half)
+        torch.testing.assert_close(
+            unpack((entry, entry), 4)[1], torch.cat([half, half])
+        )
+
+    def test_pack_reduced_precision(self):
+        tensor = torch.randn(2, 6, 4, 8) * torch.logspace(-3, 1, 6)[None, :, None, None]
+        entry = pack(tensor, torch.bfloat16)
+        self.assertEqual(entry.nbytes, tensor.numel() * 2)
+        torch.testing.assert_close(unpack(entry), tensor, atol=0, rtol=1e-2)
+        # float8 keeps a scale per token, so small tokens keep their precision
+        entry = pack(tensor, torch.float8_e4m3fn)
+        self.assertEqual(entry.scale.shape, (2, 6))
+        self.assertEqual(unpack(entry).dtype, tensor.dtype)
+        torch.testing.assert_close(unpack(entry), tensor, atol=0, rtol=7e-2)
+        # no smaller dtype, nothing to pack
+        self.assertIs(pack(tensor.half(), torch.bfloat16).data.dtype, torch.float16)
+
+    def test_cache_lifetimes(self):
+        fast_attn = xFuserFastAttention.__new__(xFuserFastAttention)
+        fast_attn.set_methods([FULL, SHARE, WINDOW_CFG, FULL_CFG, WINDOW, SHARE])
+        self.assertEqual(
+            fast_attn.need_compute_residual, [True, False, False, True, False, False]
+        )
+        self.assertEqual(
+            fast_attn.keep_residual, [True, True, False, True, False, False]
+        )
+        self.assertEqual(
+            fast_attn.keep_output, [True, False, False, False, True, False]
+        )
+        self.assertEqual(fast_attn.cache_sizes(compact=False), [2.0] * 6)
+        # the residual of the CFG shared full attention is cached once
+        self.assertEqual(
+            fast_attn.cache_sizes(compact=True), [2.0, 1.0, 0.0, 0.5, 1.0, 0.0]
+        )
+        self.assertEqual(
+            fast_attn.cache_sizes(compact=True, precision=0.5),
+            [1.0, 0.5, 0.0, 0.25, 0.5, 0.0],
+        )
+        # while the plan is selected every cache is kept
+        fast_attn.set_methods([FULL, SHARE], selecting=True)
+        self.assertEqual((fast_attn.keep_residual, fast_attn.keep_output), ([], []))
+
+
+# python -m pytest ./tests/core/test_fast_attn_cache.py
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from torch import nn
+
+from xfuser.core.fast_attention.attn_layer import FastAttnMethod
+from xfuser.core.fast_attention.fast_attn_state import fast_attn_blocks
+from xfuser.core.fast_attention.utils import (
+    calibration_prompts,
+    load_config_file,
+    num_candidate_groups,
+    save_config_file,
+)
+
+
+class TestFastAttnCalibration(unittest.TestCase):
+    def test_num_candidate_groups(self):
+        self.assertEqual(num_candidate_groups(1, 4), 1)
+        self.assertEqual(num_candidate_groups(2, 4), 2)
+        self.assertEqual(num_candidate_groups(6, 4), 3)
+        self.assertEqual(num_candidate_groups(8, 4), 4)
+
+    def test_calibration_prompts(self):
+        prompts = ["a", "b", "c"]
+        self.assertEqual(calibration_prompts(prompts, 1, 1), prompts)
+        # two candidate groups, every rank runs every prompt
+        self.assertEqual(calibration_prompts(prompts, 2, 2), prompts * 2)
+        # two groups of two ranks, each rank half of the prompts padded to two
+        self.assertEqual(
+            calibration_prompts(prompts, 4, 2),
+            ["a", "b", "a", "b", "c", "a", "c", "a"],
+        )
+
+    def test_partial_config_file(self):
+        methods = [
+            [FastAttnMethod.FULL_ATTN, FastAttnMethod.OUTPUT_SHARE],
+            [FastAttnMethod.FULL_ATTN],
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "plan.json")
+            save_config_file(methods, path)
+            self.assertEqual(load_config_file(path), methods)
+            self.assertEqual(os.listdir(tmpdir), ["plan.json"])
+
+    def test_fast_attn_blocks(self):
+        # Flux runs its joint blocks before its single stream blocks
+        transformer = nn.Module()
+        transformer.transformer_blocks = nn.ModuleList(
+            [nn.Linear(1, 1) for _ in range(2)]
+        )
+        transformer.single_transformer_blocks = nn.ModuleList([nn.Linear(1, 1)])
+        self.assertEqual(
+            fast_attn_blocks(transformer),
+            list(transformer.transformer_blocks)
+            + list(transformer.single_transformer_blocks),
+        )
+        # HunyuanDiT
+        transformer = nn.Module()
+        transformer.blocks = nn.ModuleList([nn.Linear(1, 1)])
+        self.assertEqual(fast_attn_blocks(transformer), list(transformer.blocks))
+
+
+# python -m pytest ./tests/core/test_fast_attn_calibration.py
+if __name__ == "__main__":
+    unittest.main()
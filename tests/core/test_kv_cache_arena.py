@@ -0,0 +1,131 @@
+import unittest
+
+import torch
+
+from xfuser.core.cache_manager import CacheManager, KVCacheArena
+from xfuser.core.cache_manager.cache_manager import calc_kv_gather_index
+from xfuser.core.cache_manager.kv_quant import dequantize_kv, quantize_kv
+
+
+class TestKVCacheArena(unittest.TestCase):
+    def test_views(self):
+        arena = KVCacheArena(
+            {"a": torch.Size([2, 3]), "b": torch.Size([5])},
+            dtype=torch.float16,
+            device=torch.device("cpu"),
+        )
+        a, b = arena.view("a"), arena.view("b")
+        self.assertEqual(a.shape, (2, 3))
+        # views start at 256 byte boundaries
+        self.assertEqual((b.data_ptr() - a.data_ptr()) % KVCacheArena.alignment, 0)
+        a.fill_(1)
+        b.fill_(2)
+        self.assertEqual(a.sum().item(), 6)
+        self.assertEqual(arena.layer_nbytes(), {"a": 12, "b": 10})
+        self.assertEqual(arena.nbytes(), 256 + 256)
+
+    def test_reuse_across_steps(self):
+        manager = CacheManager()
+        layers = [object(), object()]
+        for layer in layers:
+            manager.register_cache_entry(layer, layer_type="attn")
+        entries = [manager.cache["attn", layer] for layer in layers]
+        self.assertEqual([entry.name for entry in entries], ["attn.0", "attn.1"])
+
+        # the first full step keeps the kv as is, then it is packed
+        for entry in entries:
+            manager._store_full_kv(entry, torch.randn(1, 8, 4))
+        manager._pack_arenas()
+        arena = manager._arenas[torch.float32, torch.device("cpu")]
+        ptrs = [entry.tensors[0].data_ptr() for entry in entries]
+        self.assertEqual(ptrs[0], arena.buffer.data_ptr())
+
+        # later full steps of the same shape are written into the arena
+        kv = torch.randn(1, 8, 4)
+        out = manager._store_full_kv(entries[1], kv)
+        self.assertEqual(out.data_ptr(), ptrs[1])
+        self.assertTrue(torch.equal(out, kv))
+        self.assertFalse(manager._unpacked_entries)
+        self.assertEqual(manager.memory_report(), {"attn.0": 128, "attn.1": 128})
+
+
+class TestKVGatherIndex(unittest.TestCase):
+    def test_patch_major_order(self):
+        pp_patches_token_num = [3, 2, 4]
+        ulysses_world_size = 2
+        new_kv = torch.randn(1, ulysses_world_size * 9, 4)
+        kv_list = [
+            kv.split(pp_patches_token_num, dim=1)
+            for kv in new_kv.chunk(ulysses_world_size, dim=1)
+        ]
+        expected = torch.cat(
+            [
+                kv_list[rank][pp_patch_idx]
+                for pp_patch_idx in range(len(pp_patches_token_num))
+                for rank in range(ulysses_world_size)
+            ],
+            dim=1,
+        )
+        index = calc_kv_gather_index(pp_patches_token_num, ulysses_world_size)
+        out = torch.empty_like(new_kv)
+        torch.index_select(new_kv, 1, index, out=out)
+        self.assertTrue(torch.equal(out, expected))
+        # the kv of patch 1 is one contiguous range of the cache
+        self.assertTrue(
+            torch.equal(
+                out[:, 2 * 3 : 2 * 5],
+                torch.cat([kv_list[0][1], kv_list[1][1]], dim=1),
+            )
+        )
+
+
+class TestKVCacheOffload(unittest.TestCase):
+    def test_prefetch_and_write_back(self):
+        manager = CacheManager()
+        layers = [object(), object(), object()]
+        for layer in layers:
+            manager.register_cache_entry(layer, layer_type="attn")
+        entries = [manager.cache["attn", layer] for layer in layers]
+        full = [torch.randn(1, 8, 4) for _ in layers]
+        for entry, kv in zip(entries, full):
+            manager._store_offloaded_full_kv(entry, kv)
+        offloader = manager.offloader
+        # cpu is a simulated device
+        self.assertTrue(offloader.simulated)
+        manager._pack_arenas()
+
+        for start, end in [(0, 4), (4, 8)]:
+            for entry, kv in zip(entries, full):
+                new_kv = torch.randn(1, end - start, 4)
+                kv[:, start:end] = new_kv
+                out = manager._update_offloaded_kv(entry, new_kv, 1, start, end)
+                self.assertTrue(torch.equal(out, kv))
+                # the host copy is updated, not the device one only
+                self.assertTrue(torch.equal(entry.tensors[0], kv))
+                self.assertNotEqual(out.data_ptr(), entry.tensors[0].data_ptr())
+        # only the very first layer is not prefetched
+        self.assertEqual(offloader.stats["prefetch_misses"], 1)
+        self.assertEqual(offloader.stats["prefetch_hits"], 5)
+        self.assertEqual(list(offloader.prefetched), ["attn.0"])
+
+
+class TestKVQuant(unittest.TestCase):
+    def test_roundtrip(self):
+        # (batch, heads, tokens, k + v) with heads of different magnitude
+        kv = torch.randn(2, 4, 16, 8) * torch.tensor([0.1, 1.0, 10.0, 100.0]).view(
+            1, 4, 1, 1
+        )
+        q, scale = quantize_kv(kv, 2, "int8")
+        self.assertEqual(q.dtype, torch.int8)
+        self.assertEqual(q.shape, kv.shape)
+        # one scale per sample, head and k / v
+        self.assertEqual(scale.shape, (2, 4, 1, 2, 1))
+        out = torch.empty(2, 4, 20, 8)
+        dequantize_kv(q, scale, torch.float32, out=out[:, :, 4:])
+        error = (out[:, :, 4:] - kv).abs().amax(dim=(2, 3))
+        self.assertTrue((error <= kv.abs().amax(dim=(2, 3)) / 127).all())
+
+
+# python -m pytest ./tests/core/test_kv_cache_arena.py
+if __name__ == "__main__":
+    unittest.main()
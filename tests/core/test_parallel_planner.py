@@ -0,0 +1,83 @@
+import dataclasses
+import unittest
+
+from xfuser.core.distributed.shape_plan import calc_pipeline_patches_height_list
+from xfuser.core.planner import (
+    CostModel,
+    ModelProfile,
+    ParallelPlanner,
+    Workload,
+    enumerate_parallel_candidates,
+)
+
+
+def pixart_profile():
+    return ModelProfile(
+        num_layers=28,
+        num_attention_heads=16,
+        attention_head_dim=72,
+        patch_size=2,
+        in_channels=4,
+        text_seq_len=120,
+    )
+
+
+class TestParallelPlanner(unittest.TestCase):
+    def test_patches_height_list(self):
+        self.assertEqual(calc_pipeline_patches_height_list(128, 4, 2, 2), [32] * 4)
+        # too many patches for the input are merged
+        self.assertEqual(calc_pipeline_patches_height_list(16, 8, 4, 2), [8, 8])
+        with self.assertRaises(ValueError):
+            calc_pipeline_patches_height_list(130, 1, 4, 2)
+
+    def test_candidates_are_valid(self):
+        model = pixart_profile()
+        workload = Workload(height=1024, width=1024)
+        candidates = list(enumerate_parallel_candidates(8, model, workload))
+        self.assertTrue(candidates)
+        self.assertEqual(len(candidates), len(set(candidates)))
+        for candidate in candidates:
+            self.assertEqual(candidate.world_size, 8)
+            self.assertEqual(candidate.dp_degree, 1)
+
+    def test_head_padding(self):
+        model = dataclasses.replace(pixart_profile(), num_attention_heads=12)
+        workload = Workload(height=1024, width=1024)
+        candidates = {
+            candidate.ulysses_degree: candidate
+            for candidate in enumerate_parallel_candidates(8, model, workload)
+            if candidate.ring_degree == 1 and candidate.pp_degree == 1
+        }
+        # 12 heads are padded to 16 for ulysses 8, the attention of the
+        # padded heads is charged
+        self.assertIn(8, candidates)
+        cost_model = CostModel(model)
+        padded = cost_model.estimate(candidates[8], workload)
+        self.assertGreater(padded.breakdown["head_padding"], 0)
+        self.assertNotIn(
+            "head_padding", cost_model.estimate(candidates[4], workload).breakdown
+        )
+
+    def test_no_cfg_parallel_without_guidance(self):
+        model = pixart_profile()
+        workload = Workload(height=1024, width=1024, use_cfg=False)
+        for candidate in enumerate_parallel_candidates(8, model, workload):
+            self.assertEqual(candidate.cfg_degree, 1)
+
+    def test_recommend(self):
+        planner = ParallelPlanner(pixart_profile())
+        workload = Workload(height=2048, width=2048)
+        results = planner.plan(workload, 8)
+        times = [estimate.total_time for _, estimate in results]
+        self.assertEqual(times, sorted(times))
+        args = planner.recommend(workload, 8, model="PixArt-alpha/PixArt-XL-2-1024-MS")
+        best = results[0][0]
+        self.assertEqual(args.ulysses_degree, best.ulysses_degree)
+        self.assertEqual(args.pipefusion_parallel_degree, best.pp_degree)
+        self.assertEqual(args.use_cfg_parallel, best.cfg_degree > 1)
+        self.assertEqual(args.height, 2048)
+
+
+# python -m pytest ./tests/core/test_parallel_planner.py
+if __name__ == "__main__":
+    unittest.main()
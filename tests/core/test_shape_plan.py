@@ -0,0 +1,186 @@
+import types
+import unittest
+from unittest import mock
+
+import torch
+
+from xfuser.config.config import InputConfig
+from xfuser.core.distributed import runtime_state
+from xfuser.core.distributed.shape_plan import (
+    ShapePlanCache,
+    calc_shape_plan,
+    drop_padded_tokens,
+    get_plan_buffer,
+    head_padding_waste,
+    pad_heads,
+    padded_num_heads,
+)
+
+
+class TestShapePlan(unittest.TestCase):
+    def test_even_split(self):
+        # 128 latent rows, 4 pipeline patches, 2 sp ranks, patch size 2
+        plan = calc_shape_plan("k", 128, 64, 4, 2, 1, 2)
+        self.assertEqual(plan.num_pipeline_patch, 4)
+        self.assertEqual(plan.pp_patches_height, (16, 16, 16, 16))
+        self.assertEqual(plan.pp_patches_start_idx_local, (0, 16, 32, 48, 64))
+        self.assertEqual(
+            plan.pp_patches_start_end_idx_global,
+            ((16, 32), (48, 64), (80, 96), (112, 128)),
+        )
+        self.assertEqual(plan.pp_patches_token_num, (256,) * 4)
+        self.assertEqual(
+            plan.pp_patches_token_start_idx_local, (0, 256, 512, 768, 1024)
+        )
+        self.assertEqual(plan.pp_patches_token_start_end_idx_global[0], (256, 512))
+
+    def test_uneven_split_tiles_latent(self):
+        # 64 rows into 3 patches gives heights (24, 24, 16)
+        latents_height, latents_width, num_sp_patches = 64, 64, 2
+        plans = [
+            calc_shape_plan("k", latents_height, latents_width, 3, num_sp_patches, i, 2)
+            for i in range(num_sp_patches)
+        ]
+        # every sp rank holds the same number of rows of each pipeline patch
+        self.assertEqual(plans[0].pp_patches_height, plans[1].pp_patches_height)
+        self.assertEqual(plans[0].pp_patches_height, (12, 12, 8))
+        rows = sorted(
+            range_ for plan in plans for range_ in plan.pp_patches_start_end_idx_global
+        )
+        self.assertEqual(rows[0][0], 0)
+        self.assertEqual(rows[-1][1], latents_height)
+        for (_, end), (start, _) in zip(rows[:-1], rows[1:]):
+            self.assertEqual(end, start)
+
+    def test_sp_padding(self):
+        with self.assertRaises(ValueError):
+            calc_shape_plan("k", 10, 8, 1, 4, 0, 2)
+        # 10 rows are padded to 16, 4 rows per sp rank
+        plans = [calc_shape_plan("k", 10, 8, 1, 4, i, 2, pad_sp=True) for i in range(4)]
+        self.assertEqual(plans[0].padded_latents_height, 16)
+        self.assertEqual(plans[0].latents_height, 10)
+        self.assertEqual(plans[0].sp_pad_height, (0, 0, 2, 4))
+        self.assertEqual(plans[0].sp_pad_token_num, (0, 0, 4, 8))
+        self.assertEqual(plans[3].pp_patches_start_end_idx_global, ((12, 16),))
+        # divisible heights are not padded
+        plan = calc_shape_plan("k", 16, 8, 1, 4, 0, 2, pad_sp=True)
+        self.assertEqual(plan.padded_latents_height, 16)
+        self.assertEqual(plan.sp_pad_token_num, (0, 0, 0, 0))
+
+    def test_drop_padded_tokens(self):
+        x = torch.arange(12).view(1, 12, 1)
+        out = drop_padded_tokens(x, (0, 1, 4))
+        self.assertEqual(out.flatten().tolist(), [0, 1, 2, 3, 4, 5, 6])
+        self.assertIs(drop_padded_tokens(x, (0, 0)), x)
+
+    def test_pad_heads(self):
+        self.assertEqual(padded_num_heads(16, 8), 16)
+        self.assertEqual(padded_num_heads(24, 16), 32)
+        self.assertEqual(head_padding_waste(24, 16), 0.25)
+        query, key, value = (torch.randn(2, 10, 6, 8) for _ in range(3))
+        padded = [pad_heads(x, 4) for x in (query, key, value)]
+        self.assertEqual(padded[0].shape, (2, 10, 8, 8))
+        self.assertIs(pad_heads(query, 3), query)
+
+        # the padded heads leave the attention of the others unchanged
+        def attn(q, k, v):
+            return torch.nn.functional.scaled_dot_product_attention(
+                q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)
+            ).transpose(1, 2)
+
+        out = attn(*padded)
+        torch.testing.assert_close(out[:, :, :6], attn(query, key, value))
+        self.assertEqual(out[:, :, 6:].abs().max().item(), 0)
+
+    def test_lru(self):
+        cache = ShapePlanCache(max_size=2)
+        for key in ["a", "b"]:
+            cache.put(calc_shape_plan(key, 64, 64, 1, 1, 0, 2))
+        self.assertIsNotNone(cache.get("a"))
+        cache.put(calc_shape_plan("c", 64, 64, 1, 1, 0, 2))
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_runtime_state_plan_key(self):
+        state = runtime_state.DiTRuntimeState.__new__(runtime_state.DiTRuntimeState)
+        state.parallel_config = types.SimpleNamespace(
+            dp_degree=1,
+            cfg_degree=1,
+            ulysses_degree=1,
+            ring_degree=1,
+            pp_degree=2,
+            tp_degree=1,
+            pp_config=types.SimpleNamespace(num_pipeline_patch=1),
+        )
+        state.runtime_config = types.SimpleNamespace(
+            dtype=torch.float16, warmup_steps=1
+        )
+        state.input_config = InputConfig()
+        state.ready = False
+        state.shape_plan_cache = ShapePlanCache()
+        state.cogvideox = state.consisid = state.hunyuan_video = False
+        state.sp_padding_supported = False
+        state.vae_scale_factor, state.backbone_patch_size = 8, 2
+        state.max_condition_sequence_length = state.text_sequence_length = None
+        state.use_cfg = None
+        pp_group = mock.MagicMock()
+        with mock.patch.multiple(
+            runtime_state,
+            get_pp_group=lambda: pp_group,
+            get_sequence_parallel_world_size=lambda: 1,
+            get_sequence_parallel_rank=lambda: 0,
+        ):
+            state.set_input_parameters(
+                1024, 1024, 1, text_sequence_length=256, use_cfg=True
+            )
+            plan = state.shape_plan
+            # the pipeline group caches the shape of the text embeddings
+            plan.buffers.recv_shape["encoder_hidden_states"] = {
+                0: torch.Size([2, 256, 8])
+            }
+            state.set_input_parameters(
+                512, 512, 1, text_sequence_length=256, use_cfg=True
+            )
+            # the same size with longer text or without cfg exchanges new shapes
+            state.set_input_parameters(
+                1024, 1024, 1, text_sequence_length=512, use_cfg=True
+            )
+            self.assertIsNot(state.shape_plan, plan)
+            self.assertEqual(state.shape_plan.buffers.recv_shape, {})
+            state.set_input_parameters(
+                1024, 1024, 1, text_sequence_length=512, use_cfg=False
+            )
+            self.assertEqual(len(state.shape_plan_cache), 4)
+            # the buffers of a shape seen before are reused
+            state.set_input_parameters(
+                1024, 1024, 1, text_sequence_length=256, use_cfg=True
+            )
+            self.assertIs(state.shape_plan, plan)
+            pp_group.reset_buffer.assert_called_with(plan.buffers)
+
+    def test_plan_buffer(self):
+        create = lambda: torch.empty(4)
+        # without a shape plan nothing outlives the call
+        first = get_plan_buffer("attn_buffers", "a", create)
+        self.assertIsNot(get_plan_buffer("attn_buffers", "a", create), first)
+        fallback = {}
+        first = get_plan_buffer("attn_buffers", "a", create, fallback=fallback)
+        self.assertIs(get_plan_buffer("attn_buffers", "a", create, fallback), first)
+        get_plan_buffer("attn_buffers", "b", create, fallback=fallback)
+        self.assertEqual(list(fallback), ["b"])
+
+        plan = calc_shape_plan("k", 64, 64, 1, 1, 0, 2)
+        state = types.SimpleNamespace(shape_plan=plan)
+        with mock.patch.object(runtime_state, "_RUNTIME", state):
+            first = get_plan_buffer("attn_buffers", "a", create, fallback=fallback)
+            self.assertIs(get_plan_buffer("attn_buffers", "a", create), first)
+            get_plan_buffer("attn_buffers", "b", create)
+        self.assertEqual(list(plan.buffers.attn_buffers), ["a", "b"])
+        self.assertEqual(list(fallback), ["b"])
+
+
+# python -m pytest ./tests/core/test_shape_plan.py
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import unittest
+
+import torch.nn as nn
+
+from xfuser.core.planner import (
+    StagePartition,
+    StagePartitionCache,
+    estimate_stage_partition,
+    partition_blocks,
+)
+
+
+class ToyTransformer(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.x_embedder = nn.Linear(16, 32)
+        self.transformer_blocks = nn.ModuleList(
+            [nn.Sequential(nn.Linear(32, 128), nn.Linear(128, 32)) for _ in range(2)]
+        )
+        self.single_transformer_blocks = nn.ModuleList(
+            [nn.Linear(32, 32) for _ in range(4)]
+        )
+        self.proj_out = nn.Linear(32, 16)
+
+
+class TestStagePartition(unittest.TestCase):
+    def test_partition_blocks(self):
+        self.assertEqual(partition_blocks([1.0] * 8, 2), [4, 4])
+        # the embeddings make the first stage slower
+        self.assertEqual(partition_blocks([1.0] * 8, 2, first_stage_cost=2.0), [3, 5])
+        self.assertEqual(partition_blocks([5.0, 1.0, 1.0, 1.0, 1.0, 1.0], 2), [1, 5])
+        split = partition_blocks([3.0, 1.0, 1.0, 2.0, 2.0, 1.0, 1.0], 3)
+        self.assertEqual(sum(split), 7)
+        self.assertEqual(
+            max(StagePartition([3.0, 1.0, 1.0, 2.0, 2.0, 1.0, 1.0]).stage_costs(split)),
+            4.0,
+        )
+        with self.assertRaises(ValueError):
+            partition_blocks([1.0, 1.0], 3)
+
+    def test_flops_model(self):
+        partition = estimate_stage_partition(
+            ToyTransformer(),
+            ["transformer_blocks", "single_transformer_blocks"],
+            num_tokens=10,
+        )
+        self.assertEqual(len(partition.block_costs), 6)
+        self.assertEqual(partition.block_costs[0], 2 * 2 * 32 * 128 * 10)
+        self.assertEqual(partition.block_costs[-1], 2 * 32 * 32 * 10)
+        self.assertEqual(partition.first_stage_cost, 2 * 16 * 32 * 10)
+        self.assertEqual(partition.last_stage_cost, 2 * 32 * 16 * 10)
+        self.assertEqual(partition.split(2), [1, 5])
+
+    def test_cache_prefers_profile(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "partition.json")
+            cache = StagePartitionCache(path)
+            profiled = StagePartition([1.0, 3.0], source="profile")
+            profiled.split(2)
+            cache.put("model", "1024x1024", profiled)
+            cache.put("model", "1024x1024", StagePartition([1.0, 1.0]))
+            cache.save()
+            loaded = StagePartitionCache(path).get("model", "1024x1024")
+            self.assertEqual(loaded, profiled)
+            self.assertIsNone(StagePartitionCache(path).get("model", "512x512"))
+
+
+# python -m pytest ./tests/core/test_stage_partition.py
+if __name__ == "__main__":
+    unittest.main()
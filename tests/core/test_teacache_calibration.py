@@ -0,0 +1,33 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from xfuser.model_executor.cache.calibration import TeaCacheProfiles, fit_coefficients
+
+
+class TestTeaCacheCalibration(unittest.TestCase):
+    def test_fit(self):
+        x = np.linspace(0.01, 0.3, 20)
+        y = 3.0 * x**2 - 0.5 * x + 0.02
+        coefficients = fit_coefficients(x, y, degree=2)
+        np.testing.assert_allclose(coefficients, [3.0, -0.5, 0.02], atol=1e-8)
+        with self.assertRaises(ValueError):
+            fit_coefficients([0.1, 0.2], [0.1, 0.2], degree=4)
+
+    def test_profiles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "teacache.json")
+            profiles = TeaCacheProfiles(path)
+            self.assertIsNone(profiles.get("flux"))
+            profiles.put("flux-finetune", [1.0, 2.0], num_inference_steps=20)
+            profiles.save()
+            loaded = TeaCacheProfiles(path)
+            self.assertEqual(loaded.get("flux-finetune"), [1.0, 2.0])
+            self.assertEqual(loaded.entries["flux-finetune"]["num_inference_steps"], 20)
+
+
+# python -m pytest ./tests/core/test_teacache_calibration.py
+if __name__ == "__main__":
+    unittest.main()
@@ -88,6 +88,10 @@ class xFuserArgs:
     pipefusion_parallel_degree: int = 1
     num_pipeline_patch: Optional[int] = None
     attn_layer_num_for_pp: Optional[List[int]] = None
+    pipefusion_partition: str = "even"
+    pipefusion_partition_file: Optional[str] = None
+    pipefusion_kv_cache_dtype: str = "auto"
+    pipefusion_kv_cache_offload: bool = False
     # Input arguments
     height: int = 1024
     width: int = 1024
@@ -108,12 +112,19 @@ class xFuserArgs:
     # DiTFastAttn arguments
     use_fast_attn: bool = False
     n_calib: int = 8
+    n_calib_trials: int = 1
     threshold: float = 0.5
     window_size: int = 64
     coco_path: Optional[str] = None
     use_cache: bool = False
+    fast_attn_backend: str = "auto"
+    fast_attn_compact_cache: bool = False
+    fast_attn_cache_dtype: Optional[str] = None
     use_teacache: bool = False
     use_fbcache: bool = False
+    use_groupcache: bool = False
+    cache_target_latency: Optional[float] = None
+    cache_step_budget: Optional[int] = None
     use_fp8_t5_encoder: bool = False
 
     @staticmethod
@@ -160,12 +171,38 @@ class xFuserArgs:
         runtime_group.add_argument(
             "--use_teacache",
             action="store_true",
-            help="Enable teacache to accelerate inference in a single card",
+            help="Enable teacache to skip transformer blocks in steps whose "
+            "input barely changed. Works with sequence, cfg, tensor and "
+            "pipefusion parallel.",
         )
         runtime_group.add_argument(
             "--use_fbcache",
             action="store_true",
-            help="Enable teacache to accelerate inference in a single card",
+            help="Enable first block cache to skip the remaining transformer "
+            "blocks in steps whose first block output barely changed. Works "
+            "with sequence, cfg, tensor and pipefusion parallel.",
+        )
+        runtime_group.add_argument(
+            "--use_groupcache",
+            action="store_true",
+            help="Enable block group cache to skip the groups of transformer "
+            "blocks whose input barely changed since they last ran. Works "
+            "with sequence, cfg and tensor parallel.",
+        )
+        runtime_group.add_argument(
+            "--cache_target_latency",
+            type=float,
+            default=None,
+            help="Target latency of a request in seconds. The cache skips "
+            "more steps of requests that would miss it.",
+        )
+        runtime_group.add_argument(
+            "--cache_step_budget",
+            type=int,
+            default=None,
+            help="Number of steps of a request that may run the transformer "
+            "blocks. The cache skips more steps of requests that would "
+            "exceed it.",
         )
 
         # Parallel arguments
@@ -226,6 +263,38 @@ class xFuserArgs:
             type=int,
             help="List representing the number of layers per stage of the pipeline in pipefusion parallel",
         )
+        parallel_group.add_argument(
+            "--pipefusion_partition",
+            type=str,
+            default="even",
+            choices=["even", "auto"],
+            help="How to split the transformer blocks into pipefusion stages when "
+            "--attn_layer_num_for_pp is not set. 'auto' balances the estimated or "
+            "profiled time of every stage for the model and input size.",
+        )
+        parallel_group.add_argument(
+            "--pipefusion_partition_file",
+            type=str,
+            default=None,
+            help="Json file the automatic pipefusion partitions are stored in. "
+            "Defaults to ~/.cache/xfuser/pipefusion_partition.json",
+        )
+        parallel_group.add_argument(
+            "--pipefusion_kv_cache_dtype",
+            type=str,
+            default="auto",
+            choices=["auto", "int8", "fp8"],
+            help="Storage type of the stale kv cache of pipefusion. 'int8' and "
+            "'fp8' keep it quantized with per-head scales, the fresh patch kv "
+            "stays in full precision.",
+        )
+        parallel_group.add_argument(
+            "--pipefusion_kv_cache_offload",
+            action="store_true",
+            help="Keep the stale kv cache of pipefusion in pinned host memory. "
+            "The cache of the next layer is prefetched on a side stream while "
+            "the current layer computes.",
+        )
         parallel_group.add_argument(
             "--tensor_parallel_degree",
             type=int,
@@ -328,7 +397,7 @@ class xFuserArgs:
         fast_attn_group.add_argument(
             "--use_fast_attn",
             action="store_true",
-            help="Use DiTFastAttn to accelerate single inference. Only data parallelism can be used with DITFastAttn.",
+            help="Use DiTFastAttn to accelerate single inference. Only data and sequence parallelism can be used with DITFastAttn.",
         )
         fast_attn_group.add_argument(
             "--n_calib",
@@ -336,6 +405,14 @@ class xFuserArgs:
             default=8,
             help="Number of prompts for compression method seletion.",
         )
+        fast_attn_group.add_argument(
+            "--n_calib_trials",
+            type=int,
+            default=1,
+            help="Number of compression methods a rank tries in one forward "
+            "during the selection, stacked along the batch. Higher values "
+            "select faster and take more memory.",
+        )
         fast_attn_group.add_argument(
             "--threshold",
             type=float,
@@ -359,6 +436,28 @@ class xFuserArgs:
             action="store_true",
             help="Use cache config for attention compression.",
         )
+        fast_attn_group.add_argument(
+            "--fast_attn_backend",
+            type=str,
+            default="auto",
+            choices=["auto", "flash", "flex", "sdpa"],
+            help="Attention kernels of DiTFastAttn. auto uses flash_attn if it is "
+            "installed, flex_attention on GPUs and SDPA otherwise.",
+        )
+        fast_attn_group.add_argument(
+            "--fast_attn_compact_cache",
+            action="store_true",
+            help="Cache the residuals and outputs of DiTFastAttn compactly: the CFG shared "
+            "half once, in --fast_attn_cache_dtype, and only as long as the plan reads them.",
+        )
+        fast_attn_group.add_argument(
+            "--fast_attn_cache_dtype",
+            type=str,
+            default=None,
+            choices=["float16", "bfloat16", "float8_e4m3fn"],
+            help="Dtype of the compact DiTFastAttn cache, the activation dtype by default. "
+            "float8 keeps a scale per token.",
+        )
 
         return parser
 
@@ -402,6 +501,22 @@ class xFuserArgs:
             use_fp8_t5_encoder=self.use_fp8_t5_encoder,
         )
 
+        input_config = InputConfig(
+            height=self.height,
+            width=self.width,
+            num_frames=self.num_frames,
+            use_resolution_binning=not self.no_use_resolution_binning,
+            batch_size=len(self.prompt) if isinstance(self.prompt, list) else 1,
+            img_file_path=self.img_file_path,
+            prompt=self.prompt,
+            negative_prompt=self.negative_prompt,
+            num_inference_steps=self.num_inference_steps,
+            max_sequence_length=self.max_sequence_length,
+            seed=self.seed,
+            output_type=self.output_type,
+            guidance_scale=self.guidance_scale,
+        )
+
         parallel_config = ParallelConfig(
             dp_config=DataParallelConfig(
                 dp_degree=self.data_parallel_degree,
@@ -423,6 +538,11 @@ class xFuserArgs:
                 num_pipeline_patch=self.num_pipeline_patch,
                 attn_layer_num_for_pp=self.attn_layer_num_for_pp,
                 dit_parallel_size=self.dit_parallel_size,
+                partition=self.pipefusion_partition,
+                partition_file=self.pipefusion_partition_file,
+                partition_input_config=input_config,
+                kv_cache_dtype=self.pipefusion_kv_cache_dtype,
+                kv_cache_offload=self.pipefusion_kv_cache_offload,
             ),
             world_size=self.world_size,
             dit_parallel_size=self.dit_parallel_size,
@@ -433,10 +553,14 @@ class xFuserArgs:
             use_fast_attn=self.use_fast_attn,
             n_step=self.num_inference_steps,
             n_calib=self.n_calib,
+            n_calib_trials=self.n_calib_trials,
             threshold=self.threshold,
             window_size=self.window_size,
             coco_path=self.coco_path,
             use_cache=self.use_cache,
+            backend=self.fast_attn_backend,
+            compact_cache=self.fast_attn_compact_cache,
+            cache_dtype=self.fast_attn_cache_dtype,
         )
 
         engine_config = EngineConfig(
@@ -446,20 +570,4 @@ class xFuserArgs:
             fast_attn_config=fast_attn_config,
         )
 
-        input_config = InputConfig(
-            height=self.height,
-            width=self.width,
-            num_frames=self.num_frames,
-            use_resolution_binning=not self.no_use_resolution_binning,
-            batch_size=len(self.prompt) if isinstance(self.prompt, list) else 1,
-            img_file_path=self.img_file_path,
-            prompt=self.prompt,
-            negative_prompt=self.negative_prompt,
-            num_inference_steps=self.num_inference_steps,
-            max_sequence_length=self.max_sequence_length,
-            seed=self.seed,
-            output_type=self.output_type,
-            guidance_scale=self.guidance_scale,
-        )
-
         return engine_config, input_config
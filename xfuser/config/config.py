@@ -74,13 +74,23 @@ class FastAttnConfig:
     use_fast_attn: bool = False
     n_step: int = 20
     n_calib: int = 8
+    n_calib_trials: int = 1
     threshold: float = 0.5
     window_size: int = 64
     coco_path: Optional[str] = None
     use_cache: bool = False
+    # attention kernels of the compression methods: auto, flash, flex or sdpa
+    backend: str = "auto"
+    # pack the cached residuals and outputs: the CFG shared half once, in
+    # cache_dtype if given, dropped once the plan no longer reads them
+    compact_cache: bool = False
+    cache_dtype: Optional[str] = None
 
     def __post_init__(self):
         assert self.n_calib > 0, "n_calib must be greater than 0"
+        assert self.n_calib_trials > 0, "n_calib_trials must be greater than 0"
+        assert self.backend in ["auto", "flash", "flex", "sdpa"], f"Unknown fast attention backend {self.backend}"
+        assert self.cache_dtype in [None, "float16", "bfloat16", "float8_e4m3fn"], f"Unknown fast attention cache dtype {self.cache_dtype}"
         assert self.threshold > 0.0, "threshold must be greater than 0"
 
 
@@ -153,6 +163,17 @@ class PipeFusionParallelConfig:
     num_pipeline_patch: Optional[int] = None
     attn_layer_num_for_pp: Optional[List[int]] = (None,)
     dit_parallel_size: int = 1
+    # how blocks are split into stages when attn_layer_num_for_pp is not set,
+    # "even" or "auto" (minimize the slowest stage, see xfuser.core.planner)
+    partition: str = "even"
+    partition_file: Optional[str] = None
+    # input the automatic partition is tuned for
+    partition_input_config: Optional["InputConfig"] = None
+    # storage of the stale kv cache, "auto" (model dtype), "int8" or "fp8"
+    kv_cache_dtype: str = "auto"
+    # keep the stale kv cache in host memory, prefetching the cache of the
+    # next layer while the current one computes
+    kv_cache_offload: bool = False
 
     def __post_init__(self):
         assert (
@@ -176,6 +197,20 @@ class PipeFusionParallelConfig:
                 "attn_layer_num_for_pp must have the same "
                 "length as pp_degree if not None"
             )
+        assert self.partition in [
+            "even",
+            "auto",
+        ], f"partition must be 'even' or 'auto', got {self.partition}"
+        assert self.kv_cache_dtype in [
+            "auto",
+            "int8",
+            "fp8",
+        ], f"kv_cache_dtype must be 'auto', 'int8' or 'fp8', got {self.kv_cache_dtype}"
+        if self.kv_cache_dtype == "fp8" and not hasattr(torch, "float8_e4m3fn"):
+            raise RuntimeError("fp8 kv cache requires torch 2.1 or later")
+        assert (
+            not self.kv_cache_offload or self.kv_cache_dtype == "auto"
+        ), "kv_cache_offload can not be combined with a quantized kv_cache_dtype"
         if self.pp_degree == 1 and self.num_pipeline_patch > 1:
             logger.warning(
                 f"Pipefusion degree is 1, pipeline will not be used,"
@@ -242,7 +277,10 @@ class EngineConfig:
 
     def __post_init__(self):
         if self.fast_attn_config.use_fast_attn:
-            assert self.parallel_config.dp_degree == self.parallel_config.dit_parallel_size, f"dit_parallel_size must be equal to dp_degree when using DiTFastAttn"
+            assert (
+                self.parallel_config.dp_degree * self.parallel_config.sp_degree
+                == self.parallel_config.dit_parallel_size
+            ), f"dit_parallel_size must be equal to dp_degree * sp_degree when using DiTFastAttn"
 
     def to_dict(self):
         """Return the configs as a dictionary, for use in **kwargs."""
@@ -1,5 +1,8 @@
-from .cache_manager import CacheManager
+from .cache_manager import CacheManager, KVCacheArena
+from .offload import KVCacheOffloader
 
 __all__ = [
     "CacheManager",
+    "KVCacheArena",
+    "KVCacheOffloader",
 ]
@@ -1,7 +1,15 @@
-from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from itertools import accumulate
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 import torch
 
 from xfuser.core.distributed.runtime_state import runtime_state_is_initialized
+from xfuser.core.distributed.shape_plan import get_plan_buffer, get_shape_plan_buffers
+from xfuser.core.cache_manager.kv_quant import (
+    dequantize_kv,
+    get_kv_storage_dtype,
+    quantize_kv,
+)
+from xfuser.core.cache_manager.offload import KVCacheOffloader
 from xfuser.logger import init_logger
 
 logger = init_logger(__name__)
@@ -13,8 +21,12 @@ class CacheEntry:
         cache_type: "str",
         num_cache_tensors: int = 1,
         tensors: Optional[Union[torch.Tensor, List[torch.Tensor]]] = None,
+        name: Optional[str] = None,
     ):
         self.cache_type: str = cache_type
+        self.name: Optional[str] = name
+        # scales of a quantized kv cache, one per pipeline patch
+        self.scales: List[torch.Tensor] = []
         if tensors is None:
             self.tensors: List[torch.Tensor] = [
                 None,
@@ -35,6 +47,80 @@ class CacheEntry:
             ]
 
 
+def calc_kv_gather_index(
+    pp_patches_token_num: Sequence[int],
+    ulysses_world_size: int,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """Token order of the sequence parallel kv cache.
+
+    After the ulysses all to all, the kv of a full step holds the local
+    sequence of every ulysses rank one after another, each made of the tokens
+    of all pipeline patches. The cache is ordered by pipeline patch instead,
+    which is how the kv of a patch step arrives, so that a patch step updates
+    one contiguous range. ``kv_cache = new_kv.index_select(dim, index)``.
+    """
+    num_tokens = sum(pp_patches_token_num)
+    patch_starts = accumulate(pp_patches_token_num, initial=0)
+    return torch.cat(
+        [
+            torch.arange(
+                rank * num_tokens + start,
+                rank * num_tokens + start + patch_token_num,
+                device=device,
+            )
+            for start, patch_token_num in zip(patch_starts, pp_patches_token_num)
+            for rank in range(ulysses_world_size)
+        ]
+    )
+
+
+class KVCacheArena:
+    """One contiguous buffer holding the kv cache of several layers.
+
+    Every layer owns a view of its cache shape at an aligned offset of the
+    buffer, so the cache of a model is a single allocation that can be kept
+    and reused as long as the input shape does not change.
+    """
+
+    alignment = 256  # bytes
+
+    def __init__(
+        self,
+        shapes: Dict[str, torch.Size],
+        dtype: torch.dtype,
+        device: torch.device,
+        pin_memory: bool = False,
+    ):
+        element_size = torch.empty((), dtype=dtype).element_size()
+        align = max(1, self.alignment // element_size)
+        self.offsets: Dict[str, Tuple[int, torch.Size]] = {}
+        numel = 0
+        for name, shape in shapes.items():
+            shape = torch.Size(shape)
+            self.offsets[name] = (numel, shape)
+            numel += (shape.numel() + align - 1) // align * align
+        self.buffer = torch.empty(
+            numel, dtype=dtype, device=device, pin_memory=pin_memory
+        )
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.offsets
+
+    def view(self, name: str) -> torch.Tensor:
+        offset, shape = self.offsets[name]
+        return self.buffer[offset : offset + shape.numel()].view(shape)
+
+    def nbytes(self) -> int:
+        return self.buffer.numel() * self.buffer.element_size()
+
+    def layer_nbytes(self) -> Dict[str, int]:
+        return {
+            name: shape.numel() * self.buffer.element_size()
+            for name, (_, shape) in self.offsets.items()
+        }
+
+
 class CacheManager:
     supported_layer = ["attn"]
     supported_cache_type = ["naive_cache", "sequence_parallel_attn_cache"]
@@ -43,6 +129,17 @@ class CacheManager:
         self,
     ):
         self.cache: Dict[Tuple[str, Any], CacheEntry] = {}
+        # kv caches of the current full (non-patch) step that have no arena
+        # yet, they are packed into one when the patch steps start
+        self._unpacked_entries: Dict[str, CacheEntry] = {}
+        # arenas of runs without a shape plan
+        self._arenas: Dict[Any, KVCacheArena] = {}
+        # kv gather index of the last token layout run without a shape plan
+        self._gather_index: Dict[Any, torch.Tensor] = {}
+        # entries in registration order, which is the order the layers of the
+        # stage run in, used to prefetch the offloaded kv cache
+        self._layer_order: List[CacheEntry] = []
+        self.offloader: Optional[KVCacheOffloader] = None
 
     def register_cache_entry(
         self, layer, layer_type: str, cache_type: str = "naive_cache"
@@ -55,11 +152,112 @@ class CacheManager:
             raise ValueError(
                 f"Cache type: {cache_type} is not supported. Supported cache type: {self.supported_cache_type}"
             )
-        if self.cache.get((layer_type, layer), None) is not None:
+        entry = self.cache.get((layer_type, layer), None)
+        if entry is not None:
             logger.warning(
                 f"Cache for [layer_type, layer]: [{layer_type}, {layer.__class__}] is already initialized, resetting the cache..."
             )
-        self.cache[layer_type, layer] = CacheEntry(cache_type)
+            name = entry.name
+        else:
+            name = f"{layer_type}.{sum(t == layer_type for t, _ in self.cache)}"
+        new_entry = CacheEntry(cache_type, name=name)
+        if entry is not None:
+            self._layer_order[self._layer_order.index(entry)] = new_entry
+        else:
+            self._layer_order.append(new_entry)
+        self.cache[layer_type, layer] = new_entry
+
+    def memory_report(self) -> Dict[str, int]:
+        """Bytes of the kv cache held for every registered layer."""
+        return {
+            entry.name: sum(
+                t.numel() * t.element_size()
+                for t in entry.tensors + entry.scales
+                if t is not None
+            )
+            for entry in self.cache.values()
+        }
+
+    def _get_arenas(self) -> Dict[Any, KVCacheArena]:
+        # without a shape plan, only the arenas packed last are kept
+        buffers = get_shape_plan_buffers()
+        return buffers.kv_cache_arenas if buffers is not None else self._arenas
+
+    def _get_gather_index(
+        self, ulysses_world_size: int, device: torch.device
+    ) -> torch.Tensor:
+        from xfuser.core.distributed.runtime_state import get_runtime_state
+
+        pp_patches_token_num = get_runtime_state().pp_patches_token_num
+        return get_plan_buffer(
+            "kv_cache_gather_index",
+            (tuple(pp_patches_token_num), ulysses_world_size, device),
+            lambda: calc_kv_gather_index(
+                pp_patches_token_num, ulysses_world_size, device
+            ),
+            fallback=self._gather_index,
+        )
+
+    def _arena_view(
+        self,
+        entry: CacheEntry,
+        shape: torch.Size,
+        dtype: torch.dtype,
+        device: torch.device,
+    ) -> Optional[torch.Tensor]:
+        arena = self._get_arenas().get((dtype, device), None)
+        if arena is None or entry.name not in arena:
+            return None
+        view = arena.view(entry.name)
+        return view if view.shape == shape else None
+
+    def _store_full_kv(self, entry: CacheEntry, kv: torch.Tensor) -> torch.Tensor:
+        """Keep the kv of a full (non-patch) step, in the arena of the current
+        shape if it has one."""
+        view = self._arena_view(entry, kv.shape, kv.dtype, kv.device)
+        if view is None:
+            entry.tensors[0] = kv
+            self._unpacked_entries[entry.name] = entry
+            return kv
+        if view.data_ptr() != kv.data_ptr():
+            view.copy_(kv)
+        entry.tensors[0] = view
+        return view
+
+    def _pack_arenas(self):
+        """Move the kv caches stored by the last full step into one arena per
+        dtype and device."""
+        if self.offloader is not None:
+            # offloaded caches are still being copied to the host
+            self.offloader.synchronize()
+        entries = [
+            entry
+            for entry in self._unpacked_entries.values()
+            if entry.tensors[0] is not None
+        ]
+        self._unpacked_entries = {}
+        groups: Dict[Tuple[torch.dtype, torch.device], List[CacheEntry]] = {}
+        for entry in entries:
+            kv = entry.tensors[0]
+            groups.setdefault((kv.dtype, kv.device), []).append(entry)
+        arenas = self._get_arenas()
+        for (dtype, device), group in groups.items():
+            arena = KVCacheArena(
+                {entry.name: entry.tensors[0].shape for entry in group},
+                dtype=dtype,
+                device=device,
+                # host arenas only exist for the offloaded cache
+                pin_memory=device.type == "cpu" and torch.cuda.is_available(),
+            )
+            for entry in group:
+                view = arena.view(entry.name)
+                view.copy_(entry.tensors[0])
+                entry.tensors[0] = view
+            arenas[dtype, device] = arena
+            logger.debug(
+                f"Packed the kv cache of {len(group)} layers into a "
+                f"{arena.nbytes() / 2**20:.2f} MiB arena"
+            )
 
     def update_and_get_kv_cache(
         self,
@@ -109,29 +307,45 @@ class CacheManager:
     ):
         from xfuser.core.distributed.runtime_state import get_runtime_state
 
+        entry = self.cache[layer_type, layer]
         if (
             not runtime_state_is_initialized()
             or get_runtime_state().num_pipeline_patch == 1
-            or not get_runtime_state().patch_mode
         ):
+            # nothing is stale without pipeline patches
             kv_cache = new_kv
-            self.cache[layer_type, layer].tensors[0] = kv_cache
+        elif not get_runtime_state().patch_mode:
+            if self._kv_cache_offload():
+                self._store_offloaded_full_kv(entry, new_kv)
+                kv_cache = new_kv
+            elif self._kv_cache_dtype() == "auto":
+                kv_cache = self._store_full_kv(entry, new_kv)
+            else:
+                self._store_quantized_full_kv(entry, new_kv, slice_dim)
+                kv_cache = new_kv
         else:
+            if self._unpacked_entries:
+                self._pack_arenas()
             start_token_idx = get_runtime_state().pp_patches_token_start_idx_local[
                 get_runtime_state().pipeline_patch_idx
             ]
             end_token_idx = get_runtime_state().pp_patches_token_start_idx_local[
                 get_runtime_state().pipeline_patch_idx + 1
             ]
-            kv_cache = self.cache[layer_type, layer].tensors[0]
-            kv_cache = self._update_kv_in_dim(
-                kv_cache=kv_cache,
-                new_kv=new_kv,
-                dim=slice_dim,
-                start_idx=start_token_idx,
-                end_idx=end_token_idx,
-            )
-            self.cache[layer_type, layer].tensors[0] = kv_cache
+            if self._kv_cache_offload():
+                kv_cache = self._update_offloaded_kv(
+                    entry, new_kv, slice_dim, start_token_idx, end_token_idx
+                )
+            elif self._kv_cache_dtype() == "auto":
+                kv_cache = self._update_kv_in_dim(
+                    kv_cache=entry.tensors[0],
+                    new_kv=new_kv,
+                    dim=slice_dim,
+                    start_idx=start_token_idx,
+                    end_idx=end_token_idx,
+                )
+            else:
+                kv_cache = self._update_quantized_kv(entry, new_kv, slice_dim)
         return kv_cache
 
     # work inside ring attn
@@ -153,22 +367,31 @@ class CacheManager:
             or get_runtime_state().num_pipeline_patch == 1
         ):
             return new_kv
-        elif not get_runtime_state().patch_mode:
-            pp_patches_token_num = get_runtime_state().pp_patches_token_num
-            kv_list = [
-                kv.split(pp_patches_token_num, dim=slice_dim)
-                for kv in torch.chunk(new_kv, ulysses_world_size, dim=slice_dim)
-            ]
-            kv_cache = torch.cat(
-                [
-                    kv_list[rank][pp_patch_idx]
-                    for rank in range(ulysses_world_size)
-                    for pp_patch_idx in range(len(pp_patches_token_num))
-                ],
-                dim=slice_dim,
+        entry = self.cache[layer_type, layer]
+        if not get_runtime_state().patch_mode:
+            offload = self._kv_cache_offload()
+            quantized = self._kv_cache_dtype() != "auto"
+            kv_cache = torch.index_select(
+                new_kv,
+                slice_dim,
+                self._get_gather_index(ulysses_world_size, new_kv.device),
+                out=(
+                    None
+                    if quantized or offload
+                    else self._arena_view(
+                        entry, new_kv.shape, new_kv.dtype, new_kv.device
+                    )
+                ),
             )
-            self.cache[layer_type, layer].tensors[0] = kv_cache
+            if offload:
+                self._store_offloaded_full_kv(entry, kv_cache)
+            elif quantized:
+                self._store_quantized_full_kv(entry, kv_cache, slice_dim)
+            else:
+                kv_cache = self._store_full_kv(entry, kv_cache)
         else:
+            if self._unpacked_entries:
+                self._pack_arenas()
             pp_patches_token_start_idx_local = (
                 get_runtime_state().pp_patches_token_start_idx_local
             )
@@ -182,15 +405,154 @@ class CacheManager:
             # pp_patches_token_num = get_runtime_state().pp_patches_token_num
             # start_token_idx = ulysses_world_size * sum(pp_patches_token_num[:get_runtime_state().pipeline_patch_idx])
             # end_token_idx = ulysses_world_size * sum(pp_patches_token_num[:get_runtime_state().pipeline_patch_idx + 1])
-            kv_cache = self.cache[layer_type, layer].tensors[0]
-            kv_cache = self._update_kv_in_dim(
-                kv_cache=kv_cache,
-                new_kv=new_kv,
-                dim=slice_dim,
-                start_idx=start_token_idx,
-                end_idx=end_token_idx,
+            if self._kv_cache_offload():
+                kv_cache = self._update_offloaded_kv(
+                    entry, new_kv, slice_dim, start_token_idx, end_token_idx
+                )
+            elif self._kv_cache_dtype() == "auto":
+                kv_cache = self._update_kv_in_dim(
+                    kv_cache=entry.tensors[0],
+                    new_kv=new_kv,
+                    dim=slice_dim,
+                    start_idx=start_token_idx,
+                    end_idx=end_token_idx,
+                )
+            else:
+                kv_cache = self._update_quantized_kv(entry, new_kv, slice_dim)
+        return kv_cache
+
+    def _kv_cache_dtype(self) -> str:
+        from xfuser.core.distributed.runtime_state import get_runtime_state
+
+        return get_runtime_state().parallel_config.pp_config.kv_cache_dtype
+
+    def _kv_cache_offload(self) -> bool:
+        from xfuser.core.distributed.runtime_state import get_runtime_state
+
+        return get_runtime_state().parallel_config.pp_config.kv_cache_offload
+
+    def _get_offloader(self, device: torch.device) -> KVCacheOffloader:
+        if self.offloader is None or self.offloader.device != device:
+            self.offloader = KVCacheOffloader(device)
+        return self.offloader
+
+    def _store_offloaded_full_kv(self, entry: CacheEntry, kv: torch.Tensor):
+        """Copy the kv of a full step to host memory, the device kv is only
+        used by the attention of this step."""
+        offloader = self._get_offloader(kv.device)
+        # a prefetch issued by the last patch of the previous step is stale
+        offloader.prefetched.pop(entry.name, None)
+        host = self._arena_view(entry, kv.shape, kv.dtype, torch.device("cpu"))
+        if host is None:
+            host = offloader.empty_host(kv.shape, kv.dtype)
+        offloader.offload(kv, host)
+        self._store_full_kv(entry, host)
+
+    def _update_offloaded_kv(
+        self,
+        entry: CacheEntry,
+        new_kv: torch.Tensor,
+        slice_dim: int,
+        start_idx: int,
+        end_idx: int,
+    ) -> torch.Tensor:
+        """Bring the host kv cache of a layer to the device, update the tokens
+        of the current patch and write them back to the host. The cache of
+        the next layer is prefetched meanwhile."""
+        offloader = self._get_offloader(new_kv.device)
+        host = entry.tensors[0]
+        kv_cache = offloader.fetch(entry.name, host)
+        kv_cache = self._update_kv_in_dim(
+            kv_cache=kv_cache,
+            new_kv=new_kv,
+            dim=slice_dim,
+            start_idx=start_idx,
+            end_idx=end_idx,
+        )
+        offloader.write_back(kv_cache, host, slice_dim, start_idx, end_idx)
+        next_entry = self._next_cached_entry(entry)
+        if next_entry is not None:
+            offloader.prefetch(next_entry.name, next_entry.tensors[0])
+        return kv_cache
+
+    def _next_cached_entry(self, entry: CacheEntry) -> Optional[CacheEntry]:
+        """The entry with a cache that runs after ``entry``, the first layer
+        of the stage follows the last one since it runs with the next patch."""
+        idx = self._layer_order.index(entry)
+        num_layers = len(self._layer_order)
+        for i in range(1, num_layers + 1):
+            next_entry = self._layer_order[(idx + i) % num_layers]
+            if next_entry.tensors[0] is not None:
+                return next_entry
+        return None
+
+    def _patch_token_bounds(self, entry: CacheEntry) -> List[int]:
+        """Token ranges of the cache written by every pipeline patch."""
+        from xfuser.core.distributed import (
+            get_ulysses_parallel_world_size,
+            get_runtime_state,
+        )
+
+        bounds = get_runtime_state().pp_patches_token_start_idx_local
+        if entry.cache_type == "sequence_parallel_attn_cache":
+            ulysses_world_size = get_ulysses_parallel_world_size()
+            return [ulysses_world_size * idx for idx in bounds]
+        return list(bounds)
+
+    def _store_quantized_full_kv(
+        self, entry: CacheEntry, kv: torch.Tensor, slice_dim: int
+    ):
+        """Quantize the kv of a full step into the cache, with separate scales
+        for the tokens of every pipeline patch so that a patch can be
+        requantized on its own."""
+        kv_cache_dtype = self._kv_cache_dtype()
+        storage_dtype = get_kv_storage_dtype(kv_cache_dtype)
+        data = self._arena_view(entry, kv.shape, storage_dtype, kv.device)
+        if data is None:
+            data = torch.empty(kv.shape, dtype=storage_dtype, device=kv.device)
+        bounds = self._patch_token_bounds(entry)
+        entry.scales = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            q, scale = quantize_kv(
+                kv.narrow(slice_dim, start, end - start), slice_dim, kv_cache_dtype
             )
-            self.cache[layer_type, layer].tensors[0] = kv_cache
+            data.narrow(slice_dim, start, end - start).copy_(q)
+            entry.scales.append(scale)
+        self._store_full_kv(entry, data)
+
+    def _update_quantized_kv(
+        self, entry: CacheEntry, new_kv: torch.Tensor, slice_dim: int
+    ) -> torch.Tensor:
+        """Requantize the kv of the current patch and return the attention
+        input: the fresh patch kv as is and the stale kv of the other patches
+        dequantized next to it."""
+        from xfuser.core.distributed.runtime_state import get_runtime_state
+
+        pp_patch_idx = get_runtime_state().pipeline_patch_idx
+        bounds = self._patch_token_bounds(entry)
+        data = entry.tensors[0]
+        q, entry.scales[pp_patch_idx] = quantize_kv(
+            new_kv, slice_dim, self._kv_cache_dtype()
+        )
+        self._update_kv_in_dim(
+            kv_cache=data,
+            new_kv=q,
+            dim=slice_dim,
+            start_idx=bounds[pp_patch_idx],
+            end_idx=bounds[pp_patch_idx + 1],
+        )
+        kv_cache = torch.empty(data.shape, dtype=new_kv.dtype, device=new_kv.device)
+        for idx, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            out = kv_cache.narrow(slice_dim, start, end - start)
+            if idx == pp_patch_idx:
+                out.copy_(new_kv)
+            else:
+                dequantize_kv(
+                    data.narrow(slice_dim, start, end - start),
+                    entry.scales[idx],
+                    new_kv.dtype,
+                    out=out,
+                )
         return kv_cache
 
     def _update_kv_in_dim(
@@ -0,0 +1,55 @@
+from typing import Optional, Tuple
+
+import torch
+
+# largest value of each storage type that scales are computed for
+_QUANT_MAX = {"int8": 127.0, "fp8": 448.0}
+
+
+def get_kv_storage_dtype(kv_cache_dtype: str) -> torch.dtype:
+    if kv_cache_dtype == "int8":
+        return torch.int8
+    if kv_cache_dtype == "fp8":
+        return torch.float8_e4m3fn
+    raise ValueError(f"kv cache dtype {kv_cache_dtype} is not quantized")
+
+
+def quantize_kv(
+    kv: torch.Tensor,
+    token_dim: int,
+    kv_cache_dtype: str,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Quantize a kv tensor whose last dim is K and V concatenated.
+
+    K and V get separate symmetric scales for every index of the dims other
+    than ``token_dim`` and the last one, i.e. one scale per head when the kv
+    has a head dim and one per sample otherwise.
+
+    Returns:
+        the quantized tensor and the float32 scales, which broadcast against
+        ``kv.unflatten(-1, (2, -1))``.
+    """
+    x = kv.unflatten(-1, (2, -1)).float()
+    scale = x.abs().amax(dim=(token_dim, -1), keepdim=True)
+    scale = scale.clamp_(min=1e-8) / _QUANT_MAX[kv_cache_dtype]
+    x = x / scale
+    if kv_cache_dtype == "int8":
+        x = x.round_().clamp_(-127, 127)
+    return x.to(get_kv_storage_dtype(kv_cache_dtype)).flatten(-2), scale
+
+
+def dequantize_kv(
+    q: torch.Tensor,
+    scale: torch.Tensor,
+    dtype: torch.dtype,
+    out: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """Inverse of :func:`quantize_kv`, written into ``out`` if given."""
+    if out is None:
+        out = torch.empty(q.shape, dtype=dtype, device=q.device)
+    torch.mul(
+        q.unflatten(-1, (2, -1)).to(dtype),
+        scale.to(dtype),
+        out=out.unflatten(-1, (2, -1)),
+    )
+    return out
@@ -0,0 +1,110 @@
+from typing import Dict, Optional, Tuple
+
+import torch
+
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+
+class KVCacheOffloader:
+    """Moves stale kv caches between host memory and the device.
+
+    Copies run on a side stream: the cache of the next layer is prefetched
+    while the current one computes, and the patch a layer updated is written
+    back to the host without blocking the compute stream.
+
+    On devices without streams (e.g. cpu) the offloader simulates the device:
+    every copy is synchronous and "device" tensors are separate copies of the
+    host tensors, so the data flow can be tested without a GPU.
+    """
+
+    def __init__(self, device: torch.device):
+        self.device = torch.device(device)
+        self.simulated = self.device.type != "cuda"
+        self.copy_stream = (
+            None if self.simulated else torch.cuda.Stream(device=self.device)
+        )
+        # name -> (device tensor, event the copy records)
+        self.prefetched: Dict[str, Tuple[torch.Tensor, Optional[torch.cuda.Event]]] = {}
+        self.stats = {
+            "h2d_bytes": 0,
+            "d2h_bytes": 0,
+            "prefetch_hits": 0,
+            "prefetch_misses": 0,
+        }
+
+    def empty_host(self, shape: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+        return torch.empty(shape, dtype=dtype, pin_memory=not self.simulated)
+
+    def offload(self, kv: torch.Tensor, host: torch.Tensor):
+        """Copy the whole kv of a full step to ``host``."""
+        self._copy(host, kv)
+        self.stats["d2h_bytes"] += kv.numel() * kv.element_size()
+
+    def prefetch(self, name: str, host: torch.Tensor):
+        if name in self.prefetched:
+            return
+        self.prefetched[name] = self._to_device(host)
+
+    def fetch(self, name: str, host: torch.Tensor) -> torch.Tensor:
+        """Device copy of ``host``, prefetched if possible, that is ready to
+        be used on the current stream."""
+        if name in self.prefetched:
+            self.stats["prefetch_hits"] += 1
+            kv, event = self.prefetched.pop(name)
+        else:
+            self.stats["prefetch_misses"] += 1
+            kv, event = self._to_device(host)
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+        return kv
+
+    def write_back(
+        self,
+        kv: torch.Tensor,
+        host: torch.Tensor,
+        dim: int,
+        start_idx: int,
+        end_idx: int,
+    ):
+        """Copy the tokens ``[start_idx, end_idx)`` of ``kv`` along ``dim``
+        back to ``host``."""
+        src = kv.narrow(dim, start_idx, end_idx - start_idx)
+        self._copy(host.narrow(dim, start_idx, end_idx - start_idx), src)
+        self.stats["d2h_bytes"] += src.numel() * src.element_size()
+
+    def synchronize(self):
+        if self.copy_stream is not None:
+            self.copy_stream.synchronize()
+
+    def reset(self):
+        self.synchronize()
+        self.prefetched.clear()
+
+    def _to_device(
+        self, host: torch.Tensor
+    ) -> Tuple[torch.Tensor, Optional[torch.cuda.Event]]:
+        self.stats["h2d_bytes"] += host.numel() * host.element_size()
+        if self.simulated:
+            return host.clone(), None
+        # allocated on the compute stream, which is the one that uses it
+        kv = torch.empty(host.shape, dtype=host.dtype, device=self.device)
+        kv.record_stream(self.copy_stream)
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.copy_stream):
+            kv.copy_(host, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.copy_stream)
+        return kv, event
+
+    def _copy(self, dst: torch.Tensor, src: torch.Tensor):
+        if self.simulated:
+            dst.copy_(src)
+            return
+        # the copy must see src as computed, and src must stay alive until
+        # the copy is done
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        src.record_stream(self.copy_stream)
+        with torch.cuda.stream(self.copy_stream):
+            dst.copy_(src, non_blocking=True)
@@ -4,6 +4,7 @@ from .parallel_state import (
     get_cfg_group,
     get_sp_group,
     get_pp_group,
+    get_stage_group,
     get_pipeline_parallel_world_size,
     get_pipeline_parallel_rank,
     is_pipeline_first_stage,
@@ -43,6 +44,7 @@ __all__ = [
     "get_cfg_group",
     "get_sp_group",
     "get_pp_group",
+    "get_stage_group",
     "get_pipeline_parallel_world_size",
     "get_pipeline_parallel_rank",
     "is_pipeline_first_stage",
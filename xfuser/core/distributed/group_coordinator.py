@@ -4,7 +4,9 @@
 # Copyright 2023 The vLLM team.
 # Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
 from collections import namedtuple
+from contextlib import contextmanager
 from typing import Any, Dict, List, Optional, Tuple, Union
+import os
 import pickle
 
 import torch
@@ -63,6 +65,26 @@ def _split_tensor_dict(
     return metadata_list, tensor_list
 
 
+@contextmanager
+def _lazy_connection(enabled: bool = True):
+    """Defer connection setup of the process groups created in this context
+    to their first communication.
+
+    `torch.distributed.new_group` must still be called by every rank in the
+    same order, but the NCCL communicator is only built on the first
+    collective, and gloo does the same with `TORCH_GLOO_LAZY_INIT`. Groups
+    that are never used in a given config never connect.
+    """
+    if not enabled or "TORCH_GLOO_LAZY_INIT" in os.environ:
+        yield
+        return
+    os.environ["TORCH_GLOO_LAZY_INIT"] = "1"
+    try:
+        yield
+    finally:
+        del os.environ["TORCH_GLOO_LAZY_INIT"]
+
+
 def _update_nested_dict(nested_dict, flattened_key, value):
     key_splits = flattened_key.split("%")
     cur_dict = nested_dict
@@ -105,6 +127,7 @@ class GroupCoordinator:
         group_ranks: List[List[int]],
         local_rank: int,
         torch_distributed_backend: Union[str, Backend],
+        eager_init: bool = False,
     ):
 
         self.rank = torch.distributed.get_rank()
@@ -112,19 +135,20 @@ class GroupCoordinator:
         self.device_group = None
         self.cpu_group = None
 
-        for ranks in group_ranks:
-            device_group = torch.distributed.new_group(
-                ranks, backend=torch_distributed_backend
-            )
-            # a group with `gloo` backend, to allow direct coordination between
-            # processes through the CPU.
-            cpu_group = torch.distributed.new_group(ranks, backend="gloo")
-            if self.rank in ranks:
-                self.ranks = ranks
-                self.world_size = len(ranks)
-                self.rank_in_group = ranks.index(self.rank)
-                self.device_group = device_group
-                self.cpu_group = cpu_group
+        with _lazy_connection(not eager_init):
+            for ranks in group_ranks:
+                device_group = torch.distributed.new_group(
+                    ranks, backend=torch_distributed_backend
+                )
+                # a group with `gloo` backend, to allow direct coordination between
+                # processes through the CPU.
+                cpu_group = torch.distributed.new_group(ranks, backend="gloo")
+                if self.rank in ranks:
+                    self.ranks = ranks
+                    self.world_size = len(ranks)
+                    self.rank_in_group = ranks.index(self.rank)
+                    self.device_group = device_group
+                    self.cpu_group = cpu_group
 
         assert self.cpu_group is not None
         assert self.device_group is not None
@@ -608,6 +632,15 @@ class GroupCoordinator:
         )
         return tensor
 
+    def warmup(self):
+        """Connect the groups of this rank now instead of on first use."""
+        if self.world_size == 1:
+            return
+        torch.distributed.barrier(group=self.cpu_group)
+        torch.distributed.all_reduce(
+            torch.zeros(1, device=self.device), group=self.device_group
+        )
+
     def destroy(self):
         if self.device_group is not None:
             torch.distributed.destroy_process_group(self.device_group)
@@ -641,6 +674,38 @@ class PipelineGroupCoordinator(GroupCoordinator):
         group_ranks: List[List[int]],
         local_rank: int,
         torch_distributed_backend: Union[str, Backend],
+        eager_init: bool = False,
+    ):
+        with _lazy_connection(not eager_init):
+            self._init_groups(group_ranks, local_rank, torch_distributed_backend)
+
+        if torch.cuda.is_available():
+            self.device = torch.device(f"cuda:{local_rank}")
+        else:
+            self.device = torch.device("cpu")
+
+        self.recv_buffer_set: bool = False
+        self.recv_tasks_queue: List[Tuple[str, int]] = []
+        self.receiving_tasks: List[Tuple[torch.distributed.Work, str, int]] = []
+        self.dtype: Optional[torch.dtype] = None
+        self.num_pipefusion_patches: Optional[int] = None
+
+        self.recv_shape: Dict[str, Dict[int, torch.Size]] = {}
+        self.send_shape: Dict[str, Dict[int, torch.Size]] = {}
+        self.recv_buffer: Dict[str, Dict[int, torch.Size]] = {}
+
+        self.skip_tensor_recv_buffer_set: bool = False
+        self.recv_skip_tasks_queue: List[Union[int, Tuple[str, int]]] = []
+        self.receiving_skip_tasks: List[Tuple[torch.distributed.Work, str, int]] = []
+        self.skip_tensor_recv_buffer: Optional[
+            Union[List[torch.Tensor], torch.Tensor]
+        ] = None
+
+    def _init_groups(
+        self,
+        group_ranks: List[List[int]],
+        local_rank: int,
+        torch_distributed_backend: Union[str, Backend],
     ):
         self.rank = torch.distributed.get_rank()
         self.local_rank = local_rank
@@ -692,27 +757,6 @@ class PipelineGroupCoordinator(GroupCoordinator):
         assert self.cpu_group is not None
         assert self.device_group is not None
 
-        if torch.cuda.is_available():
-            self.device = torch.device(f"cuda:{local_rank}")
-        else:
-            self.device = torch.device("cpu")
-
-        self.recv_buffer_set: bool = False
-        self.recv_tasks_queue: List[Tuple[str, int]] = []
-        self.receiving_tasks: List[Tuple[torch.distributed.Work, str, int]] = []
-        self.dtype: Optional[torch.dtype] = None
-        self.num_pipefusion_patches: Optional[int] = None
-
-        self.recv_shape: Dict[str, Dict[int, torch.Size]] = {}
-        self.send_shape: Dict[str, Dict[int, torch.Size]] = {}
-        self.recv_buffer: Dict[str, Dict[int, torch.Size]] = {}
-
-        self.skip_tensor_recv_buffer_set: bool = False
-        self.recv_skip_tasks_queue: List[Union[int, Tuple[str, int]]] = []
-        self.receiving_skip_tasks: List[Tuple[torch.distributed.Work, str, int]] = []
-        self.skip_tensor_recv_buffer: Optional[
-            Union[List[torch.Tensor], torch.Tensor]
-        ] = None
         self.skip_device_group = None
         for ranks in group_ranks:
             skip_device_group = torch.distributed.new_group(
@@ -722,12 +766,60 @@ class PipelineGroupCoordinator(GroupCoordinator):
                 self.skip_device_group = skip_device_group
         assert self.skip_device_group is not None
 
-    def reset_buffer(self):
+    def warmup(self):
+        """Connect the pipeline groups of this rank now instead of on first
+        use. Point-to-point communicators are separate from the collective
+        ones, so both directions of the pipeline and the skip connection are
+        exercised."""
+        super().warmup()
+        if self.world_size == 1:
+            return
+        send_buf = torch.zeros(1, device=self.device)
+        recv_buf = torch.empty(1, device=self.device)
+        # connecting a pair blocks until both sides join, so alternate the
+        # order along the pipeline to avoid a cycle of waiting ranks
+        if self.rank_in_group % 2 == 0:
+            self._pipeline_isend(send_buf).wait()
+            self._pipeline_irecv(recv_buf).wait()
+        else:
+            self._pipeline_irecv(recv_buf).wait()
+            self._pipeline_isend(send_buf).wait()
+        # the middle stage of an odd pipeline has no skip connection
+        if self.skip_rank == self.rank:
+            return
+        ops = [
+            torch.distributed.P2POp(
+                torch.distributed.isend,
+                send_buf,
+                self.skip_rank,
+                self.skip_device_group,
+            ),
+            torch.distributed.P2POp(
+                torch.distributed.irecv,
+                recv_buf,
+                self.skip_rank,
+                self.skip_device_group,
+            ),
+        ]
+        for work in torch.distributed.batch_isend_irecv(ops):
+            work.wait()
+
+    def reset_buffer(self, buffers: Optional[Any] = None):
+        """Drop pending receive tasks and switch to the buffers of a new input
+        shape. ``buffers`` is the ``ShapePlanBuffers`` of the shape: buffers
+        created for it are kept there, so switching back to a shape seen
+        before neither reallocates them nor communicates their shapes again.
+        """
         self.recv_tasks_queue = []
         self.receiving_tasks = []
-        self.recv_shape = {}
-        self.send_shape = {}
-        self.recv_buffer = {}
+        if buffers is not None:
+            self.recv_shape = buffers.recv_shape
+            self.send_shape = buffers.send_shape
+            self.recv_buffer = buffers.recv_buffer
+        else:
+            self.recv_shape = {}
+            self.send_shape = {}
+            self.recv_buffer = {}
 
         self.recv_skip_tasks_queue = []
         self.receiving_skip_tasks = []
@@ -1049,12 +1141,14 @@ class SequenceParallelGroupCoordinator(GroupCoordinator):
         group_ranks: List[List[int]],
         local_rank: int,
         torch_distributed_backend: Union[str, Backend],
+        eager_init: bool = False,
         **kwargs,
     ):
         super().__init__(
             group_ranks=group_ranks,
             local_rank=local_rank,
             torch_distributed_backend=torch_distributed_backend,
+            eager_init=eager_init,
         )
         if HAS_LONG_CTX_ATTN:
             ulysses_group = kwargs.get("ulysses_group", None)
@@ -3,6 +3,7 @@
 # https://github.com/vllm-project/vllm/blob/main/vllm/distributed/parallel_state.py
 # Copyright 2023 The vLLM team.
 # Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+import time
 from typing import List, Optional
 
 import torch
@@ -13,6 +14,7 @@ from .group_coordinator import (
     GroupCoordinator,
     PipelineGroupCoordinator,
     SequenceParallelGroupCoordinator,
+    _lazy_connection,
 )
 from .utils import RankGenerator
 
@@ -29,6 +31,7 @@ _SP: Optional[SequenceParallelGroupCoordinator] = None
 _PP: Optional[PipelineGroupCoordinator] = None
 _CFG: Optional[GroupCoordinator] = None
 _DP: Optional[GroupCoordinator] = None
+_STAGE: Optional[GroupCoordinator] = None
 _DIT: Optional[GroupCoordinator] = None
 _VAE: Optional[GroupCoordinator] = None
 
@@ -132,6 +135,13 @@ def get_classifier_free_guidance_rank():
 
 
 # DP
+def get_stage_group() -> GroupCoordinator:
+    """Ranks that run the same pipeline stage of the same data parallel
+    replica, i.e. the tensor, sequence and cfg parallel ranks together."""
+    assert _STAGE is not None, "stage group is not initialized"
+    return _STAGE
+
+
 def get_dp_group() -> GroupCoordinator:
     assert _DP is not None, "pipeline model parallel group is not initialized"
     return _DP
@@ -194,6 +204,7 @@ def init_world_group(
         group_ranks=[ranks],
         local_rank=local_rank,
         torch_distributed_backend=backend,
+        eager_init=envs.XDIT_EAGER_PROCESS_GROUPS,
     )
 
 
@@ -224,7 +235,10 @@ def init_distributed_environment(
             world_size=world_size,
             rank=rank,
         )
-        torch.cuda.set_device(torch.distributed.get_rank() % torch.cuda.device_count())
+        if torch.cuda.is_available():
+            torch.cuda.set_device(
+                torch.distributed.get_rank() % torch.cuda.device_count()
+            )
     # set the local rank
     # local_rank is not available in torch ProcessGroup,
     # see https://github.com/pytorch/pytorch/issues/122816
@@ -261,6 +275,7 @@ def init_model_parallel_group(
     local_rank: int,
     backend: str,
     parallel_mode: str,
+    eager_init: bool = False,
     **kwargs,
 ) -> GroupCoordinator:
     assert parallel_mode in [
@@ -269,18 +284,21 @@ def init_model_parallel_group(
         "tensor",
         "sequence",
         "classifier_free_guidance",
+        "stage",
     ], f"parallel_mode {parallel_mode} is not supported"
     if parallel_mode == "pipeline":
         return PipelineGroupCoordinator(
             group_ranks=group_ranks,
             local_rank=local_rank,
             torch_distributed_backend=backend,
+            eager_init=eager_init,
         )
     elif parallel_mode == "sequence":
         return SequenceParallelGroupCoordinator(
             group_ranks=group_ranks,
             local_rank=local_rank,
             torch_distributed_backend=backend,
+            eager_init=eager_init,
             **kwargs,
         )
     else:
@@ -288,6 +306,7 @@ def init_model_parallel_group(
             group_ranks=group_ranks,
             local_rank=local_rank,
             torch_distributed_backend=backend,
+            eager_init=eager_init,
         )
 
 
@@ -296,9 +315,10 @@ def init_dit_group(
     backend: str,
 ):
     global _DIT
-    _DIT = torch.distributed.new_group(
-        ranks=list(range(dit_parallel_size)), backend=backend
-    )
+    with _lazy_connection(not envs.XDIT_EAGER_PROCESS_GROUPS):
+        _DIT = torch.distributed.new_group(
+            ranks=list(range(dit_parallel_size)), backend=backend
+        )
 
 
 def get_dit_group():
@@ -315,7 +335,8 @@ def init_vae_group(
     global _VAE
     assert _VAE is None, "VAE parallel group is already initialized"
     vae_ranks = list(range(dit_parallel_size, dit_parallel_size + vae_parallel_size))
-    _VAE = torch.distributed.new_group(ranks=vae_ranks, backend=backend)
+    with _lazy_connection(not envs.XDIT_EAGER_PROCESS_GROUPS):
+        _VAE = torch.distributed.new_group(ranks=vae_ranks, backend=backend)
 
 
 def initialize_model_parallel(
@@ -328,6 +349,7 @@ def initialize_model_parallel(
     pipeline_parallel_degree: int = 1,
     vae_parallel_size: int = 0,
     backend: Optional[str] = None,
+    eager_init: Optional[bool] = None,
 ) -> None:
     """
     Initialize model parallel groups.
@@ -341,6 +363,9 @@ def initialize_model_parallel(
         tensor_parallel_degree: number of GPUs used for tensor parallelism.
         pipeline_parallel_degree: number of GPUs used for pipeline parallelism.
         backend: distributed backend of pytorch collective comm.
+        eager_init: connect every group during initialization instead of on
+            its first communication. Defaults to the
+            XDIT_EAGER_PROCESS_GROUPS environment variable.
 
     Let's say we have a total of 16 GPUs denoted by g0 ... g15 and we
     use 2 groups to parallelize the batch dim(dp), 2 groups to parallelize
@@ -403,6 +428,10 @@ def initialize_model_parallel(
             f"data_parallel_degree ({data_parallel_degree})"
         )
 
+    if eager_init is None:
+        eager_init = envs.XDIT_EAGER_PROCESS_GROUPS
+    init_start_time = time.perf_counter()
+
     rank_generator: RankGenerator = RankGenerator(
         tensor_parallel_degree,
         sequence_parallel_degree,
@@ -418,6 +447,7 @@ def initialize_model_parallel(
         local_rank=get_world_group().local_rank,
         backend=backend,
         parallel_mode="data",
+        eager_init=eager_init,
     )
 
     global _CFG
@@ -427,6 +457,7 @@ def initialize_model_parallel(
         local_rank=get_world_group().local_rank,
         backend=backend,
         parallel_mode="classifier_free_guidance",
+        eager_init=eager_init,
     )
     global _PP
     assert _PP is None, "pipeline model parallel group is already initialized"
@@ -435,6 +466,7 @@ def initialize_model_parallel(
         local_rank=get_world_group().local_rank,
         backend=backend,
         parallel_mode="pipeline",
+        eager_init=eager_init,
     )
 
     global _SP
@@ -457,6 +489,7 @@ def initialize_model_parallel(
             local_rank=get_world_group().local_rank,
             backend=backend,
             parallel_mode="sequence",
+            eager_init=eager_init,
             ulysses_group=PROCESS_GROUP.ULYSSES_PG,
             ring_group=PROCESS_GROUP.RING_PG,
         )
@@ -466,6 +499,7 @@ def initialize_model_parallel(
             local_rank=get_world_group().local_rank,
             backend=backend,
             parallel_mode="sequence",
+            eager_init=eager_init,
         )
 
     global _TP
@@ -475,11 +509,35 @@ def initialize_model_parallel(
         local_rank=get_world_group().local_rank,
         backend=backend,
         parallel_mode="tensor",
+        eager_init=eager_init,
+    )
+
+    global _STAGE
+    assert _STAGE is None, "stage group is already initialized"
+    _STAGE = init_model_parallel_group(
+        group_ranks=rank_generator.get_ranks("tp-sp-cfg"),
+        local_rank=get_world_group().local_rank,
+        backend=backend,
+        parallel_mode="stage",
+        eager_init=eager_init,
     )
 
     if vae_parallel_size > 0:
         init_vae_group(dit_parallel_size, vae_parallel_size, backend)
     init_dit_group(dit_parallel_size, backend)
+    create_time = time.perf_counter() - init_start_time
+
+    warmup_time = 0.0
+    if eager_init:
+        warmup_start_time = time.perf_counter()
+        for group in [_DP, _CFG, _PP, _SP, _TP, _STAGE]:
+            group.warmup()
+        warmup_time = time.perf_counter() - warmup_start_time
+    logger.info(
+        f"Model parallel groups initialized in {create_time + warmup_time:.3f}s "
+        f"(create {create_time:.3f}s, warmup {warmup_time:.3f}s, "
+        f"{'eager' if eager_init else 'lazy'} connection)"
+    )
 
 
 def destroy_model_parallel():
@@ -509,6 +567,11 @@ def destroy_model_parallel():
         _PP.destroy()
     _PP = None
 
+    global _STAGE
+    if _STAGE:
+        _STAGE.destroy()
+    _STAGE = None
+
     global _VAE
     if _VAE:
         _VAE.destroy()
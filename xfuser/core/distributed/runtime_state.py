@@ -1,6 +1,6 @@
 from abc import ABCMeta
 import random
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import numpy as np
 import torch
@@ -14,6 +14,7 @@ from xfuser.config.config import (
     InputConfig,
     EngineConfig,
 )
+import xfuser.envs as envs
 from xfuser.logger import init_logger
 from .parallel_state import (
     destroy_distributed_environment,
@@ -25,6 +26,13 @@ from .parallel_state import (
     initialize_model_parallel,
     model_parallel_is_initialized,
 )
+from .shape_plan import (
+    ShapePlan,
+    ShapePlanCache,
+    calc_shape_plan,
+    head_padding_waste,
+    padded_num_heads,
+)
 
 logger = init_logger(__name__)
 
@@ -99,19 +107,39 @@ class DiTRuntimeState(RuntimeState):
     vae_scale_factor_spatial: int
     vae_scale_factor_temporal: int
     backbone_patch_size: int
-    pp_patches_height: Optional[List[int]]
-    pp_patches_start_idx_local: Optional[List[int]]
-    pp_patches_start_end_idx_global: Optional[List[List[int]]]
-    pp_patches_token_start_idx_local: Optional[List[int]]
-    pp_patches_token_start_end_idx_global: Optional[List[List[int]]]
-    pp_patches_token_num: Optional[List[int]]
-    max_condition_sequence_length: int
+    shape_plan: Optional[ShapePlan]
+    shape_plan_cache: ShapePlanCache
+    pp_patches_height: Optional[Tuple[int, ...]]
+    pp_patches_start_idx_local: Optional[Tuple[int, ...]]
+    pp_patches_start_end_idx_global: Optional[Tuple[Tuple[int, int], ...]]
+    pp_patches_token_start_idx_local: Optional[Tuple[int, ...]]
+    pp_patches_token_start_end_idx_global: Optional[Tuple[Tuple[int, int], ...]]
+    pp_patches_token_num: Optional[Tuple[int, ...]]
+    num_pad_rows: int
+    sp_pad_token_num: Tuple[int, ...]
+    sp_key_padding: Optional[Tuple[Tuple[int, ...], ...]]
+    max_condition_sequence_length: Optional[int]
+    text_sequence_length: Optional[int]
+    use_cfg: Optional[bool]
     split_text_embed_in_sp: bool
 
     def __init__(self, pipeline: DiffusionPipeline, config: EngineConfig):
         super().__init__(config)
         self.patch_mode = False
         self.pipeline_patch_idx = 0
+        self.shape_plan = None
+        self.shape_plan_cache = ShapePlanCache(envs.XDIT_SHAPE_PLAN_CACHE_SIZE)
+        self.num_pad_rows = 0
+        self.sp_pad_token_num = ()
+        self.sp_key_padding = None
+        self.max_condition_sequence_length = None
+        self.text_sequence_length = None
+        self.use_cfg = None
+        # pipelines that pad, mask and crop the latent rows that do not split
+        # evenly among the sequence parallel ranks
+        self.sp_padding_supported = pipeline.__class__.__name__.startswith(
+            ("PixArt", "StableDiffusion3", "Flux")
+        )
         self._check_model_and_parallel_config(
             pipeline=pipeline, parallel_config=config.parallel_config
         )
@@ -154,11 +182,20 @@ class DiTRuntimeState(RuntimeState):
         seed: Optional[int] = None,
         max_condition_sequence_length: Optional[int] = None,
         split_text_embed_in_sp: bool = True,
+        text_sequence_length: Optional[int] = None,
+        use_cfg: Optional[bool] = None,
     ):
+        """``text_sequence_length`` and ``use_cfg`` change the shape of the
+        text embeddings and of the batch the pipeline stages exchange, so
+        they are part of the key of the shape plan."""
         self.input_config.num_inference_steps = (
             num_inference_steps or self.input_config.num_inference_steps
         )
-        self.max_condition_sequence_length = max_condition_sequence_length
+        condition_change = self._set_condition_parameters(
+            text_sequence_length,
+            use_cfg,
+            max_condition_sequence_length=max_condition_sequence_length,
+        )
         self.split_text_embed_in_sp = split_text_embed_in_sp
         if self.runtime_config.warmup_steps > self.input_config.num_inference_steps:
             self.runtime_config.warmup_steps = self.input_config.num_inference_steps
@@ -170,6 +207,7 @@ class DiTRuntimeState(RuntimeState):
             or (height and self.input_config.height != height)
             or (width and self.input_config.width != width)
             or (batch_size and self.input_config.batch_size != batch_size)
+            or condition_change
         ):
             self._input_size_change(height, width, batch_size)
 
@@ -184,10 +222,15 @@ class DiTRuntimeState(RuntimeState):
         num_inference_steps: Optional[int] = None,
         seed: Optional[int] = None,
         split_text_embed_in_sp: bool = True,
+        text_sequence_length: Optional[int] = None,
+        use_cfg: Optional[bool] = None,
     ):
         self.input_config.num_inference_steps = (
             num_inference_steps or self.input_config.num_inference_steps
         )
+        condition_change = self._set_condition_parameters(
+            text_sequence_length, use_cfg
+        )
         if self.runtime_config.warmup_steps > self.input_config.num_inference_steps:
             self.runtime_config.warmup_steps = self.input_config.num_inference_steps
         self.split_text_embed_in_sp = split_text_embed_in_sp
@@ -200,11 +243,30 @@ class DiTRuntimeState(RuntimeState):
             or (width and self.input_config.width != width)
             or (num_frames and self.input_config.num_frames != num_frames)
             or (batch_size and self.input_config.batch_size != batch_size)
+            or condition_change
         ):
             self._video_input_size_change(height, width, num_frames, batch_size)
 
         self.ready = True
 
+    def _set_condition_parameters(
+        self,
+        text_sequence_length: Optional[int],
+        use_cfg: Optional[bool],
+        max_condition_sequence_length: Optional[int] = None,
+    ) -> bool:
+        """Set the parameters of the condition, return whether they changed."""
+        condition = (text_sequence_length, use_cfg, max_condition_sequence_length)
+        changed = condition != (
+            self.text_sequence_length,
+            self.use_cfg,
+            self.max_condition_sequence_length,
+        )
+        self.text_sequence_length = text_sequence_length
+        self.use_cfg = use_cfg
+        self.max_condition_sequence_length = max_condition_sequence_length
+        return changed
+
     def _set_cogvideox_parameters(
         self,
         vae_scale_factor_spatial: int,
@@ -238,11 +300,14 @@ class DiTRuntimeState(RuntimeState):
     ):
         num_heads = pipeline.transformer.config.num_attention_heads
         ulysses_degree = parallel_config.sp_config.ulysses_degree
-        if num_heads % ulysses_degree != 0 or num_heads < ulysses_degree:
-            raise RuntimeError(
+        if num_heads % ulysses_degree != 0:
+            # the Ulysses attention pads the heads with zero heads
+            logger.warning(
                 f"transformer backbone has {num_heads} heads, which is not "
-                f"divisible by or smaller than ulysses_degree "
-                f"{ulysses_degree}."
+                f"divisible by ulysses_degree {ulysses_degree}. The heads are "
+                f"padded to {padded_num_heads(num_heads, ulysses_degree)}, "
+                f"{head_padding_waste(num_heads, ulysses_degree):.1%} of the "
+                f"attention compute is wasted on padded heads."
             )
 
     def _set_model_parameters(
@@ -280,346 +345,118 @@ class DiTRuntimeState(RuntimeState):
         self.input_config.width = width or self.input_config.width
         self.input_config.num_frames = num_frames or self.input_config.num_frames
         self.input_config.batch_size = batch_size or self.input_config.batch_size
-        if self.cogvideox:
-            self._calc_cogvideox_patches_metadata()
-        elif self.consisid:
-            self._calc_consisid_patches_metadata()
-        elif self.hunyuan_video:
+        if self.hunyuan_video:
             # TODO: implement the hunyuan video patches metadata
-            pass
+            self.shape_plan = None
+            self.num_pad_rows = 0
+            self.sp_pad_token_num = ()
+            self.sp_key_padding = None
         else:
             self._calc_patches_metadata()
         self._reset_recv_buffer()
 
+    def _shape_plan_key(self, latents_height: int, latents_width: int):
+        parallel_config = self.parallel_config
+        return (
+            latents_height,
+            latents_width,
+            self.input_config.num_frames if self.cogvideox or self.consisid else 1,
+            self.input_config.batch_size,
+            parallel_config.dp_degree,
+            parallel_config.cfg_degree,
+            parallel_config.ulysses_degree,
+            parallel_config.ring_degree,
+            parallel_config.pp_degree,
+            parallel_config.tp_degree,
+            parallel_config.pp_config.num_pipeline_patch,
+            self.runtime_config.dtype,
+            # the text embeddings and the cfg batch exchanged by PipeFusion
+            self.text_sequence_length,
+            self.max_condition_sequence_length,
+            self.use_cfg,
+        )
+
     def _calc_patches_metadata(self):
-        num_sp_patches = get_sequence_parallel_world_size()
-        sp_patch_idx = get_sequence_parallel_rank()
-        patch_size = self.backbone_patch_size
-        vae_scale_factor = self.vae_scale_factor
+        if self.cogvideox or self.consisid:
+            vae_scale_factor = self.vae_scale_factor_spatial
+        else:
+            vae_scale_factor = self.vae_scale_factor
         latents_height = self.input_config.height // vae_scale_factor
         latents_width = self.input_config.width // vae_scale_factor
 
-        if latents_height % num_sp_patches != 0:
-            raise ValueError(
-                "The height of the input is not divisible by the number of sequence parallel devices"
-            )
-
-        self.num_pipeline_patch = self.parallel_config.pp_config.num_pipeline_patch
-        # Pipeline patches
-        pipeline_patches_height = (
-            latents_height + self.num_pipeline_patch - 1
-        ) // self.num_pipeline_patch
-        # make sure pipeline_patches_height is a multiple of (num_sp_patches * patch_size)
-        pipeline_patches_height = (
-            (pipeline_patches_height + (num_sp_patches * patch_size) - 1)
-            // (patch_size * num_sp_patches)
-        ) * (patch_size * num_sp_patches)
-        # get the number of pipeline that matches patch height requirements
-        num_pipeline_patch = (
-            latents_height + pipeline_patches_height - 1
-        ) // pipeline_patches_height
-        if num_pipeline_patch != self.num_pipeline_patch:
-            logger.warning(
-                f"Pipeline patches num changed from "
-                f"{self.num_pipeline_patch} to {num_pipeline_patch} due "
-                f"to input size and parallelisation requirements"
-            )
-        pipeline_patches_height_list = [
-            pipeline_patches_height for _ in range(num_pipeline_patch - 1)
-        ]
-        the_last_pp_patch_height = latents_height - pipeline_patches_height * (
-            num_pipeline_patch - 1
-        )
-        if the_last_pp_patch_height % (patch_size * num_sp_patches) != 0:
-            raise ValueError(
-                f"The height of the last pipeline patch is {the_last_pp_patch_height}, "
-                f"which is not a multiple of (patch_size * num_sp_patches): "
-                f"{patch_size} * {num_sp_patches}. Please try to adjust 'num_pipeline_patches "
-                f"or sp_degree argument so that the condition are met "
-            )
-        pipeline_patches_height_list.append(the_last_pp_patch_height)
-
-        # Sequence parallel patches
-        # len: sp_degree * num_pipeline_patches
-        flatten_patches_height = [
-            pp_patch_height // num_sp_patches
-            for _ in range(num_sp_patches)
-            for pp_patch_height in pipeline_patches_height_list
-        ]
-        flatten_patches_start_idx = [0] + [
-            sum(flatten_patches_height[:i])
-            for i in range(1, len(flatten_patches_height) + 1)
-        ]
-        pp_sp_patches_height = [
-            flatten_patches_height[
-                pp_patch_idx * num_sp_patches : (pp_patch_idx + 1) * num_sp_patches
-            ]
-            for pp_patch_idx in range(num_pipeline_patch)
-        ]
-        pp_sp_patches_start_idx = [
-            flatten_patches_start_idx[
-                pp_patch_idx * num_sp_patches : (pp_patch_idx + 1) * num_sp_patches + 1
-            ]
-            for pp_patch_idx in range(num_pipeline_patch)
-        ]
-
-        pp_patches_height = [
-            sp_patches_height[sp_patch_idx]
-            for sp_patches_height in pp_sp_patches_height
-        ]
-        pp_patches_start_idx_local = [0] + [
-            sum(pp_patches_height[:i]) for i in range(1, len(pp_patches_height) + 1)
-        ]
-        pp_patches_start_end_idx_global = [
-            sp_patches_start_idx[sp_patch_idx : sp_patch_idx + 2]
-            for sp_patches_start_idx in pp_sp_patches_start_idx
-        ]
-        pp_patches_token_start_end_idx_global = [
-            [
-                (latents_width // patch_size) * (start_idx // patch_size),
-                (latents_width // patch_size) * (end_idx // patch_size),
-            ]
-            for start_idx, end_idx in pp_patches_start_end_idx_global
-        ]
-        pp_patches_token_num = [
-            end - start for start, end in pp_patches_token_start_end_idx_global
-        ]
-        pp_patches_token_start_idx_local = [
-            sum(pp_patches_token_num[:i]) for i in range(len(pp_patches_token_num) + 1)
-        ]
-        self.num_pipeline_patch = num_pipeline_patch
-        self.pp_patches_height = pp_patches_height
-        self.pp_patches_start_idx_local = pp_patches_start_idx_local
-        self.pp_patches_start_end_idx_global = pp_patches_start_end_idx_global
-        self.pp_patches_token_start_idx_local = pp_patches_token_start_idx_local
-        self.pp_patches_token_start_end_idx_global = (
-            pp_patches_token_start_end_idx_global
-        )
-        self.pp_patches_token_num = pp_patches_token_num
-
-    def _calc_cogvideox_patches_metadata(self):
-        num_sp_patches = get_sequence_parallel_world_size()
-        sp_patch_idx = get_sequence_parallel_rank()
-        patch_size = self.backbone_patch_size
-        vae_scale_factor_spatial = self.vae_scale_factor_spatial
-        latents_height = self.input_config.height // vae_scale_factor_spatial
-        latents_width = self.input_config.width // vae_scale_factor_spatial
-        latents_frames = (
-            self.input_config.num_frames - 1
-        ) // self.vae_scale_factor_temporal + 1
-
-        if latents_height % num_sp_patches != 0:
-            raise ValueError(
-                "The height of the input is not divisible by the number of sequence parallel devices"
-            )
-
-        self.num_pipeline_patch = self.parallel_config.pp_config.num_pipeline_patch
-        # Pipeline patches
-        pipeline_patches_height = (
-            latents_height + self.num_pipeline_patch - 1
-        ) // self.num_pipeline_patch
-        # make sure pipeline_patches_height is a multiple of (num_sp_patches * patch_size)
-        pipeline_patches_height = (
-            (pipeline_patches_height + (num_sp_patches * patch_size) - 1)
-            // (patch_size * num_sp_patches)
-        ) * (patch_size * num_sp_patches)
-        # get the number of pipeline that matches patch height requirements
-        num_pipeline_patch = (
-            latents_height + pipeline_patches_height - 1
-        ) // pipeline_patches_height
-        if num_pipeline_patch != self.num_pipeline_patch:
-            logger.warning(
-                f"Pipeline patches num changed from "
-                f"{self.num_pipeline_patch} to {num_pipeline_patch} due "
-                f"to input size and parallelisation requirements"
+        key = self._shape_plan_key(latents_height, latents_width)
+        plan = self.shape_plan_cache.get(key)
+        if plan is None:
+            num_pipeline_patch = self.parallel_config.pp_config.num_pipeline_patch
+            plan = calc_shape_plan(
+                key=key,
+                latents_height=latents_height,
+                latents_width=latents_width,
+                num_pipeline_patch=num_pipeline_patch,
+                num_sp_patches=get_sequence_parallel_world_size(),
+                sp_patch_idx=get_sequence_parallel_rank(),
+                patch_size=self.backbone_patch_size,
+                # PipeFusion keeps the kv of every patch in a per-patch
+                # layout, padding is only masked without it.
+                pad_sp=self.sp_padding_supported
+                and self.parallel_config.pp_degree == 1,
             )
-        pipeline_patches_height_list = [
-            pipeline_patches_height for _ in range(num_pipeline_patch - 1)
-        ]
-        the_last_pp_patch_height = latents_height - pipeline_patches_height * (
-            num_pipeline_patch - 1
-        )
-        if the_last_pp_patch_height % (patch_size * num_sp_patches) != 0:
-            raise ValueError(
-                f"The height of the last pipeline patch is {the_last_pp_patch_height}, "
-                f"which is not a multiple of (patch_size * num_sp_patches): "
-                f"{patch_size} * {num_sp_patches}. Please try to adjust 'num_pipeline_patches "
-                f"or sp_degree argument so that the condition are met "
-            )
-        pipeline_patches_height_list.append(the_last_pp_patch_height)
-
-        # Sequence parallel patches
-        # len: sp_degree * num_pipeline_patches
-        flatten_patches_height = [
-            pp_patch_height // num_sp_patches
-            for _ in range(num_sp_patches)
-            for pp_patch_height in pipeline_patches_height_list
-        ]
-        flatten_patches_start_idx = [0] + [
-            sum(flatten_patches_height[:i])
-            for i in range(1, len(flatten_patches_height) + 1)
-        ]
-        pp_sp_patches_height = [
-            flatten_patches_height[
-                pp_patch_idx * num_sp_patches : (pp_patch_idx + 1) * num_sp_patches
-            ]
-            for pp_patch_idx in range(num_pipeline_patch)
-        ]
-        pp_sp_patches_start_idx = [
-            flatten_patches_start_idx[
-                pp_patch_idx * num_sp_patches : (pp_patch_idx + 1) * num_sp_patches + 1
-            ]
-            for pp_patch_idx in range(num_pipeline_patch)
-        ]
-
-        pp_patches_height = [
-            sp_patches_height[sp_patch_idx]
-            for sp_patches_height in pp_sp_patches_height
-        ]
-        pp_patches_start_idx_local = [0] + [
-            sum(pp_patches_height[:i]) for i in range(1, len(pp_patches_height) + 1)
-        ]
-        pp_patches_start_end_idx_global = [
-            sp_patches_start_idx[sp_patch_idx : sp_patch_idx + 2]
-            for sp_patches_start_idx in pp_sp_patches_start_idx
-        ]
-        pp_patches_token_start_end_idx_global = [
-            [
-                (latents_width // patch_size) * (start_idx // patch_size),
-                (latents_width // patch_size) * (end_idx // patch_size),
-            ]
-            for start_idx, end_idx in pp_patches_start_end_idx_global
-        ]
-        pp_patches_token_num = [
-            end - start for start, end in pp_patches_token_start_end_idx_global
-        ]
-        pp_patches_token_start_idx_local = [
-            sum(pp_patches_token_num[:i]) for i in range(len(pp_patches_token_num) + 1)
-        ]
-        self.num_pipeline_patch = num_pipeline_patch
-        self.pp_patches_height = pp_patches_height
-        self.pp_patches_start_idx_local = pp_patches_start_idx_local
-        self.pp_patches_start_end_idx_global = pp_patches_start_end_idx_global
-        self.pp_patches_token_start_idx_local = pp_patches_token_start_idx_local
+            if plan.padded_latents_height != latents_height:
+                overhead = (plan.padded_latents_height - latents_height) / latents_height
+                logger.info(
+                    f"Padded the latent height from {latents_height} to "
+                    f"{plan.padded_latents_height} rows for sequence parallel "
+                    f"degree {get_sequence_parallel_world_size()}, "
+                    f"{overhead:.2%} extra image tokens"
+                )
+            if plan.num_pipeline_patch != num_pipeline_patch:
+                logger.warning(
+                    f"Pipeline patches num changed from "
+                    f"{num_pipeline_patch} to {plan.num_pipeline_patch} due "
+                    f"to input size and parallelisation requirements"
+                )
+            self.shape_plan_cache.put(plan)
+        self._set_shape_plan(plan)
+
+    def _set_shape_plan(self, plan: ShapePlan):
+        self.shape_plan = plan
+        self.num_pipeline_patch = plan.num_pipeline_patch
+        self.pp_patches_height = plan.pp_patches_height
+        self.pp_patches_start_idx_local = plan.pp_patches_start_idx_local
+        self.pp_patches_start_end_idx_global = plan.pp_patches_start_end_idx_global
+        self.pp_patches_token_start_idx_local = plan.pp_patches_token_start_idx_local
         self.pp_patches_token_start_end_idx_global = (
-            pp_patches_token_start_end_idx_global
-        )
-        self.pp_patches_token_num = pp_patches_token_num
-
-    def _calc_consisid_patches_metadata(self):
-        num_sp_patches = get_sequence_parallel_world_size()
-        sp_patch_idx = get_sequence_parallel_rank()
-        patch_size = self.backbone_patch_size
-        vae_scale_factor_spatial = self.vae_scale_factor_spatial
-        latents_height = self.input_config.height // vae_scale_factor_spatial
-        latents_width = self.input_config.width // vae_scale_factor_spatial
-        latents_frames = (
-            self.input_config.num_frames - 1
-        ) // self.vae_scale_factor_temporal + 1
-
-        if latents_height % num_sp_patches != 0:
-            raise ValueError(
-                "The height of the input is not divisible by the number of sequence parallel devices"
-            )
-
-        self.num_pipeline_patch = self.parallel_config.pp_config.num_pipeline_patch
-        # Pipeline patches
-        pipeline_patches_height = (
-            latents_height + self.num_pipeline_patch - 1
-        ) // self.num_pipeline_patch
-        # make sure pipeline_patches_height is a multiple of (num_sp_patches * patch_size)
-        pipeline_patches_height = (
-            (pipeline_patches_height + (num_sp_patches * patch_size) - 1)
-            // (patch_size * num_sp_patches)
-        ) * (patch_size * num_sp_patches)
-        # get the number of pipeline that matches patch height requirements
-        num_pipeline_patch = (
-            latents_height + pipeline_patches_height - 1
-        ) // pipeline_patches_height
-        if num_pipeline_patch != self.num_pipeline_patch:
-            logger.warning(
-                f"Pipeline patches num changed from "
-                f"{self.num_pipeline_patch} to {num_pipeline_patch} due "
-                f"to input size and parallelisation requirements"
-            )
-        pipeline_patches_height_list = [
-            pipeline_patches_height for _ in range(num_pipeline_patch - 1)
-        ]
-        the_last_pp_patch_height = latents_height - pipeline_patches_height * (
-            num_pipeline_patch - 1
+            plan.pp_patches_token_start_end_idx_global
         )
-        if the_last_pp_patch_height % (patch_size * num_sp_patches) != 0:
-            raise ValueError(
-                f"The height of the last pipeline patch is {the_last_pp_patch_height}, "
-                f"which is not a multiple of (patch_size * num_sp_patches): "
-                f"{patch_size} * {num_sp_patches}. Please try to adjust 'num_pipeline_patches "
-                f"or sp_degree argument so that the condition are met "
+        self.pp_patches_token_num = plan.pp_patches_token_num
+        self.num_pad_rows = plan.padded_latents_height - plan.latents_height
+        self.sp_pad_token_num = plan.sp_pad_token_num
+        # padded tokens of every sp rank indexed as [ring_rank][ulysses_rank],
+        # the layout the keys arrive in after the ulysses all-to-all
+        if any(plan.sp_pad_token_num):
+            ulysses_degree = self.parallel_config.ulysses_degree
+            self.sp_key_padding = tuple(
+                plan.sp_pad_token_num[i : i + ulysses_degree]
+                for i in range(0, len(plan.sp_pad_token_num), ulysses_degree)
             )
-        pipeline_patches_height_list.append(the_last_pp_patch_height)
-
-        # Sequence parallel patches
-        # len: sp_degree * num_pipeline_patches
-        flatten_patches_height = [
-            pp_patch_height // num_sp_patches
-            for _ in range(num_sp_patches)
-            for pp_patch_height in pipeline_patches_height_list
-        ]
-        flatten_patches_start_idx = [0] + [
-            sum(flatten_patches_height[:i])
-            for i in range(1, len(flatten_patches_height) + 1)
-        ]
-        pp_sp_patches_height = [
-            flatten_patches_height[
-                pp_patch_idx * num_sp_patches : (pp_patch_idx + 1) * num_sp_patches
-            ]
-            for pp_patch_idx in range(num_pipeline_patch)
-        ]
-        pp_sp_patches_start_idx = [
-            flatten_patches_start_idx[
-                pp_patch_idx * num_sp_patches : (pp_patch_idx + 1) * num_sp_patches + 1
-            ]
-            for pp_patch_idx in range(num_pipeline_patch)
-        ]
-
-        pp_patches_height = [
-            sp_patches_height[sp_patch_idx]
-            for sp_patches_height in pp_sp_patches_height
-        ]
-        pp_patches_start_idx_local = [0] + [
-            sum(pp_patches_height[:i]) for i in range(1, len(pp_patches_height) + 1)
-        ]
-        pp_patches_start_end_idx_global = [
-            sp_patches_start_idx[sp_patch_idx : sp_patch_idx + 2]
-            for sp_patches_start_idx in pp_sp_patches_start_idx
-        ]
-        pp_patches_token_start_end_idx_global = [
-            [
-                (latents_width // patch_size) * (start_idx // patch_size),
-                (latents_width // patch_size) * (end_idx // patch_size),
-            ]
-            for start_idx, end_idx in pp_patches_start_end_idx_global
-        ]
-        pp_patches_token_num = [
-            end - start for start, end in pp_patches_token_start_end_idx_global
-        ]
-        pp_patches_token_start_idx_local = [
-            sum(pp_patches_token_num[:i]) for i in range(len(pp_patches_token_num) + 1)
-        ]
-        self.num_pipeline_patch = num_pipeline_patch
-        self.pp_patches_height = pp_patches_height
-        self.pp_patches_start_idx_local = pp_patches_start_idx_local
-        self.pp_patches_start_end_idx_global = pp_patches_start_end_idx_global
-        self.pp_patches_token_start_idx_local = pp_patches_token_start_idx_local
-        self.pp_patches_token_start_end_idx_global = (
-            pp_patches_token_start_end_idx_global
-        )
-        self.pp_patches_token_num = pp_patches_token_num
+        else:
+            self.sp_key_padding = None
 
     def _reset_recv_buffer(self):
-        get_pp_group().reset_buffer()
+        get_pp_group().reset_buffer(
+            self.shape_plan.buffers if self.shape_plan is not None else None
+        )
         get_pp_group().set_config(dtype=self.runtime_config.dtype)
 
     def _reset_recv_skip_buffer(self, num_blocks_per_stage):
+        if self.shape_plan is not None:
+            skip_buffers = self.shape_plan.buffers.skip_tensor_recv_buffer
+            if num_blocks_per_stage in skip_buffers:
+                get_pp_group().skip_tensor_recv_buffer = skip_buffers[
+                    num_blocks_per_stage
+                ]
+                get_pp_group().skip_tensor_recv_buffer_set = True
+                return
         batch_size = self.input_config.batch_size
         batch_size = batch_size * (2 // self.parallel_config.cfg_degree)
         hidden_dim = self.backbone_inner_dim
@@ -641,6 +478,10 @@ class DiTRuntimeState(RuntimeState):
             patches_shape_list=patches_shape,
             feature_map_shape=feature_map_shape,
         )
+        if self.shape_plan is not None:
+            self.shape_plan.buffers.skip_tensor_recv_buffer[num_blocks_per_stage] = (
+                get_pp_group().skip_tensor_recv_buffer
+            )
 
 
 # _RUNTIME: Optional[RuntimeState] = None
@@ -0,0 +1,374 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from itertools import accumulate
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import torch
+
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+
+def calc_pipeline_patches_height_list(
+    latents_height: int,
+    num_pipeline_patch: int,
+    num_sp_patches: int,
+    patch_size: int,
+) -> List[int]:
+    """Split the latent height into PipeFusion patches.
+
+    Every patch height must be a multiple of ``patch_size * num_sp_patches`` so
+    that each sequence parallel rank gets whole patch rows. The number of
+    returned patches may be smaller than ``num_pipeline_patch`` when the input
+    is too small to honour that requirement.
+
+    Raises:
+        ValueError: if the latent height cannot be split under these rules.
+    """
+    if latents_height % num_sp_patches != 0:
+        raise ValueError(
+            "The height of the input is not divisible by the number of sequence parallel devices"
+        )
+
+    # Pipeline patches
+    pipeline_patches_height = (
+        latents_height + num_pipeline_patch - 1
+    ) // num_pipeline_patch
+    # make sure pipeline_patches_height is a multiple of (num_sp_patches * patch_size)
+    pipeline_patches_height = (
+        (pipeline_patches_height + (num_sp_patches * patch_size) - 1)
+        // (patch_size * num_sp_patches)
+    ) * (patch_size * num_sp_patches)
+    # get the number of pipeline that matches patch height requirements
+    num_pipeline_patch = (
+        latents_height + pipeline_patches_height - 1
+    ) // pipeline_patches_height
+    pipeline_patches_height_list = [
+        pipeline_patches_height for _ in range(num_pipeline_patch - 1)
+    ]
+    the_last_pp_patch_height = latents_height - pipeline_patches_height * (
+        num_pipeline_patch - 1
+    )
+    if the_last_pp_patch_height % (patch_size * num_sp_patches) != 0:
+        raise ValueError(
+            f"The height of the last pipeline patch is {the_last_pp_patch_height}, "
+            f"which is not a multiple of (patch_size * num_sp_patches): "
+            f"{patch_size} * {num_sp_patches}. Please try to adjust 'num_pipeline_patches "
+            f"or sp_degree argument so that the condition are met "
+        )
+    pipeline_patches_height_list.append(the_last_pp_patch_height)
+    return pipeline_patches_height_list
+
+
+@dataclass
+class ShapePlanBuffers:
+    """Communication buffers and kv cache arenas owned by a shape plan.
+
+    The pipeline group binds its shape and receive buffer dicts to these, so
+    buffers allocated while running one shape are found again the next time
+    the same shape is requested instead of being reallocated and their shapes
+    communicated again. The cache manager does the same with its kv cache.
+    """
+
+    recv_shape: Dict[str, Dict[int, torch.Size]] = field(default_factory=dict)
+    send_shape: Dict[str, Dict[int, torch.Size]] = field(default_factory=dict)
+    recv_buffer: Dict[str, Dict[int, torch.Tensor]] = field(default_factory=dict)
+    # keyed by the number of transformer blocks per stage
+    skip_tensor_recv_buffer: Dict[int, List[torch.Tensor]] = field(default_factory=dict)
+    # PipeFusion kv cache arenas of the shape, keyed by (dtype, device)
+    kv_cache_arenas: Dict[Any, Any] = field(default_factory=dict)
+    # token gather index of the sequence parallel kv cache, keyed by
+    # (patch token numbers, ulysses world size, device)
+    kv_cache_gather_index: Dict[Any, torch.Tensor] = field(default_factory=dict)
+    # staging buffers of the sequence parallel attention, keyed by their
+    # kind, shapes, dtype and device
+    attn_buffers: Dict[Any, Any] = field(default_factory=dict)
+
+    def nbytes(self) -> int:
+        tensors = (
+            [
+                buffer
+                for buffers in self.recv_buffer.values()
+                for buffer in buffers.values()
+            ]
+            + [
+                buffer
+                for buffers in self.skip_tensor_recv_buffer.values()
+                for buffer in buffers
+            ]
+            + list(self.kv_cache_gather_index.values())
+        )
+        return (
+            sum(t.numel() * t.element_size() for t in tensors)
+            + sum(arena.nbytes() for arena in self.kv_cache_arenas.values())
+            + sum(buffers.nbytes() for buffers in self.attn_buffers.values())
+        )
+
+
+@dataclass(frozen=True)
+class ShapePlan:
+    """Patch metadata of one input shape for the local rank.
+
+    ``pp_*`` fields follow the attributes of the same name in
+    :class:`~xfuser.core.distributed.runtime_state.DiTRuntimeState`.
+
+    When the latent height had to be padded to split it among the sequence
+    parallel ranks, the ``pp_*`` fields describe the padded latent of
+    ``padded_latents_height`` rows. The padded rows are at the bottom of the
+    latent, so on every sp rank they are the trailing ``sp_pad_height[rank]``
+    rows (``sp_pad_token_num[rank]`` tokens) of its local sequence.
+    """
+
+    key: Hashable
+    latents_height: int
+    latents_width: int
+    num_pipeline_patch: int
+    pp_patches_height: Tuple[int, ...]
+    pp_patches_start_idx_local: Tuple[int, ...]
+    pp_patches_start_end_idx_global: Tuple[Tuple[int, int], ...]
+    pp_patches_token_start_idx_local: Tuple[int, ...]
+    pp_patches_token_start_end_idx_global: Tuple[Tuple[int, int], ...]
+    pp_patches_token_num: Tuple[int, ...]
+    padded_latents_height: int
+    sp_pad_height: Tuple[int, ...]
+    sp_pad_token_num: Tuple[int, ...]
+    buffers: ShapePlanBuffers = field(
+        default_factory=ShapePlanBuffers, compare=False, repr=False
+    )
+
+
+def calc_shape_plan(
+    key: Hashable,
+    latents_height: int,
+    latents_width: int,
+    num_pipeline_patch: int,
+    num_sp_patches: int,
+    sp_patch_idx: int,
+    patch_size: int,
+    pad_sp: bool = False,
+) -> ShapePlan:
+    """Compute the patch metadata of the ``sp_patch_idx``-th sp rank.
+
+    With ``pad_sp`` a latent height that is not a multiple of
+    ``patch_size * num_sp_patches`` is padded up to the next multiple instead
+    of raising, so that every resolution can use the full sp degree. The
+    height still has to be a multiple of ``patch_size``.
+    """
+    padded_latents_height = latents_height
+    sp_unit = patch_size * num_sp_patches
+    if pad_sp and latents_height % sp_unit != 0:
+        if latents_height % patch_size != 0:
+            raise ValueError(
+                f"The latent height {latents_height} is not a multiple of the "
+                f"patch size {patch_size}"
+            )
+        padded_latents_height = (latents_height + sp_unit - 1) // sp_unit * sp_unit
+
+    pipeline_patches_height_list = calc_pipeline_patches_height_list(
+        latents_height=padded_latents_height,
+        num_pipeline_patch=num_pipeline_patch,
+        num_sp_patches=num_sp_patches,
+        patch_size=patch_size,
+    )
+    num_pipeline_patch = len(pipeline_patches_height_list)
+
+    # Sequence parallel patches, every pipeline patch is split evenly among
+    # the sequence parallel ranks, the local rank owns the sp_patch_idx-th
+    # piece of each of them.
+    # start row of pipeline patch i in the global latent
+    pp_patches_start_idx_global = list(
+        accumulate(pipeline_patches_height_list, initial=0)
+    )
+    pp_patches_height = tuple(
+        pp_patch_height // num_sp_patches
+        for pp_patch_height in pipeline_patches_height_list
+    )
+    pp_patches_start_idx_local = tuple(accumulate(pp_patches_height, initial=0))
+    pp_patches_start_end_idx_global = tuple(
+        (
+            pp_start + sp_patch_idx * sp_patch_height,
+            pp_start + (sp_patch_idx + 1) * sp_patch_height,
+        )
+        for pp_start, sp_patch_height in zip(
+            pp_patches_start_idx_global, pp_patches_height
+        )
+    )
+    pp_patches_token_start_end_idx_global = tuple(
+        (
+            (latents_width // patch_size) * (start_idx // patch_size),
+            (latents_width // patch_size) * (end_idx // patch_size),
+        )
+        for start_idx, end_idx in pp_patches_start_end_idx_global
+    )
+    pp_patches_token_num = tuple(
+        end - start for start, end in pp_patches_token_start_end_idx_global
+    )
+    pp_patches_token_start_idx_local = tuple(
+        accumulate(pp_patches_token_num, initial=0)
+    )
+
+    # Padded rows only fall into the last pipeline patch, count them for the
+    # slice of every sp rank.
+    last_pp_start = pp_patches_start_idx_global[-2]
+    last_sp_patch_height = pp_patches_height[-1]
+    sp_pad_height = tuple(
+        max(
+            0,
+            last_pp_start
+            + (idx + 1) * last_sp_patch_height
+            - max(last_pp_start + idx * last_sp_patch_height, latents_height),
+        )
+        for idx in range(num_sp_patches)
+    )
+    sp_pad_token_num = tuple(
+        (pad_height // patch_size) * (latents_width // patch_size)
+        for pad_height in sp_pad_height
+    )
+    return ShapePlan(
+        key=key,
+        latents_height=latents_height,
+        latents_width=latents_width,
+        num_pipeline_patch=num_pipeline_patch,
+        pp_patches_height=pp_patches_height,
+        pp_patches_start_idx_local=pp_patches_start_idx_local,
+        pp_patches_start_end_idx_global=pp_patches_start_end_idx_global,
+        pp_patches_token_start_idx_local=pp_patches_token_start_idx_local,
+        pp_patches_token_start_end_idx_global=pp_patches_token_start_end_idx_global,
+        pp_patches_token_num=pp_patches_token_num,
+        padded_latents_height=padded_latents_height,
+        sp_pad_height=sp_pad_height,
+        sp_pad_token_num=sp_pad_token_num,
+    )
+
+
+def drop_padded_tokens(
+    x: torch.Tensor, pad_token_num: Sequence[int], dim: int = 1
+) -> torch.Tensor:
+    """Drop the padded tokens of a sequence gathered from several sp ranks.
+
+    ``x`` is the concatenation of ``len(pad_token_num)`` equally long local
+    sequences along ``dim``, the i-th of which ends with ``pad_token_num[i]``
+    padded tokens.
+    """
+    if not any(pad_token_num):
+        return x
+    chunk_len = x.shape[dim] // len(pad_token_num)
+    chunks = [
+        x.narrow(dim, i * chunk_len, chunk_len - pad)
+        for i, pad in enumerate(pad_token_num)
+        if pad < chunk_len
+    ]
+    if not chunks:
+        return x.narrow(dim, 0, 0)
+    return torch.cat(chunks, dim=dim)
+
+
+def padded_num_heads(num_heads: int, ulysses_degree: int) -> int:
+    """The number of heads rounded up to a multiple of ``ulysses_degree``."""
+    return (num_heads + ulysses_degree - 1) // ulysses_degree * ulysses_degree
+
+
+def head_padding_waste(num_heads: int, ulysses_degree: int) -> float:
+    """The fraction of the attention compute spent on padded heads."""
+    padded = padded_num_heads(num_heads, ulysses_degree)
+    return (padded - num_heads) / padded
+
+
+def pad_heads(x: torch.Tensor, ulysses_degree: int, dim: int = 2) -> torch.Tensor:
+    """Pad the heads of ``x`` along ``dim`` with zero heads up to a multiple
+    of ``ulysses_degree``, so that the Ulysses all-to-all can scatter them.
+
+    The query, key and value of a padded head are zero, so its attention
+    output is zero and is dropped after the output all-to-all.
+    """
+    num_heads = x.shape[dim]
+    pad = padded_num_heads(num_heads, ulysses_degree) - num_heads
+    if pad == 0:
+        return x
+    shape = list(x.shape)
+    shape[dim] = pad
+    return torch.cat([x, x.new_zeros(shape)], dim=dim)
+
+
+class ShapePlanCache:
+    """LRU cache of :class:`ShapePlan` keyed by input shape and parallel
+    config. Evicted plans release their communication buffers."""
+
+    def __init__(self, max_size: int = 8):
+        assert max_size >= 1, "shape plan cache size must be at least 1"
+        self.max_size = max_size
+        self.plans: "OrderedDict[Hashable, ShapePlan]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[ShapePlan]:
+        plan = self.plans.get(key, None)
+        if plan is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.plans.move_to_end(key)
+        return plan
+
+    def put(self, plan: ShapePlan):
+        self.plans[plan.key] = plan
+        self.plans.move_to_end(plan.key)
+        while len(self.plans) > self.max_size:
+            evicted_key, _ = self.plans.popitem(last=False)
+            logger.debug(f"Evicted shape plan {evicted_key}")
+
+    def clear(self):
+        self.plans.clear()
+
+    def __len__(self) -> int:
+        return len(self.plans)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.plans
+
+    def memory_report(self) -> Dict[Hashable, Any]:
+        return {key: plan.buffers.nbytes() for key, plan in self.plans.items()}
+
+
+def get_shape_plan_buffers() -> Optional[ShapePlanBuffers]:
+    """Buffers of the shape plan of the input being run, None without an
+    initialized runtime state or without a shape plan."""
+    # the runtime state imports this module
+    from xfuser.core.distributed.runtime_state import (
+        get_runtime_state,
+        runtime_state_is_initialized,
+    )
+
+    if not runtime_state_is_initialized():
+        return None
+    shape_plan = get_runtime_state().shape_plan
+    return shape_plan.buffers if shape_plan is not None else None
+
+
+def get_plan_buffer(
+    kind: str,
+    key: Hashable,
+    create: Callable[[], Any],
+    fallback: Optional[Dict[Hashable, Any]] = None,
+) -> Any:
+    """The buffer ``key`` of the ``kind`` field of the :class:`ShapePlanBuffers`
+    of the current shape plan, made by ``create`` the first time.
+
+    The buffers live with the shape plan, so they are reused by every layer
+    and request of the same shape and freed with the plan. Without a shape
+    plan the buffer is made for the call only, or kept in ``fallback``, which
+    then only holds the buffer of the last key asked for.
+    """
+    buffers = get_shape_plan_buffers()
+    if buffers is not None:
+        cache = getattr(buffers, kind)
+    elif fallback is not None:
+        cache = fallback
+        if key not in cache:
+            cache.clear()
+    else:
+        return create()
+    if key not in cache:
+        cache[key] = create()
+    return cache[key]
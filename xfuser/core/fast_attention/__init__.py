@@ -3,20 +3,32 @@ from .fast_attn_state import (
     get_fast_attn_enable,
     get_fast_attn_step,
     get_fast_attn_calib,
+    get_fast_attn_calib_trials,
     get_fast_attn_threshold,
     get_fast_attn_window_size,
+    get_fast_attn_backend,
+    get_fast_attn_compact_cache,
+    get_fast_attn_cache_dtype,
     get_fast_attn_coco_path,
     get_fast_attn_use_cache,
     get_fast_attn_config_file,
     get_fast_attn_layer_name,
+    get_fast_attn_layers,
+    fast_attn_blocks,
     initialize_fast_attn_state,
 )
 
 from .attn_layer import (
     FastAttnMethod,
     xFuserFastAttention,
+    xFuserJointFastAttention,
+    xFuserFluxFastAttention,
+    xFuserHunyuanFastAttention,
 )
 
+from .attn_backend import FAST_ATTN_BACKENDS
+from .cache_storage import FAST_ATTN_CACHE_DTYPES, CompactTensor
+
 from .utils import fast_attention_compression
 
 __all__ = [
@@ -24,14 +36,26 @@ __all__ = [
     "get_fast_attn_enable",
     "get_fast_attn_step",
     "get_fast_attn_calib",
+    "get_fast_attn_calib_trials",
     "get_fast_attn_threshold",
     "get_fast_attn_window_size",
+    "get_fast_attn_backend",
+    "get_fast_attn_compact_cache",
+    "get_fast_attn_cache_dtype",
     "get_fast_attn_coco_path",
     "get_fast_attn_use_cache",
     "get_fast_attn_config_file",
     "get_fast_attn_layer_name",
+    "get_fast_attn_layers",
+    "fast_attn_blocks",
     "initialize_fast_attn_state",
     "xFuserFastAttention",
+    "xFuserJointFastAttention",
+    "xFuserFluxFastAttention",
+    "xFuserHunyuanFastAttention",
     "FastAttnMethod",
+    "FAST_ATTN_BACKENDS",
+    "FAST_ATTN_CACHE_DTYPES",
+    "CompactTensor",
     "fast_attention_compression",
 ]
@@ -0,0 +1,155 @@
+# Copyright 2024 xDiT team.
+"""
+Attention kernels of DiTFastAttn.
+
+The full and the window attention of the compression methods run on one of
+
+- ``flash``: flash_attn, whose ``window_size`` skips the blocks outside the
+  window,
+- ``flex``: ``torch.nn.attention.flex_attention`` with a block mask of the
+  window, compiled on GPUs,
+- ``sdpa``: ``F.scaled_dot_product_attention`` with a boolean mask of the
+  window, which runs on any PyTorch install.
+
+``auto`` takes the first one available for the device. The masks of a
+sequence length and window are built once and cached.
+"""
+import functools
+from typing import Sequence
+
+import torch
+import torch.nn.functional as F
+
+try:
+    import flash_attn
+except ImportError:
+    flash_attn = None
+
+try:
+    from torch.nn.attention.flex_attention import create_block_mask, flex_attention
+except ImportError:
+    create_block_mask, flex_attention = None, None
+
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+FAST_ATTN_BACKENDS = ["auto", "flash", "flex", "sdpa"]
+
+
+def available_backends(device: torch.device) -> list:
+    """Return the backends that run on ``device``, the fastest first."""
+    backends = []
+    if flash_attn is not None and device.type == "cuda":
+        backends.append("flash")
+    if flex_attention is not None:
+        backends.append("flex")
+    backends.append("sdpa")
+    return backends
+
+
+def resolve_backend(backend: str, device: torch.device) -> str:
+    """Return the backend to run ``backend`` with on ``device``."""
+    assert (
+        backend in FAST_ATTN_BACKENDS
+    ), f"Unknown DiTFastAttn backend {backend}, choose from {FAST_ATTN_BACKENDS}"
+    backends = available_backends(device)
+    if backend == "auto":
+        if "flash" in backends:
+            return "flash"
+        # uncompiled flex attention is a reference implementation, slower than SDPA
+        if "flex" in backends and device.type == "cuda":
+            return "flex"
+        return "sdpa"
+    if backend not in backends:
+        raise RuntimeError(
+            f"DiTFastAttn backend {backend} is not available on {device.type}, available: {backends}"
+        )
+    return backend
+
+
+def _window_offset(q_len: int, k_len: int) -> int:
+    # query i is aligned with key i + k_len - q_len, as in flash_attn
+    return k_len - q_len
+
+
+@functools.lru_cache(maxsize=32)
+def window_mask(
+    q_len: int, k_len: int, window_size: Sequence[int], device: torch.device
+) -> torch.Tensor:
+    """Boolean (q_len, k_len) mask of the keys in the window of every query."""
+    left, right = window_size
+    offset = _window_offset(q_len, k_len)
+    rel = (
+        torch.arange(k_len, device=device)[None, :]
+        - torch.arange(q_len, device=device)[:, None]
+        - offset
+    )
+    return (rel >= -left) & (rel <= right)
+
+
+@functools.lru_cache(maxsize=32)
+def window_block_mask(
+    q_len: int, k_len: int, window_size: Sequence[int], device: torch.device
+):
+    """Flex attention block mask of the window of every query."""
+    left, right = window_size
+    offset = _window_offset(q_len, k_len)
+
+    def in_window(b, h, q_idx, kv_idx):
+        rel = kv_idx - q_idx - offset
+        return (rel >= -left) & (rel <= right)
+
+    return create_block_mask(in_window, None, None, q_len, k_len, device=device)
+
+
+@functools.lru_cache(maxsize=None)
+def _flex_attention_fn(device_type: str):
+    if device_type == "cuda":
+        return torch.compile(flex_attention, dynamic=False)
+    return flex_attention
+
+
+def full_attention(
+    query: torch.Tensor, key: torch.Tensor, value: torch.Tensor, backend: str
+) -> torch.Tensor:
+    """Attention of ``query``, ``key`` and ``value`` of shape
+    (batch, seq_len, heads, head_dim)."""
+    if backend == "flash":
+        return flash_attn.flash_attn_func(query, key, value)
+    return F.scaled_dot_product_attention(
+        query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2)
+    ).transpose(1, 2)
+
+
+def window_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    window_size: Sequence[int],
+    backend: str,
+) -> torch.Tensor:
+    """Attention of every query to the keys at most ``window_size`` (left,
+    right) tokens away, shapes as in :func:`full_attention`."""
+    window_size = tuple(window_size)
+    if backend == "flash":
+        return flash_attn.flash_attn_func(query, key, value, window_size=window_size)
+    q_len, k_len = query.shape[1], key.shape[1]
+    query, key, value = (
+        query.transpose(1, 2),
+        key.transpose(1, 2),
+        value.transpose(1, 2),
+    )
+    if backend == "flex":
+        block_mask = window_block_mask(q_len, k_len, window_size, query.device)
+        out = _flex_attention_fn(query.device.type)(
+            query, key, value, block_mask=block_mask
+        )
+    else:
+        out = F.scaled_dot_product_attention(
+            query,
+            key,
+            value,
+            attn_mask=window_mask(q_len, k_len, window_size, query.device),
+        )
+    return out.transpose(1, 2)
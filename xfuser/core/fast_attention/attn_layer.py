@@ -5,16 +5,21 @@
 
 import torch
 from diffusers.models.attention_processor import Attention
+from diffusers.models.embeddings import apply_rotary_emb
 from typing import Optional
 import torch.nn.functional as F
 
-try:
-    import flash_attn
-except ImportError:
-    flash_attn = None
-
 from enum import Flag, auto
-from .fast_attn_state import get_fast_attn_window_size
+from xfuser.core.distributed import get_sequence_parallel_world_size, get_sp_group
+from xfuser.core.distributed.runtime_state import get_runtime_state
+from .attn_backend import full_attention, resolve_backend, window_attention
+from .cache_storage import pack, unpack
+from .fast_attn_state import (
+    get_fast_attn_backend,
+    get_fast_attn_cache_dtype,
+    get_fast_attn_compact_cache,
+    get_fast_attn_window_size,
+)
 
 
 class FastAttnMethod(Flag):
@@ -35,18 +40,33 @@ class xFuserFastAttention:
     cond_first: bool = False
     need_compute_residual: list[bool] = []
     need_cache_output: bool = False
+    # whether the cached residual / output is read after every step
+    keep_residual: list[bool] = []
+    keep_output: list[bool] = []
+    # method of every chunk of a batch that stacks calibration trials
+    batch_methods: Optional[list[FastAttnMethod]] = None
 
     def __init__(
         self,
         steps_method: list[FastAttnMethod] = [],
         cond_first: bool = False,
+        hybrid_seq_parallel_attn=None,
     ):
         window_size = get_fast_attn_window_size()
         self.window_size = [window_size, window_size]
+        self.backend = get_fast_attn_backend()
+        # pack the cached residual and output, and drop them once the plan
+        # no longer reads them
+        self.compact_cache = get_fast_attn_compact_cache()
+        self.cache_dtype = get_fast_attn_cache_dtype()
         self.steps_method = steps_method
         # CFG order flag (conditional first or unconditional first)
         self.cond_first = cond_first
+        # the xFuserLongContextAttention of the processor, which runs the full
+        # attention of the sequence split among the sequence parallel ranks
+        self.hybrid_seq_parallel_attn = hybrid_seq_parallel_attn
         self.need_compute_residual = self.compute_need_compute_residual()
+        self.keep_residual, self.keep_output = self.compute_cache_lifetimes()
         self.need_cache_output = True
 
     def set_methods(
@@ -58,8 +78,11 @@ class xFuserFastAttention:
         if selecting:
             if len(self.need_compute_residual) != len(self.steps_method):
                 self.need_compute_residual = [False] * len(self.steps_method)
+            # the plan is not known yet, keep every cache
+            self.keep_residual, self.keep_output = [], []
         else:
             self.need_compute_residual = self.compute_need_compute_residual()
+            self.keep_residual, self.keep_output = self.compute_cache_lifetimes()
 
     def compute_need_compute_residual(self):
         """Check at which timesteps do we need to compute the full-window residual of this attention module"""
@@ -79,6 +102,53 @@ class xFuserFastAttention:
             need_compute_residual.append(need)
         return need_compute_residual
 
+    def compute_cache_lifetimes(self):
+        """Check after which timesteps the cached residual and output are still read"""
+        keep_residual, keep_output = [], []
+        for i in range(len(self.steps_method)):
+            keep = False
+            for method in self.steps_method[i + 1 :]:
+                if method.has(FastAttnMethod.FULL_ATTN):
+                    break
+                if method.has(FastAttnMethod.RESIDUAL_WINDOW_ATTN):
+                    keep = True
+                    break
+            keep_residual.append(keep)
+            keep_output.append(i + 1 < len(self.steps_method) and self.steps_method[i + 1].has(FastAttnMethod.OUTPUT_SHARE))
+        return keep_residual, keep_output
+
+    def cache_sizes(self, compact: bool, precision: float = 1.0) -> list[float]:
+        """Size of the residual and output cached after every step of the
+        plan, in attention outputs of the full batch. ``precision`` is the
+        size of a compact cache element relative to an activation, the
+        float8 scales are not counted."""
+        residual = output = 0.0
+        sizes = []
+        for i, method in enumerate(self.steps_method):
+            size = (0.5 if method.has(FastAttnMethod.CFG_SHARE) else 1.0) * precision if compact else 1.0
+            if method.has(FastAttnMethod.FULL_ATTN) and self.need_compute_residual[i]:
+                residual = size
+            if not method.has(FastAttnMethod.OUTPUT_SHARE):
+                output = size
+            if compact:
+                residual = residual if self.keep_residual[i] else 0.0
+                output = output if self.keep_output[i] else 0.0
+            sizes.append(residual + output)
+        return sizes
+
+    def release_cache(self, attn: Attention):
+        """Drop the cached residual and output the next steps do not read."""
+        if attn.stepi < len(self.keep_residual) and not self.keep_residual[attn.stepi]:
+            attn.cached_residual = None
+        if attn.stepi < len(self.keep_output) and not self.keep_output[attn.stepi]:
+            attn.cached_output = None
+
+    def pack_cache(self, tensors, repeats: int = 1):
+        """Compact cache entry of a tensor or a tuple of tensors."""
+        if isinstance(tensors, tuple):
+            return tuple(pack(tensor, self.cache_dtype, repeats) for tensor in tensors)
+        return pack(tensors, self.cache_dtype, repeats)
+
     def __call__(
         self,
         attn: Attention,
@@ -94,133 +164,524 @@ class xFuserFastAttention:
         method = self.steps_method[attn.stepi] if attn.stepi < len(self.steps_method) else FastAttnMethod.FULL_ATTN
         need_compute_residual = self.need_compute_residual[attn.stepi] if attn.stepi < len(self.need_compute_residual) else False
 
+        if self.batch_methods is None:
+            hidden_states = self.forward_method(
+                attn, method, need_compute_residual, hidden_states, encoder_hidden_states, attention_mask, temb, **kwargs
+            )
+        else:
+            # Calibration trials stacked along the batch, every chunk is a
+            # copy of the batch that runs its own method
+            n_chunks = len(self.batch_methods)
+            chunks = [
+                t.chunk(n_chunks) if t is not None else [None] * n_chunks
+                for t in (hidden_states, encoder_hidden_states, attention_mask)
+            ]
+            outputs = [
+                self.forward_method(attn, chunk_method, False, *chunk, temb, **kwargs)
+                for chunk_method, *chunk in zip(self.batch_methods, *chunks)
+            ]
+            if isinstance(outputs[0], tuple):
+                hidden_states = tuple(torch.cat(output, dim=0) for output in zip(*outputs))
+            else:
+                hidden_states = torch.cat(outputs, dim=0)
+
+        if self.compact_cache:
+            self.release_cache(attn)
+
+        # After been call once, add the timestep index of this attention module by 1
+        attn.stepi += 1
+
+        return hidden_states
+
+    def forward_method(
+        self,
+        attn: Attention,
+        method: FastAttnMethod,
+        need_compute_residual: bool,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        temb: Optional[torch.Tensor] = None,
+        **kwargs,
+    ):
         # Run the forward method according to the selected strategy
         residual = hidden_states
         if method.has(FastAttnMethod.OUTPUT_SHARE):
-            hidden_states = attn.cached_output
+            outputs = unpack(attn.cached_output)
         else:
             if method.has(FastAttnMethod.CFG_SHARE):
                 # Directly use the unconditional branch's attention output
                 # as the conditional branch's attention output
+                hidden_states = self.cfg_branch(hidden_states)
+                encoder_hidden_states = self.cfg_branch(encoder_hidden_states)
+                attention_mask = self.cfg_branch(attention_mask)
+
+            outputs = self.compute(
+                attn,
+                method,
+                need_compute_residual,
+                hidden_states,
+                encoder_hidden_states,
+                attention_mask,
+                temb,
+                **kwargs,
+            )
+
+            repeats = 2 if method.has(FastAttnMethod.CFG_SHARE) else 1
+            if self.need_cache_output and self.compact_cache:
+                keep = attn.stepi >= len(self.keep_output) or self.keep_output[attn.stepi]
+                # the CFG shared half is cached once
+                attn.cached_output = self.pack_cache(outputs, repeats) if keep else None
 
-                batch_size = hidden_states.shape[0]
-                if self.cond_first:
-                    hidden_states = hidden_states[: batch_size // 2]
+            if method.has(FastAttnMethod.CFG_SHARE):
+                if isinstance(outputs, tuple):
+                    outputs = tuple(torch.cat([output, output], dim=0) for output in outputs)
                 else:
-                    hidden_states = hidden_states[batch_size // 2 :]
-                if encoder_hidden_states is not None:
-                    if self.cond_first:
-                        encoder_hidden_states = encoder_hidden_states[: batch_size // 2]
-                    else:
-                        encoder_hidden_states = encoder_hidden_states[batch_size // 2 :]
-                if attention_mask is not None:
-                    if self.cond_first:
-                        attention_mask = attention_mask[: batch_size // 2]
-                    else:
-                        attention_mask = attention_mask[batch_size // 2 :]
-
-            if attn.spatial_norm is not None:
-                hidden_states = attn.spatial_norm(hidden_states, temb)
-
-            input_ndim = hidden_states.ndim
-
-            if input_ndim == 4:
-                batch_size, channel, height, width = hidden_states.shape
-                hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
-
-            batch_size, sequence_length, _ = hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
-            if attention_mask is not None:
-                attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
-                # scaled_dot_product_attention expects attention_mask shape to be
-                # (batch, heads, source_length, target_length)
-                attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
-
-            if attn.group_norm is not None:
-                hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
-
-            query = attn.to_q(hidden_states)
-
-            if encoder_hidden_states is None:
-                encoder_hidden_states = hidden_states
-            elif attn.norm_cross:
-                encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
-
-            key = attn.to_k(encoder_hidden_states)
-            value = attn.to_v(encoder_hidden_states)
-
-            inner_dim = key.shape[-1]
-            head_dim = inner_dim // attn.heads
-
-            query = query.view(batch_size, -1, attn.heads, head_dim)
-
-            key = key.view(batch_size, -1, attn.heads, head_dim)
-            value = value.view(batch_size, -1, attn.heads, head_dim)
-
-            if attention_mask is not None:
-                assert (
-                    method.has(FastAttnMethod.RESIDUAL_WINDOW_ATTN) == False
-                ), "Attention mask is not supported in windowed attention"
-
-                hidden_states = F.scaled_dot_product_attention(
-                    query.transpose(1, 2),
-                    key.transpose(1, 2),
-                    value.transpose(1, 2),
-                    attn_mask=attention_mask,
-                    dropout_p=0.0,
-                    is_causal=False,
-                ).transpose(1, 2)
-            elif method.has(FastAttnMethod.FULL_ATTN):
-                assert flash_attn is not None, f"FlashAttention is not available, please install flash_attn"
-                all_hidden_states = flash_attn.flash_attn_func(query, key, value)
-                if need_compute_residual:
-                    # Compute the full-window attention residual
-                    w_hidden_states = flash_attn.flash_attn_func(query, key, value, window_size=self.window_size)
-                    window_residual = all_hidden_states - w_hidden_states
-                    if method.has(FastAttnMethod.CFG_SHARE):
-                        window_residual = torch.cat([window_residual, window_residual], dim=0)
-                    # Save the residual for usage in follow-up steps
-                    attn.cached_residual = window_residual
-                hidden_states = all_hidden_states
-            elif method.has(FastAttnMethod.RESIDUAL_WINDOW_ATTN):
-                w_hidden_states = flash_attn.flash_attn_func(query, key, value, window_size=self.window_size)
-                hidden_states = w_hidden_states + attn.cached_residual[:batch_size].view_as(w_hidden_states)
-
-            hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
-            hidden_states = hidden_states.to(query.dtype)
+                    outputs = torch.cat([outputs, outputs], dim=0)
 
-            # linear proj
-            hidden_states = attn.to_out[0](hidden_states)
-            # dropout
-            hidden_states = attn.to_out[1](hidden_states)
+            if self.need_cache_output and not self.compact_cache:
+                attn.cached_output = outputs
 
-            if input_ndim == 4:
-                hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
-
-            if method.has(FastAttnMethod.CFG_SHARE):
-                hidden_states = torch.cat([hidden_states, hidden_states], dim=0)
-
-            if self.need_cache_output:
-                attn.cached_output = hidden_states
+        if isinstance(outputs, tuple):
+            return outputs
 
+        hidden_states = outputs
         if attn.residual_connection:
             hidden_states = hidden_states + residual
 
         hidden_states = hidden_states / attn.rescale_output_factor
 
-        # After been call once, add the timestep index of this attention module by 1
-        attn.stepi += 1
+        return hidden_states
+
+    def cfg_branch(self, tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        """The half of a classifier free guidance batch that is computed."""
+        if tensor is None:
+            return None
+        batch_size = tensor.shape[0]
+        return tensor[: batch_size // 2] if self.cond_first else tensor[batch_size // 2 :]
+
+    def attention(
+        self,
+        attn: Attention,
+        method: FastAttnMethod,
+        need_compute_residual: bool,
+        query: torch.Tensor,
+        key: torch.Tensor,
+        value: torch.Tensor,
+        sequence_parallel: bool = False,
+    ) -> torch.Tensor:
+        """Full or window attention with the cached residual of ``query``,
+        ``key`` and ``value`` of shape (batch, seq_len, heads, head_dim).
+
+        With ``sequence_parallel`` they are the local shards of a sequence
+        split among the sequence parallel ranks in rank order, and so are the
+        output and the cached residual.
+        """
+        batch_size = query.shape[0]
+        backend = resolve_backend(self.backend, query.device)
+        if sequence_parallel and get_sequence_parallel_world_size() > 1:
+            key_padding = get_runtime_state().sp_key_padding
+            full_fn = lambda q, k, v: self.sequence_parallel_full_attention(q, k, v, key_padding)
+            window_fn = lambda q, k, v: self.sequence_parallel_window_attention(q, k, v, key_padding, backend)
+        else:
+            full_fn = lambda q, k, v: full_attention(q, k, v, backend)
+            window_fn = lambda q, k, v: window_attention(q, k, v, self.window_size, backend)
+
+        if method.has(FastAttnMethod.FULL_ATTN):
+            all_hidden_states = full_fn(query, key, value)
+            if need_compute_residual:
+                # Compute the full-window attention residual
+                w_hidden_states = window_fn(query, key, value)
+                window_residual = all_hidden_states - w_hidden_states
+                # Save the residual for usage in follow-up steps
+                if self.compact_cache:
+                    attn.cached_residual = pack(
+                        window_residual, self.cache_dtype, 2 if method.has(FastAttnMethod.CFG_SHARE) else 1
+                    )
+                else:
+                    if method.has(FastAttnMethod.CFG_SHARE):
+                        window_residual = torch.cat([window_residual, window_residual], dim=0)
+                    attn.cached_residual = window_residual
+            return all_hidden_states
+        w_hidden_states = window_fn(query, key, value)
+        return w_hidden_states + unpack(attn.cached_residual, batch_size).view_as(w_hidden_states)
+
+    def sequence_parallel_full_attention(self, query, key, value, key_padding=None) -> torch.Tensor:
+        assert self.hybrid_seq_parallel_attn is not None, "DiTFastAttn with sequence parallelism needs yunchang"
+        return self.hybrid_seq_parallel_attn(
+            None,
+            query,
+            key,
+            value,
+            dropout_p=0.0,
+            causal=False,
+            joint_strategy="none",
+            key_padding=key_padding,
+        )
+
+    def sequence_parallel_window_attention(self, query, key, value, key_padding=None, backend="auto") -> torch.Tensor:
+        """Window attention of the local shards of a sequence parallel sequence.
+
+        A window reaches at most ``window_size`` tokens into the shards of the
+        neighbouring ranks, so the ranks gather the first and the last
+        ``window_size`` valid keys and values of every shard instead of
+        exchanging the whole sequence. The padded tokens at the end of the
+        shards (``key_padding`` as ``[ring_rank][ulysses_rank]``) are no keys,
+        their outputs are zero.
+        """
+        sp_group = get_sp_group()
+        window = self.window_size[0]
+        local_len = key.shape[1]
+        pad_token_num = [pad for ring in key_padding for pad in ring] if key_padding is not None else [0] * sp_group.world_size
+        valid_lens = [max(local_len - pad, 0) for pad in pad_token_num]
+        edge_len = min(window, local_len)
+
+        # [first edge_len keys, last edge_len valid keys, the same of the values]
+        edges = []
+        for tensor in (key, value):
+            tail_start = max(valid_lens[sp_group.rank_in_group] - edge_len, 0)
+            edges += [tensor[:, :edge_len], tensor[:, tail_start : tail_start + edge_len]]
+        gathered = sp_group.all_gather(torch.cat(edges, dim=1).contiguous(), dim=0, separate_tensors=True)
+
+        def valid_edges(rank, head):
+            key_edges, value_edges = gathered[rank][:, : 2 * edge_len], gathered[rank][:, 2 * edge_len :]
+            tail_start = max(valid_lens[rank] - edge_len, 0)
+            if head:
+                n = min(edge_len, valid_lens[rank])
+                return key_edges[:, :n], value_edges[:, :n]
+            n = valid_lens[rank] - tail_start
+            return key_edges[:, edge_len : edge_len + n], value_edges[:, edge_len : edge_len + n]
+
+        # the last window_size valid tokens before the shard and the first
+        # window_size after it, which may span several short shards
+        rank = sp_group.rank_in_group
+        prev_k, prev_v, next_k, next_v = [], [], [], []
+        for prev_rank in range(rank - 1, -1, -1):
+            if sum(t.shape[1] for t in prev_k) >= window:
+                break
+            k, v = valid_edges(prev_rank, head=False)
+            prev_k.insert(0, k)
+            prev_v.insert(0, v)
+        for next_rank in range(rank + 1, sp_group.world_size):
+            if sum(t.shape[1] for t in next_k) >= window:
+                break
+            k, v = valid_edges(next_rank, head=True)
+            next_k.append(k)
+            next_v.append(v)
+        valid_len = valid_lens[rank]
+        prev_k, prev_v = (torch.cat([t[:, :0]] + ts, dim=1) for t, ts in ((key, prev_k), (value, prev_v)))
+        prev_k, prev_v = prev_k[:, max(prev_k.shape[1] - window, 0) :], prev_v[:, max(prev_v.shape[1] - window, 0) :]
+        next_k, next_v = (torch.cat([t[:, :0]] + ts, dim=1)[:, :window] for t, ts in ((key, next_k), (value, next_v)))
+
+        # queries of the halo tokens are zeros whose outputs are dropped, the
+        # window of every local query is then the one in the whole sequence
+        n_prev, n_next = prev_k.shape[1], next_k.shape[1]
+        batch_size, _, heads, head_dim = query.shape
+        query = torch.cat(
+            [
+                query.new_zeros(batch_size, n_prev, heads, head_dim),
+                query[:, :valid_len],
+                query.new_zeros(batch_size, n_next, heads, head_dim),
+            ],
+            dim=1,
+        )
+        key = torch.cat([prev_k, key[:, :valid_len], next_k], dim=1)
+        value = torch.cat([prev_v, value[:, :valid_len], next_v], dim=1)
+        hidden_states = window_attention(query, key, value, self.window_size, resolve_backend(backend, query.device))
+        hidden_states = hidden_states[:, n_prev : n_prev + valid_len]
+        if valid_len < local_len:
+            hidden_states = torch.cat(
+                [hidden_states, hidden_states.new_zeros(batch_size, local_len - valid_len, heads, head_dim)], dim=1
+            )
+        return hidden_states
+
+    def compute(
+        self,
+        attn: Attention,
+        method: FastAttnMethod,
+        need_compute_residual: bool,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        temb: Optional[torch.Tensor] = None,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+        **kwargs,
+    ):
+        """Attention output of the batch before the residual connection."""
+        if attn.spatial_norm is not None:
+            hidden_states = attn.spatial_norm(hidden_states, temb)
+
+        input_ndim = hidden_states.ndim
+
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+
+        batch_size, sequence_length, _ = hidden_states.shape if encoder_hidden_states is None else encoder_hidden_states.shape
+        if attention_mask is not None:
+            attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+            # scaled_dot_product_attention expects attention_mask shape to be
+            # (batch, heads, source_length, target_length)
+            attention_mask = attention_mask.view(batch_size, attn.heads, -1, attention_mask.shape[-1])
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = attn.to_q(hidden_states)
+
+        is_cross_attention = encoder_hidden_states is not None
+        if encoder_hidden_states is None:
+            encoder_hidden_states = hidden_states
+        elif attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+        key = attn.to_k(encoder_hidden_states)
+        value = attn.to_v(encoder_hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim)
+
+        key = key.view(batch_size, -1, attn.heads, head_dim)
+        value = value.view(batch_size, -1, attn.heads, head_dim)
+
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        if image_rotary_emb is not None:
+            # rotary embeddings are applied in (batch, heads, seq_len, head_dim)
+            query = apply_rotary_emb(query.transpose(1, 2), image_rotary_emb).transpose(1, 2)
+            if not is_cross_attention:
+                key = apply_rotary_emb(key.transpose(1, 2), image_rotary_emb).transpose(1, 2)
+
+        if attention_mask is not None:
+            assert (
+                method.has(FastAttnMethod.RESIDUAL_WINDOW_ATTN) == False
+            ), "Attention mask is not supported in windowed attention"
+            assert (
+                is_cross_attention or get_sequence_parallel_world_size() == 1
+            ), "Attention mask is not supported in sequence parallel self attention"
+
+            hidden_states = F.scaled_dot_product_attention(
+                query.transpose(1, 2),
+                key.transpose(1, 2),
+                value.transpose(1, 2),
+                attn_mask=attention_mask,
+                dropout_p=0.0,
+                is_causal=False,
+            ).transpose(1, 2)
+        else:
+            # the keys of cross attention are the whole text on every rank
+            hidden_states = self.attention(
+                attn, method, need_compute_residual, query, key, value, sequence_parallel=not is_cross_attention
+            )
+
+        hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
 
         return hidden_states
 
 
-# TODO: Implement classes to support DiTFastAttn in different diffusion models
 class xFuserJointFastAttention(xFuserFastAttention):
-    pass
+    """DiTFastAttn of the joint attention of SD3, the image tokens followed
+    by the text tokens in one sequence. The window slides over the joint
+    sequence, output and residual sharing cover both streams.
+
+    With sequence parallelism the text is split among the ranks like the
+    image, and the window slides over the local joint sequences in rank
+    order. The text goes in front when the image tokens are padded, the
+    padding has to end the local sequence.
+    """
+
+    def compute(
+        self,
+        attn: Attention,
+        method: FastAttnMethod,
+        need_compute_residual: bool,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        temb: Optional[torch.Tensor] = None,
+        **kwargs,
+    ):
+        batch_size = hidden_states.shape[0]
+        num_query_tokens = hidden_states.shape[1]
+
+        # `sample` projections.
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim)
+        key = key.view(batch_size, -1, attn.heads, head_dim)
+        value = value.view(batch_size, -1, attn.heads, head_dim)
+
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        # `context` projections.
+        if encoder_hidden_states is not None:
+            encoder_hidden_states_query_proj = attn.add_q_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim)
+            encoder_hidden_states_key_proj = attn.add_k_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim)
+            encoder_hidden_states_value_proj = attn.add_v_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim)
+
+            if attn.norm_added_q is not None:
+                encoder_hidden_states_query_proj = attn.norm_added_q(encoder_hidden_states_query_proj)
+            if attn.norm_added_k is not None:
+                encoder_hidden_states_key_proj = attn.norm_added_k(encoder_hidden_states_key_proj)
+
+            text_in_front = False
+            if get_sequence_parallel_world_size() > 1:
+                assert get_runtime_state().split_text_embed_in_sp, (
+                    "DiTFastAttn with sequence parallelism needs the text split among the ranks"
+                )
+                text_in_front = get_runtime_state().sp_key_padding is not None
+            if text_in_front:
+                query = torch.cat([encoder_hidden_states_query_proj, query], dim=1)
+                key = torch.cat([encoder_hidden_states_key_proj, key], dim=1)
+                value = torch.cat([encoder_hidden_states_value_proj, value], dim=1)
+            else:
+                query = torch.cat([query, encoder_hidden_states_query_proj], dim=1)
+                key = torch.cat([key, encoder_hidden_states_key_proj], dim=1)
+                value = torch.cat([value, encoder_hidden_states_value_proj], dim=1)
+
+        hidden_states = self.attention(
+            attn, method, need_compute_residual, query, key, value, sequence_parallel=True
+        )
+        hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        # Split the attention outputs.
+        if encoder_hidden_states is not None:
+            if text_in_front:
+                encoder_hidden_states, hidden_states = hidden_states.split(
+                    [hidden_states.shape[1] - num_query_tokens, num_query_tokens], dim=1
+                )
+            else:
+                hidden_states, encoder_hidden_states = (
+                    hidden_states[:, :num_query_tokens],
+                    hidden_states[:, num_query_tokens:],
+                )
+            if not attn.context_pre_only:
+                encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if encoder_hidden_states is not None:
+            return hidden_states, encoder_hidden_states
+        return hidden_states
 
 
 class xFuserFluxFastAttention(xFuserFastAttention):
-    pass
+    """DiTFastAttn of the rotary joint attention of Flux, the text tokens
+    followed by the image tokens. The single stream blocks get the joint
+    sequence as their hidden states and return it without projection.
+    With sequence parallelism the text is split among the ranks like the
+    image, see :class:`xFuserJointFastAttention`."""
+
+    def compute(
+        self,
+        attn: Attention,
+        method: FastAttnMethod,
+        need_compute_residual: bool,
+        hidden_states: torch.Tensor,
+        encoder_hidden_states: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        temb: Optional[torch.Tensor] = None,
+        image_rotary_emb: Optional[torch.Tensor] = None,
+        **kwargs,
+    ):
+        batch_size = hidden_states.shape[0]
+
+        # `sample` projections.
+        query = attn.to_q(hidden_states)
+        key = attn.to_k(hidden_states)
+        value = attn.to_v(hidden_states)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        if attn.norm_q is not None:
+            query = attn.norm_q(query)
+        if attn.norm_k is not None:
+            key = attn.norm_k(key)
+
+        # the attention in FluxSingleTransformerBlock does not use `encoder_hidden_states`
+        if encoder_hidden_states is not None:
+            # `context` projections.
+            encoder_hidden_states_query_proj = attn.add_q_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            encoder_hidden_states_key_proj = attn.add_k_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+            encoder_hidden_states_value_proj = attn.add_v_proj(encoder_hidden_states).view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+            if attn.norm_added_q is not None:
+                encoder_hidden_states_query_proj = attn.norm_added_q(encoder_hidden_states_query_proj)
+            if attn.norm_added_k is not None:
+                encoder_hidden_states_key_proj = attn.norm_added_k(encoder_hidden_states_key_proj)
+
+            query = torch.cat([encoder_hidden_states_query_proj, query], dim=2)
+            key = torch.cat([encoder_hidden_states_key_proj, key], dim=2)
+            value = torch.cat([encoder_hidden_states_value_proj, value], dim=2)
+
+        if image_rotary_emb is not None:
+            query = apply_rotary_emb(query, image_rotary_emb)
+            key = apply_rotary_emb(key, image_rotary_emb)
+
+        if get_sequence_parallel_world_size() > 1:
+            assert get_runtime_state().split_text_embed_in_sp, (
+                "DiTFastAttn with sequence parallelism needs the text split among the ranks"
+            )
+        hidden_states = self.attention(
+            attn,
+            method,
+            need_compute_residual,
+            query.transpose(1, 2),
+            key.transpose(1, 2),
+            value.transpose(1, 2),
+            sequence_parallel=True,
+        )
+        hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
+
+        if encoder_hidden_states is None:
+            return hidden_states
+
+        encoder_hidden_states, hidden_states = (
+            hidden_states[:, : encoder_hidden_states.shape[1]],
+            hidden_states[:, encoder_hidden_states.shape[1] :],
+        )
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+        encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+
+        return hidden_states, encoder_hidden_states
 
 
 class xFuserHunyuanFastAttention(xFuserFastAttention):
-    pass
+    """DiTFastAttn of HunyuanDiT, whose self attention rotates the queries
+    and keys of the image tokens, see :meth:`xFuserFastAttention.compute`."""
@@ -0,0 +1,90 @@
+# Copyright 2024 xDiT team.
+"""
+Compact storage of the residuals and outputs DiTFastAttn caches between steps.
+
+A :class:`CompactTensor` holds a cached tensor
+
+- in a lower precision ``dtype``; float8 keeps a float32 scale per token,
+- once for the two halves of a classifier free guidance batch that share it
+  (``repeats=2``) instead of the ``torch.cat([x, x])`` of the full batch.
+"""
+import dataclasses
+from typing import Optional, Union
+
+import torch
+
+FAST_ATTN_CACHE_DTYPES = ["float16", "bfloat16", "float8_e4m3fn"]
+
+_FLOAT8_DTYPES = {
+    getattr(torch, name)
+    for name in ["float8_e4m3fn", "float8_e5m2"]
+    if hasattr(torch, name)
+}
+
+
+@dataclasses.dataclass
+class CompactTensor:
+    data: torch.Tensor
+    # float8: scale of every token, shape (batch, seq_len)
+    scale: Optional[torch.Tensor]
+    # dtype of the tensor that was packed
+    dtype: torch.dtype
+    # times the batch of ``data`` repeats in the packed tensor
+    repeats: int = 1
+
+    @property
+    def nbytes(self) -> int:
+        scale_bytes = (
+            self.scale.numel() * self.scale.element_size()
+            if self.scale is not None
+            else 0
+        )
+        return self.data.numel() * self.data.element_size() + scale_bytes
+
+    def unpack(self, batch_size: Optional[int] = None) -> torch.Tensor:
+        """The first ``batch_size`` samples of the packed tensor, all by default."""
+        stored = self.data.shape[0]
+        batch_size = stored * self.repeats if batch_size is None else batch_size
+        n = min(batch_size, stored)
+        tensor = self.data[:n].to(self.dtype)
+        if self.scale is not None:
+            scale = self.scale[:n]
+            tensor = tensor * scale.view(*scale.shape, *[1] * (tensor.dim() - 2)).to(
+                self.dtype
+            )
+        if batch_size > n:
+            tensor = tensor.repeat(-(-batch_size // n), *[1] * (tensor.dim() - 1))[
+                :batch_size
+            ]
+        return tensor
+
+
+def pack(
+    tensor: torch.Tensor, dtype: Optional[torch.dtype] = None, repeats: int = 1
+) -> CompactTensor:
+    """Pack ``tensor`` of shape (batch, seq_len, ...) in ``dtype``, the
+    dtype of ``tensor`` if None or not smaller."""
+    if dtype is None or dtype.itemsize >= tensor.element_size():
+        return CompactTensor(tensor, None, tensor.dtype, repeats)
+    if dtype in _FLOAT8_DTYPES:
+        amax = tensor.detach().flatten(2).abs().amax(dim=-1).float()
+        scale = (amax / torch.finfo(dtype).max).clamp(min=1e-12)
+        data = (
+            tensor.float() / scale.view(*scale.shape, *[1] * (tensor.dim() - 2))
+        ).to(dtype)
+        return CompactTensor(data, scale, tensor.dtype, repeats)
+    return CompactTensor(tensor.to(dtype), None, tensor.dtype, repeats)
+
+
+def unpack(
+    entry: Union[torch.Tensor, CompactTensor, tuple, None],
+    batch_size: Optional[int] = None,
+):
+    """Unpack a cached tensor, tuple of cached tensors or plain tensor."""
+    if entry is None:
+        return None
+    if isinstance(entry, tuple):
+        return tuple(unpack(e, batch_size) for e in entry)
+    if isinstance(entry, CompactTensor):
+        return entry.unpack(batch_size)
+    return entry if batch_size is None else entry[:batch_size]
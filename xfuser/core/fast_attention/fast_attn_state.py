@@ -1,4 +1,5 @@
 from typing import Optional
+import torch
 from diffusers import DiffusionPipeline
 from xfuser.config.config import (
     ParallelConfig,
@@ -11,15 +12,30 @@ from xfuser.logger import init_logger
 
 logger = init_logger(__name__)
 
+# attributes of the transformer holding its blocks, in the order they run
+BLOCK_LIST_NAMES = ["transformer_blocks", "single_transformer_blocks", "blocks"]
+
+
+def fast_attn_blocks(transformer) -> list:
+    """Return the blocks of the transformer whose attention is compressed."""
+    blocks = []
+    for name in BLOCK_LIST_NAMES:
+        blocks.extend(getattr(transformer, name, None) or [])
+    return blocks
+
 
 class FastAttnState:
     enable: bool = False
     n_step: int = 20
     n_calib: int = 8
+    n_calib_trials: int = 1
     threshold: float = 0.5
     window_size: int = 64
     coco_path: Optional[str] = None
     use_cache: bool = False
+    backend: str = "auto"
+    compact_cache: bool = False
+    cache_dtype: Optional[str] = None
     config_file: str
     layer_name: str
 
@@ -28,10 +44,14 @@ class FastAttnState:
         if self.enable:
             self.n_step = config.n_step
             self.n_calib = config.n_calib
+            self.n_calib_trials = config.n_calib_trials
             self.threshold = config.threshold
             self.window_size = config.window_size
             self.coco_path = config.coco_path
             self.use_cache = config.use_cache
+            self.backend = config.backend
+            self.compact_cache = config.compact_cache
+            self.cache_dtype = config.cache_dtype
             self.config_file = self.config_file_path(pipe, config)
             self.layer_name = self.attn_name_to_wrap(pipe)
 
@@ -43,8 +63,9 @@ class FastAttnState:
         """Return the attr name of attention layer to wrap."""
         names = ["attn1", "attn"]  # names of self attention layer
         assert hasattr(pipe, "transformer"), "transformer is not found in pipeline."
-        assert hasattr(pipe.transformer, "transformer_blocks"), "transformer_blocks is not found in pipeline."
-        block = pipe.transformer.transformer_blocks[0]
+        blocks = fast_attn_blocks(pipe.transformer)
+        assert len(blocks) > 0, f"None of {BLOCK_LIST_NAMES} is found in the transformer."
+        block = blocks[0]
         for name in names:
             if hasattr(block, name):
                 return name
@@ -78,6 +99,12 @@ def get_fast_attn_calib() -> int:
     return get_fast_attn_state().n_calib
 
 
+def get_fast_attn_calib_trials() -> int:
+    """Return the number of compression methods tried in one forward."""
+    assert get_fast_attn_state() is not None, "FastAttn state is not initialized"
+    return get_fast_attn_state().n_calib_trials
+
+
 def get_fast_attn_threshold() -> float:
     """Return the fast attention threshold."""
     return get_fast_attn_state().threshold
@@ -88,6 +115,22 @@ def get_fast_attn_window_size() -> int:
     return get_fast_attn_state().window_size
 
 
+def get_fast_attn_backend() -> str:
+    """Return the attention backend of fast attention."""
+    return get_fast_attn_state().backend
+
+
+def get_fast_attn_compact_cache() -> bool:
+    """Return whether fast attention packs its cached residuals and outputs."""
+    return get_fast_attn_state().compact_cache
+
+
+def get_fast_attn_cache_dtype() -> Optional[torch.dtype]:
+    """Return the dtype of the compact cache, None to keep the activation dtype."""
+    cache_dtype = get_fast_attn_state().cache_dtype
+    return getattr(torch, cache_dtype) if cache_dtype is not None else None
+
+
 def get_fast_attn_coco_path() -> Optional[str]:
     """Return the fast attention coco path."""
     return get_fast_attn_state().coco_path
@@ -108,6 +151,11 @@ def get_fast_attn_layer_name() -> str:
     return get_fast_attn_state().layer_name
 
 
+def get_fast_attn_layers(transformer) -> list:
+    """Return the attention layers DiTFastAttn compresses, one per block."""
+    return [getattr(block, get_fast_attn_layer_name()) for block in fast_attn_blocks(transformer)]
+
+
 def initialize_fast_attn_state(pipeline: DiffusionPipeline, single_config: FastAttnConfig):
     global _FASTATTN
     if _FASTATTN is not None:
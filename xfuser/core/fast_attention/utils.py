@@ -3,10 +3,17 @@
 # https://github.com/thu-nics/DiTFastAttn/blob/main/dit_fast_attention.py
 # Copyright (c) 2024 NICS-EFC Lab of Tsinghua University.
 
+import dataclasses
+import inspect
+from typing import Optional
+
 import torch
 from xfuser.core.distributed import (
     get_dp_group,
+    get_sp_group,
     get_data_parallel_rank,
+    get_data_parallel_world_size,
+    get_sequence_parallel_rank,
 )
 from diffusers import DiffusionPipeline
 from diffusers.models.transformers.transformer_2d import Transformer2DModel
@@ -20,11 +27,15 @@ import numpy as np
 from .fast_attn_state import (
     get_fast_attn_step,
     get_fast_attn_calib,
+    get_fast_attn_calib_trials,
     get_fast_attn_threshold,
     get_fast_attn_coco_path,
     get_fast_attn_use_cache,
     get_fast_attn_config_file,
     get_fast_attn_layer_name,
+    get_fast_attn_layers,
+    get_fast_attn_compact_cache,
+    get_fast_attn_cache_dtype,
 )
 
 from .attn_layer import (
@@ -39,14 +50,17 @@ logger = init_logger(__name__)
 
 def save_config_file(step_methods, file_path):
     folder = os.path.dirname(file_path)
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
     format_data = {
         f"block{blocki}": {f"step{stepi}": method.name for stepi, method in enumerate(methods)}
         for blocki, methods in enumerate(step_methods)
     }
-    with open(file_path, "w") as file:
+    # a crash mid-write must not leave a truncated plan to resume from
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
         json.dump(format_data, file, indent=2)
+    os.replace(tmp_path, file_path)
 
 
 def load_config_file(file_path):
@@ -56,98 +70,236 @@ def load_config_file(file_path):
     return steps_methods
 
 
-def compression_loss(a, b):
+def partial_config_file(file_path):
+    """Path of the plan of a selection in progress, whose blocks may cover
+    fewer steps than the final plan."""
+    return f"{file_path}.partial"
+
+
+METHOD_CANDIDATES = [
+    FastAttnMethod.OUTPUT_SHARE,
+    FastAttnMethod.RESIDUAL_WINDOW_ATTN_CFG_SHARE,
+    FastAttnMethod.RESIDUAL_WINDOW_ATTN,
+    FastAttnMethod.FULL_ATTN_CFG_SHARE,
+]
+
+
+def num_candidate_groups(dp_degree: int, n_candidates: int) -> int:
+    """Number of groups of data parallel ranks that try different method
+    candidates, the largest divisor of ``dp_degree`` up to ``n_candidates``.
+    The ranks of a group split the calibration prompts."""
+    return max(g for g in range(1, min(dp_degree, n_candidates) + 1) if dp_degree % g == 0)
+
+
+def calibration_prompts(prompts: list, dp_degree: int, n_groups: int) -> list:
+    """Prompt list whose data parallel split gives every candidate group the
+    whole prompt set, sharded among the ranks of the group.
+
+    Rank ``r`` is in candidate group ``r % n_groups`` and takes prompt shard
+    ``r // n_groups``. Shards are padded with prompts from the start of the
+    set to the same length, the split gives every rank the same count.
+    """
+    n_shards = dp_degree // n_groups
+    shard_size = (len(prompts) + n_shards - 1) // n_shards
+    return [
+        prompts[(rank // n_groups * shard_size + i) % len(prompts)]
+        for rank in range(dp_degree)
+        for i in range(shard_size)
+    ]
+
+
+def _output_tensors(outs):
+    if outs.__class__.__name__ == "Transformer2DModelOutput":
+        return [outs.sample]
+    return [out for out in outs if isinstance(out, torch.Tensor)]
+
+
+def _repeat_batch(value, batch_size: int, repeats: int):
+    if isinstance(value, torch.Tensor) and value.ndim > 0 and value.shape[0] == batch_size:
+        return torch.cat([value] * repeats, dim=0)
+    if isinstance(value, dict):
+        return {k: _repeat_batch(v, batch_size, repeats) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_repeat_batch(v, batch_size, repeats) for v in value)
+    return value
+
+
+def local_compression_loss(a, b):
+    """Loss of the outputs ``b`` against ``a`` on this rank and its weight,
+    the number of output elements."""
     ls = []
-    if a.__class__.__name__ == "Transformer2DModelOutput":
-        a = [a.sample]
-        b = [b.sample]
-    weight = torch.tensor(0.0)
-    for ai, bi in zip(a, b):
-        if isinstance(ai, torch.Tensor):
-            weight += ai.numel()
-            diff = (ai - bi) / (torch.max(ai, bi) + 1e-6)
-            loss = diff.abs().clip(0, 10).mean()
-            ls.append(loss)
-    weight_sum = get_dp_group().all_reduce(weight.clone().to(ai.device))
-    local_loss = (weight / weight_sum) * (sum(ls) / len(ls))
-    global_loss = get_dp_group().all_reduce(local_loss.clone().to(ai.device)).item()
+    weight = 0
+    for ai, bi in zip(_output_tensors(a), _output_tensors(b)):
+        weight += ai.numel()
+        diff = (ai - bi) / (torch.max(ai, bi) + 1e-6)
+        loss = diff.abs().clip(0, 10).mean()
+        ls.append(loss)
+    return sum(ls) / len(ls), weight
+
+
+def compression_loss(a, b):
+    local_loss, weight = local_compression_loss(a, b)
+    device = local_loss.device
+    weight_sum = get_dp_group().all_reduce(torch.tensor(float(weight), device=device))
+    local_loss = (weight / weight_sum) * local_loss
+    global_loss = get_dp_group().all_reduce(local_loss.clone()).item()
     return global_loss
 
 
+@dataclasses.dataclass
+class _CalibrationState:
+    # [step][block] loss threshold of a compression method
+    loss_thresholds: list
+    # candidate groups of the data parallel ranks, and the candidates this
+    # rank tries with their index in METHOD_CANDIDATES
+    n_groups: int
+    candidates: list
+    trials_per_forward: int
+    checkpoint_path: Optional[str] = None
+    # per block, the methods of the steps a previous selection decided
+    resumed: list = dataclasses.field(default_factory=list)
+    # per block, the number of steps decided so far
+    decided: list = dataclasses.field(default_factory=list)
+
+    def resumed_method(self, blocki, stepi):
+        if blocki < len(self.resumed) and stepi < len(self.resumed[blocki]):
+            return self.resumed[blocki][stepi]
+        return None
+
+
+def _is_first_rank():
+    return get_data_parallel_rank() == 0 and get_sequence_parallel_rank() == 0
+
+
+def _reset_stepi(m: Transformer2DModel, stepi: int):
+    # Set the timestep index of every layer back to stepi
+    # (which are increased by one in every forward)
+    for layer in m.modules():
+        if isinstance(layer, xFuserAttentionBaseWrapper):
+            layer.stepi = stepi
+
+
+def run_trials(m: Transformer2DModel, blocki: int, stepi: int, trials: list, raw_outs, args, kwargs):
+    """Outputs of the transformer with every method in ``trials`` at
+    ``blocki``. Several trials run in one forward on copies of the batch,
+    every attention layer runs its method on every copy, the one of
+    ``blocki`` the trial of the copy."""
+    fast_attns = [layer.processor.fast_attn for layer in get_fast_attn_layers(m)]
+    _reset_stepi(m, stepi)
+    if len(trials) == 1:
+        # Try compress this attention using the method
+        fast_attns[blocki].steps_method[stepi] = trials[0]
+        return [m.forward(*args, **kwargs)]
+
+    batch_size = _output_tensors(raw_outs)[0].shape[0]
+    for i, fast_attn in enumerate(fast_attns):
+        fast_attn.batch_methods = list(trials) if i == blocki else [fast_attn.steps_method[stepi]] * len(trials)
+    try:
+        outs = m.forward(
+            *_repeat_batch(args, batch_size, len(trials)),
+            **_repeat_batch(kwargs, batch_size, len(trials)),
+        )
+    finally:
+        for fast_attn in fast_attns:
+            fast_attn.batch_methods = None
+    chunks = [out.chunk(len(trials)) for out in _output_tensors(outs)]
+    return [list(chunk) for chunk in zip(*chunks)]
+
+
+def select_method(m: Transformer2DModel, blocki: int, stepi: int, raw_outs, args, kwargs):
+    """The first method candidate of ``blocki`` at ``stepi`` whose loss is
+    below the threshold, full attention if none is.
+
+    The candidate groups of data parallel ranks try their candidates in
+    rounds of ``trials_per_forward`` each and reduce the losses after every
+    round. The selection stops once a candidate is below the threshold and
+    every candidate before it has been tried, so it selects the method that
+    trying the candidates one after the other does.
+    """
+    state: _CalibrationState = m.fast_attn_calibration
+    threshold = state.loss_thresholds[stepi][blocki]
+    n_candidates = len(METHOD_CANDIDATES)
+    per_round = state.n_groups * state.trials_per_forward
+    device = _output_tensors(raw_outs)[0].device
+    # weighted loss and weight of every candidate
+    sums = torch.zeros(2, n_candidates, device=device)
+    for round_i in range((n_candidates + per_round - 1) // per_round):
+        trials = state.candidates[round_i * state.trials_per_forward : (round_i + 1) * state.trials_per_forward]
+        round_sums = torch.zeros(2, n_candidates, device=device)
+        if trials:
+            outs_list = run_trials(m, blocki, stepi, [method for _, method in trials], raw_outs, args, kwargs)
+            for (idx, _), outs in zip(trials, outs_list):
+                loss, weight = local_compression_loss(raw_outs, outs)
+                round_sums[0, idx] = loss * weight
+                round_sums[1, idx] = weight
+            del outs_list
+        # the sequence parallel ranks of a data parallel rank run the same
+        # trials, the sums over their outputs keep their decisions the same
+        sums += get_dp_group().all_reduce(get_sp_group().all_reduce(round_sums))
+        tried = min(n_candidates, (round_i + 1) * per_round)
+        for idx in range(tried):
+            if (sums[0, idx] / sums[1, idx]).item() < threshold:
+                return METHOD_CANDIDATES[idx]
+    return FastAttnMethod.FULL_ATTN
+
+
 def transformer_forward_pre_hook(m: Transformer2DModel, args, kwargs):
-    attn_name = get_fast_attn_layer_name()
-    now_stepi = getattr(m.transformer_blocks[0], attn_name).stepi
-    # batch_size = get_fast_attn_calib()
-    # dp_degree =
+    layers = get_fast_attn_layers(m)
+    now_stepi = layers[0].stepi
+    state: _CalibrationState = m.fast_attn_calibration
+    selecting = now_stepi > 0 and any(
+        state.resumed_method(blocki, now_stepi) is None for blocki in range(len(layers))
+    )
 
-    for blocki, block in enumerate(m.transformer_blocks):
+    for layer in layers:
         # Set `need_compute_residual` to False to avoid the process of trying different
         # compression strategies to override the saved residual.
-        fast_attn = getattr(block, attn_name).processor.fast_attn
+        fast_attn = layer.processor.fast_attn
         fast_attn.need_compute_residual[now_stepi] = False
         fast_attn.need_cache_output = False
-    raw_outs = m.forward(*args, **kwargs)
-    for blocki, block in enumerate(m.transformer_blocks):
-        if now_stepi == 0:
-            continue
-        fast_attn = getattr(block, attn_name).processor.fast_attn
-        method_candidates = [
-            FastAttnMethod.OUTPUT_SHARE,
-            FastAttnMethod.RESIDUAL_WINDOW_ATTN_CFG_SHARE,
-            FastAttnMethod.RESIDUAL_WINDOW_ATTN,
-            FastAttnMethod.FULL_ATTN_CFG_SHARE,
-        ]
-        selected_method = FastAttnMethod.FULL_ATTN
-        for method in method_candidates:
-            # Try compress this attention using `method`
-            fast_attn.steps_method[now_stepi] = method
-
-            # Set the timestep index of every layer back to now_stepi
-            # (which are increased by one in every forward)
-            for _block in m.transformer_blocks:
-                for layer in _block.children():
-                    if isinstance(layer, xFuserAttentionBaseWrapper):
-                        layer.stepi = now_stepi
-
-            # Compute the overall transformer output
-            outs = m.forward(*args, **kwargs)
-
-            loss = compression_loss(raw_outs, outs)
-            threshold = m.loss_thresholds[now_stepi][blocki]
-
-            if loss < threshold:
-                selected_method = method
-                break
-
-        fast_attn.steps_method[now_stepi] = selected_method
-        del loss, outs
+    # the output with full attention in every block, the steps a previous
+    # selection decided need no trials
+    raw_outs = m.forward(*args, **kwargs) if selecting else None
+    for blocki, layer in enumerate(layers):
+        fast_attn = layer.processor.fast_attn
+        resumed_method = state.resumed_method(blocki, now_stepi)
+        if resumed_method is not None:
+            fast_attn.steps_method[now_stepi] = resumed_method
+        elif now_stepi > 0:
+            fast_attn.steps_method[now_stepi] = select_method(m, blocki, now_stepi, raw_outs, args, kwargs)
+        state.decided[blocki] = now_stepi + 1
+        if resumed_method is None and now_stepi > 0 and state.checkpoint_path is not None:
+            save_config_file(
+                [l.processor.fast_attn.steps_method[:n] for l, n in zip(layers, state.decided)],
+                state.checkpoint_path,
+            )
     del raw_outs
 
-    # Set the timestep index of every layer back to now_stepi
-    # (which are increased by one in every forward)
-    for _block in m.transformer_blocks:
-        for layer in _block.children():
-            if isinstance(layer, xFuserAttentionBaseWrapper):
-                layer.stepi = now_stepi
+    _reset_stepi(m, now_stepi)
 
-    for blocki, block in enumerate(m.transformer_blocks):
+    for layer in layers:
         # During the compression plan decision process,
         # we set the `need_compute_residual` property of all attention modules to `True`,
         # so that all full attention modules will save its residual for convenience.
         # The residual will be saved in the follow-up forward call.
-        fast_attn = getattr(block, attn_name).processor.fast_attn
+        fast_attn = layer.processor.fast_attn
         fast_attn.need_compute_residual[now_stepi] = True
         fast_attn.need_cache_output = True
 
 
-def select_methods(pipe: DiffusionPipeline):
-    blocks = pipe.transformer.transformer_blocks
+def select_methods(pipe: DiffusionPipeline, resumed: Optional[list] = None):
+    """Select the compression method of every block and step.
+
+    The methods of the blocks and steps in ``resumed``, the plan of an
+    interrupted selection, are taken as they are. Rank 0 saves the plan
+    after every selected block to the partial config file.
+    """
     transformer: Transformer2DModel = pipe.transformer
-    attn_name = get_fast_attn_layer_name()
+    blocks = get_fast_attn_layers(transformer)
     n_steps = get_fast_attn_step()
     # reset all processors
-    for block in blocks:
-        fast_attn: xFuserFastAttention = getattr(block, attn_name).processor.fast_attn
+    for layer in blocks:
+        fast_attn: xFuserFastAttention = layer.processor.fast_attn
         fast_attn.set_methods(
             [FastAttnMethod.FULL_ATTN] * n_steps,
             selecting=True,
@@ -162,9 +314,35 @@ def select_methods(pipe: DiffusionPipeline):
             sub_list.append(threshold_i)
         loss_thresholds.append(sub_list)
 
+    # Spread the candidates over the data parallel ranks
+    dp_degree = get_data_parallel_world_size()
+    n_groups = num_candidate_groups(dp_degree, len(METHOD_CANDIDATES))
+    group = get_data_parallel_rank() % n_groups
+    candidates = list(enumerate(METHOD_CANDIDATES))[group::n_groups]
+    call_parameters = inspect.signature(pipe.__call__).parameters
+    if not any(p.kind == inspect.Parameter.VAR_KEYWORD for p in call_parameters.values()):
+        call_parameters = set(call_parameters)
+    else:
+        call_parameters = None
+    if "guidance_embeds" in transformer.config or (call_parameters is not None and "negative_prompt" not in call_parameters):
+        # guidance distilled models (Flux) run no unconditional branch to share
+        candidates = [(idx, method) for idx, method in candidates if not method.has(FastAttnMethod.CFG_SHARE)]
+
+    if resumed is not None and len(resumed) != len(blocks):
+        logger.warning(f"Ignoring the partial plan of {len(resumed)} blocks, the model has {len(blocks)}")
+        resumed = None
+
     # calibration
     hook = transformer.register_forward_pre_hook(transformer_forward_pre_hook, with_kwargs=True)
-    transformer.loss_thresholds = loss_thresholds
+    transformer.fast_attn_calibration = _CalibrationState(
+        loss_thresholds=loss_thresholds,
+        n_groups=n_groups,
+        candidates=candidates,
+        trials_per_forward=get_fast_attn_calib_trials(),
+        checkpoint_path=partial_config_file(get_fast_attn_config_file()) if _is_first_rank() else None,
+        resumed=resumed or [],
+        decided=[0] * len(blocks),
+    )
 
     seed = 3
     guidance_scale = 4.5
@@ -175,8 +353,8 @@ def select_methods(pipe: DiffusionPipeline):
     np.random.seed(seed)
     slice_ = np.random.choice(mscoco_anno["annotations"], get_fast_attn_calib())
     calib_x = [d["caption"] for d in slice_]
-    pipe(
-        prompt=calib_x,
+    call_kwargs = dict(
+        prompt=calibration_prompts(calib_x, dp_degree, n_groups),
         num_inference_steps=n_steps,
         generator=torch.manual_seed(seed),
         output_type="latent",
@@ -184,11 +362,12 @@ def select_methods(pipe: DiffusionPipeline):
         return_dict=False,
         guidance_scale=guidance_scale,
     )
+    pipe(**{k: v for k, v in call_kwargs.items() if call_parameters is None or k in call_parameters})
 
     hook.remove()
-    del transformer.loss_thresholds
+    del transformer.fast_attn_calibration
 
-    blocks_methods = [getattr(block, attn_name).processor.fast_attn.steps_method for block in blocks]
+    blocks_methods = [layer.processor.fast_attn.steps_method for layer in blocks]
     return blocks_methods
 
 
@@ -196,19 +375,40 @@ def set_methods(
     pipe: DiffusionPipeline,
     blocks_methods: list,
 ):
-    attn_name = get_fast_attn_layer_name()
-    blocks = pipe.transformer.transformer_blocks
-    for blocki, block in enumerate(blocks):
-        getattr(block, attn_name).processor.fast_attn.set_methods(blocks_methods[blocki])
+    for blocki, layer in enumerate(get_fast_attn_layers(pipe.transformer)):
+        layer.processor.fast_attn.set_methods(blocks_methods[blocki])
 
 
 def statistics(pipe: DiffusionPipeline):
     attn_name = get_fast_attn_layer_name()
-    blocks = pipe.transformer.transformer_blocks
-    counts = Counter([method for block in blocks for method in getattr(block, attn_name).processor.fast_attn.steps_method])
+    layers = get_fast_attn_layers(pipe.transformer)
+    counts = Counter([method for layer in layers for method in layer.processor.fast_attn.steps_method])
     total = sum(counts.values())
     for k, v in counts.items():
         logger.info(f"{attn_name} {k} {v/total}")
+    cache_memory(pipe)
+
+
+def cache_memory(pipe: DiffusionPipeline):
+    """Peak and mean memory of the residuals and outputs the plan caches
+    between two steps, summed over the layers in attention outputs of a
+    layer, as cached by default and by the compact cache."""
+    fast_attns = [layer.processor.fast_attn for layer in get_fast_attn_layers(pipe.transformer)]
+    cache_dtype = get_fast_attn_cache_dtype()
+    precision = 1.0
+    if cache_dtype is not None:
+        precision = min(1.0, cache_dtype.itemsize / pipe.transformer.dtype.itemsize)
+    memory = {}
+    for compact in [False, True]:
+        steps = np.sum([fast_attn.cache_sizes(compact, precision) for fast_attn in fast_attns], axis=0)
+        memory[compact] = (float(steps.max()), float(steps.mean()))
+    (default_peak, default_mean), (compact_peak, compact_mean) = memory[False], memory[True]
+    logger.info(
+        f"DiTFastAttn cache: peak {default_peak:.1f}, mean {default_mean:.1f} attention outputs, "
+        f"compact cache peak {compact_peak:.1f}, mean {compact_mean:.1f}"
+        f"{'' if get_fast_attn_compact_cache() else ' (not enabled)'}"
+    )
+    return memory
 
 
 def fast_attention_compression(pipe: DiffusionPipeline):
@@ -219,12 +419,18 @@ def fast_attention_compression(pipe: DiffusionPipeline):
         logger.info(f"load config file {config_file} as DiTFastAttn compression methods.")
         blocks_methods = load_config_file(config_file)
     else:
+        resumed = None
         if get_fast_attn_use_cache():
             logger.warning(f"config file {config_file} not found.")
+            if os.path.exists(partial_config_file(config_file)):
+                logger.info(f"resume DiTFastAttn compression method selection from {partial_config_file(config_file)}")
+                resumed = load_config_file(partial_config_file(config_file))
         logger.info("start to select DiTFastAttn compression methods.")
-        blocks_methods = select_methods(pipe)
-        if get_data_parallel_rank() == 0:
+        blocks_methods = select_methods(pipe, resumed)
+        if _is_first_rank():
             save_config_file(blocks_methods, config_file)
+            if os.path.exists(partial_config_file(config_file)):
+                os.remove(partial_config_file(config_file))
             logger.info(f"save DiTFastAttn compression methods to {config_file}")
 
     set_methods(pipe, blocks_methods)
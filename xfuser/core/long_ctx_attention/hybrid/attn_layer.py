@@ -18,6 +18,7 @@ from xfuser.logger import init_logger
 from xfuser.core.distributed import (
     get_ring_parallel_world_size,
     )
+from xfuser.core.distributed.shape_plan import get_plan_buffer, pad_heads
 
 logger = init_logger(__name__)
 
@@ -39,6 +40,52 @@ def get_output_cuda_stream():
     return _output_cuda_stream
 
 
+class UlyssesChunkBuffers:
+    """Staging buffers and events of the head chunk pipeline of
+    :class:`xFuserLongContextAttention` for one input shape.
+
+    They are shared by all the layers: the layers run one after the other on
+    the same streams, and the compute stream waits for the output all-to-all
+    of a layer before the next one stages its inputs, so the buffers are
+    never reused while a previous layer still reads them. For the same
+    reason, buffers made for a single call without a shape plan can be freed
+    as soon as it returns.
+    """
+
+    def __init__(self, world_size, num_chunks, group_shapes, out_shape, dtype, device):
+        # per group of inputs sharing a sequence length, shapes as
+        # (stacked batch, local seq_len, head_size)
+        self.send = [
+            torch.empty(num_chunks, world_size, batch, seq_len, head_dim, dtype=dtype, device=device)
+            for batch, seq_len, head_dim in group_shapes
+        ]
+        self.recv = [torch.empty_like(send) for send in self.send]
+        # inputs of the attention of one chunk, (stacked batch, seq_len, 1, head_size)
+        self.gathered = [
+            torch.empty(batch, world_size * seq_len, 1, head_dim, dtype=dtype, device=device)
+            for batch, seq_len, head_dim in group_shapes
+        ]
+        batch, seq_len, head_dim = out_shape
+        self.out_send = torch.empty(num_chunks, world_size, batch, seq_len, head_dim, dtype=dtype, device=device)
+        self.out_recv = torch.empty(world_size, batch, seq_len, head_dim, dtype=dtype, device=device)
+        self.staged = torch.cuda.Event()
+        self.comm_done = [torch.cuda.Event() for _ in range(num_chunks)]
+        self.comp_done = [torch.cuda.Event() for _ in range(num_chunks)]
+        self.done = torch.cuda.Event()
+
+    def nbytes(self) -> int:
+        tensors = self.send + self.recv + self.gathered + [self.out_send, self.out_recv]
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def get_chunk_buffers(world_size, num_chunks, group_shapes, out_shape, dtype, device) -> UlyssesChunkBuffers:
+    return get_plan_buffer(
+        "attn_buffers",
+        ("ulysses_chunks", world_size, num_chunks, tuple(group_shapes), out_shape, dtype, device),
+        lambda: UlyssesChunkBuffers(world_size, num_chunks, group_shapes, out_shape, dtype, device),
+    )
+
+
 class xFuserLongContextAttention(LongContextAttention):
     ring_impl_type_supported_kv_cache = ["basic"]
 
@@ -95,7 +142,6 @@ class xFuserLongContextAttention(LongContextAttention):
         from xfuser.core.long_ctx_attention.ring import xdit_ring_flash_attn_func
         self.ring_attn_fn = xdit_ring_flash_attn_func
 
-        self.comp_stream = torch.cuda.default_stream()
         self.input_comm_stream = get_input_cuda_stream()
         self.output_comm_stream = get_output_cuda_stream()
 
@@ -118,77 +164,168 @@ class xFuserLongContextAttention(LongContextAttention):
         deterministic=False,
         return_attn_probs=False,
         joint_strategy="none",
+        key_padding=None,
     ) -> Tensor:
-
-        per_chunk_head = self.ulysses_pg.size()
+        """Ulysses attention pipelined over chunks of ``ulysses_degree`` heads:
+        the all-to-all of the inputs of a chunk, its ring attention and the
+        all-to-all of its output run on three streams, so the communication
+        of a chunk overlaps the attention of the others.
+
+        Takes the arguments of :meth:`forward_`, which runs instead on CPUs,
+        without Ulysses or with the kv cache of PipeFusion. A number of heads
+        that is not a multiple of ``ulysses_degree`` is padded with zero
+        heads, see :func:`~xfuser.core.distributed.shape_plan.pad_heads`.
+        """
+        ulysses_world_size = self.ulysses_pg.size()
         num_heads = query.shape[2]
-        NUM_BUFFERS = num_heads // per_chunk_head
+        if num_heads % ulysses_world_size != 0:
+            # zero heads pad the heads to a multiple of the ulysses degree,
+            # their output is dropped
+            def pad(x):
+                return None if x is None else pad_heads(x, ulysses_world_size)
+
+            output = self.forward(
+                attn,
+                pad(query),
+                pad(key),
+                pad(value),
+                joint_tensor_query=pad(joint_tensor_query),
+                joint_tensor_key=pad(joint_tensor_key),
+                joint_tensor_value=pad(joint_tensor_value),
+                dropout_p=dropout_p,
+                softmax_scale=softmax_scale,
+                causal=causal,
+                window_size=window_size,
+                alibi_slopes=alibi_slopes,
+                deterministic=deterministic,
+                return_attn_probs=return_attn_probs,
+                joint_strategy=joint_strategy,
+                key_padding=key_padding,
+            )
+            return output[:, :, :num_heads].contiguous()
+        if not query.is_cuda or ulysses_world_size == 1 or self.use_kv_cache:
+            return self.forward_(
+                attn,
+                query,
+                key,
+                value,
+                joint_tensor_query=joint_tensor_query,
+                joint_tensor_key=joint_tensor_key,
+                joint_tensor_value=joint_tensor_value,
+                dropout_p=dropout_p,
+                softmax_scale=softmax_scale,
+                causal=causal,
+                window_size=window_size,
+                alibi_slopes=alibi_slopes,
+                deterministic=deterministic,
+                return_attn_probs=return_attn_probs,
+                joint_strategy=joint_strategy,
+                key_padding=key_padding,
+            )
 
-        buffers_input = [{"comm_done": torch.cuda.Event(), "data": None, "in_use": False} for _ in range(NUM_BUFFERS)]
-        buffers_output = [{"comp_done": torch.cuda.Event(), "data": None, "in_use": False} for _ in range(NUM_BUFFERS)]
+        is_joint = joint_tensor_query is not None
+        if is_joint:
+            if joint_strategy not in ["front", "rear"]:
+                raise ValueError(
+                    f"joint_strategy: {joint_strategy} not supprted. supported joint strategy: ['front', 'rear']"
+                )
+            if joint_strategy == "rear":
+                query = torch.cat([query, joint_tensor_query], dim=1)
+            else:
+                query = torch.cat([joint_tensor_query, query], dim=1)
 
-        qkv = torch.cat([query, key, value]).contiguous()
-        split_qkv =  torch.split(qkv, per_chunk_head, dim=2)
+        num_chunks = num_heads // ulysses_world_size
+        ulysses_rank = torch.distributed.get_rank(self.ulysses_pg)
+        batch_size, query_len, _, head_dim = query.shape
+        # inputs of the same sequence length share one all-to-all
+        if query_len == key.shape[1]:
+            groups = [[query, key, value]]
+        else:
+            groups = [[query], [key, value]]
+        buffers = get_chunk_buffers(
+            ulysses_world_size,
+            num_chunks,
+            [(sum(t.shape[0] for t in group), group[0].shape[1], head_dim) for group in groups],
+            (batch_size, query_len, head_dim),
+            query.dtype,
+            query.device,
+        )
 
-        for buf in buffers_output:
-            buf["comp_done"].record(stream=self.comp_stream)
-            buf["comp_done"].wait(stream=self.input_comm_stream)
+        comp_stream = torch.cuda.current_stream()
+        # (bs, seq_len/N, head_cnt, head_size) -> (chunk, N, bs, seq_len/N, head_size),
+        # head j of every chunk goes to ulysses rank j
+        for group, send in zip(groups, buffers.send):
+            offset = 0
+            for tensor in group:
+                bs, seq_len = tensor.shape[:2]
+                send[:, :, offset : offset + bs].copy_(
+                    tensor.reshape(bs, seq_len, num_chunks, ulysses_world_size, head_dim).permute(2, 3, 0, 1, 4)
+                )
+                offset += bs
+        buffers.staged.record(comp_stream)
 
+        self.input_comm_stream.wait_event(buffers.staged)
         with torch.cuda.stream(self.input_comm_stream):
-            for i in range(NUM_BUFFERS):
-                buffers_input[i]["data"] = SeqAllToAll4D.apply(
-                    self.ulysses_pg, split_qkv[i], self.scatter_idx, self.gather_idx
+            for i in range(num_chunks):
+                for send, recv in zip(buffers.send, buffers.recv):
+                    torch.distributed.all_to_all_single(recv[i], send[i], group=self.ulysses_pg)
+                buffers.comm_done[i].record(self.input_comm_stream)
+
+        output = torch.empty(batch_size, query_len, num_heads, head_dim, dtype=query.dtype, device=query.device)
+        for i in range(num_chunks):
+            comp_stream.wait_event(buffers.comm_done[i])
+            inputs = []
+            for group, recv, gathered in zip(groups, buffers.recv, buffers.gathered):
+                # (N, bs, seq_len/N, head_size) -> (bs, seq_len, 1, head_size)
+                gathered.view(-1, ulysses_world_size, *recv.shape[3:]).copy_(recv[i].transpose(0, 1))
+                inputs.extend(gathered.split([t.shape[0] for t in group]))
+            q, k, v = inputs
+
+            head = i * ulysses_world_size + ulysses_rank
+            out = self.ring_attn_fn(
+                q,
+                k,
+                v,
+                dropout_p=dropout_p,
+                softmax_scale=softmax_scale,
+                causal=causal,
+                window_size=window_size,
+                alibi_slopes=alibi_slopes,
+                deterministic=deterministic,
+                return_attn_probs=return_attn_probs,
+                group=self.ring_pg,
+                attn_type=self.attn_type,
+                attn_processor=self.attn_processor,
+                attn_layer=None,
+                joint_tensor_key=joint_tensor_key[:, :, head : head + 1] if is_joint else None,
+                joint_tensor_value=joint_tensor_value[:, :, head : head + 1] if is_joint else None,
+                joint_strategy=joint_strategy,
+                q_descale=self.q_descale,
+                k_descale=self.k_descale,
+                v_descale=self.v_descale,
+                key_padding=key_padding,
+            )
+            context_layer = out[0] if isinstance(out, tuple) else out
+            # (bs, seq_len, 1, head_size) -> (N, bs, seq_len/N, head_size),
+            # the rows of the local sequence of ulysses rank j go to rank j
+            buffers.out_send[i].copy_(
+                context_layer.reshape(batch_size, ulysses_world_size, query_len, head_dim).transpose(0, 1)
+            )
+            buffers.comp_done[i].record(comp_stream)
+
+            self.output_comm_stream.wait_event(buffers.comp_done[i])
+            with torch.cuda.stream(self.output_comm_stream):
+                torch.distributed.all_to_all_single(buffers.out_recv, buffers.out_send[i], group=self.ulysses_pg)
+                # head j of the chunk came from ulysses rank j
+                output.view(batch_size, query_len, num_chunks, ulysses_world_size, head_dim)[:, :, i].copy_(
+                    buffers.out_recv.permute(1, 2, 0, 3)
                 )
-                buffers_input[i]["comm_done"].record(stream=self.input_comm_stream)
-                buffers_input[i]['in_use'] = True
-
-        output_list = []
-        processed_count = 0
-
-        while processed_count < NUM_BUFFERS:
-            for i in range(NUM_BUFFERS):
-                if buffers_input[i]["in_use"]:
-                    with torch.cuda.stream(self.comp_stream):
-                        buffers_input[i]["comm_done"].wait(stream=self.comp_stream)
-                        qkv = torch.split(buffers_input[i]["data"], 1, dim=0)
-                        q, k, v = qkv
-                        context_layer = self.ring_attn_fn(
-                            q,
-                            k,
-                            v,
-                            dropout_p=dropout_p,
-                            softmax_scale=softmax_scale,
-                            causal=causal,
-                            window_size=window_size,
-                            alibi_slopes=alibi_slopes,
-                            deterministic=deterministic,
-                            return_attn_probs=return_attn_probs,
-                            group=self.ring_pg,
-                            attn_type=self.attn_type,
-                            attn_processor=self.attn_processor,
-                            attn_layer=attn if self.use_kv_cache else None,
-                            joint_tensor_key=joint_tensor_key,
-                            joint_tensor_value=joint_tensor_value,
-                            joint_strategy=joint_strategy,
-                        )
-                        buffers_output[i]["data"] = context_layer
-                        buffers_output[i]["comp_done"].record(stream=self.comp_stream)
-                        buffers_output[i]["in_use"] = True
-                        buffers_input[i]["in_use"] = False
-
-            for i in range(NUM_BUFFERS):
-                if buffers_output[i]["in_use"]:
-                    with torch.cuda.stream(self.output_comm_stream):
-                        buffers_output[i]["comp_done"].wait(stream=self.output_comm_stream)
-                        out = SeqAllToAll4D.apply(self.ulysses_pg, buffers_output[i]["data"], self.gather_idx, self.scatter_idx)
-                        comm_done_event = torch.cuda.Event()
-                        output_list.append(out)
-                        processed_count += 1
-                        buffers_output[i]["in_use"] = False
-
-        torch.cuda.synchronize()
-
-        return torch.cat(output_list, dim=2)
+
+        # the compute stream waits for the output, the host does not
+        buffers.done.record(self.output_comm_stream)
+        comp_stream.wait_event(buffers.done)
+
+        return output
 
     @torch.compiler.disable
     def forward_(
@@ -209,6 +346,7 @@ class xFuserLongContextAttention(LongContextAttention):
         deterministic=False,
         return_attn_probs=False,
         joint_strategy="none",
+        key_padding=None,
     ) -> Tensor:
         """forward
 
@@ -223,6 +361,7 @@ class xFuserLongContextAttention(LongContextAttention):
             joint_tensor_value: Tensor = None, a replicated tensor among processes appended to the front or rear of value, depends the joint_strategy,
             *args: the args same as flash_attn_interface
             joint_strategy: str = "none", the joint strategy for joint attention, currently only support "front" and "rear"
+            key_padding: the number of padded tokens at the end of the local sequence of every sp rank as [ring_rank][ulysses_rank], dropped from the keys and values
 
         Returns:
             * output (Tensor): context output
@@ -316,6 +455,7 @@ class xFuserLongContextAttention(LongContextAttention):
             q_descale=self.q_descale,
             k_descale=self.k_descale,
             v_descale=self.v_descale,
+            key_padding=key_padding,
         )
 
         if type(out) == tuple:
@@ -383,6 +523,11 @@ class xFuserSanaLinearLongContextAttention(xFuserLongContextAttention):
             * output (Tensor): context output
         """
         # (bs, seq_len/N, head_cnt, head_size)
+        num_heads = query.shape[2]
+        ulysses_world_size = self.ulysses_pg.size()
+        query = pad_heads(query, ulysses_world_size)
+        key = pad_heads(key, ulysses_world_size)
+        value = pad_heads(value, ulysses_world_size)
 
         # 3 X (bs, seq_len/N, head_cnt, head_size) -> 3 X (bs, seq_len, head_cnt/N, head_size)
         # scatter 2, gather 1
@@ -426,6 +571,6 @@ class xFuserSanaLinearLongContextAttention(xFuserLongContextAttention):
             self.ulysses_pg, context_layer, self.gather_idx, self.scatter_idx
         )
         
-        output = output.flatten(2, 3)
+        output = output[:, :, :num_heads].flatten(2, 3)
 
         return output
\ No newline at end of file
@@ -6,6 +6,7 @@ from torch.nn.attention.flex_attention import flex_attention
 
 from xfuser.core.long_ctx_attention import xFuserLongContextAttention
 from xfuser.core.cache_manager.cache_manager import get_cache_manager
+from xfuser.core.distributed.shape_plan import drop_padded_tokens, get_plan_buffer
 from yunchang.ring.utils import RingComm, update_out_and_lse
 from yunchang.ring.ring_flash_attn import RingFlashAttnFunc
 from yunchang.kernels import select_flash_attn_impl, AttnType
@@ -18,6 +19,70 @@ except ImportError:
     _flash_attn_forward = None
     from yunchang.kernels.attention import pytorch_attn_forward
 
+
+class RingKVBuffers:
+    """Buffers of the K/V exchange of the ring attention for one K/V shape.
+
+    K and V travel packed in one (2, batch, seq_len, heads, head_dim) tensor,
+    so every ring step is a single P2P transfer, received into the one of
+    the two ``kv`` buffers that is not being sent. ``joint`` holds the K/V of
+    the step that attends to the joint text, keyed by its shape.
+    """
+
+    def __init__(self, shape, dtype, device):
+        self.kv = [torch.empty(2, *shape, dtype=dtype, device=device) for _ in range(2)]
+        self.joint = {}
+
+    def get_joint(self, shape, dtype, device) -> torch.Tensor:
+        if shape not in self.joint:
+            self.joint[shape] = torch.empty(2, *shape, dtype=dtype, device=device)
+        return self.joint[shape]
+
+    def nbytes(self) -> int:
+        tensors = self.kv + list(self.joint.values())
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+
+def get_ring_kv_buffers(shape, dtype, device) -> RingKVBuffers:
+    return get_plan_buffer(
+        "attn_buffers",
+        ("ring_kv", tuple(shape), dtype, device),
+        lambda: RingKVBuffers(shape, dtype, device),
+    )
+
+
+def packed_kv_view(k: torch.Tensor, v: torch.Tensor):
+    """``k`` and ``v`` as one (2, ...) tensor without a copy if ``v``
+    directly follows ``k`` in memory, as when both are split from a packed
+    qkv, else None."""
+    if (
+        k.shape != v.shape
+        or k.dtype != v.dtype
+        or not k.is_contiguous()
+        or not v.is_contiguous()
+        or k.untyped_storage().data_ptr() != v.untyped_storage().data_ptr()
+        or v.storage_offset() != k.storage_offset() + k.numel()
+    ):
+        return None
+    return torch.empty(0, dtype=k.dtype, device=k.device).set_(
+        k.untyped_storage(), k.storage_offset(), (2, *k.shape)
+    )
+
+
+def joint_kv(buffers, block_k, block_v, joint_tensor_key, joint_tensor_value, joint_strategy):
+    """K and V of a block joined with the joint text, in a buffer of the
+    ring instead of new tensors."""
+    keys = [block_k, joint_tensor_key] if joint_strategy == "rear" else [joint_tensor_key, block_k]
+    values = [block_v, joint_tensor_value] if joint_strategy == "rear" else [joint_tensor_value, block_v]
+    shape = (block_k.shape[0], block_k.shape[1] + joint_tensor_key.shape[1], *block_k.shape[2:])
+    if buffers is None:
+        return torch.cat(keys, dim=1), torch.cat(values, dim=1)
+    joint = buffers.get_joint(shape, block_k.dtype, block_k.device)
+    torch.cat(keys, dim=1, out=joint[0])
+    torch.cat(values, dim=1, out=joint[1])
+    return joint[0], joint[1]
+
+
 def xdit_ring_flash_attn_forward(
     process_group,
     q: torch.Tensor,
@@ -37,8 +102,12 @@ def xdit_ring_flash_attn_forward(
     joint_strategy="none",
     q_descale=None,
     k_descale=None,
-    v_descale=None
+    v_descale=None,
+    key_padding=None,
 ):
+    """``key_padding`` holds the number of padded tokens at the end of the
+    local sequence of every sp rank as ``[ring_rank][ulysses_rank]``, they are
+    dropped from the keys and values of each ring step."""
     is_joint = False
     if (joint_tensor_key is not None and 
         joint_tensor_value is not None):
@@ -62,8 +131,6 @@ def xdit_ring_flash_attn_forward(
     out = None
     lse = None
 
-    next_k, next_v = None, None
-
     if attn_layer is not None:
         k, v = get_cache_manager().update_and_get_kv_cache(
             new_kv=[k, v],
@@ -74,28 +141,42 @@ def xdit_ring_flash_attn_forward(
         k = k.contiguous()
         v = v.contiguous()
 
+    # K and V are exchanged packed, ping-ponging between two buffers
+    buffers, kv, next_kv = None, None, None
+    if comm.world_size > 1:
+        buffers = get_ring_kv_buffers(k.shape, k.dtype, k.device)
+        kv = packed_kv_view(k, v)
+        if kv is None:
+            kv = buffers.kv[0]
+            kv[0].copy_(k)
+            kv[1].copy_(v)
+        next_kv = buffers.kv[1]
+
     for step in range(comm.world_size):
         if step + 1 != comm.world_size:
-            next_k: torch.Tensor = comm.send_recv(k)
-            next_v: torch.Tensor = comm.send_recv(v)
+            comm.send_recv(kv, next_kv)
             comm.commit()
 
-        if is_joint and joint_strategy == "rear":
-            if step + 1 == comm.world_size:
-                key = torch.cat([k, joint_tensor_key], dim=1)
-                value = torch.cat([v, joint_tensor_value], dim=1)
-            else:
-                key, value = k, v
-        elif is_joint and joint_strategy == "front":
-            if step == 0:
-                key = torch.cat([joint_tensor_key, k], dim=1)
-                value = torch.cat([joint_tensor_value, v], dim=1)
-            else:
-                key, value = k, v
+        if kv is not None:
+            k, v = kv[0], kv[1]
+        block_k, block_v = k, v
+        if key_padding is not None:
+            # the kv of this step comes from ring rank (rank - step)
+            src_rank = (comm.rank - step) % comm.world_size
+            block_k = drop_padded_tokens(k, key_padding[src_rank])
+            block_v = drop_padded_tokens(v, key_padding[src_rank])
+
+        if is_joint and (
+            (joint_strategy == "rear" and step + 1 == comm.world_size)
+            or (joint_strategy == "front" and step == 0)
+        ):
+            key, value = joint_kv(
+                buffers, block_k, block_v, joint_tensor_key, joint_tensor_value, joint_strategy
+            )
         else:
-            key, value = k, v
+            key, value = block_k, block_v
 
-        if not causal or step <= comm.rank:
+        if (not causal or step <= comm.rank) and key.shape[1] > 0:
             fn = select_flash_attn_impl(attn_type, stage="fwd-only", attn_processor=attn_processor)
             if attn_type == AttnType.FA3: 
                 block_out, block_lse = fn(
@@ -133,8 +214,8 @@ def xdit_ring_flash_attn_forward(
 
         if step + 1 != comm.world_size:
             comm.wait()
-            k = next_k
-            v = next_v
+            # the next step receives into the buffer that is not sent
+            kv, next_kv = next_kv, buffers.kv[0] if next_kv is buffers.kv[1] else buffers.kv[1]
 
     out = out.to(q.dtype)
     if attn_type != AttnType.SPARSE_SAGE:
@@ -163,6 +244,7 @@ class xFuserRingFlashAttnFunc(RingFlashAttnFunc):
         joint_tensor_key,
         joint_tensor_value,
         joint_strategy,
+        key_padding=None,
     ):
         if softmax_scale is None:
             softmax_scale = q.shape[-1] ** (-0.5)
@@ -188,6 +270,7 @@ class xFuserRingFlashAttnFunc(RingFlashAttnFunc):
             joint_tensor_key=joint_tensor_key,
             joint_tensor_value=joint_tensor_value,
             joint_strategy=joint_strategy,
+            key_padding=key_padding,
         )
         # this should be out_padded
         ctx.save_for_backward(q, k, v, out, softmax_lse)
@@ -225,6 +308,7 @@ def xdit_ring_flash_attn_func(
     q_descale=None,
     k_descale=None,
     v_descale=None,
+    key_padding=None,
 ):
     if attn_type == AttnType.FA3:
         return xFuserRingFlashAttnFunc.apply(
@@ -245,6 +329,7 @@ def xdit_ring_flash_attn_func(
             joint_tensor_key,
             joint_tensor_value,
             joint_strategy,
+            key_padding,
             q_descale=q_descale,
             k_descale=k_descale,
             v_descale=v_descale
@@ -268,6 +353,7 @@ def xdit_ring_flash_attn_func(
             joint_tensor_key,
             joint_tensor_value,
             joint_strategy,
+            key_padding,
         )
 
 def xdit_sana_ring_flash_attn_forward(
@@ -0,0 +1,41 @@
+from .cost_model import (
+    ModelProfile,
+    HardwareProfile,
+    Workload,
+    CostEstimate,
+    CostModel,
+    calibrate_hardware_profile,
+)
+from .partition import (
+    BlockProfiler,
+    StagePartition,
+    StagePartitionCache,
+    estimate_module_flops,
+    estimate_stage_partition,
+    partition_blocks,
+)
+from .planner import (
+    ParallelCandidate,
+    ParallelPlanner,
+    enumerate_parallel_candidates,
+    is_valid_candidate,
+)
+
+__all__ = [
+    "ModelProfile",
+    "HardwareProfile",
+    "Workload",
+    "CostEstimate",
+    "CostModel",
+    "calibrate_hardware_profile",
+    "ParallelCandidate",
+    "ParallelPlanner",
+    "enumerate_parallel_candidates",
+    "is_valid_candidate",
+    "BlockProfiler",
+    "StagePartition",
+    "StagePartitionCache",
+    "estimate_module_flops",
+    "estimate_stage_partition",
+    "partition_blocks",
+]
@@ -0,0 +1,379 @@
+import json
+import math
+import time
+from dataclasses import dataclass, asdict, field
+from typing import Any, Dict, Optional
+
+import torch
+import torch.distributed
+
+from xfuser.core.distributed.shape_plan import padded_num_heads
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+
+@dataclass
+class ModelProfile:
+    """Shape information of a DiT backbone used by the cost model."""
+
+    num_layers: int
+    num_attention_heads: int
+    attention_head_dim: int
+    patch_size: int = 2
+    in_channels: int = 4
+    text_seq_len: int = 0
+    vae_scale_factor: int = 8
+    vae_scale_factor_temporal: int = 1
+    is_video: bool = False
+    cfg_parallel_available: bool = True
+    num_params: Optional[int] = None
+
+    @property
+    def hidden_size(self) -> int:
+        return self.num_attention_heads * self.attention_head_dim
+
+    @property
+    def param_count(self) -> int:
+        if self.num_params is not None:
+            return self.num_params
+        # qkv + out projections (4 d^2) and a 4x MLP (8 d^2) per block
+        return 12 * self.num_layers * self.hidden_size**2
+
+    @classmethod
+    def from_pretrained(
+        cls, model: str, text_seq_len: int = 256, **kwargs
+    ) -> "ModelProfile":
+        """Build a profile from the ``transformer`` and ``vae`` configs of a
+        diffusers checkpoint, without loading any weights."""
+        from diffusers import ModelMixin
+
+        config = ModelMixin.load_config(model, subfolder="transformer")
+        try:
+            vae_config = ModelMixin.load_config(model, subfolder="vae")
+        except EnvironmentError:
+            vae_config = {}
+        class_name = config.get("_class_name", "")
+
+        num_layers = config.get("num_layers", config.get("depth", 0)) + config.get(
+            "num_single_layers", 0
+        )
+        num_attention_heads = config["num_attention_heads"]
+        attention_head_dim = config.get(
+            "attention_head_dim",
+            config.get("hidden_size", 0) // max(num_attention_heads, 1),
+        )
+        patch_size = config.get("patch_size", 2) or 1
+        vae_scale_factor = 2 ** (len(vae_config.get("block_out_channels", [0] * 4)) - 1)
+        if class_name.startswith("Flux"):
+            # flux packs 2x2 latent patches before the transformer
+            vae_scale_factor *= 2
+        is_video = config.get("sample_frames", None) is not None or (
+            "temporal_compression_ratio" in vae_config
+        )
+        profile_kwargs = dict(
+            num_layers=num_layers,
+            num_attention_heads=num_attention_heads,
+            attention_head_dim=attention_head_dim,
+            patch_size=patch_size,
+            in_channels=config.get("in_channels", 4),
+            text_seq_len=text_seq_len,
+            vae_scale_factor=vae_scale_factor,
+            vae_scale_factor_temporal=vae_config.get("temporal_compression_ratio", 1),
+            is_video=is_video,
+            cfg_parallel_available=not class_name.startswith("Flux"),
+        )
+        profile_kwargs.update(kwargs)
+        return cls(**profile_kwargs)
+
+
+@dataclass
+class Workload:
+    """A single generation request the plan is made for."""
+
+    height: int = 1024
+    width: int = 1024
+    num_frames: int = 1
+    batch_size: int = 1
+    num_inference_steps: int = 20
+    warmup_steps: int = 1
+    use_cfg: bool = True
+
+    def num_image_tokens(self, model: ModelProfile) -> int:
+        latents_height = self.height // model.vae_scale_factor
+        latents_width = self.width // model.vae_scale_factor
+        tokens = (latents_height // model.patch_size) * (
+            latents_width // model.patch_size
+        )
+        if model.is_video:
+            tokens *= (self.num_frames - 1) // model.vae_scale_factor_temporal + 1
+        return tokens
+
+    def latents_height(self, model: ModelProfile) -> int:
+        return self.height // model.vae_scale_factor
+
+
+@dataclass
+class HardwareProfile:
+    """Achievable throughput numbers of the target cluster.
+
+    The defaults are rough numbers for an 8-GPU NVLink node and are meant to be
+    replaced by :func:`calibrate_hardware_profile` on the real machine.
+    """
+
+    matmul_tflops: float = 200.0
+    intra_node_bandwidth_gbps: float = 150.0
+    inter_node_bandwidth_gbps: float = 12.5
+    comm_latency_us: float = 20.0
+    gpus_per_node: int = 8
+    memory_gb: float = 80.0
+
+    def bandwidth(self, span: int) -> float:
+        """Bytes per second for a group whose ranks cover ``span`` consecutive
+        global ranks."""
+        if span > self.gpus_per_node:
+            return self.inter_node_bandwidth_gbps * 1e9
+        return self.intra_node_bandwidth_gbps * 1e9
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(asdict(self), f, indent=4)
+
+    @classmethod
+    def load(cls, path: str) -> "HardwareProfile":
+        with open(path, "r") as f:
+            return cls(**json.load(f))
+
+
+@dataclass
+class CostEstimate:
+    """Estimated wall time (seconds) and peak memory (bytes) of a plan."""
+
+    compute_time: float
+    comm_time: float
+    memory_bytes: int
+    fits_in_memory: bool = True
+    breakdown: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def total_time(self) -> float:
+        return self.compute_time + self.comm_time
+
+
+class CostModel:
+    """Analytical compute + communication + memory model of one generation.
+
+    Per DiT block the model counts ``24 * n * d^2`` FLOPs for the linear layers
+    and ``4 * n^2 * d`` FLOPs for attention, where ``n`` is the joint sequence
+    length. Communication volumes follow the collectives issued by each
+    parallel method in xDiT: four all-to-alls per attention layer for Ulysses,
+    ``ring_degree - 1`` K/V exchanges overlapped with attention for Ring, one
+    patch activation per stage boundary for PipeFusion, two all-reduces per
+    block for tensor parallel and one latent all-gather per step for CFG and
+    PipeFusion. Heads padded to a multiple of the Ulysses degree scale the
+    attention FLOPs and the Ulysses and Ring volumes.
+    """
+
+    def __init__(
+        self,
+        model: ModelProfile,
+        hardware: Optional[HardwareProfile] = None,
+        dtype_bytes: int = 2,
+    ):
+        self.model = model
+        self.hardware = hardware or HardwareProfile()
+        self.dtype_bytes = dtype_bytes
+
+    def _comm_time(self, num_bytes: float, span: int, count: int = 1) -> float:
+        if num_bytes <= 0 or count <= 0:
+            return 0.0
+        return count * (
+            num_bytes / self.hardware.bandwidth(span)
+            + self.hardware.comm_latency_us * 1e-6
+        )
+
+    def estimate(self, candidate: Any, workload: Workload) -> CostEstimate:
+        """Estimate the cost of running ``workload`` with ``candidate``, a
+        :class:`~xfuser.core.planner.ParallelCandidate`."""
+        model, hw = self.model, self.hardware
+        d = model.hidden_size
+        num_layers = model.num_layers
+        image_tokens = workload.num_image_tokens(model)
+        seq_len = image_tokens + model.text_seq_len
+
+        # batch handled by a single replica of the model
+        batch = workload.batch_size * (2 if workload.use_cfg else 1)
+        batch = math.ceil(batch / (candidate.dp_degree * candidate.cfg_degree))
+
+        sp = candidate.ulysses_degree * candidate.ring_degree
+        pp = candidate.pp_degree
+        tp = candidate.tp_degree
+        flops_per_second = hw.matmul_tflops * 1e12
+
+        # heads of a tensor parallel rank, padded to a multiple of the
+        # ulysses degree
+        u = candidate.ulysses_degree
+        local_heads = model.num_attention_heads // tp
+        head_padding = padded_num_heads(local_heads, u) / local_heads
+
+        # ---- compute ----
+        linear_flops = 24 * batch * seq_len * d**2
+        attn_flops = 4 * batch * seq_len**2 * d * head_padding
+        block_time = (linear_flops + attn_flops) / (sp * tp) / flops_per_second
+        attn_time = attn_flops / (sp * tp) / flops_per_second
+        layers_per_stage = math.ceil(num_layers / pp)
+        stage_step_time = block_time * layers_per_stage
+
+        num_steps = workload.num_inference_steps
+        warmup_steps = min(workload.warmup_steps, num_steps) if pp > 1 else 0
+        patch_steps = num_steps - warmup_steps
+        if pp > 1:
+            num_patch = candidate.num_pipeline_patch
+            # warmup steps run the stages one after another, the rest is a
+            # pipeline of num_patch micro-batches with a single fill bubble
+            compute_time = warmup_steps * stage_step_time * pp + (
+                stage_step_time * (patch_steps + (pp - 1) / num_patch)
+            )
+        else:
+            compute_time = num_steps * stage_step_time
+
+        # ---- communication ----
+        span_tp = tp
+        span_sp = tp * sp
+        span_pp = span_sp * pp
+        span_cfg = span_pp * candidate.cfg_degree
+        shard_bytes = batch * math.ceil(seq_len / sp) * d / tp * self.dtype_bytes
+
+        breakdown: Dict[str, float] = {}
+        if u > 1:
+            a2a_bytes = shard_bytes * head_padding * (u - 1) / u
+            breakdown["ulysses"] = self._comm_time(
+                a2a_bytes, span_tp * u, 4 * layers_per_stage
+            )
+        r = candidate.ring_degree
+        if r > 1:
+            kv_bytes = 2 * shard_bytes * head_padding / u
+            ring_step = self._comm_time(kv_bytes, span_sp)
+            ring_attn_step = attn_time / r
+            # the transfer overlaps with attention on the previous block, but
+            # the launch latency of each step is always exposed
+            exposed = max(hw.comm_latency_us * 1e-6, ring_step - ring_attn_step)
+            breakdown["ring"] = layers_per_stage * (r - 1) * exposed
+        if tp > 1:
+            ar_bytes = 2 * (tp - 1) / tp * shard_bytes * tp
+            breakdown["tp"] = self._comm_time(ar_bytes, span_tp, 2 * layers_per_stage)
+        latent_bytes = (
+            batch * image_tokens * model.in_channels * model.patch_size**2
+        ) * self.dtype_bytes
+        if pp > 1:
+            patch_act_bytes = shard_bytes / candidate.num_pipeline_patch
+            per_step = self._comm_time(
+                patch_act_bytes, span_pp, candidate.num_pipeline_patch
+            )
+            breakdown["pipefusion"] = (
+                per_step * num_steps
+                + self._comm_time(latent_bytes, span_pp) * num_steps
+            )
+        if candidate.cfg_degree > 1:
+            breakdown["cfg"] = self._comm_time(latent_bytes, span_cfg) * num_steps
+        per_step_comm = sum(
+            v for k, v in breakdown.items() if k in ("ulysses", "ring", "tp")
+        )
+        comm_time = per_step_comm * (num_steps + warmup_steps * (pp - 1)) + sum(
+            v for k, v in breakdown.items() if k in ("pipefusion", "cfg")
+        )
+        breakdown["compute"] = compute_time
+        if head_padding > 1:
+            # part of the compute spent on the attention of padded heads
+            breakdown["head_padding"] = (
+                compute_time * attn_time * (1 - 1 / head_padding) / block_time
+            )
+
+        # ---- memory ----
+        param_bytes = model.param_count * self.dtype_bytes / (tp * pp)
+        activation_bytes = 4 * batch * math.ceil(seq_len / sp) * d * self.dtype_bytes
+        attn_bytes = batch * math.ceil(seq_len / sp) * d * 3 * self.dtype_bytes
+        kv_cache_bytes = 0
+        if pp > 1:
+            # PipeFusion keeps the stale full-sequence K/V of every local layer
+            kv_cache_bytes = (
+                2 * layers_per_stage * batch * image_tokens * d / (sp * tp)
+            ) * self.dtype_bytes
+        memory_bytes = int(param_bytes + activation_bytes + attn_bytes + kv_cache_bytes)
+
+        return CostEstimate(
+            compute_time=compute_time,
+            comm_time=comm_time,
+            memory_bytes=memory_bytes,
+            fits_in_memory=memory_bytes <= hw.memory_gb * 1024**3,
+            breakdown=breakdown,
+        )
+
+
+def _time_it(fn, iters: int, device: torch.device) -> float:
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def calibrate_hardware_profile(
+    device: Optional[torch.device] = None,
+    dtype: torch.dtype = torch.bfloat16,
+    matmul_size: int = 4096,
+    comm_bytes: int = 64 * 1024**2,
+    iters: int = 10,
+    base: Optional[HardwareProfile] = None,
+) -> HardwareProfile:
+    """Measure matmul throughput and collective bandwidth on this machine.
+
+    The collective benchmark runs only when ``torch.distributed`` is
+    initialized with more than one rank; every rank must call this function.
+    Results are averaged over ranks so that all of them produce the same plan.
+    """
+    profile = HardwareProfile(**asdict(base)) if base is not None else HardwareProfile()
+    if device is None:
+        device = torch.device(
+            f"cuda:{torch.cuda.current_device()}"
+            if torch.cuda.is_available()
+            else "cpu"
+        )
+    if device.type == "cpu":
+        dtype = torch.float32
+
+    a = torch.randn(matmul_size, matmul_size, device=device, dtype=dtype)
+    b = torch.randn(matmul_size, matmul_size, device=device, dtype=dtype)
+    matmul_time = _time_it(lambda: torch.matmul(a, b), iters, device)
+    profile.matmul_tflops = 2 * matmul_size**3 / matmul_time / 1e12
+    if device.type == "cuda":
+        profile.memory_gb = torch.cuda.get_device_properties(device).total_memory / (
+            1024**3
+        )
+
+    if torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1:
+        world_size = torch.distributed.get_world_size()
+        buf = torch.empty(comm_bytes // 2, device=device, dtype=torch.float16)
+        small = torch.empty(1, device=device, dtype=torch.float16)
+        ar_time = _time_it(lambda: torch.distributed.all_reduce(buf), iters, device)
+        latency = _time_it(lambda: torch.distributed.all_reduce(small), iters, device)
+        # ring all-reduce moves 2 * (n - 1) / n of the buffer through each link
+        bus_bandwidth = comm_bytes * 2 * (world_size - 1) / world_size / ar_time
+        stats = torch.tensor(
+            [profile.matmul_tflops, bus_bandwidth, latency], device=device
+        ).double()
+        torch.distributed.all_reduce(stats)
+        stats /= world_size
+        profile.matmul_tflops = stats[0].item()
+        if world_size > profile.gpus_per_node:
+            profile.inter_node_bandwidth_gbps = stats[1].item() / 1e9
+        else:
+            profile.intra_node_bandwidth_gbps = stats[1].item() / 1e9
+        profile.comm_latency_us = stats[2].item() * 1e6
+
+    logger.info(f"Calibrated hardware profile: {profile}")
+    return profile
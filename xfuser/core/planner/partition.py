@@ -0,0 +1,423 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn as nn
+
+from xfuser.logger import init_logger
+
+logger = init_logger(__name__)
+
+# modules outside of the transformer blocks that only run on the last stage
+LAST_STAGE_MODULES = ("norm_out", "proj_out", "norm_final", "final_layer")
+# name fragments of layers that project the text stream instead of the image
+CONTEXT_LAYER_PATTERNS = ("context", "caption", "text", "add_", "added_")
+# name fragments of layers that run once per sample (timestep, pooled text)
+SAMPLE_LAYER_PATTERNS = ("time", "guidance", "pooled")
+
+
+@dataclass
+class StagePartition:
+    """Per block cost of a transformer and the stage split chosen from it.
+
+    ``block_costs`` follow the concatenated order of the wrapper's
+    ``transformer_blocks_name``. ``first_stage_cost`` accounts for the
+    embeddings and ``last_stage_cost`` for the output layers and scheduler
+    step. Costs are relative, either FLOPs (``source="flops"``) or seconds
+    (``source="profile"``).
+    """
+
+    block_costs: List[float]
+    first_stage_cost: float = 0.0
+    last_stage_cost: float = 0.0
+    source: str = "flops"
+    splits: Dict[str, List[int]] = field(default_factory=dict)
+
+    def split(self, num_stages: int) -> List[int]:
+        key = str(num_stages)
+        if key not in self.splits:
+            self.splits[key] = partition_blocks(
+                self.block_costs,
+                num_stages,
+                first_stage_cost=self.first_stage_cost,
+                last_stage_cost=self.last_stage_cost,
+            )
+        return self.splits[key]
+
+    def stage_costs(self, attn_layer_num_for_pp: Sequence[int]) -> List[float]:
+        return _stage_costs(
+            self.block_costs,
+            attn_layer_num_for_pp,
+            self.first_stage_cost,
+            self.last_stage_cost,
+        )
+
+
+def _stage_costs(
+    block_costs: Sequence[float],
+    attn_layer_num_for_pp: Sequence[int],
+    first_stage_cost: float,
+    last_stage_cost: float,
+) -> List[float]:
+    costs = []
+    start = 0
+    for num_blocks in attn_layer_num_for_pp:
+        costs.append(sum(block_costs[start : start + num_blocks]))
+        start += num_blocks
+    costs[0] += first_stage_cost
+    costs[-1] += last_stage_cost
+    return costs
+
+
+def partition_blocks(
+    block_costs: Sequence[float],
+    num_stages: int,
+    first_stage_cost: float = 0.0,
+    last_stage_cost: float = 0.0,
+) -> List[int]:
+    """Split consecutive blocks into ``num_stages`` non-empty stages so that
+    the slowest stage is as fast as possible.
+
+    Returns the number of blocks of every stage, in the format of
+    ``--attn_layer_num_for_pp``. Among splits with the same bottleneck the one
+    whose stage sizes are closest to an even split is returned.
+    """
+    num_blocks = len(block_costs)
+    if num_stages < 1 or num_blocks < num_stages:
+        raise ValueError(
+            f"Cannot split {num_blocks} blocks into {num_stages} pipeline stages"
+        )
+    prefix = [0.0]
+    for cost in block_costs:
+        prefix.append(prefix[-1] + cost)
+
+    def stage_cost(stage: int, start: int, end: int) -> float:
+        cost = prefix[end] - prefix[start]
+        if stage == 0:
+            cost += first_stage_cost
+        if stage == num_stages - 1:
+            cost += last_stage_cost
+        return cost
+
+    def imbalance(stage: int, start: int, end: int) -> float:
+        return abs((end - start) - num_blocks / num_stages)
+
+    # best[s][i]: (bottleneck, imbalance) of the first s + 1 stages covering
+    # blocks [0, i), choice[s][i]: start block of stage s in that split
+    inf = (float("inf"), float("inf"))
+    best = [[inf] * (num_blocks + 1) for _ in range(num_stages)]
+    choice = [[0] * (num_blocks + 1) for _ in range(num_stages)]
+    for end in range(1, num_blocks + 1):
+        best[0][end] = (stage_cost(0, 0, end), imbalance(0, 0, end))
+    for stage in range(1, num_stages):
+        for end in range(stage + 1, num_blocks + 1):
+            for start in range(stage, end):
+                prev_cost, prev_imbalance = best[stage - 1][start]
+                candidate = (
+                    max(prev_cost, stage_cost(stage, start, end)),
+                    prev_imbalance + imbalance(stage, start, end),
+                )
+                # tolerate float noise when comparing bottlenecks
+                if candidate[0] < best[stage][end][0] * (1 - 1e-9) or (
+                    candidate[0] <= best[stage][end][0] * (1 + 1e-9)
+                    and candidate[1] < best[stage][end][1]
+                ):
+                    best[stage][end] = candidate
+                    choice[stage][end] = start
+
+    split = []
+    end = num_blocks
+    for stage in range(num_stages - 1, 0, -1):
+        start = choice[stage][end]
+        split.append(end - start)
+        end = start
+    split.append(end)
+    return split[::-1]
+
+
+def _num_layer_tokens(name: str, num_tokens: int, num_context_tokens: int) -> int:
+    leaf = name.lower()
+    if any(pattern in leaf for pattern in SAMPLE_LAYER_PATTERNS):
+        return 1
+    if any(pattern in leaf for pattern in CONTEXT_LAYER_PATTERNS):
+        return num_context_tokens
+    return num_tokens
+
+
+def estimate_module_flops(
+    module: nn.Module, num_tokens: int, num_context_tokens: int = 0
+) -> float:
+    """FLOPs of one forward of a transformer block or embedding module.
+
+    Linear and convolution layers count ``2 * weight.numel()`` FLOPs per
+    token they are applied to. Layers whose name refers to the text stream
+    (``add_q_proj``, ``ff_context``, ...) see ``num_context_tokens`` tokens,
+    timestep and pooled embeddings one token, the others ``num_tokens``.
+    Attention layers add ``4 * q_len * kv_len * inner_dim``; joint attention
+    layers attend over both streams.
+    """
+    flops = 0.0
+    for name, layer in module.named_modules():
+        if isinstance(layer, (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d)):
+            flops += (
+                2
+                * layer.weight.numel()
+                * _num_layer_tokens(name, num_tokens, num_context_tokens)
+            )
+        elif hasattr(layer, "heads") and hasattr(layer, "inner_dim"):
+            q_len = num_tokens
+            if getattr(layer, "added_kv_proj_dim", None) is not None:
+                q_len += num_context_tokens
+            kv_len = (
+                num_context_tokens
+                if getattr(layer, "is_cross_attention", False)
+                else q_len
+            )
+            flops += 4 * q_len * kv_len * layer.inner_dim
+    return flops
+
+
+def estimate_stage_partition(
+    transformer: nn.Module,
+    blocks_name: List[str],
+    num_tokens: int,
+    num_context_tokens: int = 0,
+    blocks_tokens: Optional[Dict[str, Tuple[int, int]]] = None,
+) -> StagePartition:
+    """Build a :class:`StagePartition` from the FLOP model.
+
+    ``blocks_tokens`` overrides ``(num_tokens, num_context_tokens)`` for the
+    block lists whose blocks see a different sequence, e.g. the single stream
+    blocks of Flux that run on the concatenated text and image tokens.
+    """
+    blocks_tokens = blocks_tokens or {}
+    block_costs = []
+    for block_name in blocks_name:
+        tokens, context_tokens = blocks_tokens.get(
+            block_name, (num_tokens, num_context_tokens)
+        )
+        block_costs.extend(
+            estimate_module_flops(block, tokens, context_tokens)
+            for block in getattr(transformer, block_name)
+        )
+
+    first_stage_cost = last_stage_cost = 0.0
+    for name, module in transformer.named_children():
+        if name in blocks_name:
+            continue
+        cost = estimate_module_flops(module, num_tokens, num_context_tokens)
+        if name in LAST_STAGE_MODULES:
+            last_stage_cost += cost
+        else:
+            # parameters registered directly on the transformer are ignored
+            first_stage_cost += cost
+    return StagePartition(
+        block_costs=block_costs,
+        first_stage_cost=first_stage_cost,
+        last_stage_cost=last_stage_cost,
+        source="flops",
+    )
+
+
+class BlockProfiler:
+    """Time every transformer block, the whole transformer and the output
+    layers through forward hooks while the unmodified pipeline runs.
+
+    Use it on a single device before the transformer is split::
+
+        profiler = BlockProfiler(pipe.transformer, ["transformer_blocks"])
+        with profiler.profile(scheduler=pipe.scheduler):
+            pipe(prompt, height=1024, width=1024, num_inference_steps=4)
+        partition = profiler.stage_partition()
+
+    The first ``skip_calls`` forwards of the transformer are treated as warmup
+    and discarded.
+    """
+
+    def __init__(
+        self,
+        transformer: nn.Module,
+        blocks_name: List[str],
+        skip_calls: int = 1,
+    ):
+        self.transformer = transformer
+        self.blocks_name = blocks_name
+        self.skip_calls = skip_calls
+        self.blocks = [
+            block
+            for block_name in blocks_name
+            for block in getattr(transformer, block_name)
+        ]
+        self.last_stage_modules = [
+            getattr(transformer, name)
+            for name in LAST_STAGE_MODULES
+            if isinstance(getattr(transformer, name, None), nn.Module)
+        ]
+        self.reset()
+
+    def reset(self):
+        self.num_calls = 0
+        self.block_times = [0.0] * len(self.blocks)
+        self.transformer_time = 0.0
+        self.last_stage_time = 0.0
+        self.scheduler_time = 0.0
+        self._events: List[Tuple[str, int, object, object]] = []
+        self._open: Dict[Tuple[str, int], object] = {}
+
+    def _record(self):
+        if torch.cuda.is_available():
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def _elapsed(start, end) -> float:
+        if isinstance(start, float):
+            return end - start
+        return start.elapsed_time(end) / 1000
+
+    def _pre_hook(self, kind: str, idx: int):
+        def hook(module, args):
+            if self.num_calls >= self.skip_calls:
+                self._open[(kind, idx)] = self._record()
+
+        return hook
+
+    def _post_hook(self, kind: str, idx: int):
+        def hook(module, args, output):
+            start = self._open.pop((kind, idx), None)
+            if start is not None:
+                self._events.append((kind, idx, start, self._record()))
+            if kind == "transformer":
+                self.num_calls += 1
+
+        return hook
+
+    @contextmanager
+    def profile(self, scheduler: Optional[object] = None):
+        handles = []
+        modules = (
+            [("transformer", 0, self.transformer)]
+            + [("block", i, block) for i, block in enumerate(self.blocks)]
+            + [("last", i, m) for i, m in enumerate(self.last_stage_modules)]
+        )
+        for kind, idx, module in modules:
+            handles.append(module.register_forward_pre_hook(self._pre_hook(kind, idx)))
+            handles.append(module.register_forward_hook(self._post_hook(kind, idx)))
+        step = getattr(scheduler, "step", None)
+        if step is not None:
+
+            def timed_step(*args, **kwargs):
+                start = self._record() if self.num_calls > self.skip_calls else None
+                output = step(*args, **kwargs)
+                if start is not None:
+                    self._events.append(("scheduler", 0, start, self._record()))
+                return output
+
+            scheduler.step = timed_step
+        try:
+            yield self
+        finally:
+            for handle in handles:
+                handle.remove()
+            if step is not None:
+                del scheduler.step
+            self._collect()
+
+    def _collect(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        for kind, idx, start, end in self._events:
+            elapsed = self._elapsed(start, end)
+            if kind == "block":
+                self.block_times[idx] += elapsed
+            elif kind == "transformer":
+                self.transformer_time += elapsed
+            elif kind == "last":
+                self.last_stage_time += elapsed
+            else:
+                self.scheduler_time += elapsed
+        self._events.clear()
+
+    def stage_partition(self) -> StagePartition:
+        num_calls = self.num_calls - self.skip_calls
+        if num_calls <= 0:
+            raise RuntimeError(
+                "No transformer forward was profiled, run more inference steps "
+                f"than skip_calls={self.skip_calls}"
+            )
+        block_costs = [t / num_calls for t in self.block_times]
+        last_stage_cost = (self.last_stage_time + self.scheduler_time) / num_calls
+        first_stage_cost = max(
+            self.transformer_time / num_calls
+            - sum(block_costs)
+            - self.last_stage_time / num_calls,
+            0.0,
+        )
+        return StagePartition(
+            block_costs=block_costs,
+            first_stage_cost=first_stage_cost,
+            last_stage_cost=last_stage_cost,
+            source="profile",
+        )
+
+
+def stage_partition_model_key(transformer: nn.Module) -> str:
+    config = getattr(transformer, "config", {})
+    return config.get("_name_or_path", None) or transformer.__class__.__name__
+
+
+def stage_partition_key(
+    height: int, width: int, num_frames: int = 1, text_len: int = 0
+) -> str:
+    key = f"{height}x{width}"
+    if num_frames > 1:
+        key = f"{num_frames}x{key}"
+    if text_len > 0:
+        key = f"{key}-text{text_len}"
+    return key
+
+
+class StagePartitionCache:
+    """Json file of :class:`StagePartition` keyed by model and input size.
+
+    Profiled partitions take precedence over FLOP estimates of the same key.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = os.path.expanduser(
+            path or os.path.join("~", ".cache", "xfuser", "pipefusion_partition.json")
+        )
+        self.entries: Dict[str, Dict[str, Dict]] = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"Ignoring unreadable partition cache {self.path}: {e}")
+
+    def get(self, model: str, key: str) -> Optional[StagePartition]:
+        entry = self.entries.get(model, {}).get(key, None)
+        return StagePartition(**entry) if entry is not None else None
+
+    def put(self, model: str, key: str, partition: StagePartition):
+        existing = self.get(model, key)
+        if (
+            existing is not None
+            and existing.source == "profile"
+            and partition.source != "profile"
+        ):
+            return
+        self.entries.setdefault(model, {})[key] = asdict(partition)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)
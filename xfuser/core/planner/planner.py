@@ -0,0 +1,265 @@
+import dataclasses
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Tuple
+
+from xfuser.config import (
+    xFuserArgs,
+    ParallelConfig,
+    DataParallelConfig,
+    SequenceParallelConfig,
+    PipeFusionParallelConfig,
+    TensorParallelConfig,
+)
+from xfuser.core.distributed.shape_plan import calc_pipeline_patches_height_list
+from xfuser.logger import init_logger
+from .cost_model import CostEstimate, CostModel, HardwareProfile, ModelProfile, Workload
+
+logger = init_logger(__name__)
+
+
+def _divisors(n: int) -> List[int]:
+    return [i for i in range(1, n + 1) if n % i == 0]
+
+
+@dataclass(frozen=True)
+class ParallelCandidate:
+    """One point of the hybrid parallel search space."""
+
+    dp_degree: int = 1
+    cfg_degree: int = 1
+    ulysses_degree: int = 1
+    ring_degree: int = 1
+    pp_degree: int = 1
+    num_pipeline_patch: int = 1
+    tp_degree: int = 1
+
+    @property
+    def world_size(self) -> int:
+        return (
+            self.dp_degree
+            * self.cfg_degree
+            * self.ulysses_degree
+            * self.ring_degree
+            * self.pp_degree
+            * self.tp_degree
+        )
+
+    def to_parallel_config(self) -> ParallelConfig:
+        return ParallelConfig(
+            dp_config=DataParallelConfig(
+                dp_degree=self.dp_degree,
+                use_cfg_parallel=self.cfg_degree > 1,
+                dit_parallel_size=self.world_size,
+            ),
+            sp_config=SequenceParallelConfig(
+                ulysses_degree=self.ulysses_degree,
+                ring_degree=self.ring_degree,
+                dit_parallel_size=self.world_size,
+            ),
+            pp_config=PipeFusionParallelConfig(
+                pp_degree=self.pp_degree,
+                num_pipeline_patch=self.num_pipeline_patch,
+                attn_layer_num_for_pp=None,
+                dit_parallel_size=self.world_size,
+            ),
+            tp_config=TensorParallelConfig(
+                tp_degree=self.tp_degree,
+                dit_parallel_size=self.world_size,
+            ),
+            world_size=self.world_size,
+            dit_parallel_size=self.world_size,
+        )
+
+    def to_cli_args(self) -> List[str]:
+        args = [
+            f"--data_parallel_degree={self.dp_degree}",
+            f"--ulysses_degree={self.ulysses_degree}",
+            f"--ring_degree={self.ring_degree}",
+            f"--pipefusion_parallel_degree={self.pp_degree}",
+        ]
+        if self.pp_degree > 1:
+            args.append(f"--num_pipeline_patch={self.num_pipeline_patch}")
+        if self.tp_degree > 1:
+            args.append(f"--tensor_parallel_degree={self.tp_degree}")
+        if self.cfg_degree > 1:
+            args.append("--use_cfg_parallel")
+        return args
+
+    def __str__(self) -> str:
+        return (
+            f"dp{self.dp_degree}_cfg{self.cfg_degree}_ulysses{self.ulysses_degree}"
+            f"_ring{self.ring_degree}_pp{self.pp_degree}"
+            f"_patch{self.num_pipeline_patch}_tp{self.tp_degree}"
+        )
+
+
+def is_valid_candidate(
+    candidate: ParallelCandidate,
+    model: ModelProfile,
+    workload: Workload,
+) -> bool:
+    """Apply the same constraints xDiT checks at runtime to ``candidate``."""
+    if candidate.cfg_degree > 1 and not (
+        workload.use_cfg and model.cfg_parallel_available
+    ):
+        return False
+    if candidate.dp_degree > workload.batch_size:
+        return False
+    if candidate.pp_degree > model.num_layers:
+        return False
+    # heads that do not split among the ulysses ranks are padded, the cost
+    # model charges the padded heads
+    if model.num_attention_heads % candidate.tp_degree != 0:
+        return False
+    # DiTRuntimeState._calc_patches_metadata
+    num_sp_patches = candidate.ulysses_degree * candidate.ring_degree
+    try:
+        height_list = calc_pipeline_patches_height_list(
+            latents_height=workload.latents_height(model),
+            num_pipeline_patch=candidate.num_pipeline_patch,
+            num_sp_patches=num_sp_patches,
+            patch_size=model.patch_size,
+        )
+    except ValueError:
+        return False
+    # the runtime would silently shrink the number of patches, which makes
+    # this candidate a duplicate of one with fewer patches
+    if len(height_list) != candidate.num_pipeline_patch:
+        return False
+    try:
+        candidate.to_parallel_config()
+    except (AssertionError, ImportError):
+        return False
+    return True
+
+
+def enumerate_parallel_candidates(
+    world_size: int,
+    model: ModelProfile,
+    workload: Workload,
+    max_tp_degree: int = 1,
+    max_num_pipeline_patch: int = 16,
+) -> Iterator[ParallelCandidate]:
+    """Yield every valid :class:`ParallelCandidate` that uses exactly
+    ``world_size`` devices."""
+    for dp in _divisors(world_size):
+        for cfg in (1, 2):
+            if (world_size // dp) % cfg != 0:
+                continue
+            rest = world_size // dp // cfg
+            for tp in _divisors(rest):
+                if tp > max_tp_degree:
+                    continue
+                for pp in _divisors(rest // tp):
+                    sp = rest // tp // pp
+                    for ulysses in _divisors(sp):
+                        ring = sp // ulysses
+                        patches = (
+                            [p for p in _divisors(max_num_pipeline_patch) if p >= pp]
+                            if pp > 1
+                            else [1]
+                        )
+                        for num_patch in patches:
+                            candidate = ParallelCandidate(
+                                dp_degree=dp,
+                                cfg_degree=cfg,
+                                ulysses_degree=ulysses,
+                                ring_degree=ring,
+                                pp_degree=pp,
+                                num_pipeline_patch=num_patch,
+                                tp_degree=tp,
+                            )
+                            if is_valid_candidate(candidate, model, workload):
+                                yield candidate
+
+
+class ParallelPlanner:
+    """Rank hybrid parallel configurations with :class:`CostModel`.
+
+    Example::
+
+        model_id = "PixArt-alpha/PixArt-XL-2-1024-MS"
+        planner = ParallelPlanner(
+            ModelProfile.from_pretrained(model_id), calibrate_hardware_profile()
+        )
+        args = planner.recommend(
+            Workload(height=2048, width=2048), world_size=8, model=model_id
+        )
+    """
+
+    def __init__(
+        self,
+        model: ModelProfile,
+        hardware: Optional[HardwareProfile] = None,
+        dtype_bytes: int = 2,
+    ):
+        self.model = model
+        self.cost_model = CostModel(model, hardware, dtype_bytes)
+
+    def plan(
+        self,
+        workload: Workload,
+        world_size: int,
+        top_k: Optional[int] = None,
+        max_tp_degree: int = 1,
+        max_num_pipeline_patch: int = 16,
+    ) -> List[Tuple[ParallelCandidate, CostEstimate]]:
+        """Return candidates sorted by estimated latency, the ones that do not
+        fit in device memory last."""
+        results = [
+            (candidate, self.cost_model.estimate(candidate, workload))
+            for candidate in enumerate_parallel_candidates(
+                world_size,
+                self.model,
+                workload,
+                max_tp_degree=max_tp_degree,
+                max_num_pipeline_patch=max_num_pipeline_patch,
+            )
+        ]
+        results.sort(key=lambda x: (not x[1].fits_in_memory, x[1].total_time))
+        if not results:
+            logger.warning(
+                f"No valid parallel configuration found for {world_size} devices "
+                f"and workload {workload}"
+            )
+        return results[:top_k] if top_k is not None else results
+
+    def recommend(
+        self,
+        workload: Workload,
+        world_size: int,
+        base_args: Optional[xFuserArgs] = None,
+        model: Optional[str] = None,
+        **kwargs,
+    ) -> xFuserArgs:
+        """Return ``xFuserArgs`` of the best plan for ``workload``."""
+        results = self.plan(workload, world_size, top_k=1, **kwargs)
+        if not results:
+            raise ValueError(
+                f"No valid parallel configuration for world size {world_size}"
+            )
+        candidate, estimate = results[0]
+        logger.info(
+            f"Recommended parallel config {candidate}, estimated latency "
+            f"{estimate.total_time:.3f}s, memory "
+            f"{estimate.memory_bytes / 1024**3:.2f}GB"
+        )
+        if base_args is None:
+            if model is None:
+                raise ValueError("Either base_args or model should be provided")
+            base_args = xFuserArgs(model=model)
+        return dataclasses.replace(
+            base_args,
+            height=workload.height,
+            width=workload.width,
+            num_frames=workload.num_frames,
+            num_inference_steps=workload.num_inference_steps,
+            warmup_steps=workload.warmup_steps,
+            data_parallel_degree=candidate.dp_degree,
+            use_cfg_parallel=candidate.cfg_degree > 1,
+            ulysses_degree=candidate.ulysses_degree,
+            ring_degree=candidate.ring_degree,
+            pipefusion_parallel_degree=candidate.pp_degree,
+            num_pipeline_patch=candidate.num_pipeline_patch,
+            tensor_parallel_degree=candidate.tp_degree,
+        )
@@ -15,6 +15,8 @@ if TYPE_CHECKING:
     LOCAL_RANK: int = 0
     CUDA_VISIBLE_DEVICES: Optional[str] = None
     XDIT_LOGGING_LEVEL: str = "INFO"
+    XDIT_EAGER_PROCESS_GROUPS: bool = False
+    XDIT_SHAPE_PLAN_CACHE_SIZE: int = 8
     CUDA_VERSION: version.Version
     TORCH_VERSION: version.Version
 
@@ -37,6 +39,16 @@ environment_variables: Dict[str, Callable[[], Any]] = {
     "CUDA_VISIBLE_DEVICES": lambda: os.environ.get("CUDA_VISIBLE_DEVICES", None),
     # this is used for configuring the default logging level
     "XDIT_LOGGING_LEVEL": lambda: os.getenv("XDIT_LOGGING_LEVEL", "INFO"),
+    # connect every process group when the parallel state is initialized
+    # instead of on the first communication through the group
+    "XDIT_EAGER_PROCESS_GROUPS": lambda: bool(
+        int(os.getenv("XDIT_EAGER_PROCESS_GROUPS", "0"))
+    ),
+    # number of input shapes whose patch metadata and communication buffers
+    # are kept by the runtime state for mixed-resolution serving
+    "XDIT_SHAPE_PLAN_CACHE_SIZE": lambda: int(
+        os.getenv("XDIT_SHAPE_PLAN_CACHE_SIZE", "8")
+    ),
 }
 
 def _is_hip():
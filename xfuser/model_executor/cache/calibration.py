@@ -0,0 +1,111 @@
+"""
+Calibration of the TeaCache rescale polynomials.
+
+TeaCache estimates how much the output of the transformer blocks changes
+between two steps from the relative L1 distance of their modulated inputs,
+rescaled by a polynomial. The polynomial is fitted on the distances recorded
+while running the model without skipping any step.
+"""
+
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from xfuser.logger import init_logger
+from xfuser.model_executor.cache.utils import CacheCallback
+
+logger = init_logger(__name__)
+
+
+class TeaCacheProfiles:
+    """Json file of fitted rescale coefficients keyed by profile name.
+
+    The adapters look up the profile named after the model (e.g. "flux")
+    unless another one is given, and fall back to the built-in coefficients.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = os.path.expanduser(
+            path or os.path.join("~", ".cache", "xfuser", "teacache_coefficients.json")
+        )
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r") as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(
+                    f"Ignoring unreadable TeaCache profiles {self.path}: {e}"
+                )
+
+    def get(self, name: str) -> Optional[List[float]]:
+        entry = self.entries.get(name, None)
+        return entry["coefficients"] if entry is not None else None
+
+    def put(self, name: str, coefficients: Sequence[float], **metadata):
+        self.entries[name] = {
+            "coefficients": [float(c) for c in coefficients],
+            **metadata,
+        }
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+
+def fit_coefficients(
+    input_distances: Sequence[float],
+    output_distances: Sequence[float],
+    degree: int = 4,
+) -> List[float]:
+    """Least squares polynomial mapping input distances to output distances,
+    highest degree first like :class:`~xfuser.model_executor.cache.utils.VectorizedPoly1D`.
+    """
+    if len(input_distances) != len(output_distances):
+        raise ValueError("input and output distances must have the same length")
+    if len(input_distances) <= degree:
+        raise ValueError(
+            f"{len(input_distances)} distances are not enough to fit a polynomial of degree {degree}"
+        )
+    return np.polyfit(
+        np.asarray(input_distances, dtype=np.float64),
+        np.asarray(output_distances, dtype=np.float64),
+        degree,
+    ).tolist()
+
+
+class TeaCacheCalibrator(CacheCallback):
+    """Records the modulated input and block output distances of consecutive
+    steps. Attach it to blocks that never skip (a threshold of 0)."""
+
+    def __init__(self):
+        self.input_distances: List[float] = []
+        self.output_distances: List[float] = []
+        self.prev_input: Optional[torch.Tensor] = None
+        self.prev_output: Optional[torch.Tensor] = None
+        self.step = 0
+
+    def on_forward_end(self, state, **kwargs):
+        context = state.cache_context
+        modulated = context.modulated_inputs
+        output = context.original_hidden_states + context.hidden_states_residual
+        if self.step > 0:
+            # one pair per sample of the batch
+            self.input_distances.extend(
+                state.l1_distance(self.prev_input, modulated).tolist()
+            )
+            self.output_distances.extend(
+                state.l1_distance(self.prev_output, output).tolist()
+            )
+        self.prev_input, self.prev_output = modulated, output
+        # the distances of a request do not continue into the next one
+        self.step = (self.step + 1) % state.num_steps
+
+    def fit(self, degree: int = 4) -> List[float]:
+        return fit_coefficients(self.input_distances, self.output_distances, degree)
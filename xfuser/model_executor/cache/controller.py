@@ -0,0 +1,267 @@
+"""
+Latency driven thresholds of TeaCache and FBCache.
+
+A higher threshold skips more steps, trading a little quality for latency.
+The controller keeps the configured threshold while a request is on track
+for its latency target or step budget, and raises it just enough to meet
+them from the measured cost of the steps and the distances the request has
+moved so far.
+"""
+
+import dataclasses
+import math
+import time
+from typing import Dict, Hashable, List, Optional, Sequence
+
+import torch
+
+from xfuser.logger import init_logger
+from xfuser.model_executor.cache.utils import (
+    CacheCallback,
+    TeaCachedTransformerBlocks,
+    current_request,
+)
+
+logger = init_logger(__name__)
+
+
+def allowed_computed_steps(
+    remaining_time: float,
+    remaining_steps: int,
+    run_cost: float,
+    skip_cost: float,
+) -> int:
+    """Number of the remaining steps that can run the blocks within
+    ``remaining_time`` if the others skip them."""
+    if run_cost <= skip_cost:
+        return remaining_steps
+    allowed = math.floor(
+        (remaining_time - remaining_steps * skip_cost) / (run_cost - skip_cost)
+    )
+    return max(0, min(remaining_steps, allowed))
+
+
+def accumulated_threshold(
+    distances: Sequence[float],
+    remaining_steps: int,
+    computed_steps: int,
+) -> float:
+    """TeaCache threshold at which about ``computed_steps`` of the remaining
+    steps run the blocks.
+
+    TeaCache runs the blocks whenever the accumulated distance reaches the
+    threshold, so the distance the remaining steps are expected to move,
+    split in ``computed_steps`` parts, spaces them evenly.
+    """
+    if computed_steps <= 0:
+        return math.inf
+    expected = sum(distances) / len(distances) * remaining_steps
+    return expected / computed_steps
+
+
+def step_threshold(
+    distances: Sequence[float],
+    remaining_steps: int,
+    computed_steps: int,
+) -> float:
+    """FBCache threshold at which about ``computed_steps`` of the remaining
+    steps run the blocks, the distance that this share of the recent steps
+    reached."""
+    if computed_steps >= remaining_steps:
+        return 0.0
+    if computed_steps <= 0:
+        return math.inf
+    ordered = sorted(distances)
+    idx = int(len(ordered) * (1 - computed_steps / remaining_steps))
+    return ordered[min(idx, len(ordered) - 1)]
+
+
+@dataclasses.dataclass
+class RequestCacheRecord:
+    request_id: Hashable
+    num_steps: int = 0
+    # steps that ran the blocks for at least one sample
+    computed_steps: int = 0
+    # steps every sample skipped, and the steps each sample skipped
+    skipped_steps: int = 0
+    sample_skipped_steps: List[int] = dataclasses.field(default_factory=list)
+    latency: float = 0.0
+    thresholds: List[float] = dataclasses.field(default_factory=list)
+
+
+@dataclasses.dataclass
+class _RequestTracker:
+    record: RequestCacheRecord
+    start: float
+    last_end: float
+    # the configured threshold and the one the request runs with
+    base_thresh: float = 0.0
+    threshold: float = 0.0
+    last_decision: Optional[List[bool]] = None
+    # mean distances of the last steps, on the device until a new threshold
+    # needs them
+    distances: List[torch.Tensor] = dataclasses.field(default_factory=list)
+
+
+class CacheThresholdController(CacheCallback):
+    """Adjusts the threshold of every request to a latency target (seconds
+    per request) or a step budget (steps that run the blocks per request).
+
+    The ``rel_l1_thresh`` of the cached blocks is the lowest threshold, the
+    one of a request on track. Step costs are measured on the host between
+    the ends of consecutive steps, which follows the device as long as the
+    cache decision reads back every step. The ranks of a stage take the
+    costs of the slowest one, so they all set the same threshold and skip
+    the same steps. ``records`` holds the realized skipped steps and latency
+    of every finished request.
+
+    The distances stay on the device and are read back only for a new
+    threshold, while a request is behind its budget or target. The cost
+    all-reduce of a latency target reads back every step, which costs one
+    more host sync per step with ``decide_ahead`` but keeps the measured
+    costs those of the device.
+
+    The stages of PipeFusion could only agree on their costs in the middle
+    of the pipeline, so with PipeFusion only a step budget is supported.
+    """
+
+    def __init__(
+        self,
+        target_latency: Optional[float] = None,
+        step_budget: Optional[int] = None,
+        max_thresh: float = 1.0,
+        window: int = 4,
+        cost_momentum: float = 0.8,
+    ):
+        if (target_latency is None) == (step_budget is None):
+            raise ValueError("Either target_latency or step_budget must be given")
+        self.target_latency = target_latency
+        self.step_budget = step_budget
+        self.max_thresh = max_thresh
+        self.window = window
+        self.cost_momentum = cost_momentum
+        # seconds of a step that runs and of one that skips the blocks
+        self.run_cost: Optional[float] = None
+        self.skip_cost: Optional[float] = None
+        self.active: Dict[Hashable, _RequestTracker] = {}
+        self.records: List[RequestCacheRecord] = []
+
+    def on_forward_begin(self, state, **kwargs):
+        if self.target_latency is not None and state.is_pipeline_parallelized:
+            raise RuntimeError(
+                "A cache latency target is not supported with PipeFusion, use a step budget instead"
+            )
+        request_id = current_request()
+        if request_id not in self.active:
+            now = time.perf_counter()
+            # read back once per request
+            base_thresh = float(state.rel_l1_thresh)
+            self.active[request_id] = _RequestTracker(
+                RequestCacheRecord(request_id),
+                start=now,
+                last_end=now,
+                base_thresh=base_thresh,
+                threshold=base_thresh,
+            )
+
+    def on_forward_end(self, state, **kwargs):
+        context = state.cache_context
+        tracker = self.active.get(current_request(), None)
+        decision = context.use_cache_host
+        # later PipeFusion patches of a step see the decision of its first one
+        if tracker is None or decision is None or decision is tracker.last_decision:
+            return
+        tracker.last_decision = decision
+        now = time.perf_counter()
+        ran = not all(decision)
+        self._update_cost(ran, now - tracker.last_end)
+        tracker.last_end = now
+
+        record = tracker.record
+        record.num_steps += 1
+        record.computed_steps += ran
+        record.skipped_steps += not ran
+        if len(record.sample_skipped_steps) != len(decision):
+            record.sample_skipped_steps = [0] * len(decision)
+        record.sample_skipped_steps = [
+            n + cached for n, cached in zip(record.sample_skipped_steps, decision)
+        ]
+        record.thresholds.append(tracker.threshold)
+        if context.last_distance is not None:
+            tracker.distances.append(context.last_distance.mean())
+            del tracker.distances[: -self.window]
+
+        if state.num_steps > 0 and record.num_steps >= state.num_steps:
+            self.finish(state)
+            return
+        threshold = self.next_threshold(state, tracker, now)
+        if threshold != tracker.threshold:
+            tracker.threshold = threshold
+            context.rel_l1_thresh = torch.tensor(
+                threshold, device=state.rel_l1_thresh.device
+            )
+
+    def next_threshold(self, state, tracker: _RequestTracker, now: float) -> float:
+        base = tracker.base_thresh
+        record = tracker.record
+        remaining = state.num_steps - record.num_steps
+        if remaining <= 0 or not tracker.distances:
+            return base
+        if self.step_budget is not None:
+            allowed = self.step_budget - record.computed_steps
+        elif self.run_cost is not None:
+            run_cost, skip_cost, elapsed = self._stage_costs(state, now - tracker.start)
+            allowed = allowed_computed_steps(
+                self.target_latency - elapsed, remaining, run_cost, skip_cost
+            )
+        else:
+            return base
+        if allowed >= remaining:
+            # on track, every remaining step may run
+            return base
+
+        distances = torch.stack(tracker.distances).tolist()
+        if isinstance(state, TeaCachedTransformerBlocks):
+            # the last step runs the blocks whatever the threshold
+            threshold = accumulated_threshold(distances, remaining - 1, allowed - 1)
+        else:
+            threshold = step_threshold(distances, remaining, allowed)
+        return min(max(base, threshold), self.max_thresh)
+
+    def finish(self, state, request_id: Hashable = None):
+        """Close the record of a request, done by itself once a request ran
+        ``num_steps`` steps."""
+        request_id = current_request() if request_id is None else request_id
+        tracker = self.active.pop(request_id, None)
+        if tracker is None:
+            return
+        record = tracker.record
+        record.latency = tracker.last_end - tracker.start
+        self.records.append(record)
+        state.cache_contexts[request_id].rel_l1_thresh = None
+        logger.info(
+            f"cache request {request_id}: {record.skipped_steps}/{record.num_steps} steps skipped, "
+            f"latency {record.latency:.3f}s, final threshold {record.thresholds[-1]:.4f}"
+        )
+
+    def _stage_costs(self, state, elapsed: float) -> List[float]:
+        """Step costs and elapsed time of the slowest rank of the stage."""
+        costs = torch.tensor(
+            [self.run_cost, self.skip_cost or 0.0, elapsed],
+            dtype=torch.float64,
+            device=state.rel_l1_thresh.device,
+        )
+        return state.all_reduce(costs, op=torch.distributed.ReduceOp.MAX).tolist()
+
+    def _update_cost(self, ran: bool, cost: float):
+        name = "run_cost" if ran else "skip_cost"
+        prev = getattr(self, name)
+        setattr(
+            self,
+            name,
+            (
+                cost
+                if prev is None
+                else self.cost_momentum * prev + (1 - self.cost_momentum) * cost
+            ),
+        )
@@ -0,0 +1,128 @@
+"""
+adapted from https://github.com/ali-vilab/TeaCache.git
+adapted from https://github.com/chengzeyi/ParaAttention.git
+"""
+
+import functools
+import unittest
+
+import torch
+from torch import nn
+from diffusers import CogVideoXTransformer3DModel
+from xfuser.model_executor.cache.diffusers_adapters.registry import (
+    TRANSFORMER_ADAPTER_REGISTRY,
+)
+
+from xfuser.model_executor.cache import utils
+
+
+class CogVideoXCachedBlocksMixin:
+    def get_tea_input(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        # the coefficients of TeaCache for CogVideoX are fitted on the time
+        # embedding, which is what modulates every block
+        return kwargs["temb"]
+
+
+class CogVideoXFBCachedTransformerBlocks(
+    CogVideoXCachedBlocksMixin, utils.FBCachedTransformerBlocks
+):
+    pass
+
+
+class CogVideoXTeaCachedTransformerBlocks(
+    CogVideoXCachedBlocksMixin, utils.TeaCachedTransformerBlocks
+):
+    pass
+
+
+class CogVideoXGroupCachedTransformerBlocks(
+    CogVideoXCachedBlocksMixin, utils.BlockGroupCachedTransformerBlocks
+):
+    pass
+
+
+def get_coef_name(transformer) -> str:
+    config = transformer.config
+    if getattr(config, "patch_size_t", None) is not None:
+        return "cogvideox1_5_5b"
+    return "cogvideox_2b" if config.num_attention_heads == 30 else "cogvideox_5b"
+
+
+def create_cached_transformer_blocks(
+    use_cache,
+    transformer,
+    rel_l1_thresh,
+    return_hidden_states_first,
+    num_steps,
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_class = {
+        "Fb": CogVideoXFBCachedTransformerBlocks,
+        "Tea": CogVideoXTeaCachedTransformerBlocks,
+        "Group": CogVideoXGroupCachedTransformerBlocks,
+    }.get(use_cache)
+
+    if not cached_transformer_class:
+        raise ValueError(f"Unsupported use_cache value: {use_cache}")
+
+    return cached_transformer_class(
+        transformer.transformer_blocks,
+        transformer=transformer,
+        rel_l1_thresh=rel_l1_thresh,
+        return_hidden_states_first=return_hidden_states_first,
+        num_steps=num_steps,
+        name=coef_profile or get_coef_name(transformer),
+        callbacks=callbacks,
+        decide_ahead=decide_ahead,
+    )
+
+
+def apply_cache_on_transformer(
+    transformer: CogVideoXTransformer3DModel,
+    *,
+    rel_l1_thresh=0.12,
+    return_hidden_states_first=True,
+    num_steps=8,
+    use_cache="Fb",
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_blocks = nn.ModuleList(
+        [
+            create_cached_transformer_blocks(
+                use_cache,
+                transformer,
+                rel_l1_thresh,
+                return_hidden_states_first,
+                num_steps,
+                coef_profile,
+                callbacks,
+                decide_ahead,
+            )
+        ]
+    )
+
+    original_forward = transformer.forward
+
+    @functools.wraps(original_forward)
+    def new_forward(
+        self,
+        *args,
+        **kwargs,
+    ):
+        with unittest.mock.patch.object(
+            self,
+            "transformer_blocks",
+            cached_transformer_blocks,
+        ):
+            return original_forward(
+                *args,
+                **kwargs,
+            )
+
+    transformer.forward = new_forward.__get__(transformer)
+
+    return transformer
@@ -12,10 +12,11 @@ from xfuser.model_executor.cache.diffusers_adapters.registry import TRANSFORMER_
 
 from xfuser.model_executor.cache import utils
 
-def create_cached_transformer_blocks(use_cache, transformer, rel_l1_thresh, return_hidden_states_first, num_steps):
+def create_cached_transformer_blocks(use_cache, transformer, rel_l1_thresh, return_hidden_states_first, num_steps, coef_profile=None, callbacks=None, decide_ahead=False):
     cached_transformer_class = {
         "Fb": utils.FBCachedTransformerBlocks,
         "Tea": utils.TeaCachedTransformerBlocks,
+        "Group": utils.BlockGroupCachedTransformerBlocks,
     }.get(use_cache)
 
     if not cached_transformer_class:
@@ -28,7 +29,9 @@ def create_cached_transformer_blocks(use_cache, transformer, rel_l1_thresh, retu
         rel_l1_thresh=rel_l1_thresh,
         return_hidden_states_first=return_hidden_states_first,
         num_steps=num_steps,
-        name=TRANSFORMER_ADAPTER_REGISTRY.get(type(transformer)),
+        name=coef_profile or TRANSFORMER_ADAPTER_REGISTRY.get(type(transformer)),
+        callbacks=callbacks,
+        decide_ahead=decide_ahead,
     )
 
 
@@ -39,9 +42,14 @@ def apply_cache_on_transformer(
     return_hidden_states_first=False,
     num_steps=8,
     use_cache="Fb",
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
 ):
     cached_transformer_blocks = nn.ModuleList([
-        create_cached_transformer_blocks(use_cache, transformer, rel_l1_thresh, return_hidden_states_first, num_steps)
+        create_cached_transformer_blocks(
+            use_cache, transformer, rel_l1_thresh, return_hidden_states_first, num_steps, coef_profile, callbacks, decide_ahead
+        )
     ])
 
     dummy_single_transformer_blocks = torch.nn.ModuleList()
@@ -0,0 +1,152 @@
+"""
+adapted from https://github.com/ali-vilab/TeaCache.git
+adapted from https://github.com/chengzeyi/ParaAttention.git
+"""
+
+import functools
+import unittest
+
+import torch
+from torch import nn
+from diffusers import HunyuanDiT2DModel
+from xfuser.model_executor.cache.diffusers_adapters.registry import (
+    TRANSFORMER_ADAPTER_REGISTRY,
+)
+
+from xfuser.core.distributed import (
+    get_pipeline_parallel_world_size,
+    model_parallel_is_initialized,
+)
+from xfuser.logger import init_logger
+from xfuser.model_executor.cache import utils
+
+logger = init_logger(__name__)
+
+
+class HunyuanDiTCachedBlocksMixin:
+    # HunyuanDiT blocks only update the hidden states and the blocks of the
+    # second half take the outputs of the first half as long skips, so the
+    # skips are kept here while the blocks run
+    def call_block(self, idx, hidden, encoder, *args, **kwargs):
+        num_layers = len(self.transformer_blocks)
+        if idx == 0:
+            self.skips = []
+        skip = self.skips.pop() if idx > num_layers // 2 else None
+        hidden = self.transformer_blocks[idx](
+            hidden, *args, encoder_hidden_states=encoder, skip=skip, **kwargs
+        )
+        if idx < num_layers // 2 - 1:
+            self.skips.append(hidden)
+        return hidden, encoder
+
+    def select_batch(self, index):
+        self.skips = [skip.index_select(0, index) for skip in self.skips]
+
+    def pack_outputs(self, hidden, encoder):
+        return hidden
+
+    def get_tea_input(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        return self.transformer_blocks[0].norm1(hidden_states, kwargs["temb"])
+
+
+class HunyuanDiTFBCachedTransformerBlocks(
+    HunyuanDiTCachedBlocksMixin, utils.FBCachedTransformerBlocks
+):
+    pass
+
+
+class HunyuanDiTTeaCachedTransformerBlocks(
+    HunyuanDiTCachedBlocksMixin, utils.TeaCachedTransformerBlocks
+):
+    pass
+
+
+def create_cached_transformer_blocks(
+    use_cache,
+    transformer,
+    rel_l1_thresh,
+    return_hidden_states_first,
+    num_steps,
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_class = {
+        "Fb": HunyuanDiTFBCachedTransformerBlocks,
+        "Tea": HunyuanDiTTeaCachedTransformerBlocks,
+        # no "Group": a skipped group would not pass on the long skips of
+        # its blocks
+    }.get(use_cache)
+
+    if not cached_transformer_class:
+        raise ValueError(f"Unsupported use_cache value: {use_cache}")
+
+    return cached_transformer_class(
+        transformer.blocks,
+        transformer=transformer,
+        rel_l1_thresh=rel_l1_thresh,
+        return_hidden_states_first=return_hidden_states_first,
+        num_steps=num_steps,
+        name=coef_profile or TRANSFORMER_ADAPTER_REGISTRY.get(type(transformer)),
+        callbacks=callbacks,
+        decide_ahead=decide_ahead,
+    )
+
+
+def apply_cache_on_transformer(
+    transformer: HunyuanDiT2DModel,
+    *,
+    rel_l1_thresh=0.12,
+    return_hidden_states_first=True,
+    num_steps=8,
+    use_cache="Fb",
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    if model_parallel_is_initialized() and get_pipeline_parallel_world_size() > 1:
+        # the stages exchange the long skips of every block, which a stage
+        # that skips its blocks does not produce
+        logger.warning(
+            "TeaCache / FBCache do not support HunyuanDiT with PipeFusion, disabling the cache"
+        )
+        return transformer
+
+    cached_transformer_blocks = nn.ModuleList(
+        [
+            create_cached_transformer_blocks(
+                use_cache,
+                transformer,
+                rel_l1_thresh,
+                return_hidden_states_first,
+                num_steps,
+                coef_profile,
+                callbacks,
+                decide_ahead,
+            )
+        ]
+    )
+
+    original_forward = transformer.forward
+
+    @functools.wraps(original_forward)
+    def new_forward(
+        self,
+        *args,
+        **kwargs,
+    ):
+        # a single block in the list also means there are no skips to take
+        # outside of the cached blocks
+        with unittest.mock.patch.object(
+            self,
+            "blocks",
+            cached_transformer_blocks,
+        ):
+            return original_forward(
+                *args,
+                **kwargs,
+            )
+
+    transformer.forward = new_forward.__get__(transformer)
+
+    return transformer
@@ -0,0 +1,138 @@
+"""
+adapted from https://github.com/ali-vilab/TeaCache.git
+adapted from https://github.com/chengzeyi/ParaAttention.git
+"""
+
+import functools
+import unittest
+
+import torch
+from torch import nn
+from diffusers import PixArtTransformer2DModel
+from xfuser.model_executor.cache.diffusers_adapters.registry import (
+    TRANSFORMER_ADAPTER_REGISTRY,
+)
+
+from xfuser.model_executor.cache import utils
+
+
+class PixArtCachedBlocksMixin:
+    # the blocks of PixArt only update the hidden states, the encoder hidden
+    # states are the cross attention context
+    def call_block(self, idx, hidden, encoder, *args, **kwargs):
+        hidden = self.transformer_blocks[idx](
+            hidden, *args, encoder_hidden_states=encoder, **kwargs
+        )
+        return hidden, encoder
+
+    def pack_outputs(self, hidden, encoder):
+        return hidden
+
+    def get_tea_input(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        block = self.transformer_blocks[0]
+        shift_msa, scale_msa = (
+            block.scale_shift_table[None]
+            + kwargs["timestep"].reshape(hidden_states.shape[0], 6, -1)
+        ).chunk(6, dim=1)[:2]
+        return block.norm1(hidden_states) * (1 + scale_msa) + shift_msa
+
+    def get_step_embedding(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        return kwargs["timestep"]
+
+
+class PixArtFBCachedTransformerBlocks(
+    PixArtCachedBlocksMixin, utils.FBCachedTransformerBlocks
+):
+    pass
+
+
+class PixArtTeaCachedTransformerBlocks(
+    PixArtCachedBlocksMixin, utils.TeaCachedTransformerBlocks
+):
+    pass
+
+
+class PixArtGroupCachedTransformerBlocks(
+    PixArtCachedBlocksMixin, utils.BlockGroupCachedTransformerBlocks
+):
+    pass
+
+
+def create_cached_transformer_blocks(
+    use_cache,
+    transformer,
+    rel_l1_thresh,
+    return_hidden_states_first,
+    num_steps,
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_class = {
+        "Fb": PixArtFBCachedTransformerBlocks,
+        "Tea": PixArtTeaCachedTransformerBlocks,
+        "Group": PixArtGroupCachedTransformerBlocks,
+    }.get(use_cache)
+
+    if not cached_transformer_class:
+        raise ValueError(f"Unsupported use_cache value: {use_cache}")
+
+    return cached_transformer_class(
+        transformer.transformer_blocks,
+        transformer=transformer,
+        rel_l1_thresh=rel_l1_thresh,
+        return_hidden_states_first=return_hidden_states_first,
+        num_steps=num_steps,
+        name=coef_profile or TRANSFORMER_ADAPTER_REGISTRY.get(type(transformer)),
+        callbacks=callbacks,
+        decide_ahead=decide_ahead,
+    )
+
+
+def apply_cache_on_transformer(
+    transformer: PixArtTransformer2DModel,
+    *,
+    rel_l1_thresh=0.12,
+    return_hidden_states_first=True,
+    num_steps=8,
+    use_cache="Fb",
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_blocks = nn.ModuleList(
+        [
+            create_cached_transformer_blocks(
+                use_cache,
+                transformer,
+                rel_l1_thresh,
+                return_hidden_states_first,
+                num_steps,
+                coef_profile,
+                callbacks,
+                decide_ahead,
+            )
+        ]
+    )
+
+    original_forward = transformer.forward
+
+    @functools.wraps(original_forward)
+    def new_forward(
+        self,
+        *args,
+        **kwargs,
+    ):
+        with unittest.mock.patch.object(
+            self,
+            "transformer_blocks",
+            cached_transformer_blocks,
+        ):
+            return original_forward(
+                *args,
+                **kwargs,
+            )
+
+    transformer.forward = new_forward.__get__(transformer)
+
+    return transformer
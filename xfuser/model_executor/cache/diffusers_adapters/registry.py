@@ -3,8 +3,18 @@ adapted from https://github.com/ali-vilab/TeaCache.git
 adapted from https://github.com/chengzeyi/ParaAttention.git
 """
 from typing import Type, Dict
+from diffusers import (
+    CogVideoXTransformer3DModel,
+    HunyuanDiT2DModel,
+    PixArtTransformer2DModel,
+    SD3Transformer2DModel,
+)
 from diffusers.models.transformers.transformer_flux import FluxTransformer2DModel
 from xfuser.model_executor.models.transformers.transformer_flux import xFuserFluxTransformer2DWrapper
+from xfuser.model_executor.models.transformers.transformer_sd3 import xFuserSD3Transformer2DWrapper
+from xfuser.model_executor.models.transformers.pixart_transformer_2d import xFuserPixArtTransformer2DWrapper
+from xfuser.model_executor.models.transformers.hunyuan_transformer_2d import xFuserHunyuanDiT2DWrapper
+from xfuser.model_executor.models.transformers.cogvideox_transformer_3d import xFuserCogVideoXTransformer3DWrapper
 
 TRANSFORMER_ADAPTER_REGISTRY: Dict[Type, str] = {}
 
@@ -13,4 +23,12 @@ def register_transformer_adapter(transformer_class: Type, adapter_name: str):
 
 register_transformer_adapter(FluxTransformer2DModel, "flux")
 register_transformer_adapter(xFuserFluxTransformer2DWrapper, "flux")
+register_transformer_adapter(SD3Transformer2DModel, "sd3")
+register_transformer_adapter(xFuserSD3Transformer2DWrapper, "sd3")
+register_transformer_adapter(PixArtTransformer2DModel, "pixart")
+register_transformer_adapter(xFuserPixArtTransformer2DWrapper, "pixart")
+register_transformer_adapter(HunyuanDiT2DModel, "hunyuan_dit")
+register_transformer_adapter(xFuserHunyuanDiT2DWrapper, "hunyuan_dit")
+register_transformer_adapter(CogVideoXTransformer3DModel, "cogvideox")
+register_transformer_adapter(xFuserCogVideoXTransformer3DWrapper, "cogvideox")
 
@@ -0,0 +1,132 @@
+"""
+adapted from https://github.com/ali-vilab/TeaCache.git
+adapted from https://github.com/chengzeyi/ParaAttention.git
+"""
+
+import functools
+import unittest
+
+import torch
+from torch import nn
+from diffusers import SD3Transformer2DModel
+from xfuser.model_executor.cache.diffusers_adapters.registry import (
+    TRANSFORMER_ADAPTER_REGISTRY,
+)
+
+from xfuser.core.distributed import get_runtime_state
+from xfuser.model_executor.cache import utils
+
+
+class SD3CachedBlocksMixin:
+    # with PipeFusion every block takes the encoder hidden states it got for
+    # the first patch of the step, like xFuserSD3Transformer2DWrapper does
+    def call_block(self, idx, hidden, encoder, *args, **kwargs):
+        if self.is_pipeline_parallelized and get_runtime_state().patch_mode:
+            if not hasattr(self, "encoder_hidden_states_cache"):
+                self.encoder_hidden_states_cache = [None] * len(self.transformer_blocks)
+            if get_runtime_state().pipeline_patch_idx == 0:
+                self.encoder_hidden_states_cache[idx] = encoder
+            else:
+                encoder = self.encoder_hidden_states_cache[idx]
+        return super().call_block(idx, hidden, encoder, *args, **kwargs)
+
+
+class SD3FBCachedTransformerBlocks(
+    SD3CachedBlocksMixin, utils.FBCachedTransformerBlocks
+):
+    pass
+
+
+class SD3TeaCachedTransformerBlocks(
+    SD3CachedBlocksMixin, utils.TeaCachedTransformerBlocks
+):
+    pass
+
+
+class SD3GroupCachedTransformerBlocks(
+    SD3CachedBlocksMixin, utils.BlockGroupCachedTransformerBlocks
+):
+    pass
+
+
+def create_cached_transformer_blocks(
+    use_cache,
+    transformer,
+    rel_l1_thresh,
+    return_hidden_states_first,
+    num_steps,
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_class = {
+        "Fb": SD3FBCachedTransformerBlocks,
+        "Tea": SD3TeaCachedTransformerBlocks,
+        "Group": SD3GroupCachedTransformerBlocks,
+    }.get(use_cache)
+
+    if not cached_transformer_class:
+        raise ValueError(f"Unsupported use_cache value: {use_cache}")
+
+    # the joint blocks of SD3 return (encoder_hidden_states, hidden_states),
+    # the last one returns no encoder hidden states, which the cached blocks
+    # keep as they are
+    return cached_transformer_class(
+        transformer.transformer_blocks,
+        transformer=transformer,
+        rel_l1_thresh=rel_l1_thresh,
+        return_hidden_states_first=return_hidden_states_first,
+        num_steps=num_steps,
+        name=coef_profile or TRANSFORMER_ADAPTER_REGISTRY.get(type(transformer)),
+        callbacks=callbacks,
+        decide_ahead=decide_ahead,
+    )
+
+
+def apply_cache_on_transformer(
+    transformer: SD3Transformer2DModel,
+    *,
+    rel_l1_thresh=0.12,
+    return_hidden_states_first=False,
+    num_steps=8,
+    use_cache="Fb",
+    coef_profile=None,
+    callbacks=None,
+    decide_ahead=False,
+):
+    cached_transformer_blocks = nn.ModuleList(
+        [
+            create_cached_transformer_blocks(
+                use_cache,
+                transformer,
+                rel_l1_thresh,
+                return_hidden_states_first,
+                num_steps,
+                coef_profile,
+                callbacks,
+                decide_ahead,
+            )
+        ]
+    )
+
+    original_forward = transformer.forward
+
+    @functools.wraps(original_forward)
+    def new_forward(
+        self,
+        *args,
+        **kwargs,
+    ):
+        with unittest.mock.patch.object(
+            self,
+            "transformer_blocks",
+            cached_transformer_blocks,
+        ):
+            return original_forward(
+                *args,
+                **kwargs,
+            )
+
+    transformer.forward = new_forward.__get__(transformer)
+
+    return transformer
@@ -0,0 +1,133 @@
+"""
+Telemetry of TeaCache, FBCache and block group caching.
+
+Records, for every step of every request, the distance each sample moved,
+the threshold it was held against and whether it reused its cached
+residuals, so the effect of a threshold on the skipped steps can be read
+off a run instead of inferred from its latency.
+"""
+
+import dataclasses
+import math
+import time
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple
+
+from xfuser.model_executor.cache.utils import (
+    BlockGroupCachedTransformerBlocks,
+    CacheCallback,
+    current_request,
+)
+
+
+@dataclasses.dataclass
+class CacheStepRecord:
+    request_id: Hashable
+    step: int
+    # per sample, whether it skipped every block of the step
+    use_cache: List[bool]
+    # per sample distance to the step it is compared with (rescaled for
+    # TeaCache), None on the steps that run without comparing. Block group
+    # caching records one list per group, nan for groups without reference.
+    distance: Optional[List] = None
+    # TeaCache: per sample distance accumulated into the next step
+    accumulated_distance: Optional[List[float]] = None
+    # the threshold of the step, one per group for block group caching
+    threshold: Optional[List[float]] = None
+    # block group caching: per group, the samples that ran it
+    groups_ran: Optional[List[List[bool]]] = None
+    # host seconds since the end of the previous step of the request
+    duration: float = 0.0
+
+
+class CacheTelemetry(CacheCallback):
+    """Collects a :class:`CacheStepRecord` for every step the cached blocks
+    run, in ``records``.
+
+    Attach it through the ``callbacks`` of the cached blocks and look it up
+    with ``callback_handler.find(CacheTelemetry)``. The distances are read
+    back at the end of every step, which costs one more host sync per step
+    with ``decide_ahead``.
+    """
+
+    def __init__(self):
+        self.records: List[CacheStepRecord] = []
+        # request -> (step, decision of the last step, end of the last step
+        # or begin of the first one)
+        self.active: Dict[Hashable, Tuple[int, Optional[List], Optional[float]]] = {}
+
+    def on_forward_begin(self, state, **kwargs):
+        request_id = current_request()
+        step, last_decision, last_end = self.active.get(request_id, (0, None, None))
+        if last_end is None:
+            self.active[request_id] = (step, last_decision, time.perf_counter())
+
+    def on_forward_end(self, state, **kwargs):
+        request_id = current_request()
+        context = state.cache_context
+        step, last_decision, last_end = self.active[request_id]
+        group_cache = isinstance(state, BlockGroupCachedTransformerBlocks)
+        decision = context.groups_ran if group_cache else context.use_cache_host
+        # later PipeFusion patches of a step see the decision of its first one
+        if decision is None or decision is last_decision:
+            return
+        now = time.perf_counter()
+
+        record = CacheStepRecord(
+            request_id=request_id, step=step, use_cache=[], duration=now - last_end
+        )
+        if group_cache:
+            record.groups_ran = [list(ran) for ran in decision]
+            record.use_cache = [not any(ran) for ran in zip(*decision)]
+            record.threshold = state.group_thresholds.tolist()
+        else:
+            record.use_cache = list(decision)
+            record.threshold = [float(state.get_threshold(context))]
+            if context.accumulated_rel_l1_distance is not None:
+                record.accumulated_distance = (
+                    context.accumulated_rel_l1_distance.tolist()
+                )
+        if context.last_distance is not None:
+            record.distance = context.last_distance.tolist()
+        self.records.append(record)
+
+        if state.num_steps > 0 and step + 1 >= state.num_steps:
+            # the next step of the request id starts a new request
+            self.active[request_id] = (0, decision, None)
+        else:
+            self.active[request_id] = (step + 1, decision, now)
+
+    def clear(self):
+        self.records.clear()
+        self.active.clear()
+
+    def summary(
+        self, request_ids: Optional[Sequence[Hashable]] = None
+    ) -> Dict[str, float]:
+        """Steps, steps every sample skipped, the share of the block work
+        skipped (per sample, or per sample and group for block group
+        caching) and the mean distance, over ``request_ids`` or all requests."""
+        records = [
+            r
+            for r in self.records
+            if request_ids is None or r.request_id in request_ids
+        ]
+        runs = [
+            ran
+            for r in records
+            for ran in (r.groups_ran or [[not c for c in r.use_cache]])
+        ]
+        total = sum(len(ran) for ran in runs)
+        distances = [
+            d
+            for r in records
+            if r.distance is not None and r.groups_ran is None
+            for d in r.distance
+        ]
+        return {
+            "num_steps": len(records),
+            "skipped_steps": sum(all(r.use_cache) for r in records),
+            "skipped_ratio": (
+                1 - sum(sum(ran) for ran in runs) / total if total else 0.0
+            ),
+            "mean_distance": sum(distances) / len(distances) if distances else math.nan,
+        }
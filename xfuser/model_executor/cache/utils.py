@@ -2,33 +2,133 @@
 adapted from https://github.com/ali-vilab/TeaCache.git
 adapted from https://github.com/chengzeyi/ParaAttention.git
 """
+import contextlib
+import contextvars
 import dataclasses
-from typing import Dict, Optional, List
+import functools
+from typing import Callable, Dict, Hashable, Optional, List, Tuple
 from xfuser.core.distributed import (
-    get_sp_group,
-    get_sequence_parallel_world_size,
+    get_pipeline_parallel_world_size,
+    get_runtime_state,
+    get_stage_group,
+    model_parallel_is_initialized,
 )
 
+from xfuser.logger import init_logger
+
 import torch
 from torch.nn import Module
 from abc import ABC, abstractmethod
 
+logger = init_logger(__name__)
+
+
+def _default_device() -> torch.device:
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _to_device(values: List, dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+    # copies from pinned memory do not wait for the device to finish its work
+    tensor = torch.tensor(values, dtype=dtype)
+    if device.type == "cuda":
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
+
+
+def _to_host(tensor: torch.Tensor):
+    """Start copying ``tensor`` to the host, return the copy and the event to
+    wait for before reading it."""
+    if tensor.device.type != "cuda":
+        return tensor, None
+    host = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record()
+    return host, event
+
 
 # --------- CacheContext --------- #
 class CacheContext(Module):
     def __init__(self):
         super().__init__()
-        self.register_buffer("default_coef", torch.tensor([1.0, 0.0]).cuda())
-        self.register_buffer("flux_coef", torch.tensor([498.651651, -283.781631, 55.8554382, -3.82021401, 0.264230861]).cuda())
-        
+        self.register_buffer("default_coef", torch.tensor([1.0, 0.0]).to(_default_device()))
+        self.register_buffer("flux_coef", torch.tensor([498.651651, -283.781631, 55.8554382, -3.82021401, 0.264230861]).to(_default_device()))
+        self.register_buffer("cogvideox_2b_coef", torch.tensor([-31.0658903, 25.4732368, -5.92380459, 1.75769064, -0.00361568434]).to(_default_device()))
+        self.register_buffer("cogvideox_5b_coef", torch.tensor([-1538.80483, 843.202495, -134.363087, 7.97131516, -0.0523162339]).to(_default_device()))
+        self.register_buffer("cogvideox1_5_5b_coef", torch.tensor([250.210439, -165.061612, 35.7804877, -0.781551492, 0.0358559703]).to(_default_device()))
+
         self.register_buffer("original_hidden_states", None, persistent=False)
         self.register_buffer("original_encoder_hidden_states", None, persistent=False)
         self.register_buffer("hidden_states_residual", None, persistent=False)
         self.register_buffer("encoder_hidden_states_residual", None, persistent=False)
         self.register_buffer("modulated_inputs", None, persistent=False)
+        # steps of the request run so far, modulo the number of steps
+        self.cnt = 0
+        # (batch,) distance accumulated since a sample last ran the blocks
+        self.accumulated_rel_l1_distance: Optional[torch.Tensor] = None
+        # (batch,) whether a sample reused its residuals in the last step,
+        # the blocks branch on the host copy
+        self.use_cache: Optional[torch.Tensor] = None
+        self.use_cache_host: Optional[List[bool]] = None
+        # with decide_ahead, the decision for the next step on its way to
+        # the host and the event that marks its arrival
+        self.next_use_cache: Optional[torch.Tensor] = None
+        self.next_use_cache_event: Optional[torch.cuda.Event] = None
+        # per step distance of every sample (rescaled for TeaCache, per group
+        # for block group caching), and the threshold of the request if a
+        # controller overrides rel_l1_thresh
+        self.last_distance: Optional[torch.Tensor] = None
+        self.rel_l1_thresh: Optional[torch.Tensor] = None
+        # block group caching: group -> (input the group last ran on, hidden
+        # residual, encoder residual), and per group the samples that ran
+        # it in the last step
+        self.block_groups: Dict[int, Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]] = {}
+        self.groups_ran: List[List[bool]] = []
+        # (hidden, encoder) residuals of every PipeFusion patch, the key None
+        # holds the residuals of a step that ran without patches
+        self.patch_residuals: Dict[Optional[int], Tuple[torch.Tensor, Optional[torch.Tensor]]] = {}
+
+    def get_patch_residuals(self, patch_idx: Optional[int]) -> Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        if patch_idx in self.patch_residuals:
+            return self.patch_residuals[patch_idx]
+        if patch_idx is not None and None in self.patch_residuals:
+            # the tokens of the patch in the residuals of a full step
+            hidden_residual, encoder_residual = self.patch_residuals[None]
+            start_idx, end_idx = get_runtime_state().pp_patches_token_start_idx_local[patch_idx:patch_idx + 2]
+            return hidden_residual[:, start_idx:end_idx], encoder_residual
+        return None
 
     def get_coef(self, name: str) -> torch.Tensor:
-        return getattr(self, f"{name}_coef")
+        from xfuser.model_executor.cache.calibration import TeaCacheProfiles
+
+        # a calibrated profile comes first, models without any coefficients
+        # use the raw relative l1 distance
+        coefficients = TeaCacheProfiles().get(name)
+        if coefficients is not None:
+            return torch.tensor(coefficients, device=self.default_coef.device)
+        return getattr(self, f"{name}_coef", self.default_coef)
+
+_current_request = contextvars.ContextVar("xfuser_cache_request", default=None)
+
+
+def current_request() -> Hashable:
+    """Id of the request the cached blocks run for, see :func:`cache_request`."""
+    return _current_request.get()
+
+
+@contextlib.contextmanager
+def cache_request(request_id: Hashable):
+    """Run the cached blocks with the cache state of ``request_id``.
+
+    Requests whose steps interleave on the same transformer each keep their
+    own cache state; the state of a finished request is freed with
+    :meth:`CachedTransformerBlocks.release_request`.
+    """
+    token = _current_request.set(request_id)
+    try:
+        yield
+    finally:
+        _current_request.reset(token)
 
 #---------  CacheCallback  ---------#
 @dataclasses.dataclass
@@ -45,6 +145,7 @@ class CacheState:
 
 
 class CacheCallback:
+    def on_init_begin(self, state: CacheState, **kwargs): pass
     def on_init_end(self, state: CacheState, **kwargs): pass
     def on_forward_begin(self, state: CacheState, **kwargs): pass
     def on_forward_remaining_begin(self, state: CacheState, **kwargs): pass
@@ -59,6 +160,10 @@ class CallbackHandler(CacheCallback):
         for cb in self.callbacks:
             getattr(cb, event)(state)
 
+    def find(self, cls: type) -> Optional[CacheCallback]:
+        """First callback of type ``cls``, e.g. the telemetry of the blocks."""
+        return next((cb for cb in self.callbacks if isinstance(cb, cls)), None)
+
 # --------- Vectorized Poly1D --------- #
 class VectorizedPoly1D(Module):
     def __init__(self, coefficients: torch.Tensor):
@@ -73,6 +178,18 @@ class VectorizedPoly1D(Module):
         return result
 
 
+def _select_samples(value, batch_size: int, index: torch.Tensor):
+    # tensors with a batch dimension, positional embeddings are (tokens, dim)
+    # and are passed on as they are
+    if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch_size:
+        return value.index_select(0, index)
+    return value
+
+
+def _expand_mask(mask: torch.Tensor, like: torch.Tensor) -> torch.Tensor:
+    return mask.view(-1, *([1] * (like.dim() - 1)))
+
+
 class CachedTransformerBlocks(torch.nn.Module, ABC):
     def __init__(
         self,
@@ -85,36 +202,65 @@ class CachedTransformerBlocks(torch.nn.Module, ABC):
         num_steps: int = -1,
         name: str = "default",
         callbacks: Optional[List[CacheCallback]] = None,
+        decide_ahead: bool = False,
     ):
         super().__init__()
         self.transformer_blocks = torch.nn.ModuleList(transformer_blocks)
         self.single_transformer_blocks = torch.nn.ModuleList(single_transformer_blocks) if single_transformer_blocks else None
         self.transformer = transformer
-        self.register_buffer("cnt", torch.tensor(0).cuda())
-        self.register_buffer("accumulated_rel_l1_distance", torch.tensor([0.0]).cuda())
-        self.register_buffer("use_cache", torch.tensor(False, dtype=torch.bool).cuda())
 
-        self.cache_context = CacheContext()
+        # request id -> state of the request, see cache_request
+        self.cache_contexts: Dict[Hashable, CacheContext] = {}
         self.callback_handler = CallbackHandler(callbacks)
 
-        self.rel_l1_thresh = torch.tensor(rel_l1_thresh).cuda()
+        self.rel_l1_thresh = torch.tensor(rel_l1_thresh).to(_default_device())
         self.return_hidden_states_first = return_hidden_states_first
         self.num_steps = num_steps
         self.name = name
+        # decide the samples to skip one step ahead, see decide_one_step_ahead
+        self.decide_ahead = decide_ahead
         self.callback_handler.trigger_event("on_init_begin", self)
 
+    @property
+    def cache_context(self) -> CacheContext:
+        """State of the request that is running, see :func:`cache_request`."""
+        request_id = current_request()
+        if request_id not in self.cache_contexts:
+            self.cache_contexts[request_id] = CacheContext()
+        return self.cache_contexts[request_id]
+
+    @property
+    def use_cache(self) -> Optional[torch.Tensor]:
+        return self.cache_context.use_cache
+
+    def release_request(self, request_id: Hashable = None):
+        self.cache_contexts.pop(request_id, None)
+
+    # blocks of a plain diffusers pipeline run without the model parallel groups
     @property
     def is_parallelized(self) -> bool:
-        return get_sequence_parallel_world_size() > 1
+        return model_parallel_is_initialized() and get_stage_group().world_size > 1
 
-    def all_reduce(self, input_: torch.Tensor, op=torch.distributed.ReduceOp.AVG) -> torch.Tensor:
-        return get_sp_group().all_reduce(input_, op=op) if self.is_parallelized else input_
+    @property
+    def is_pipeline_parallelized(self) -> bool:
+        return model_parallel_is_initialized() and get_pipeline_parallel_world_size() > 1
+
+    def all_reduce(self, input_: torch.Tensor, op=torch.distributed.ReduceOp.SUM) -> torch.Tensor:
+        # the sequence parallel ranks of a stage hold different tokens, the
+        # cfg ranks different branches and the tensor parallel ranks the same
+        # tokens, one reduction over all of them gives every rank the same
+        # decision. Pipeline stages are not reduced over, they would wait on
+        # each other in the middle of the pipeline.
+        if not self.is_parallelized:
+            return input_
+        return get_stage_group().all_reduce(input_, op=op)
 
     def l1_distance(self, t1: torch.Tensor, t2: torch.Tensor) -> torch.Tensor:
-        diff = (t1 - t2).abs().mean()
-        norm = t1.abs().mean()
-        diff, norm = self.all_reduce(diff.unsqueeze(0)), self.all_reduce(norm.unsqueeze(0))
-        return (diff / norm).squeeze()
+        """Relative L1 distance of every sample of the batch."""
+        diff = (t1 - t2).abs().reshape(t1.shape[0], -1).mean(dim=1)
+        norm = t1.abs().reshape(t1.shape[0], -1).mean(dim=1)
+        diff, norm = self.all_reduce(torch.stack([diff, norm]).float())
+        return diff / norm
 
     @abstractmethod
     def are_two_tensor_similar(self, t1: torch.Tensor, t2: torch.Tensor, threshold: float) -> torch.Tensor: pass
@@ -125,45 +271,285 @@ class CachedTransformerBlocks(torch.nn.Module, ABC):
     @abstractmethod
     def get_modulated_inputs(self, hidden_states: torch.Tensor, encoder_hidden_states: torch.Tensor, *args, **kwargs): pass
 
+    def get_threshold(self, context: CacheContext) -> torch.Tensor:
+        return context.rel_l1_thresh if context.rel_l1_thresh is not None else self.rel_l1_thresh
+
+    def is_forced_step(self, context: CacheContext) -> bool:
+        """Whether the current step runs the blocks whatever the distance."""
+        return False
+
+    def update_context(self, context: CacheContext, use_cache: torch.Tensor):
+        """Bookkeeping of a subclass once the samples to skip are known."""
+        pass
+
+    def plan_next_step(self, context: CacheContext, t1: torch.Tensor, t2: torch.Tensor, use_cache: torch.Tensor) -> torch.Tensor:
+        """Samples to skip in the next step, from the distance of this step
+        to the previous one, see :meth:`decide_one_step_ahead`."""
+        self.update_context(context, use_cache)
+        return self.are_two_tensor_similar(t1, t2, self.get_threshold(context))
+
+    def decide(
+        self,
+        context: CacheContext,
+        modulated: torch.Tensor,
+        prev_modulated: Optional[torch.Tensor],
+        per_sample: bool = True,
+    ) -> List[bool]:
+        """Which samples of the batch reuse their cached residuals.
+
+        The first step of a request, and a step whose batch differs from the
+        previous one, run the blocks for every sample. Without ``per_sample``
+        the batch is only skipped if every sample can be. Reading the
+        decision back is the one point of the step at which the host waits
+        for the device.
+        """
+        if self.decide_ahead:
+            return self.decide_one_step_ahead(context, modulated, prev_modulated, per_sample)
+        batch_size = modulated.shape[0]
+        if prev_modulated is None or prev_modulated.shape != modulated.shape:
+            use_cache = torch.zeros(batch_size, dtype=torch.bool, device=modulated.device)
+            context.accumulated_rel_l1_distance = torch.zeros(batch_size, device=modulated.device)
+            context.last_distance = None
+            prev_modulated = None
+        else:
+            use_cache = self.are_two_tensor_similar(prev_modulated, modulated, self.get_threshold(context))
+            if self.is_forced_step(context):
+                use_cache = torch.zeros_like(use_cache)
+            if not per_sample:
+                use_cache = use_cache.all().expand(batch_size)
+        self.update_context(context, use_cache)
+        self.finish_decision(context, modulated, prev_modulated, use_cache)
+        context.use_cache_host = use_cache.tolist()
+        return context.use_cache_host
+
+    def decide_one_step_ahead(
+        self,
+        context: CacheContext,
+        modulated: torch.Tensor,
+        prev_modulated: Optional[torch.Tensor],
+        per_sample: bool = True,
+    ) -> List[bool]:
+        """Like :meth:`decide`, without the host waiting for the device.
+
+        The samples to skip in a step are decided by the previous step, which
+        expects the next step to move as far as itself. The decision is
+        copied to the host while the blocks of the previous step run, so the
+        branch costs no synchronization and a captured or compiled step
+        contains no data dependent control flow. The callbacks
+        :class:`CacheTelemetry` and :class:`CacheThresholdController` with a
+        latency target still read back once per step.
+        """
+        batch_size = modulated.shape[0]
+        fresh = prev_modulated is None or prev_modulated.shape != modulated.shape
+        use_cache_host = [False] * batch_size
+        if not fresh and context.next_use_cache is not None and not self.is_forced_step(context):
+            if context.next_use_cache_event is not None:
+                context.next_use_cache_event.synchronize()
+            if context.next_use_cache.shape[0] == batch_size:
+                use_cache_host = context.next_use_cache.tolist()
+        use_cache = _to_device(use_cache_host, torch.bool, modulated.device)
+
+        if fresh:
+            context.accumulated_rel_l1_distance = torch.zeros(batch_size, device=modulated.device)
+            context.last_distance = None
+            next_use_cache = torch.zeros(batch_size, dtype=torch.bool, device=modulated.device)
+            prev_modulated = None
+        else:
+            next_use_cache = self.plan_next_step(context, prev_modulated, modulated, use_cache)
+            if not per_sample:
+                next_use_cache = next_use_cache.all().expand(batch_size)
+        context.next_use_cache, context.next_use_cache_event = _to_host(next_use_cache)
+        self.finish_decision(context, modulated, prev_modulated, use_cache)
+        context.use_cache_host = use_cache_host
+        return use_cache_host
+
+    def finish_decision(
+        self,
+        context: CacheContext,
+        modulated: torch.Tensor,
+        prev_modulated: Optional[torch.Tensor],
+        use_cache: torch.Tensor,
+    ):
+        if prev_modulated is None or self.refresh_reference_on_skip:
+            context.modulated_inputs = modulated
+        else:
+            # skipped samples keep comparing with their last computed step
+            context.modulated_inputs = torch.where(_expand_mask(use_cache, modulated), prev_modulated, modulated)
+        context.cnt = context.cnt + 1 if context.cnt + 1 != self.num_steps else 0
+        context.use_cache = use_cache
+
+    def call_block(self, idx: int, hidden: torch.Tensor, encoder: torch.Tensor, *args, **kwargs):
+        """Run the ``idx``-th transformer block and return ``(hidden, encoder)``.
+
+        Adapters of models whose blocks take other arguments or return a
+        single tensor override this.
+        """
+        hidden, encoder = self.transformer_blocks[idx](hidden, encoder, *args, **kwargs)
+        return (hidden, encoder) if self.return_hidden_states_first else (encoder, hidden)
+
+    def pack_outputs(self, hidden: torch.Tensor, encoder: torch.Tensor):
+        """Outputs in the form the model expects from one of its blocks."""
+        return (hidden, encoder) if self.return_hidden_states_first else (encoder, hidden)
+
+    def select_batch(self, index: torch.Tensor):
+        """Keep the samples ``index`` of the state the blocks of an adapter
+        carry between calls, before the remaining blocks run on them only."""
+        pass
+
     def process_blocks(self, start_idx: int, hidden: torch.Tensor, encoder: torch.Tensor, *args, **kwargs):
-        for block in self.transformer_blocks[start_idx:]:
-            hidden, encoder = block(hidden, encoder, *args, **kwargs)
-            hidden, encoder = (hidden, encoder) if self.return_hidden_states_first else (encoder, hidden)
+        for idx in range(start_idx, len(self.transformer_blocks)):
+            hidden, encoder = self.call_block(idx, hidden, encoder, *args, **kwargs)
 
         if self.single_transformer_blocks:
             hidden = torch.cat([encoder, hidden], dim=1)
             for block in self.single_transformer_blocks:
                 hidden = block(hidden, *args, **kwargs)
             encoder, hidden = hidden.split([encoder.shape[1], hidden.shape[1] - encoder.shape[1]], dim=1)
-
-        self.cache_context.hidden_states_residual = hidden - self.cache_context.original_hidden_states
-        self.cache_context.encoder_hidden_states_residual = encoder - self.cache_context.original_encoder_hidden_states
         return hidden, encoder
 
+    @staticmethod
+    def encoder_residual(encoder: Optional[torch.Tensor], original_encoder: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        # single stream blocks leave the encoder hidden states as they are and
+        # the last joint block of some models does not return them
+        if encoder is None or encoder is original_encoder:
+            return None
+        return encoder - original_encoder
+
+    def run_masked(
+        self,
+        run: Callable,
+        use_cache: List[bool],
+        hidden: torch.Tensor,
+        encoder: torch.Tensor,
+        residuals: Tuple[Optional[torch.Tensor], Optional[torch.Tensor]],
+        *args,
+        **kwargs,
+    ):
+        """Run ``run(hidden, encoder, *args, **kwargs)`` for the samples that
+        are not cached, the cached ones add their ``(hidden, encoder)``
+        residuals to their inputs.
+
+        The samples that run are gathered into a smaller batch, so skipped
+        samples cost no block compute. Returns the outputs and the residuals
+        updated with the samples that ran.
+        """
+        hidden_residual, encoder_residual = residuals
+        batch_size = hidden.shape[0]
+        compute = [idx for idx, cached in enumerate(use_cache) if not cached]
+        if len(compute) == batch_size:
+            out_hidden, out_encoder = run(hidden, encoder, *args, **kwargs)
+            return out_hidden, out_encoder, (out_hidden - hidden, self.encoder_residual(out_encoder, encoder))
+
+        # residuals are relative to the inputs of the skipped blocks
+        out_hidden = hidden + hidden_residual
+        out_encoder = encoder
+        if encoder_residual is not None:
+            out_encoder = encoder + encoder_residual
+        if not compute:
+            return out_hidden, out_encoder, residuals
+
+        compute_idx = _to_device(compute, torch.long, hidden.device)
+        self.select_batch(compute_idx)
+        args = [_select_samples(arg, batch_size, compute_idx) for arg in args]
+        kwargs = {key: _select_samples(value, batch_size, compute_idx) for key, value in kwargs.items()}
+        sub_hidden = hidden.index_select(0, compute_idx)
+        sub_encoder = encoder.index_select(0, compute_idx) if encoder is not None else None
+        sub_out_hidden, sub_out_encoder = run(sub_hidden, sub_encoder, *args, **kwargs)
+
+        out_hidden = out_hidden.index_copy(0, compute_idx, sub_out_hidden)
+        hidden_residual = hidden_residual.index_copy(0, compute_idx, sub_out_hidden - sub_hidden)
+        sub_encoder_residual = self.encoder_residual(sub_out_encoder, sub_encoder)
+        if sub_encoder_residual is not None and encoder_residual is not None:
+            out_encoder = out_encoder.index_copy(0, compute_idx, sub_out_encoder)
+            encoder_residual = encoder_residual.index_copy(0, compute_idx, sub_encoder_residual)
+        return out_hidden, out_encoder, (hidden_residual, encoder_residual)
+
+    def run_remaining_blocks(self, context: CacheContext, use_cache: List[bool], hidden: torch.Tensor, encoder: torch.Tensor, *args, **kwargs):
+        """Run the blocks from ``get_start_idx()`` on for the samples that are
+        not cached, see :meth:`run_masked`."""
+        out_hidden, out_encoder, residuals = self.run_masked(
+            functools.partial(self.process_blocks, self.get_start_idx()),
+            use_cache,
+            hidden,
+            encoder,
+            (context.hidden_states_residual, context.encoder_hidden_states_residual),
+            *args,
+            **kwargs,
+        )
+        context.hidden_states_residual, context.encoder_hidden_states_residual = residuals
+        return out_hidden, out_encoder
+
+    def get_step_embedding(self, hidden_states, encoder_hidden_states, *args, **kwargs) -> torch.Tensor:
+        """Embedding of the timestep (and condition) that modulates the
+        blocks, the same on every pipeline stage."""
+        return kwargs["temb"]
+
+    def pipefusion_forward(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        """Forward of a PipeFusion stage, which runs once for every patch.
+
+        The cache is decided once per step, at its first patch, from the step
+        embedding. Every stage computes that embedding alike, so all stages
+        skip the same steps without waiting on each other. Residuals are kept
+        per patch. The patches of a batch go through the stages and their kv
+        caches together, so a step is skipped for the whole batch or not at all.
+        """
+        runtime_state = get_runtime_state()
+        patch_idx = runtime_state.pipeline_patch_idx if runtime_state.patch_mode else None
+        context = self.cache_context
+        if not patch_idx:
+            modulated = self.get_step_embedding(hidden_states, encoder_hidden_states, *args, **kwargs)
+            self.decide(context, modulated, context.modulated_inputs, per_sample=False)
+
+        self.callback_handler.trigger_event("on_forward_remaining_begin", self)
+        residuals = context.get_patch_residuals(patch_idx) if all(context.use_cache_host) else None
+        if residuals is not None:
+            hidden_residual, encoder_residual = residuals
+            hidden = hidden_states + hidden_residual
+            encoder = encoder_hidden_states
+            if encoder_residual is not None:
+                encoder = encoder_hidden_states + encoder_residual
+        else:
+            context.original_hidden_states = hidden_states
+            context.original_encoder_hidden_states = encoder_hidden_states
+            hidden, encoder = self.process_blocks(0, hidden_states, encoder_hidden_states, *args, **kwargs)
+            context.hidden_states_residual = hidden - hidden_states
+            context.encoder_hidden_states_residual = self.encoder_residual(encoder, encoder_hidden_states)
+            if patch_idx is None:
+                # patch residuals of older steps are staler than these
+                context.patch_residuals.clear()
+            context.patch_residuals[patch_idx] = (
+                context.hidden_states_residual,
+                context.encoder_hidden_states_residual,
+            )
+
+        self.callback_handler.trigger_event("on_forward_end", self)
+        return self.pack_outputs(hidden, encoder)
+
     def forward(self, hidden_states, encoder_hidden_states, *args, **kwargs):
         self.callback_handler.trigger_event("on_forward_begin", self)
+        if self.is_pipeline_parallelized:
+            return self.pipefusion_forward(hidden_states, encoder_hidden_states, *args, **kwargs)
 
+        context = self.cache_context
         modulated, prev_modulated, orig_hidden, orig_encoder = \
             self.get_modulated_inputs(hidden_states, encoder_hidden_states, *args, **kwargs)
 
-        self.cache_context.original_hidden_states = orig_hidden
-        self.cache_context.original_encoder_hidden_states = orig_encoder
+        context.original_hidden_states = orig_hidden
+        context.original_encoder_hidden_states = orig_encoder
 
-        self.use_cache = self.are_two_tensor_similar(prev_modulated, modulated, self.rel_l1_thresh) \
-            if prev_modulated is not None else torch.tensor(False, dtype=torch.bool)
+        use_cache = self.decide(context, modulated, prev_modulated)
 
         self.callback_handler.trigger_event("on_forward_remaining_begin", self)
-        if self.use_cache:
-            hidden = hidden_states + self.cache_context.hidden_states_residual
-            encoder = encoder_hidden_states + self.cache_context.encoder_hidden_states_residual
-        else:
-            hidden, encoder = self.process_blocks(self.get_start_idx(), orig_hidden, orig_encoder, *args, **kwargs)
+        hidden, encoder = self.run_remaining_blocks(context, use_cache, orig_hidden, orig_encoder, *args, **kwargs)
 
         self.callback_handler.trigger_event("on_forward_end", self)
-        return ((hidden, encoder) if self.return_hidden_states_first else (encoder, hidden))
+        return self.pack_outputs(hidden, encoder)
 
 
 class FBCachedTransformerBlocks(CachedTransformerBlocks):
+    # compare with the last step that ran the blocks
+    refresh_reference_on_skip = False
+
     def __init__(
         self,
         transformer_blocks,
@@ -175,6 +561,7 @@ class FBCachedTransformerBlocks(CachedTransformerBlocks):
         num_steps=-1,
         name="default",
         callbacks: Optional[List[CacheCallback]] = None,
+        decide_ahead: bool = False,
     ):
         super().__init__(transformer_blocks,
                        single_transformer_blocks=single_transformer_blocks,
@@ -183,28 +570,30 @@ class FBCachedTransformerBlocks(CachedTransformerBlocks):
                        num_steps=num_steps,
                        return_hidden_states_first=return_hidden_states_first,
                        name=name,
-                       callbacks=callbacks)
+                       callbacks=callbacks,
+                       decide_ahead=decide_ahead)
 
     def get_start_idx(self) -> int:
         return 1
 
     def are_two_tensor_similar(self, t1: torch.Tensor, t2: torch.Tensor, threshold: torch.Tensor) -> torch.Tensor:
-        return self.l1_distance(t1, t2) < threshold
+        distance = self.l1_distance(t1, t2)
+        self.cache_context.last_distance = distance
+        return distance < threshold
 
     def get_modulated_inputs(self, hidden_states, encoder_hidden_states, *args, **kwargs):
         original_hidden_states = hidden_states
-        first_transformer_block = self.transformer_blocks[0]
-        hidden_states, encoder_hidden_states = first_transformer_block(hidden_states, encoder_hidden_states, *args, **kwargs)
-        hidden_states, encoder_hidden_states = (hidden_states, encoder_hidden_states) if self.return_hidden_states_first else (encoder_hidden_states, hidden_states)
+        hidden_states, encoder_hidden_states = self.call_block(0, hidden_states, encoder_hidden_states, *args, **kwargs)
         first_hidden_states_residual = hidden_states - original_hidden_states
         prev_first_hidden_states_residual = self.cache_context.modulated_inputs
-        if not self.use_cache:
-           self.cache_context.modulated_inputs = first_hidden_states_residual
 
         return first_hidden_states_residual, prev_first_hidden_states_residual, hidden_states, encoder_hidden_states
 
 
 class TeaCachedTransformerBlocks(CachedTransformerBlocks):
+    # compare consecutive steps and accumulate the distance
+    refresh_reference_on_skip = True
+
     def __init__(
         self,
         transformer_blocks,
@@ -216,6 +605,7 @@ class TeaCachedTransformerBlocks(CachedTransformerBlocks):
         num_steps=-1,
         name="default",
         callbacks: Optional[List[CacheCallback]] = None,
+        decide_ahead: bool = False,
     ):
         super().__init__(transformer_blocks,
                        single_transformer_blocks=single_transformer_blocks,
@@ -224,26 +614,183 @@ class TeaCachedTransformerBlocks(CachedTransformerBlocks):
                        num_steps=num_steps,
                        return_hidden_states_first=return_hidden_states_first,
                        name=name,
-                       callbacks=callbacks)
+                       callbacks=callbacks,
+                       decide_ahead=decide_ahead)
         self.rescale_func = VectorizedPoly1D(self.cache_context.get_coef(self.name))
 
     def get_start_idx(self) -> int:
         return 0
 
-    def are_two_tensor_similar(self, t1: torch.Tensor, t2: torch.Tensor, threshold: float) -> torch.Tensor:
-        diff = self.l1_distance(t1, t2)
-        new_accum = self.accumulated_rel_l1_distance + self.rescale_func(diff)
-        reset_mask = (self.cnt == 0) or (self.cnt == self.num_steps - 1)
-        self.use_cache = torch.logical_and(new_accum < threshold, torch.logical_not(reset_mask))
-        self.accumulated_rel_l1_distance[0] = torch.where(self.use_cache, new_accum[0], 0.0)
-        self.cnt = torch.where(self.cnt + 1 < self.num_steps, self.cnt + 1, 0)
+    def is_forced_step(self, context: CacheContext) -> bool:
+        return context.cnt == 0 or context.cnt == self.num_steps - 1
 
-        return self.use_cache
+    def are_two_tensor_similar(self, t1: torch.Tensor, t2: torch.Tensor, threshold: float) -> torch.Tensor:
+        context = self.cache_context
+        context.last_distance = self.rescale_func(self.l1_distance(t1, t2))
+        context.accumulated_rel_l1_distance = context.accumulated_rel_l1_distance + context.last_distance
+        return context.accumulated_rel_l1_distance < threshold
+
+    def plan_next_step(self, context, t1, t2, use_cache):
+        distance = self.rescale_func(self.l1_distance(t1, t2))
+        context.accumulated_rel_l1_distance = torch.where(
+            use_cache, context.accumulated_rel_l1_distance + distance, 0.0
+        )
+        context.last_distance = distance
+        return context.accumulated_rel_l1_distance + distance < self.get_threshold(context)
+
+    def update_context(self, context: CacheContext, use_cache: torch.Tensor):
+        # samples that run the blocks start accumulating again
+        context.accumulated_rel_l1_distance = torch.where(use_cache, context.accumulated_rel_l1_distance, 0.0)
+
+    def get_tea_input(self, hidden_states, encoder_hidden_states, *args, **kwargs) -> torch.Tensor:
+        """Timestep modulated input of the first block, whose change between
+        steps estimates the change of the output."""
+        return self.transformer_blocks[0].norm1(hidden_states, emb=kwargs["temb"])[0]
 
     def get_modulated_inputs(self, hidden_states, encoder_hidden_states, *args, **kwargs):
-        inp = hidden_states.clone()
-        temb_ = kwargs.get("temb", None).clone()
-        modulated, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.transformer_blocks[0].norm1(inp, emb=temb_)
+        modulated = self.get_tea_input(hidden_states, encoder_hidden_states, *args, **kwargs)
         prev_modulated = self.cache_context.modulated_inputs
-        self.cache_context.modulated_inputs = modulated
-        return modulated, prev_modulated, hidden_states, encoder_hidden_states
\ No newline at end of file
+        return modulated, prev_modulated, hidden_states, encoder_hidden_states
+
+
+class BlockGroupCachedTransformerBlocks(CachedTransformerBlocks):
+    """Caches the residual of every group of ``group_size`` consecutive
+    blocks, in the spirit of Delta-DiT and FORA.
+
+    A group runs for the samples whose input to the group moved more than
+    the threshold of the group since the group last ran for them, the other
+    samples add the residual the group had then. ``rel_l1_thresh`` is one
+    threshold for all groups or one per group, joint blocks first. The
+    samples that ran every group in the last step are in
+    ``cache_context.groups_ran``.
+    """
+    # compare with the input the group last ran on
+    refresh_reference_on_skip = False
+
+    def __init__(
+        self,
+        transformer_blocks,
+        single_transformer_blocks=None,
+        *,
+        transformer=None,
+        rel_l1_thresh=0.6,
+        return_hidden_states_first=True,
+        num_steps=-1,
+        name="default",
+        callbacks: Optional[List[CacheCallback]] = None,
+        decide_ahead: bool = False,
+        group_size: int = 4,
+    ):
+        if decide_ahead:
+            raise ValueError("Block group caching decides every group within the step, decide_ahead is not supported")
+        super().__init__(transformer_blocks,
+                       single_transformer_blocks=single_transformer_blocks,
+                       transformer=transformer,
+                       rel_l1_thresh=rel_l1_thresh,
+                       num_steps=num_steps,
+                       return_hidden_states_first=return_hidden_states_first,
+                       name=name,
+                       callbacks=callbacks)
+        self.group_size = group_size
+        # (single stream, block indices) of every group
+        self.groups = [
+            (False, range(start, min(start + group_size, len(self.transformer_blocks))))
+            for start in range(0, len(self.transformer_blocks), group_size)
+        ]
+        if self.single_transformer_blocks:
+            self.groups += [
+                (True, range(start, min(start + group_size, len(self.single_transformer_blocks))))
+                for start in range(0, len(self.single_transformer_blocks), group_size)
+            ]
+        thresholds = self.rel_l1_thresh.flatten()
+        if thresholds.numel() == 1:
+            thresholds = thresholds.expand(len(self.groups))
+        if thresholds.numel() != len(self.groups):
+            raise ValueError(
+                f"{thresholds.numel()} thresholds given for {len(self.groups)} block groups"
+            )
+        self.group_thresholds = thresholds
+        if self.is_pipeline_parallelized:
+            logger.warning("Block group caching does not support PipeFusion, every block will run")
+
+    def get_start_idx(self) -> int:
+        return 0
+
+    def are_two_tensor_similar(self, t1: torch.Tensor, t2: torch.Tensor, threshold: torch.Tensor) -> torch.Tensor:
+        return self.l1_distance(t1, t2) < threshold
+
+    def get_modulated_inputs(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        # every group compares its own input
+        return hidden_states, self.cache_context.modulated_inputs, hidden_states, encoder_hidden_states
+
+    def run_group(self, single_stream: bool, indices: range, hidden, encoder, *args, **kwargs):
+        for idx in indices:
+            if single_stream:
+                hidden = self.single_transformer_blocks[idx](hidden, *args, **kwargs)
+            else:
+                hidden, encoder = self.call_block(idx, hidden, encoder, *args, **kwargs)
+        return hidden, encoder
+
+    def run_groups(self, context: CacheContext, hidden, encoder, *args, **kwargs):
+        context.groups_ran = []
+        distances = []
+        encoder_len = None
+        for group_idx, (single_stream, indices) in enumerate(self.groups):
+            if single_stream and encoder_len is None:
+                encoder_len = encoder.shape[1]
+                hidden, encoder = torch.cat([encoder, hidden], dim=1), None
+
+            state = context.block_groups.get(group_idx, None)
+            if state is None or state[0].shape != hidden.shape:
+                state = None
+                use_cache = [False] * hidden.shape[0]
+                distances.append(torch.full((hidden.shape[0],), float("nan"), device=hidden.device))
+            else:
+                distances.append(self.l1_distance(state[0], hidden))
+                # one read back per group, the next group depends on it
+                use_cache = (distances[-1] < self.group_thresholds[group_idx]).tolist()
+
+            out_hidden, out_encoder, residuals = self.run_masked(
+                functools.partial(self.run_group, single_stream, indices),
+                use_cache,
+                hidden,
+                encoder,
+                state[1:] if state is not None else (None, None),
+                *args,
+                **kwargs,
+            )
+            if state is None:
+                reference = hidden
+            else:
+                reference = torch.where(_expand_mask(_to_device(use_cache, torch.bool, hidden.device), hidden), state[0], hidden)
+            context.block_groups[group_idx] = (reference, *residuals)
+            context.groups_ran.append([not cached for cached in use_cache])
+            hidden, encoder = out_hidden, out_encoder
+
+        # (group, batch), nan for the groups that ran without a reference
+        context.last_distance = torch.stack(distances)
+        if encoder_len is not None:
+            encoder, hidden = hidden.split([encoder_len, hidden.shape[1] - encoder_len], dim=1)
+        return hidden, encoder
+
+    def forward(self, hidden_states, encoder_hidden_states, *args, **kwargs):
+        self.callback_handler.trigger_event("on_forward_begin", self)
+        context = self.cache_context
+        context.original_hidden_states = hidden_states
+        context.original_encoder_hidden_states = encoder_hidden_states
+
+        self.callback_handler.trigger_event("on_forward_remaining_begin", self)
+        if self.is_pipeline_parallelized:
+            # the patches of a stage share its kv caches, which a group
+            # skipped for some patches would leave behind
+            hidden, encoder = self.process_blocks(0, hidden_states, encoder_hidden_states, *args, **kwargs)
+            context.groups_ran = [[True] * hidden_states.shape[0] for _ in self.groups]
+        else:
+            hidden, encoder = self.run_groups(context, hidden_states, encoder_hidden_states, *args, **kwargs)
+        context.hidden_states_residual = hidden - hidden_states
+        context.encoder_hidden_states_residual = self.encoder_residual(encoder, encoder_hidden_states)
+        context.use_cache = None
+        context.cnt = context.cnt + 1 if context.cnt + 1 != self.num_steps else 0
+
+        self.callback_handler.trigger_event("on_forward_end", self)
+        return self.pack_outputs(hidden, encoder)
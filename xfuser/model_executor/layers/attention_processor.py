@@ -33,6 +33,9 @@ from xfuser.core.distributed import (
 )
 from xfuser.core.fast_attention import (
     xFuserFastAttention,
+    xFuserJointFastAttention,
+    xFuserFluxFastAttention,
+    xFuserHunyuanFastAttention,
     get_fast_attn_enable,
 )
 
@@ -212,7 +215,7 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
             self.hybrid_seq_parallel_attn = None
 
         if get_fast_attn_enable():
-            self.fast_attn = xFuserFastAttention()
+            self.fast_attn = xFuserFastAttention(hybrid_seq_parallel_attn=self.hybrid_seq_parallel_attn)
 
     def __call__(
         self,
@@ -277,6 +280,12 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
 
         query = attn.to_q(hidden_states)
 
+        # padded image tokens are only in the keys of self attention
+        key_padding = (
+            get_runtime_state().sp_key_padding
+            if encoder_hidden_states is None
+            else None
+        )
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
         elif attn.norm_cross:
@@ -327,6 +336,7 @@ class xFuserAttnProcessor2_0(AttnProcessor2_0):
                 dropout_p=0.0,
                 causal=False,
                 joint_strategy="none",
+                key_padding=key_padding,
             )
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
@@ -418,7 +428,9 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
                 )
 
         if get_fast_attn_enable():
-            self.fast_attn = xFuserFastAttention()
+            self.fast_attn = xFuserJointFastAttention(
+                hybrid_seq_parallel_attn=getattr(self, "hybrid_seq_parallel_attn", None)
+            )
 
     def __call__(
         self,
@@ -429,6 +441,16 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
         *args,
         **kwargs,
     ) -> torch.FloatTensor:
+        #! ---------------------------------------- Fast Attention ----------------------------------------
+        if get_fast_attn_enable():
+            return self.fast_attn(
+                attn,
+                hidden_states,
+                encoder_hidden_states,
+                attention_mask,
+            )
+        #! ---------------------------------------- Fast Attention ----------------------------------------
+
         residual = hidden_states
         batch_size = hidden_states.shape[0]
 
@@ -502,12 +524,21 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
             key = attn.norm_k(key)
 
         #! ---------------------------------------- ATTENTION ----------------------------------------
+        # padded image tokens have to end the local sequence, put the text
+        # in front of them
+        text_in_front = False
         if HAS_LONG_CTX_ATTN and get_sequence_parallel_world_size() > 1:
             if encoder_hidden_states is not None:
                 if get_runtime_state().split_text_embed_in_sp:
-                    query = torch.cat([query, encoder_hidden_states_query_proj], dim=1)
-                    key = torch.cat([key, encoder_hidden_states_key_proj], dim=1)
-                    value = torch.cat([value, encoder_hidden_states_value_proj], dim=1)
+                    if get_runtime_state().sp_key_padding is not None:
+                        text_in_front = True
+                        query = torch.cat([encoder_hidden_states_query_proj, query], dim=1)
+                        key = torch.cat([encoder_hidden_states_key_proj, key], dim=1)
+                        value = torch.cat([encoder_hidden_states_value_proj, value], dim=1)
+                    else:
+                        query = torch.cat([query, encoder_hidden_states_query_proj], dim=1)
+                        key = torch.cat([key, encoder_hidden_states_key_proj], dim=1)
+                        value = torch.cat([value, encoder_hidden_states_value_proj], dim=1)
 
                     encoder_hidden_states_query_proj = None
                     encoder_hidden_states_key_proj = None
@@ -538,6 +569,7 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
                 joint_tensor_key=encoder_hidden_states_key_proj,
                 joint_tensor_value=encoder_hidden_states_value_proj,
                 joint_strategy="rear",
+                key_padding=get_runtime_state().sp_key_padding,
             )
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
@@ -593,7 +625,14 @@ class xFuserJointAttnProcessor2_0(JointAttnProcessor2_0):
         hidden_states = hidden_states.to(query.dtype)
 
         # Split the attention outputs.
-        if encoder_hidden_states is not None:
+        if text_in_front:
+            encoder_hidden_states, hidden_states = (
+                hidden_states[:, : -residual.shape[1]],
+                hidden_states[:, -residual.shape[1] :],
+            )
+            if not attn.context_pre_only:
+                encoder_hidden_states = attn.to_add_out(encoder_hidden_states)
+        elif encoder_hidden_states is not None:
             hidden_states, encoder_hidden_states = (
                 hidden_states[:, : residual.shape[1]],
                 hidden_states[:, residual.shape[1] :],
@@ -650,6 +689,11 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
                     attn_type=AttnType.TORCH,
                 )
 
+        if get_fast_attn_enable():
+            self.fast_attn = xFuserFluxFastAttention(
+                hybrid_seq_parallel_attn=getattr(self, "hybrid_seq_parallel_attn", None)
+            )
+
     def __call__(
         self,
         attn: Attention,
@@ -660,6 +704,17 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
         *args,
         **kwargs,
     ) -> torch.FloatTensor:
+        #! ---------------------------------------- Fast Attention ----------------------------------------
+        if get_fast_attn_enable():
+            return self.fast_attn(
+                attn,
+                hidden_states,
+                encoder_hidden_states,
+                attention_mask,
+                image_rotary_emb=image_rotary_emb,
+            )
+        #! ---------------------------------------- Fast Attention ----------------------------------------
+
         batch_size, _, _ = (
             hidden_states.shape
             if encoder_hidden_states is None
@@ -752,7 +807,14 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
             get_pipeline_parallel_world_size() == 1
             and get_runtime_state().split_text_embed_in_sp
         ):
-            hidden_states = USP(query, key, value, dropout_p=0.0, is_causal=False)
+            hidden_states = USP(
+                query,
+                key,
+                value,
+                dropout_p=0.0,
+                is_causal=False,
+                key_padding=get_runtime_state().sp_key_padding,
+            )
             hidden_states = hidden_states.transpose(1, 2).reshape(
                 batch_size, -1, attn.heads * head_dim
             )
@@ -785,6 +847,7 @@ class xFuserFluxAttnProcessor2_0(FluxAttnProcessor2_0):
                 joint_tensor_key=encoder_hidden_states_key_proj,
                 joint_tensor_value=encoder_hidden_states_value_proj,
                 joint_strategy="front",
+                key_padding=get_runtime_state().sp_key_padding,
             )
             hidden_states = hidden_states.reshape(batch_size, -1, attn.heads * head_dim)
 
@@ -858,6 +921,11 @@ class xFuserHunyuanAttnProcessor2_0(HunyuanAttnProcessor2_0):
         else:
             self.hybrid_seq_parallel_attn = None
 
+        if get_fast_attn_enable():
+            self.fast_attn = xFuserHunyuanFastAttention(
+                hybrid_seq_parallel_attn=getattr(self, "hybrid_seq_parallel_attn", None)
+            )
+
     # NOTE() torch.compile dose not works for V100
     @torch_compile_disable_if_v100
     def __call__(
@@ -870,6 +938,18 @@ class xFuserHunyuanAttnProcessor2_0(HunyuanAttnProcessor2_0):
         image_rotary_emb: Optional[torch.Tensor] = None,
         latte_temporal_attention: Optional[bool] = False,
     ) -> torch.Tensor:
+        #! ---------------------------------------- Fast Attention ----------------------------------------
+        if get_fast_attn_enable():
+            return self.fast_attn(
+                attn,
+                hidden_states,
+                encoder_hidden_states,
+                attention_mask,
+                temb,
+                image_rotary_emb=image_rotary_emb,
+            )
+        #! ---------------------------------------- Fast Attention ----------------------------------------
+
         residual = hidden_states
         if attn.spatial_norm is not None:
             hidden_states = attn.spatial_norm(hidden_states, temb)
@@ -1,5 +1,6 @@
 # adapted from https://github.com/huggingface/diffusers/blob/v0.29.0/src/diffusers/models/embeddings.py
 import torch
+import torch.nn.functional as F
 import inspect
 
 from diffusers.models.embeddings import PatchEmbed, get_2d_sincos_pos_embed, CogVideoXPatchEmbed
@@ -30,6 +31,7 @@ class xFuserPatchEmbedWrapper(xFuserLayerBaseWrapper):
             // get_runtime_state().vae_scale_factor
         )
         width = latent.shape[-1]
+        num_width_tokens = width // self.module.patch_size
         if not get_runtime_state().patch_mode:
             if getattr(self.module, "pos_embed_max_size", None) is not None:
                 pass
@@ -96,6 +98,13 @@ class xFuserPatchEmbedWrapper(xFuserLayerBaseWrapper):
                 pos_embed = self.module.pos_embed
             else:
                 pos_embed = self.module.pos_embed
+        if get_runtime_state().num_pad_rows > 0:
+            # the rows padded for sequence parallel are masked out of
+            # attention, they need no position
+            num_pad_tokens = (
+                get_runtime_state().num_pad_rows // self.module.patch_size
+            ) * num_width_tokens
+            pos_embed = F.pad(pos_embed, (0, 0, 0, num_pad_tokens))
         b, c, h = pos_embed.shape
 
         if get_runtime_state().patch_mode:
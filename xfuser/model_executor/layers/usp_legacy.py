@@ -13,6 +13,7 @@ from xfuser.core.distributed import (
     get_ulysses_parallel_world_size,
     get_ring_parallel_world_size,
 )
+from xfuser.core.distributed.shape_plan import drop_padded_tokens, pad_heads
 
 from xfuser.envs import PACKAGES_CHECKER
 env_info = PACKAGES_CHECKER.get_packages_info()
@@ -47,6 +48,25 @@ def ring_attn(query, key, value, dropout_p=0.0, is_causal=False):
     return out
 
 
+def _padded_ring_attn(query, key, value, key_padding, dropout_p=0.0, is_causal=False):
+    # The torch ring attention takes no key mask, the xDiT ring attention
+    # drops the padded keys of every ring step instead.
+    from yunchang.kernels import AttnType
+    from xfuser.core.long_ctx_attention.ring import xdit_ring_flash_attn_func
+
+    out = xdit_ring_flash_attn_func(
+        query.transpose(1, 2),
+        key.transpose(1, 2),
+        value.transpose(1, 2),
+        dropout_p=dropout_p,
+        causal=is_causal,
+        group=PROCESS_GROUP.RING_PG,
+        attn_type=AttnType.FA if HAS_FLASH_ATTN else AttnType.TORCH,
+        key_padding=key_padding,
+    )
+    return out.transpose(1, 2)
+
+
 def _maybe_wait(tensor: torch.Tensor) -> torch.Tensor:
     """
     When tracing the code, the result tensor is not an AsyncCollectiveTensor,
@@ -72,8 +92,10 @@ def _ft_c_input_all_to_all(x):
         return x
 
     assert x.ndim == 4, "x must have 4 dimensions, got {}".format(x.ndim)
+    # heads that do not split among the ranks are padded with zero heads,
+    # whose output USP drops
+    x = pad_heads(x, world_size, dim=1)
     b, h, s, d = x.shape
-    assert h % world_size == 0, "h must be divisible by world_size, got {} and {}".format(h, world_size)
 
     x = x.permute(1, 0, 2, 3).contiguous()
     x = _sdpa_all_to_all_single(x)
@@ -97,25 +119,46 @@ def _ft_c_output_all_to_all(x):
 
 
 @torch.compiler.disable
-def USP(query, key, value, dropout_p=0.0, is_causal=False):
+def USP(query, key, value, dropout_p=0.0, is_causal=False, key_padding=None):
+    """
+    ``key_padding`` holds the number of padded tokens at the end of the local
+    sequence of every sp rank as ``[ring_rank][ulysses_rank]``, see
+    ``DiTRuntimeState.sp_key_padding``. Those tokens are left out of the keys.
+
+    Heads that are not a multiple of the ulysses degree are padded with zero
+    heads for the all-to-all, and dropped from the output.
+    """
     if get_sequence_parallel_world_size() == 1:
         out = F.scaled_dot_product_attention(
             query, key, value, dropout_p=dropout_p, is_causal=is_causal
         )
     elif get_ulysses_parallel_world_size() == 1:
-        out = ring_attn(query, key, value, dropout_p=dropout_p, is_causal=is_causal)
+        if key_padding is None:
+            out = ring_attn(query, key, value, dropout_p=dropout_p, is_causal=is_causal)
+        else:
+            out = _padded_ring_attn(
+                query, key, value, key_padding, dropout_p=dropout_p, is_causal=is_causal
+            )
     elif get_ulysses_parallel_world_size() > 1:
+        num_heads = query.shape[1]
         query = _ft_c_input_all_to_all(query)
         key = _ft_c_input_all_to_all(key)
         value = _ft_c_input_all_to_all(value)
 
         if get_ring_parallel_world_size() == 1:
+            if key_padding is not None:
+                key = drop_padded_tokens(key, key_padding[0], dim=2)
+                value = drop_padded_tokens(value, key_padding[0], dim=2)
             out = F.scaled_dot_product_attention(
                 query, key, value, dropout_p=dropout_p, is_causal=is_causal
             )
-        else:
+        elif key_padding is None:
             out = ring_attn(query, key, value, dropout_p=dropout_p, is_causal=is_causal)
+        else:
+            out = _padded_ring_attn(
+                query, key, value, key_padding, dropout_p=dropout_p, is_causal=is_causal
+            )
 
-        out = _ft_c_output_all_to_all(out)
+        out = _ft_c_output_all_to_all(out)[:, :num_heads]
         
     return out
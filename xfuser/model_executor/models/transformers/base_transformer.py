@@ -5,6 +5,8 @@ import torch
 import torch.nn as nn
 
 from xfuser.core.distributed import (
+    get_pp_group,
+    get_world_group,
     get_pipeline_parallel_rank,
     is_pipeline_first_stage,
     is_pipeline_last_stage,
@@ -14,6 +16,12 @@ from xfuser.core.distributed import (
 )
 from xfuser.core.fast_attention import get_fast_attn_enable
 from xfuser.core.distributed.runtime_state import get_runtime_state
+from xfuser.core.planner.partition import (
+    StagePartitionCache,
+    estimate_stage_partition,
+    stage_partition_key,
+    stage_partition_model_key,
+)
 from xfuser.logger import init_logger
 from xfuser.model_executor.models import xFuserModelBaseWrapper
 
@@ -86,9 +94,8 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
                 )
 
         # transformer layer split
-        attn_layer_num_for_pp = (
-            get_runtime_state().parallel_config.pp_config.attn_layer_num_for_pp
-        )
+        pp_config = get_runtime_state().parallel_config.pp_config
+        attn_layer_num_for_pp = pp_config.attn_layer_num_for_pp
         pp_rank = get_pipeline_parallel_rank()
         pp_world_size = get_pipeline_parallel_world_size()
         blocks_list = {
@@ -99,6 +106,14 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
             name: [sum(num_blocks_list[:i]), sum(num_blocks_list[: i + 1])]
             for i, name in enumerate(blocks_name)
         }
+        if (
+            attn_layer_num_for_pp is None
+            and pp_config.partition == "auto"
+            and pp_world_size > 1
+        ):
+            attn_layer_num_for_pp = self._auto_partition_transformer_blocks(
+                transformer, blocks_name
+            )
         if attn_layer_num_for_pp is not None:
             assert sum(attn_layer_num_for_pp) == sum(num_blocks_list), (
                 "Sum of attn_layer_num_for_pp should be equal to the "
@@ -159,6 +174,88 @@ class xFuserTransformerBaseWrapper(xFuserModelBaseWrapper, metaclass=ABCMeta):
 
         return transformer
 
+    def _auto_partition_transformer_blocks(
+        self,
+        transformer: nn.Module,
+        blocks_name: List[str],
+    ) -> List[int]:
+        """Choose the number of blocks of every pipefusion stage so that the
+        slowest stage, including the embeddings on the first and the output
+        layers on the last stage, is as fast as possible.
+
+        A profiled partition stored for this model and input size is used
+        when available, otherwise the blocks are weighted by the FLOP model
+        of :mod:`xfuser.core.planner.partition` and the result is stored.
+        """
+        runtime_state = get_runtime_state()
+        pp_config = runtime_state.parallel_config.pp_config
+        input_config = pp_config.partition_input_config or runtime_state.input_config
+        num_frames = 1
+        if runtime_state.cogvideox or runtime_state.consisid:
+            vae_scale_factor = runtime_state.vae_scale_factor_spatial
+            num_frames = (
+                input_config.num_frames - 1
+            ) // runtime_state.vae_scale_factor_temporal + 1
+        else:
+            vae_scale_factor = runtime_state.vae_scale_factor
+        patch_size = runtime_state.backbone_patch_size
+        num_tokens = (
+            num_frames
+            * (input_config.height // vae_scale_factor // patch_size)
+            * (input_config.width // vae_scale_factor // patch_size)
+        )
+        num_context_tokens = input_config.max_sequence_length
+        num_blocks = sum(len(getattr(transformer, name)) for name in blocks_name)
+
+        model = stage_partition_model_key(transformer)
+        key = stage_partition_key(
+            input_config.height,
+            input_config.width,
+            num_frames=input_config.num_frames if num_frames > 1 else 1,
+            text_len=num_context_tokens,
+        )
+        cache = StagePartitionCache(pp_config.partition_file)
+        partition = cache.get(model, key)
+        if partition is None or len(partition.block_costs) != num_blocks:
+            partition = estimate_stage_partition(
+                transformer,
+                blocks_name,
+                num_tokens,
+                num_context_tokens,
+                blocks_tokens=self._get_partition_blocks_tokens(
+                    num_tokens, num_context_tokens
+                ),
+            )
+        attn_layer_num_for_pp = partition.split(get_pipeline_parallel_world_size())
+        cache.put(model, key, partition)
+        if get_world_group().rank == 0:
+            try:
+                cache.save()
+            except OSError as e:
+                logger.warning(f"Failed to save pipefusion partition: {e}")
+        # every stage of the pipeline has to agree on the split
+        attn_layer_num_for_pp = get_pp_group().broadcast_object_list(
+            [attn_layer_num_for_pp], src=0
+        )[0]
+        logger.info(
+            f"Auto pipefusion partition ({partition.source}) for {model} {key}: "
+            f"{attn_layer_num_for_pp}, relative stage costs "
+            f"{self._format_stage_costs(partition.stage_costs(attn_layer_num_for_pp))}"
+        )
+        return attn_layer_num_for_pp
+
+    @staticmethod
+    def _format_stage_costs(stage_costs: List[float]) -> List[float]:
+        max_cost = max(stage_costs) or 1.0
+        return [round(cost / max_cost, 3) for cost in stage_costs]
+
+    def _get_partition_blocks_tokens(
+        self, num_tokens: int, num_context_tokens: int
+    ) -> Dict[str, Tuple[int, int]]:
+        """(tokens, context tokens) seen by the blocks of each block list when
+        they differ from the image and text sequence lengths."""
+        return {}
+
     @abstractmethod
     def forward(self, *args, **kwargs):
         pass
@@ -1,4 +1,4 @@
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Tuple, Union
 import torch
 import torch.distributed
 import torch.nn as nn
@@ -49,6 +49,12 @@ class xFuserFluxTransformer2DWrapper(xFuserTransformerBaseWrapper):
             None for _ in range(len(self.transformer_blocks))
         ]
 
+    def _get_partition_blocks_tokens(
+        self, num_tokens: int, num_context_tokens: int
+    ) -> Dict[str, Tuple[int, int]]:
+        # single stream blocks run on the concatenated text and image tokens
+        return {"single_transformer_blocks": (num_tokens + num_context_tokens, 0)}
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -49,6 +49,7 @@ from xfuser.model_executor.schedulers import *
 from xfuser.model_executor.models.transformers import *
 from xfuser.model_executor.layers.attention_processor import *
 from xfuser.model_executor.cache.diffusers_adapters import apply_cache_on_transformer
+from xfuser.model_executor.cache.controller import CacheThresholdController
 from xfuser.config.config import ParallelConfig
 try:
     import os
@@ -206,19 +207,17 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         @wraps(func)
         def fast_attn_fn(self, *args, **kwargs):
             if get_fast_attn_enable():
-                for block in self.module.transformer.transformer_blocks:
-                    for layer in block.children():
-                        if isinstance(layer, xFuserAttentionBaseWrapper):
-                            layer.stepi = 0
-                            layer.cached_residual = None
-                            layer.cached_output = None
+                for layer in self.module.transformer.modules():
+                    if isinstance(layer, xFuserAttentionBaseWrapper):
+                        layer.stepi = 0
+                        layer.cached_residual = None
+                        layer.cached_output = None
                 out = func(self, *args, **kwargs)
-                for block in self.module.transformer.transformer_blocks:
-                    for layer in block.children():
-                        if isinstance(layer, xFuserAttentionBaseWrapper):
-                            layer.stepi = 0
-                            layer.cached_residual = None
-                            layer.cached_output = None
+                for layer in self.module.transformer.modules():
+                    if isinstance(layer, xFuserAttentionBaseWrapper):
+                        layer.stepi = 0
+                        layer.cached_residual = None
+                        layer.cached_output = None
                 return out
             else:
                 return func(self, *args, **kwargs)
@@ -385,24 +384,29 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         if cache_args:
             use_teacache = cache_args["use_teacache"]
             use_fbcache = cache_args["use_fbcache"]
+            use_groupcache = cache_args.pop("use_groupcache", False)
             cache_args.pop("use_teacache")
             cache_args.pop("use_fbcache")
-            use_cache = use_teacache or use_fbcache
-            use_cache = (
-                use_cache
-                and get_pipeline_parallel_world_size() == 1
-                and get_classifier_free_guidance_world_size() == 1
-                and get_tensor_model_parallel_world_size() == 1
-            )
+            use_cache = use_teacache or use_fbcache or use_groupcache
             if use_cache:
-                if use_teacache and use_fbcache:
-                    logger.warning(f"apply --use_teacache and --use_fbcache togather. we use FBCache")
+                if use_teacache + use_fbcache + use_groupcache > 1:
+                    logger.warning(
+                        "apply several of --use_fbcache, --use_teacache and --use_groupcache together. "
+                        "we use FBCache over TeaCache over GroupCache"
+                    )
+                if use_fbcache:
                     cache_args["use_cache"] = "Fb"
                 elif use_teacache:
                     cache_args["use_cache"] = "Tea"
-                elif use_fbcache:
-                    cache_args["use_cache"] = "Fb"
-
+                else:
+                    cache_args["use_cache"] = "Group"
+
+                target_latency = cache_args.pop("target_latency", None)
+                step_budget = cache_args.pop("step_budget", None)
+                if target_latency is not None or step_budget is not None:
+                    cache_args["callbacks"] = list(cache_args.get("callbacks") or []) + [
+                        CacheThresholdController(target_latency=target_latency, step_budget=step_budget)
+                    ]
                 transformer = apply_cache_on_transformer(transformer, **cache_args)
         self.original_transformer = transformer
         if enable_torch_compile or enable_onediff:
@@ -475,6 +479,7 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
     def _init_sync_pipeline(self, latents: torch.Tensor):
         get_runtime_state().set_patched_mode(patch_mode=False)
 
+        latents = self._pad_latents_for_sp(latents)
         latents_list = [
             latents[:, :, start_idx:end_idx, :]
             for start_idx, end_idx in get_runtime_state().pp_patches_start_end_idx_global
@@ -482,6 +487,20 @@ class xFuserPipelineBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
         latents = torch.cat(latents_list, dim=-2)
         return latents
 
+    def _pad_latents_for_sp(self, latents: torch.Tensor) -> torch.Tensor:
+        """Zero pad the latent rows up to the height the sequence parallel
+        split needs, see ``DiTRuntimeState.num_pad_rows``."""
+        num_pad_rows = get_runtime_state().num_pad_rows
+        if num_pad_rows == 0:
+            return latents
+        return nn.functional.pad(latents, (0, 0, 0, num_pad_rows))
+
+    def _crop_padded_latents(self, latents: torch.Tensor) -> torch.Tensor:
+        num_pad_rows = get_runtime_state().num_pad_rows
+        if num_pad_rows == 0:
+            return latents
+        return latents[..., : latents.shape[-2] - num_pad_rows, :]
+
     def _init_video_sync_pipeline(self, latents: torch.Tensor):
         get_runtime_state().set_patched_mode(patch_mode=False)
         latents_list = [
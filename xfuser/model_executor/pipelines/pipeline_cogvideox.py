@@ -36,10 +36,11 @@ class xFuserCogVideoXPipeline(xFuserPipelineBaseWrapper):
         cls,
         pretrained_model_name_or_path: Optional[Union[str, os.PathLike]],
         engine_config: EngineConfig,
+        cache_args: Dict = {},
         **kwargs,
     ):
         pipeline = CogVideoXPipeline.from_pretrained(pretrained_model_name_or_path, **kwargs)
-        return cls(pipeline, engine_config)
+        return cls(pipeline, engine_config, cache_args)
 
     @torch.no_grad()
     @xFuserPipelineBaseWrapper.enable_data_parallel
@@ -196,6 +197,8 @@ class xFuserCogVideoXPipeline(xFuserPipelineBaseWrapper):
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
             split_text_embed_in_sp=get_pipeline_parallel_world_size() == 1,
+            text_sequence_length=max_sequence_length,
+            use_cfg=do_classifier_free_guidance,
         )
 
         # 3. Encode input prompt
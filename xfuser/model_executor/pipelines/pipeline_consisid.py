@@ -293,6 +293,8 @@ class xFuserConsisIDPipeline(xFuserPipelineBaseWrapper):
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
             split_text_embed_in_sp=get_pipeline_parallel_world_size() == 1,
+            text_sequence_length=max_sequence_length,
+            use_cfg=do_classifier_free_guidance,
         )
 
         # 3. Encode input prompt
@@ -38,6 +38,10 @@ from xfuser.core.distributed import (
     get_dit_world_size,
 )
 from xfuser.core.distributed.group_coordinator import GroupCoordinator
+from xfuser.core.fast_attention import (
+    get_fast_attn_enable,
+    fast_attention_compression,
+)
 from .base_pipeline import xFuserPipelineBaseWrapper
 from .register import xFuserPipelineWrapperRegister
 
@@ -72,6 +76,10 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         steps: int = 3,
         sync_steps: int = 1,
     ):
+        if get_fast_attn_enable():
+            # set compression methods for DiTFastAttn
+            fast_attention_compression(self)
+
         prompt = [""] * input_config.batch_size if input_config.batch_size > 1 else ""
         warmup_steps = get_runtime_state().runtime_config.warmup_steps
         get_runtime_state().runtime_config.warmup_steps = sync_steps
@@ -103,6 +111,7 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
         return self._interrupt
 
     @torch.no_grad()
+    @xFuserPipelineBaseWrapper.enable_fast_attn
     @xFuserPipelineBaseWrapper.check_model_parallel_state(cfg_parallel_available=False)
     @xFuserPipelineBaseWrapper.enable_data_parallel
     @xFuserPipelineBaseWrapper.check_to_use_naive_forward
@@ -402,6 +411,14 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
     ):
         get_runtime_state().set_patched_mode(patch_mode=False)
 
+        num_pad_tokens = self._get_num_pad_tokens()
+        if num_pad_tokens > 0:
+            # the padded tokens are masked out of attention, their ids do
+            # not matter
+            latents = torch.nn.functional.pad(latents, (0, 0, 0, num_pad_tokens))
+            latent_image_ids = torch.nn.functional.pad(
+                latent_image_ids, (0, 0, 0, num_pad_tokens)
+            )
         latents_list = [
             latents[:, start_idx:end_idx, :]
             for start_idx, end_idx in get_runtime_state().pp_patches_token_start_end_idx_global
@@ -539,9 +556,19 @@ class xFuserFluxPipeline(xFuserPipelineBaseWrapper):
                     for sp_patch_idx in range(sp_degree)
                 ]
             latents = torch.cat(latents_list, dim=-2)
+            num_pad_tokens = self._get_num_pad_tokens()
+            if num_pad_tokens > 0:
+                latents = latents[:, : latents.shape[1] - num_pad_tokens, :]
 
         return latents
 
+    def _get_num_pad_tokens(self) -> int:
+        # flux latents are packed into tokens of the same width as the latent
+        return (
+            get_runtime_state().num_pad_rows
+            * get_runtime_state().shape_plan.latents_width
+        )
+
     def _async_pipeline(
         self,
         latents: torch.Tensor,
@@ -44,6 +44,7 @@ class xFuserHunyuanDiTPipeline(xFuserPipelineBaseWrapper):
         cls,
         pretrained_model_name_or_path: Optional[Union[str, os.PathLike]],
         engine_config: EngineConfig,
+        cache_args: Dict = {},
         return_org_pipeline: bool = False,
         **kwargs,
     ):
@@ -52,7 +53,7 @@ class xFuserHunyuanDiTPipeline(xFuserPipelineBaseWrapper):
         )
         if return_org_pipeline:
             return pipeline
-        return cls(pipeline, engine_config)
+        return cls(pipeline, engine_config, cache_args)
 
     @property
     def guidance_scale(self):
@@ -78,6 +79,7 @@ class xFuserHunyuanDiTPipeline(xFuserPipelineBaseWrapper):
         return self._interrupt
 
     @torch.no_grad()
+    @xFuserPipelineBaseWrapper.enable_fast_attn
     @xFuserPipelineBaseWrapper.enable_data_parallel
     @xFuserPipelineBaseWrapper.check_to_use_naive_forward
     def __call__(
@@ -252,6 +254,7 @@ class xFuserHunyuanDiTPipeline(xFuserPipelineBaseWrapper):
             width=width,
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
+            use_cfg=self.do_classifier_free_guidance,
         )
         if get_pipeline_parallel_rank() >= get_pipeline_parallel_world_size() // 2:
             num_blocks_per_stage = len(self.transformer.blocks)
@@ -214,6 +214,7 @@ class xFuserLattePipeline(xFuserPipelineBaseWrapper):
             num_frames=num_frames,
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
+            use_cfg=do_classifier_free_guidance,
         )
 
         # 3. Encode input prompt
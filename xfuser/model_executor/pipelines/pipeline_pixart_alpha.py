@@ -39,6 +39,7 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
         cls,
         pretrained_model_name_or_path: Optional[Union[str, os.PathLike]],
         engine_config: EngineConfig,
+        cache_args: Dict = {},
         return_org_pipeline: bool = False,
         **kwargs,
     ):
@@ -47,7 +48,7 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
         )
         if return_org_pipeline:
             return pipeline
-        return cls(pipeline, engine_config)
+        return cls(pipeline, engine_config, cache_args)
 
     @torch.no_grad()
     @xFuserPipelineBaseWrapper.enable_fast_attn
@@ -214,6 +215,8 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
             width=width,
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
+            text_sequence_length=max_sequence_length,
+            use_cfg=do_classifier_free_guidance,
         )
         #! ---------------------------------------- ADDED ABOVE ----------------------------------------
 
@@ -506,6 +509,7 @@ class xFuserPixArtAlphaPipeline(xFuserPipelineBaseWrapper):
                     for sp_patch_idx in range(sp_degree)
                 ]
             latents = torch.cat(latents_list, dim=-2)
+            latents = self._crop_padded_latents(latents)
 
         return latents
 
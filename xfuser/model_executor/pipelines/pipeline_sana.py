@@ -1116,6 +1116,8 @@ class xFuserSanaPipeline(xFuserPipelineBaseWrapper):
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
             split_text_embed_in_sp=False,
+            text_sequence_length=max_sequence_length,
+            use_cfg=self.do_classifier_free_guidance,
         )
 
         # 3. Encode input prompt
@@ -39,6 +39,10 @@ from xfuser.core.distributed import (
     get_sp_group,
     is_dp_last_group,
 )
+from xfuser.core.fast_attention import (
+    get_fast_attn_enable,
+    fast_attention_compression,
+)
 from .base_pipeline import xFuserPipelineBaseWrapper
 from .register import xFuserPipelineWrapperRegister
 
@@ -58,6 +62,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         cls,
         pretrained_model_name_or_path: Optional[Union[str, os.PathLike]],
         engine_config: EngineConfig,
+        cache_args: Dict = {},
         return_org_pipeline: bool = False,
         **kwargs,
     ):
@@ -66,11 +71,15 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         )
         if return_org_pipeline:
             return pipeline
-        return cls(pipeline, engine_config)
+        return cls(pipeline, engine_config, cache_args)
 
     def prepare_run(
         self, input_config: InputConfig, steps: int = 3, sync_steps: int = 1
     ):
+        if get_fast_attn_enable():
+            # set compression methods for DiTFastAttn
+            fast_attention_compression(self)
+
         prompt = [""] * input_config.batch_size if input_config.batch_size > 1 else ""
         warmup_steps = get_runtime_state().runtime_config.warmup_steps
         get_runtime_state().runtime_config.warmup_steps = sync_steps
@@ -112,6 +121,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
         return self._interrupt
 
     @torch.no_grad()
+    @xFuserPipelineBaseWrapper.enable_fast_attn
     @xFuserPipelineBaseWrapper.enable_data_parallel
     @xFuserPipelineBaseWrapper.check_to_use_naive_forward
     def __call__(
@@ -276,6 +286,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
             batch_size=batch_size,
             num_inference_steps=num_inference_steps,
             split_text_embed_in_sp=get_pipeline_parallel_world_size() == 1,
+            use_cfg=self.do_classifier_free_guidance,
         )
         #! ---------------------------------------- ADDED ABOVE ----------------------------------------
 
@@ -428,6 +439,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
     def _init_sync_pipeline(self, latents: torch.Tensor, prompt_embeds: torch.Tensor):
         get_runtime_state().set_patched_mode(patch_mode=False)
 
+        latents = self._pad_latents_for_sp(latents)
         latents_list = [
             latents[:, :, start_idx:end_idx, :]
             for start_idx, end_idx in get_runtime_state().pp_patches_start_end_idx_global
@@ -549,6 +561,7 @@ class xFuserStableDiffusion3Pipeline(xFuserPipelineBaseWrapper):
                     for sp_patch_idx in range(sp_degree)
                 ]
             latents = torch.cat(latents_list, dim=-2)
+            latents = self._crop_padded_latents(latents)
 
         return latents
 
@@ -5,7 +5,9 @@ from typing import List
 from diffusers.schedulers import SchedulerMixin
 from xfuser.core.distributed import (
     get_pipeline_parallel_world_size,
+    get_sequence_parallel_rank,
     get_sequence_parallel_world_size,
+    get_runtime_state,
 )
 from xfuser.model_executor.base_wrapper import xFuserBaseWrapper
 
@@ -45,6 +47,25 @@ class xFuserSchedulerBaseWrapper(xFuserBaseWrapper, metaclass=ABCMeta):
             ):
                 return self.module.step(*args, **kwargs)
             else:
-                return func(self, *args, **kwargs)
+                return self._mask_padded_sample(func(self, *args, **kwargs))
 
         return check_naive_step_fn
+
+    @staticmethod
+    def _mask_padded_sample(output):
+        """Zero the latent rows padded for sequence parallel, so that they do
+        not drift away from the padding across steps."""
+        runtime_state = get_runtime_state()
+        if runtime_state.num_pad_rows == 0:
+            return output
+        sample = output[0] if isinstance(output, tuple) else output.prev_sample
+        sp_rank = get_sequence_parallel_rank()
+        if sample.dim() == 4:
+            # (batch, channel, height, width)
+            num_pad = runtime_state.shape_plan.sp_pad_height[sp_rank]
+        else:
+            # packed tokens (batch, tokens, channel)
+            num_pad = runtime_state.sp_pad_token_num[sp_rank]
+        if num_pad > 0:
+            sample.narrow(-2, sample.shape[-2] - num_pad, num_pad).zero_()
+        return output